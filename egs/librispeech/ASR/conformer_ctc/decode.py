@@ -206,6 +206,26 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--rnn-lm-prefix-tree",
+        type=str2bool,
+        default=False,
+        help="""Used only when --method is rnn-lm.
+        True to run the RNN LM once per unique prefix of the n-best paths,
+        reusing hidden states across paths that share a prefix.
+        """,
+    )
+
+    parser.add_argument(
+        "--rnn-lm-max-tokens",
+        type=int,
+        default=0,
+        help="""Used only when --method is rnn-lm.
+        If positive, maximum number of tokens, including padding, the RNN LM
+        processes at a time. Use it to bound memory usage for long utterances.
+        """,
+    )
+
     return parser
 
 
@@ -453,6 +473,8 @@ def decode_one_batch(
             eos_id=eos_id,
             blank_id=0,
             nbest_scale=params.nbest_scale,
+            rnn_lm_prefix_tree=params.rnn_lm_prefix_tree,
+            rnn_lm_max_tokens=params.rnn_lm_max_tokens,
         )
     else:
         assert False, f"Unsupported decoding method: {params.method}"
@@ -30,9 +30,10 @@ Usage:
 
 import argparse
 import logging
+from functools import partial
 from pathlib import Path
 from shutil import copyfile
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 
 import k2
 import torch
@@ -51,6 +52,7 @@ from transformer import Noam
 from icefall.bpe_graph_compiler import BpeCtcTrainingGraphCompiler
 from icefall.checkpoint import load_checkpoint
 from icefall.checkpoint import save_checkpoint as save_checkpoint_impl
+from icefall.dataset.targets import GraphTargets, get_graphs
 from icefall.dist import cleanup_dist, setup_dist
 from icefall.env import get_env_info
 from icefall.graph_compiler import CtcTrainingGraphCompiler
@@ -159,6 +161,27 @@ def get_parser():
         help="The seed for random generators intended for reproducibility",
     )
 
+    parser.add_argument(
+        "--graph-cache-max-num-arcs",
+        type=int,
+        default=0,
+        help="""If positive, the training graph of each utterance is
+        compiled only once and cached in memory. It is the maximum total
+        number of arcs of the cached graphs. Least recently used graphs
+        are evicted first.
+        """,
+    )
+
+    parser.add_argument(
+        "--graph-cache-dir",
+        type=str,
+        default=None,
+        help="""If not None and --graph-cache-max-num-arcs is positive,
+        compiled training graphs are also saved in this directory and
+        reused by later epochs and later runs.
+        """,
+    )
+
     return parser
 
 
@@ -385,17 +408,25 @@ def compute_loss(
         supervisions, subsampling_factor=params.subsampling_factor
     )
 
-    if isinstance(graph_compiler, BpeCtcTrainingGraphCompiler):
-        # Works with a BPE model
-        token_ids = graph_compiler.texts_to_ids(texts)
-        decoding_graph = graph_compiler.compile(token_ids)
-    elif isinstance(graph_compiler, CtcTrainingGraphCompiler):
-        # Works with a phone lexicon
-        decoding_graph = graph_compiler.compile(texts)
-    else:
-        raise ValueError(
-            f"Unsupported type of graph compiler: {type(graph_compiler)}"
-        )
+    # The graphs are compiled in dataloader workers
+    # if --targets-in-workers is true
+    decoding_graph = get_graphs(batch, texts, device)
+    if decoding_graph is None:
+        if isinstance(graph_compiler, BpeCtcTrainingGraphCompiler):
+            # Works with a BPE model
+            token_ids = graph_compiler.texts_to_ids(texts)
+            decoding_graph = graph_compiler.compile(token_ids)
+        elif isinstance(graph_compiler, CtcTrainingGraphCompiler):
+            # Works with a phone lexicon. The word IDs are taken from the
+            # cuts, which are tokenized in run()
+            word_ids = graph_compiler.word_tokenizer.supervisions_to_word_ids(
+                supervisions, texts
+            )
+            decoding_graph = graph_compiler.compile(texts, word_ids)
+        else:
+            raise ValueError(
+                f"Unsupported type of graph compiler: {type(graph_compiler)}"
+            )
 
     dense_fsa_vec = k2.DenseFsaVec(
         nnet_output,
@@ -595,6 +626,63 @@ def train_one_epoch(
         params.best_train_loss = params.train_loss
 
 
+def make_graph_compiler(
+    params: AttributeDict,
+    device: torch.device,
+    cache_max_num_arcs: Optional[int] = None,
+) -> Union[BpeCtcTrainingGraphCompiler, CtcTrainingGraphCompiler]:
+    """Create the graph compiler for the lang dir in `params`.
+
+    It is also called in dataloader workers with a CPU device
+    if --targets-in-workers is true.
+
+    Args:
+      params:
+        It contains the lang dir and the options of the graph cache.
+      device:
+        The device of the compiler.
+      cache_max_num_arcs:
+        If not None, it overrides --graph-cache-max-num-arcs.
+    """
+    if cache_max_num_arcs is None:
+        cache_max_num_arcs = params.graph_cache_max_num_arcs
+    if "lang_bpe" in str(params.lang_dir):
+        return BpeCtcTrainingGraphCompiler(
+            params.lang_dir,
+            device=device,
+            sos_token="<sos/eos>",
+            eos_token="<sos/eos>",
+        )
+    elif "lang_phone" in str(params.lang_dir):
+        assert params.att_rate == 0, (
+            "Attention decoder training does not support phone lang dirs "
+            "at this time due to a missing <sos/eos> symbol. Set --att-rate=0 "
+            "for pure CTC training when using a phone-based lang dir."
+        )
+        assert params.num_decoder_layers == 0, (
+            "Attention decoder training does not support phone lang dirs "
+            "at this time due to a missing <sos/eos> symbol. "
+            "Set --num-decoder-layers=0 for pure CTC training when using "
+            "a phone-based lang dir."
+        )
+        graph_compiler = CtcTrainingGraphCompiler(
+            Lexicon(params.lang_dir),
+            device=device,
+            cache_max_num_arcs=cache_max_num_arcs,
+            cache_dir=params.graph_cache_dir,
+        )
+        # Manually add the sos/eos ID with their default values
+        # from the BPE recipe which we're adapting here.
+        graph_compiler.sos_id = 1
+        graph_compiler.eos_id = 1
+        return graph_compiler
+    else:
+        raise ValueError(
+            f"Unsupported type of lang dir (we expected it to have "
+            f"'lang_bpe' or 'lang_phone' in its name): {params.lang_dir}"
+        )
+
+
 def run(rank, world_size, args):
     """
     Args:
@@ -631,38 +719,7 @@ def run(rank, world_size, args):
     if torch.cuda.is_available():
         device = torch.device("cuda", rank)
 
-    if "lang_bpe" in str(params.lang_dir):
-        graph_compiler = BpeCtcTrainingGraphCompiler(
-            params.lang_dir,
-            device=device,
-            sos_token="<sos/eos>",
-            eos_token="<sos/eos>",
-        )
-    elif "lang_phone" in str(params.lang_dir):
-        assert params.att_rate == 0, (
-            "Attention decoder training does not support phone lang dirs "
-            "at this time due to a missing <sos/eos> symbol. Set --att-rate=0 "
-            "for pure CTC training when using a phone-based lang dir."
-        )
-        assert params.num_decoder_layers == 0, (
-            "Attention decoder training does not support phone lang dirs "
-            "at this time due to a missing <sos/eos> symbol. "
-            "Set --num-decoder-layers=0 for pure CTC training when using "
-            "a phone-based lang dir."
-        )
-        graph_compiler = CtcTrainingGraphCompiler(
-            lexicon,
-            device=device,
-        )
-        # Manually add the sos/eos ID with their default values
-        # from the BPE recipe which we're adapting here.
-        graph_compiler.sos_id = 1
-        graph_compiler.eos_id = 1
-    else:
-        raise ValueError(
-            f"Unsupported type of lang dir (we expected it to have "
-            f"'lang_bpe' or 'lang_phone' in its name): {params.lang_dir}"
-        )
+    graph_compiler = make_graph_compiler(params, device)
 
     logging.info("About to create model")
     model = Conformer(
@@ -693,6 +750,11 @@ def run(rank, world_size, args):
     if checkpoints:
         optimizer.load_state_dict(checkpoints["optimizer"])
 
+    if isinstance(graph_compiler, CtcTrainingGraphCompiler):
+        # The word IDs stored in the training cuts are read from
+        # batch["supervisions"]["cut"]
+        args.return_cuts = True
+
     librispeech = LibriSpeechAsrDataModule(args)
 
     train_cuts = librispeech.train_clean_100_cuts()
@@ -712,12 +774,35 @@ def run(rank, world_size, args):
         return 1.0 <= c.duration <= 20.0
 
     train_cuts = train_cuts.filter(remove_short_and_long_utt)
+    if isinstance(graph_compiler, CtcTrainingGraphCompiler):
+        # Convert the transcripts to word IDs once, instead of in every
+        # epoch in compute_loss() or in the dataloader workers. The cuts
+        # are loaded into memory for that.
+        train_cuts = graph_compiler.word_tokenizer.tokenize_cuts(
+            train_cuts
+        ).to_eager()
+
+    targets_fn = None
+    if params.targets_in_workers:
+        # Each worker has a graph cache of its own. The workers are kept
+        # alive across epochs and share the graphs flushed to
+        # --graph-cache-dir, so the memory budget is split among them.
+        targets_fn = GraphTargets(
+            partial(
+                make_graph_compiler,
+                params=params,
+                device=torch.device("cpu"),
+                cache_max_num_arcs=params.graph_cache_max_num_arcs
+                // max(params.num_workers, 1),
+            ),
+            subsampling_factor=params.subsampling_factor,
+        )
 
-    train_dl = librispeech.train_dataloaders(train_cuts)
+    train_dl = librispeech.train_dataloaders(train_cuts, targets_fn=targets_fn)
 
     valid_cuts = librispeech.dev_clean_cuts()
     valid_cuts += librispeech.dev_other_cuts()
-    valid_dl = librispeech.valid_dataloaders(valid_cuts)
+    valid_dl = librispeech.valid_dataloaders(valid_cuts, targets_fn=targets_fn)
 
     scan_pessimistic_batches_for_oom(
         model=model,
@@ -754,6 +839,13 @@ def run(rank, world_size, args):
             world_size=world_size,
         )
 
+        if getattr(graph_compiler, "cache", None) is not None:
+            graph_compiler.cache.flush()
+            logging.info(
+                f"Graph cache: {graph_compiler.cache.num_hits} hits, "
+                f"{graph_compiler.cache.num_misses} misses"
+            )
+
         save_checkpoint(
             params=params,
             model=model,
@@ -19,6 +19,7 @@
 
 import argparse
 import logging
+from functools import partial
 from pathlib import Path
 from shutil import copyfile
 from typing import Dict, Optional
@@ -43,6 +44,7 @@ from icefall.ali import (
 )
 from icefall.checkpoint import load_checkpoint
 from icefall.checkpoint import save_checkpoint as save_checkpoint_impl
+from icefall.dataset.targets import GraphTargets, get_graphs
 from icefall.dist import cleanup_dist, setup_dist
 from icefall.lexicon import Lexicon
 from icefall.mmi import LFMMILoss
@@ -116,6 +118,27 @@ def get_parser():
         help="The seed for random generators intended for reproducibility",
     )
 
+    parser.add_argument(
+        "--graph-cache-max-num-arcs",
+        type=int,
+        default=0,
+        help="""If positive, the training graph of each utterance is
+        compiled only once and cached in memory. It is the maximum total
+        number of arcs of the cached graphs. Least recently used graphs
+        are evicted first.
+        """,
+    )
+
+    parser.add_argument(
+        "--graph-cache-dir",
+        type=str,
+        default=None,
+        help="""If not None and --graph-cache-max-num-arcs is positive,
+        compiled training graphs are also saved in this directory and
+        reused by later epochs and later runs.
+        """,
+    )
+
     return parser
 
 
@@ -398,7 +421,12 @@ def compute_loss(
             supervision_segments,
             allow_truncate=params.subsampling_factor - 1,
         )
-        mmi_loss = loss_fn(dense_fsa_vec=dense_fsa_vec, texts=texts)
+        # The numerator graphs are compiled in dataloader workers
+        # if --targets-in-workers is true
+        num_graphs = get_graphs(batch, texts, device)
+        mmi_loss = loss_fn(
+            dense_fsa_vec=dense_fsa_vec, texts=texts, num_graphs=num_graphs
+        )
 
     if params.att_rate != 0.0:
         token_ids = graph_compiler.texts_to_ids(supervisions["text"])
@@ -665,6 +693,38 @@ def train_one_epoch(
         params.best_train_loss = params.train_loss
 
 
+def make_graph_compiler(
+    params: AttributeDict,
+    device: torch.device,
+    cache_max_num_arcs: Optional[int] = None,
+) -> MmiTrainingGraphCompiler:
+    """Create the graph compiler for the lang dir in `params`.
+
+    It is also called in dataloader workers with a CPU device
+    if --targets-in-workers is true.
+
+    Args:
+      params:
+        It contains the lang dir and the options of the graph cache.
+      device:
+        The device of the compiler.
+      cache_max_num_arcs:
+        If not None, it overrides --graph-cache-max-num-arcs.
+    """
+    if cache_max_num_arcs is None:
+        cache_max_num_arcs = params.graph_cache_max_num_arcs
+    return MmiTrainingGraphCompiler(
+        params.lang_dir,
+        uniq_filename="lexicon.txt",
+        device=device,
+        oov="<UNK>",
+        sos_id=1,
+        eos_id=1,
+        cache_max_num_arcs=cache_max_num_arcs,
+        cache_dir=params.graph_cache_dir,
+    )
+
+
 def run(rank, world_size, args):
     """
     Args:
@@ -701,14 +761,7 @@ def run(rank, world_size, args):
     if torch.cuda.is_available():
         device = torch.device("cuda", rank)
 
-    graph_compiler = MmiTrainingGraphCompiler(
-        params.lang_dir,
-        uniq_filename="lexicon.txt",
-        device=device,
-        oov="<UNK>",
-        sos_id=1,
-        eos_id=1,
-    )
+    graph_compiler = make_graph_compiler(params, device)
 
     logging.info("About to create model")
     if params.att_rate == 0:
@@ -764,8 +817,33 @@ def run(rank, world_size, args):
         valid_ali = None
 
     librispeech = LibriSpeechAsrDataModule(args)
-    train_dl = librispeech.train_dataloaders()
-    valid_dl = librispeech.valid_dataloaders()
+
+    train_cuts = librispeech.train_clean_100_cuts()
+    if params.full_libri:
+        train_cuts += librispeech.train_clean_360_cuts()
+        train_cuts += librispeech.train_other_500_cuts()
+
+    targets_fn = None
+    if params.targets_in_workers:
+        # Each worker has a graph cache of its own. The workers are kept
+        # alive across epochs and share the graphs flushed to
+        # --graph-cache-dir, so the memory budget is split among them.
+        targets_fn = GraphTargets(
+            partial(
+                make_graph_compiler,
+                params=params,
+                device=torch.device("cpu"),
+                cache_max_num_arcs=params.graph_cache_max_num_arcs
+                // max(params.num_workers, 1),
+            ),
+            subsampling_factor=params.subsampling_factor,
+        )
+
+    train_dl = librispeech.train_dataloaders(train_cuts, targets_fn=targets_fn)
+
+    valid_cuts = librispeech.dev_clean_cuts()
+    valid_cuts += librispeech.dev_other_cuts()
+    valid_dl = librispeech.valid_dataloaders(valid_cuts, targets_fn=targets_fn)
 
     for epoch in range(params.start_epoch, params.num_epochs):
         fix_random_seed(params.seed + epoch)
@@ -803,6 +881,13 @@ def run(rank, world_size, args):
             world_size=world_size,
         )
 
+        if graph_compiler.cache is not None:
+            graph_compiler.cache.flush()
+            logging.info(
+                f"Graph cache: {graph_compiler.cache.num_hits} hits, "
+                f"{graph_compiler.cache.num_misses} misses"
+            )
+
         save_checkpoint(
             params=params,
             model=model,
@@ -16,12 +16,15 @@
 # limitations under the License.
 
 import math
-from typing import List, Optional, Tuple
+from dataclasses import fields
+from typing import Any, Dict, List, Optional, Tuple
 
 import k2
 import torch
 from beam_search import Hypothesis, HypothesisList
+from kaldifeat import FbankOptions, OnlineFbank
 
+from icefall.stream_pool import pack_state, unpack_state
 from icefall.utils import AttributeDict
 
 
@@ -46,6 +49,8 @@ class Stream(object):
         """
         self.LOG_EPS = LOG_EPS
         self.cut_id = cut_id
+        self.device = device
+        self.feature_dim = params.feature_dim
 
         # Containing attention caches and convolution caches
         self.states: Optional[
@@ -55,16 +60,20 @@ class Stream(object):
         # It uses different attributes for different decoding methods.
         self.context_size = params.context_size
         self.decoding_method = params.decoding_method
-        if params.decoding_method == "greedy_search":
-            self.hyp = [params.blank_id] * params.context_size
-        elif params.decoding_method == "modified_beam_search":
-            self.hyps = HypothesisList()
-            self.hyps.add(
-                Hypothesis(
-                    ys=[params.blank_id] * params.context_size,
-                    log_prob=torch.zeros(1, dtype=torch.float32, device=device),
-                )
-            )
+        self.blank_id = params.blank_id
+
+        # The token IDs of the finalized segments of current utterance,
+        # see :func:`finalize_segment`.
+        self.segments: List[List[int]] = []
+        # The value of `self.num_processed_frames` when the current segment
+        # starts
+        self.segment_start_frame: int = 0
+        # Number of trailing frames on which greedy search emits only
+        # blanks. Used only when decoding_method is greedy_search.
+        self.num_trailing_blanks: int = 0
+
+        if params.decoding_method in ("greedy_search", "modified_beam_search"):
+            self._init_search_state()
         elif params.decoding_method == "fast_beam_search":
             # feature_len is needed to get partial results.
             # The rnnt_decoding_stream for fast_beam_search.
@@ -79,21 +88,62 @@ class Stream(object):
 
         self.ground_truth: str = ""
 
+        # Feature frames not consumed yet. Its first row is the frame with
+        # index `self.feature_offset` of the utterance.
         self.feature: Optional[torch.Tensor] = None
+        self.feature_offset = 0
         # Make sure all feature frames can be used.
         # Add 2 here since we will drop the first and last after subsampling.
         self.chunk_length = params.chunk_length
         self.pad_length = (
             params.right_context_length + 2 * params.subsampling_factor + 3
         )
+        # Number of available frames, excluding the tail padding frames
         self.num_frames = 0
         self.num_processed_frames = 0
 
+        # Used only when features are computed incrementally from
+        # audio samples, see :func:`accept_waveform`.
+        self.online_fbank: Optional[OnlineFbank] = None
+        # Number of frames fetched from `self.online_fbank`
+        self.num_fetched_frames = 0
+        self.sampling_rate: Optional[float] = None
+        self.max_feature_vectors = 0
+        # The frame of the utterance with index `self.fbank_frame_offset`
+        # is the first frame of `self.online_fbank`. It is not 0 only for
+        # a stream restored by :func:`load_state_dict`.
+        self.fbank_frame_offset = 0
+        # The audio samples starting from the first sample of the frame
+        # `self.waveform_tail_frame`, from which the feature extractor
+        # can be recreated.
+        self.waveform_tail: Optional[torch.Tensor] = None
+        self.waveform_tail_frame = 0
+
+        # True if all features of the utterance are available
+        self._input_finished = False
         # After all feature frames are processed, we set this flag to True
         self._done = False
 
+    def _init_search_state(self) -> None:
+        """Set the search state to that of the start of an utterance."""
+        blanks = [self.blank_id] * self.context_size
+        if self.decoding_method == "greedy_search":
+            self.hyp = blanks
+        else:
+            self.hyps = HypothesisList()
+            self.hyps.add(
+                Hypothesis(
+                    ys=blanks,
+                    log_prob=torch.zeros(
+                        1, dtype=torch.float32, device=self.device
+                    ),
+                )
+            )
+        self.num_trailing_blanks = 0
+
     def set_feature(self, feature: torch.Tensor) -> None:
         assert feature.dim() == 2, feature.dim()
+        assert self.online_fbank is None, "Don't mix it with accept_waveform"
         self.num_frames = feature.size(0)
         # tail padding
         self.feature = torch.nn.functional.pad(
@@ -102,6 +152,119 @@ class Stream(object):
             mode="constant",
             value=self.LOG_EPS,
         )
+        self.feature_offset = 0
+        self._input_finished = True
+
+    def accept_waveform(
+        self,
+        sampling_rate: float,
+        waveform: torch.Tensor,
+        max_feature_vectors: int = 1000,
+    ) -> None:
+        """Feed audio samples and compute features incrementally.
+        Consumed frames are dropped, so the memory used by a stream does not
+        grow with the length of the utterance.
+
+        Args:
+          sampling_rate:
+            The sampling rate of `waveform`. It must not change between
+            calls.
+          waveform:
+            A 1-D float32 tensor containing audio samples normalized
+            to [-1, 1].
+          max_feature_vectors:
+            Maximum number of frames kept inside the feature extractor.
+            Used only in the first call.
+        """
+        assert waveform.dim() == 1, waveform.dim()
+        assert not self._input_finished, "input_finished() has been called"
+        if self.online_fbank is None:
+            self.sampling_rate = sampling_rate
+            self.max_feature_vectors = max_feature_vectors
+            self.online_fbank = self._create_online_fbank()
+            self.waveform_tail = torch.zeros(0)
+
+        # Fetch frames after every piece so that none of them is dropped
+        # from the bounded buffer of the feature extractor.
+        frame_shift = int(sampling_rate * 0.01)
+        piece_size = self.max_feature_vectors // 2 * frame_shift
+        waveform = waveform.cpu()
+        for start in range(0, waveform.numel(), piece_size):
+            piece = waveform[start : start + piece_size]
+            self.online_fbank.accept_waveform(
+                sampling_rate=sampling_rate, waveform=piece
+            )
+            self._fetch_frames()
+            self._update_waveform_tail(piece)
+
+    def _create_online_fbank(self) -> OnlineFbank:
+        opts = FbankOptions()
+        opts.device = "cpu"
+        opts.frame_opts.dither = 0
+        opts.frame_opts.snip_edges = False
+        opts.frame_opts.samp_freq = self.sampling_rate
+        opts.frame_opts.max_feature_vectors = self.max_feature_vectors
+        opts.mel_opts.num_bins = self.feature_dim
+        return OnlineFbank(opts)
+
+    def _update_waveform_tail(self, piece: torch.Tensor) -> None:
+        """Append `piece` to `self.waveform_tail` and drop the samples
+        that are not used by the frames that are not fetched yet.
+        See `_update_waveform_tail()` in
+        pruned_transducer_stateless/decode_stream.py for details."""
+        frame_shift = int(self.sampling_rate * 0.01)
+        tail_frame = max(self.num_fetched_frames - 1, 0)
+        drop = (tail_frame - self.waveform_tail_frame) * frame_shift
+        self.waveform_tail = torch.cat([self.waveform_tail, piece])[drop:]
+        self.waveform_tail_frame = tail_frame
+
+    def input_finished(self) -> None:
+        """Indicate that no more audio samples will be fed."""
+        assert not self._input_finished, "input_finished() has been called"
+        if self.online_fbank is not None:
+            self.online_fbank.input_finished()
+            self._fetch_frames()
+            self.waveform_tail = None
+
+        # tail padding
+        padding = torch.full(
+            (self.pad_length, self.feature_dim),
+            self.LOG_EPS,
+            device=self.device,
+        )
+        self._append_frames(padding)
+        self._input_finished = True
+
+    def _fetch_frames(self) -> None:
+        offset = self.fbank_frame_offset
+        num_frames_ready = offset + self.online_fbank.num_frames_ready
+        if num_frames_ready == self.num_fetched_frames:
+            return
+        frames = [
+            self.online_fbank.get_frame(i - offset)
+            for i in range(self.num_fetched_frames, num_frames_ready)
+        ]
+        self.num_fetched_frames = num_frames_ready
+        self._append_frames(torch.cat(frames, dim=0).to(self.device))
+        self.num_frames = num_frames_ready
+
+    def _append_frames(self, frames: torch.Tensor) -> None:
+        if self.feature is None:
+            self.feature = frames
+        else:
+            self.feature = torch.cat([self.feature, frames], dim=0)
+
+    @property
+    def is_ready(self) -> bool:
+        """Return True if there are enough frames for the next chunk."""
+        if self._done:
+            return False
+        if self._input_finished:
+            return True
+        return (
+            self.num_processed_frames + self.chunk_length + self.pad_length
+            <= self.num_frames
+        )
 
     def set_ground_truth(self, ground_truth: str) -> None:
         self.ground_truth = ground_truth
@@ -123,16 +286,21 @@ class Stream(object):
         )
         ret_length = update_length + self.pad_length
 
-        ret_feature = self.feature[
-            self.num_processed_frames : self.num_processed_frames + ret_length
-        ]
-        # Cut off used frames.
-        # self.feature = self.feature[update_length:]
+        start = self.num_processed_frames - self.feature_offset
+        ret_feature = self.feature[start : start + ret_length]
 
         self.num_processed_frames += update_length
-        if self.num_processed_frames >= self.num_frames:
+        if (
+            self._input_finished
+            and self.num_processed_frames >= self.num_frames
+        ):
             self._done = True
 
+        if self.online_fbank is not None:
+            # Cut off used frames.
+            self.feature = self.feature[update_length:]
+            self.feature_offset = self.num_processed_frames
+
         return ret_feature
 
     @property
@@ -154,3 +322,170 @@ class Stream(object):
         else:
             assert self.decoding_method == "fast_beam_search"
             return self.hyp
+
+    def get_num_trailing_blanks(self) -> int:
+        """Return the number of trailing frames of the current segment on
+        which the best path emits only blanks."""
+        if self.decoding_method == "modified_beam_search":
+            best_hyp = self.hyps.get_most_probable(length_norm=True)
+            return best_hyp.num_trailing_blanks
+        return self.num_trailing_blanks
+
+    def finalize_segment(self) -> List[int]:
+        """Finalize the decoding result of the current segment, e.g., when
+        an endpoint is detected, and start a new segment.
+
+        The search state, i.e., the hypotheses and the decoder context, is
+        reset. The attention and convolution caches are kept.
+
+        Returns:
+          Return the token IDs of the finalized segment.
+        """
+        assert self.decoding_method in (
+            "greedy_search",
+            "modified_beam_search",
+        ), self.decoding_method
+        result = self.decoding_result()
+        self.segments.append(result)
+        self.segment_start_frame = self.num_processed_frames
+        self._init_search_state()
+        return result
+
+    def final_result(self) -> List[int]:
+        """Return the token IDs of all finalized segments and the current
+        one."""
+        return [t for s in self.segments for t in s] + self.decoding_result()
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the state of this stream, i.e., the attention and
+        convolution caches, the unconsumed feature frames, the state of
+        the feature extractor and the search state.
+
+        It is not supported for fast_beam_search, since the state of
+        `k2.RnntDecodingStream` cannot be saved.
+        """
+        if self.decoding_method == "fast_beam_search":
+            raise ValueError(
+                "Saving the state of a stream is not supported for "
+                "fast_beam_search"
+            )
+
+        feature = None
+        if self.feature is not None:
+            start = self.num_processed_frames - self.feature_offset
+            feature = self.feature[start:]
+
+        state_dict = {
+            "cut_id": self.cut_id,
+            "decoding_method": self.decoding_method,
+            "states": self.states,
+            "feature": feature,
+            "num_frames": self.num_frames,
+            "num_processed_frames": self.num_processed_frames,
+            "num_fetched_frames": self.num_fetched_frames,
+            "sampling_rate": self.sampling_rate,
+            "max_feature_vectors": self.max_feature_vectors,
+            "waveform_tail": self.waveform_tail,
+            "waveform_tail_frame": self.waveform_tail_frame,
+            "input_finished": self._input_finished,
+            "done": self._done,
+            "ground_truth": self.ground_truth,
+            "segments": [list(s) for s in self.segments],
+            "segment_start_frame": self.segment_start_frame,
+            "num_trailing_blanks": self.num_trailing_blanks,
+        }
+        if self.decoding_method == "greedy_search":
+            state_dict["hyp"] = list(self.hyp)
+        else:
+            hyps = []
+            for hyp in self.hyps:
+                hyp = {f.name: getattr(hyp, f.name) for f in fields(hyp)}
+                if hyp.pop("state_cost", None) is not None:
+                    raise ValueError("The LM state cannot be saved")
+                hyps.append(hyp)
+            state_dict["hyps"] = hyps
+        return state_dict
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restore the state returned by :func:`state_dict`. The stream
+        has to be created with the same `params`."""
+        assert state_dict["decoding_method"] == self.decoding_method, (
+            state_dict["decoding_method"],
+            self.decoding_method,
+        )
+        self.cut_id = state_dict["cut_id"]
+        self.states = None
+        if state_dict["states"] is not None:
+            attn_caches, conv_caches = state_dict["states"]
+            self.states = (
+                [[c.to(self.device) for c in layer] for layer in attn_caches],
+                [c.to(self.device) for c in conv_caches],
+            )
+
+        self.feature = state_dict["feature"]
+        if self.feature is not None:
+            self.feature = self.feature.to(self.device)
+        self.num_frames = state_dict["num_frames"]
+        self.num_processed_frames = state_dict["num_processed_frames"]
+        self.feature_offset = self.num_processed_frames
+
+        self.num_fetched_frames = state_dict["num_fetched_frames"]
+        self.sampling_rate = state_dict["sampling_rate"]
+        self.max_feature_vectors = state_dict["max_feature_vectors"]
+        self.waveform_tail = state_dict["waveform_tail"]
+        self.waveform_tail_frame = state_dict["waveform_tail_frame"]
+        self._input_finished = state_dict["input_finished"]
+        self._done = state_dict["done"]
+        self.online_fbank = None
+        if self.sampling_rate is not None and not self._input_finished:
+            # Recreate the feature extractor from the samples of the
+            # frames that are not fetched yet.
+            self.online_fbank = self._create_online_fbank()
+            self.online_fbank.accept_waveform(
+                sampling_rate=self.sampling_rate,
+                waveform=self.waveform_tail.cpu(),
+            )
+            self.fbank_frame_offset = self.waveform_tail_frame
+
+        self.ground_truth = state_dict["ground_truth"]
+        self.segments = [list(s) for s in state_dict["segments"]]
+        self.segment_start_frame = state_dict["segment_start_frame"]
+        self.num_trailing_blanks = state_dict["num_trailing_blanks"]
+        if self.decoding_method == "greedy_search":
+            self.hyp = list(state_dict["hyp"])
+        else:
+            self.hyps = HypothesisList()
+            for hyp in state_dict["hyps"]:
+                hyp = dict(
+                    hyp,
+                    ys=list(hyp["ys"]),
+                    log_prob=hyp["log_prob"].to(self.device),
+                )
+                self.hyps.add(Hypothesis(**hyp))
+
+    def snapshot(self) -> bytes:
+        """Return the state of this stream as bytes.
+        See :func:`from_snapshot`."""
+        return pack_state(self.state_dict())
+
+    @classmethod
+    def from_snapshot(
+        cls,
+        data: bytes,
+        params: AttributeDict,
+        device: torch.device = torch.device("cpu"),
+    ) -> "Stream":
+        """Create a stream from the return value of :func:`snapshot`.
+
+        Args:
+          data:
+            The return value of :func:`snapshot`.
+          params:
+            The same `params` as the one of the saved stream.
+          device:
+            The device to run the restored stream.
+        """
+        state_dict = unpack_state(data)
+        stream = cls(params=params, cut_id=state_dict["cut_id"], device=device)
+        stream.load_state_dict(state_dict)
+        return stream
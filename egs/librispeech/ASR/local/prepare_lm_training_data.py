@@ -37,15 +37,29 @@ representation of a dict with the following format:
             together with 'words' and the bpe.model).
   'sentence_lengths' -> a 1-D torch.Tensor of dtype torch.int32, containing
             number of BPE tokens of each sentence.
+
+If --sorted-lm-archive is given, it also sorts the sentences by length and
+writes the result in the same pass. The output is the same as running
+./local/sort_lm_training_data.py on the archive given by --lm-archive,
+which can then be omitted.
+
+Unique words are encoded with a pool of --num-workers processes.
 """
 
 import argparse
 import logging
+import multiprocessing
 from pathlib import Path
+from typing import List
 
 import k2
 import sentencepiece as spm
 import torch
+from sort_lm_training_data import (
+    compute_sentence_lengths,
+    sort_lm_data,
+    write_statistics,
+)
 
 
 def get_args():
@@ -67,26 +81,84 @@ def get_args():
         help="""Path to output archive, e.g. data/bpe_500/lm_data.pt;
         look at the source of this script to see the format.""",
     )
+    parser.add_argument(
+        "--sorted-lm-archive",
+        type=str,
+        help="""Optional. Path to output archive with sentences sorted by
+        length, e.g. data/bpe_500/sorted_lm_data.pt. It is the same as
+        the output of ./local/sort_lm_training_data.py""",
+    )
+    parser.add_argument(
+        "--out-statistics",
+        type=str,
+        help="""Statistics about LM training data, e.g.,
+        data/bpe_500/statistics.txt. Used only when --sorted-lm-archive
+        is given""",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=8,
+        help="Number of worker processes for BPE encoding",
+    )
 
     return parser.parse_args()
 
 
+_sp = None
+
+
+def _init_worker(bpe_model: str):
+    global _sp
+    _sp = spm.SentencePieceProcessor()
+    _sp.load(bpe_model)
+
+
+def _encode_words(words: List[str]) -> List[List[int]]:
+    return _sp.encode(words)
+
+
+def encode_words(
+    words: List[str], bpe_model: str, num_workers: int
+) -> List[List[int]]:
+    """Encode each word with the given BPE model.
+
+    Args:
+      words:
+        A list of words.
+      bpe_model:
+        Path to the BPE model.
+      num_workers:
+        Number of worker processes.
+    Returns:
+      Return a list-of-list-of-int containing the BPE pieces of each word.
+    """
+    chunk_size = 10000
+    chunks = [
+        words[i : i + chunk_size] for i in range(0, len(words), chunk_size)
+    ]
+    with multiprocessing.Pool(
+        num_workers, initializer=_init_worker, initargs=(bpe_model,)
+    ) as pool:
+        # map() keeps the order of the input
+        ans = pool.map(_encode_words, chunks)
+    return [w for chunk in ans for w in chunk]
+
+
 def main():
     args = get_args()
 
-    if Path(args.lm_archive).exists():
-        logging.warning(f"{args.lm_archive} exists - skipping")
+    out_files = [f for f in (args.lm_archive, args.sorted_lm_archive) if f]
+    assert len(out_files) > 0, "Please specify --lm-archive"
+    if all(Path(f).exists() for f in out_files):
+        logging.warning(f"{out_files} exist - skipping")
         return
 
-    sp = spm.SentencePieceProcessor()
-    sp.load(args.bpe_model)
-
     # word2index is a dictionary from words to integer ids.  No need to reserve
     # space for epsilon, etc.; the words are just used as a convenient way to
     # compress the sequences of BPE pieces.
     word2index = dict()
 
-    word2bpe = []  # Will be a list-of-list-of-int, representing BPE pieces.
     sentences = []  # Will be a list-of-list-of-int, representing word-ids.
 
     if "librispeech-lm-norm" in args.lm_data:
@@ -120,11 +192,17 @@ def main():
             line_words = line.split()
             for w in line_words:
                 if w not in word2index:
-                    w_bpe = sp.encode(w)
-                    word2index[w] = len(word2bpe)
-                    word2bpe.append(w_bpe)
+                    word2index[w] = len(word2index)
             sentences.append([word2index[w] for w in line_words])
 
+    logging.info(f"Encoding {len(word2index)} unique words")
+    # Will be a list-of-list-of-int, representing BPE pieces.
+    word2bpe = encode_words(
+        list(word2index.keys()),
+        bpe_model=args.bpe_model,
+        num_workers=args.num_workers,
+    )
+
     logging.info("Constructing ragged tensors")
     words = k2.ragged.RaggedTensor(word2bpe)
     sentences = k2.ragged.RaggedTensor(sentences)
@@ -133,34 +211,26 @@ def main():
 
     num_sentences = sentences.dim0
     logging.info(f"Computing sentence lengths, num_sentences: {num_sentences}")
-    sentence_lengths = [0] * num_sentences
-    for i in range(num_sentences):
-        if step and i % step == 0:
-            logging.info(
-                f"Processed number of lines: {i} "
-                f"({i/num_sentences*100: .3f}%)"
+    output["sentence_lengths"] = compute_sentence_lengths(words, sentences)
+
+    if args.lm_archive:
+        torch.save(output, args.lm_archive)
+        logging.info(f"Saved to {args.lm_archive}")
+
+    if args.sorted_lm_archive:
+        sentence_lengths = output["sentence_lengths"]
+        output, indices = sort_lm_data(output)
+        torch.save(output, args.sorted_lm_archive)
+        logging.info(f"Saved to {args.sorted_lm_archive}")
+
+        if args.out_statistics:
+            write_statistics(
+                args.out_statistics,
+                sorted_sentences=output["sentences"],
+                sentence_lengths=sentence_lengths,
+                indices=indices,
             )
 
-        word_ids = sentences[i]
-
-        # NOTE: If word_ids is a tensor with only 1 entry,
-        # token_ids is a torch.Tensor
-        token_ids = words[word_ids]
-        if isinstance(token_ids, k2.RaggedTensor):
-            token_ids = token_ids.values
-
-        # token_ids is a 1-D tensor containing the BPE tokens
-        # of the current sentence
-
-        sentence_lengths[i] = token_ids.numel()
-
-    output["sentence_lengths"] = torch.tensor(
-        sentence_lengths, dtype=torch.int32
-    )
-
-    torch.save(output, args.lm_archive)
-    logging.info(f"Saved to {args.lm_archive}")
-
 
 if __name__ == "__main__":
     formatter = (
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Copyright    2026  agent
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This script takes a `bpe.model` and a text file such as
+./download/lm/librispeech-lm-norm.txt
+and outputs the LM training data as memory mappable shards to a supplied
+directory such as data/lm_training_bpe_500/lm_data_shards.
+
+For each shard i, it writes two files:
+
+  - shard-{i:05d}-tokens.npy, a 1-D np.int32 array containing the BPE
+    tokens of all sentences of the shard, concatenated.
+  - shard-{i:05d}-offsets.npy, a 1-D np.int64 array of shape
+    (num_sentences + 1,). Tokens of the j-th sentence are
+    tokens[offsets[j]:offsets[j+1]].
+
+Sentences are sorted by the number of tokens in descending order within
+each shard, so no extra sorting step is needed. The output directory can
+be passed to ./rnn_lm/train.py via --lm-data and --lm-data-valid.
+
+The input text is read in chunks and encoded by a pool of worker
+processes, so only one shard is kept in memory at a time.
+
+Usage:
+
+    ./local/prepare_lm_training_shards.py \
+      --bpe-model data/lang_bpe_500/bpe.model \
+      --lm-data download/lm/librispeech-lm-norm.txt \
+      --out-dir data/lm_training_bpe_500/lm_data_shards
+"""
+
+import argparse
+import logging
+import multiprocessing
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import sentencepiece as spm
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bpe-model",
+        type=str,
+        help="Input BPE model, e.g. data/bpe_500/bpe.model",
+    )
+    parser.add_argument(
+        "--lm-data",
+        type=str,
+        help="""Input LM training data as text, e.g.
+        download/pb.train.txt""",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=str,
+        help="""Output directory for the shards, e.g.
+        data/lm_training_bpe_500/lm_data_shards""",
+    )
+    parser.add_argument(
+        "--sentences-per-shard",
+        type=int,
+        default=2000000,
+        help="Number of sentences in each shard",
+    )
+    parser.add_argument(
+        "--lines-per-job",
+        type=int,
+        default=10000,
+        help="Number of lines each worker encodes at a time",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=8,
+        help="Number of worker processes for BPE encoding",
+    )
+
+    return parser.parse_args()
+
+
+_sp = None
+
+
+def _init_worker(bpe_model: str):
+    global _sp
+    _sp = spm.SentencePieceProcessor()
+    _sp.load(bpe_model)
+
+
+def encode_lines(lines: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Encode lines with the BPE model loaded in this worker.
+
+    Returns:
+      Return a tuple containing:
+        - the concatenated tokens of all lines, of dtype np.int32
+        - number of tokens of each line, of dtype np.int64
+    """
+    # Encoding a sentence is the same as concatenating the encodings of
+    # its words since sentencepiece splits the input on whitespace
+    # before applying BPE.
+    token_ids = _sp.encode([" ".join(line.split()) for line in lines])
+    lengths = np.fromiter(
+        (len(t) for t in token_ids), dtype=np.int64, count=len(token_ids)
+    )
+    tokens = np.fromiter(
+        (i for t in token_ids for i in t),
+        dtype=np.int32,
+        count=int(lengths.sum()),
+    )
+    return tokens, lengths
+
+
+def read_lines(filename: str, lines_per_job: int) -> Iterator[List[str]]:
+    lines = []
+    with open(filename) as f:
+        for line in f:
+            lines.append(line)
+            if len(lines) == lines_per_job:
+                yield lines
+                lines = []
+    if lines:
+        yield lines
+
+
+def write_shard(
+    out_dir: Path,
+    shard_index: int,
+    tokens: List[np.ndarray],
+    lengths: List[np.ndarray],
+) -> int:
+    """Sort sentences by length in descending order and write them as a
+    shard.
+
+    Returns:
+      Return the number of sentences in the shard.
+    """
+    tokens = np.concatenate(tokens)
+    lengths = np.concatenate(lengths)
+    offsets = np.zeros(lengths.size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    order = np.argsort(-lengths, kind="stable")
+    sorted_lengths = lengths[order]
+    sorted_offsets = np.zeros_like(offsets)
+    np.cumsum(sorted_lengths, out=sorted_offsets[1:])
+
+    # For each output position, the index of its token in `tokens`
+    src = np.repeat(offsets[order] - sorted_offsets[:-1], sorted_lengths)
+    src += np.arange(src.size, dtype=np.int64)
+
+    prefix = out_dir / f"shard-{shard_index:05d}"
+    np.save(f"{prefix}-tokens.npy", tokens[src])
+    np.save(f"{prefix}-offsets.npy", sorted_offsets)
+    logging.info(
+        f"Wrote {prefix}: {lengths.size} sentences, {tokens.size} tokens"
+    )
+    return lengths.size
+
+
+def main():
+    args = get_args()
+
+    out_dir = Path(args.out_dir)
+    if out_dir.is_dir() and any(out_dir.glob("shard-*-tokens.npy")):
+        logging.warning(f"{out_dir} already contains shards - skipping")
+        return
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    num_shards = 0
+    num_sentences = 0
+
+    tokens = []
+    lengths = []
+    num_pending = 0
+
+    with multiprocessing.Pool(
+        args.num_workers, initializer=_init_worker, initargs=(args.bpe_model,)
+    ) as pool:
+        # imap() keeps the order of the input lines
+        for t, n in pool.imap(
+            encode_lines, read_lines(args.lm_data, args.lines_per_job)
+        ):
+            tokens.append(t)
+            lengths.append(n)
+            num_pending += n.size
+            if num_pending >= args.sentences_per_shard:
+                num_sentences += write_shard(
+                    out_dir, num_shards, tokens, lengths
+                )
+                num_shards += 1
+                tokens = []
+                lengths = []
+                num_pending = 0
+
+    if num_pending > 0:
+        num_sentences += write_shard(out_dir, num_shards, tokens, lengths)
+        num_shards += 1
+
+    logging.info(
+        f"Saved {num_sentences} sentences in {num_shards} shards to {out_dir}"
+    )
+
+
+if __name__ == "__main__":
+    formatter = (
+        "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    )
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    main()
@@ -57,16 +57,21 @@ class Stream(object):
         # It uses different attributes for different decoding methods.
         self.context_size = params.context_size
         self.decoding_method = params.decoding_method
-        if params.decoding_method == "greedy_search":
-            self.hyp = [params.blank_id] * params.context_size
-        elif params.decoding_method == "modified_beam_search":
-            self.hyps = HypothesisList()
-            self.hyps.add(
-                Hypothesis(
-                    ys=[params.blank_id] * params.context_size,
-                    log_prob=torch.zeros(1, dtype=torch.float32, device=device),
-                )
-            )
+        self.blank_id = params.blank_id
+        self.device = device
+
+        # The token IDs of the finalized segments of current utterance,
+        # see :func:`finalize_segment`.
+        self.segments: List[List[int]] = []
+        # The value of `self.num_processed_frames` when the current segment
+        # starts
+        self.segment_start_frame: int = 0
+        # Number of trailing frames on which greedy search emits only
+        # blanks. Used only when decoding_method is greedy_search.
+        self.num_trailing_blanks: int = 0
+
+        if params.decoding_method in ("greedy_search", "modified_beam_search"):
+            self._init_search_state()
         elif params.decoding_method == "fast_beam_search":
             # feature_len is needed to get partial results.
             # The rnnt_decoding_stream for fast_beam_search.
@@ -92,6 +97,23 @@ class Stream(object):
         # After all feature frames are processed, we set this flag to True
         self._done = False
 
+    def _init_search_state(self) -> None:
+        """Set the search state to that of the start of an utterance."""
+        blanks = [self.blank_id] * self.context_size
+        if self.decoding_method == "greedy_search":
+            self.hyp = blanks
+        else:
+            self.hyps = HypothesisList()
+            self.hyps.add(
+                Hypothesis(
+                    ys=blanks,
+                    log_prob=torch.zeros(
+                        1, dtype=torch.float32, device=self.device
+                    ),
+                )
+            )
+        self.num_trailing_blanks = 0
+
     def set_feature(self, feature: torch.Tensor) -> None:
         assert feature.dim() == 2, feature.dim()
         # tail padding here to alleviate the tail deletion problem
@@ -146,3 +168,36 @@ class Stream(object):
         else:
             assert self.decoding_method == "fast_beam_search"
             return self.hyp
+
+    def get_num_trailing_blanks(self) -> int:
+        """Return the number of trailing frames of the current segment on
+        which the best path emits only blanks."""
+        if self.decoding_method == "modified_beam_search":
+            best_hyp = self.hyps.get_most_probable(length_norm=True)
+            return best_hyp.num_trailing_blanks
+        return self.num_trailing_blanks
+
+    def finalize_segment(self) -> List[int]:
+        """Finalize the decoding result of the current segment, e.g., when
+        an endpoint is detected, and start a new segment.
+
+        The search state, i.e., the hypotheses and the decoder context, is
+        reset. The encoder states are kept.
+
+        Returns:
+          Return the token IDs of the finalized segment.
+        """
+        assert self.decoding_method in (
+            "greedy_search",
+            "modified_beam_search",
+        ), self.decoding_method
+        result = self.decoding_result()
+        self.segments.append(result)
+        self.segment_start_frame = self.num_processed_frames
+        self._init_search_state()
+        return result
+
+    def final_result(self) -> List[int]:
+        """Return the token IDs of all finalized segments and the current
+        one."""
+        return [t for s in self.segments for t in s] + self.decoding_result()
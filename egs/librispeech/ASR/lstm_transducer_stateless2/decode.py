@@ -91,6 +91,17 @@ Usage:
     --beam 20.0 \
     --max-contexts 8 \
     --max-states 64
+
+(8) modified beam search with token n-gram LM shallow fusion
+./lstm_transducer_stateless2/decode.py \
+    --epoch 35 \
+    --avg 15 \
+    --exp-dir ./lstm_transducer_stateless2/exp \
+    --max-duration 600 \
+    --decoding-method modified_beam_search_ngram_fusion \
+    --beam-size 4 \
+    --tokens-ngram 3 \
+    --ngram-lm-scale 0.1
 """
 
 
@@ -99,7 +110,7 @@ import logging
 import math
 from collections import defaultdict
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 import k2
 import sentencepiece as spm
@@ -116,11 +127,12 @@ from beam_search import (
     greedy_search_batch,
     modified_beam_search,
     modified_beam_search_ngram_rescoring,
+    modified_beam_search_vectorized,
 )
 from librispeech import LibriSpeech
 from train import add_model_arguments, get_params, get_transducer_model
 
-from icefall import NgramLm
+from icefall import CompiledNgramLm, NgramLm
 from icefall.checkpoint import (
     average_checkpoints,
     average_checkpoints_with_averaged_model,
@@ -217,6 +229,7 @@ def get_parser():
           - fast_beam_search_nbest_oracle
           - fast_beam_search_nbest_LG
           - modified_beam_search_ngram_rescoring
+          - modified_beam_search_ngram_fusion
         If you use fast_beam_search_nbest_LG, you have to specify
         `--lang-dir`, which should contain `LG.pt`.
         """,
@@ -249,7 +262,9 @@ def get_parser():
         type=float,
         default=0.01,
         help="""
-        Used only when --decoding_method is fast_beam_search_nbest_LG.
+        Used only when --decoding_method is fast_beam_search_nbest_LG,
+        modified_beam_search_ngram_rescoring or
+        modified_beam_search_ngram_fusion.
         It specifies the scale for n-gram LM scores.
         """,
     )
@@ -311,7 +326,9 @@ def get_parser():
         type=int,
         default=3,
         help="""Token Ngram used for rescoring.
-            Used only when the decoding method is modified_beam_search_ngram_rescoring""",
+            Used only when the decoding method is
+            modified_beam_search_ngram_rescoring or
+            modified_beam_search_ngram_fusion""",
     )
 
     parser.add_argument(
@@ -319,7 +336,22 @@ def get_parser():
         type=int,
         default=500,
         help="""ID of the backoff symbol.
-                Used only when the decoding method is modified_beam_search_ngram_rescoring""",
+                Used only when the decoding method is
+                modified_beam_search_ngram_rescoring or
+                modified_beam_search_ngram_fusion""",
+    )
+
+    parser.add_argument(
+        "--use-compiled-ngram-lm",
+        type=str2bool,
+        default=False,
+        help="""True to use an array-backed CompiledNgramLm instead of NgramLm.
+        It is loaded from lang_dir/<tokens-ngram>gram-compiled if it exists.
+        Otherwise, it is compiled from lang_dir/<tokens-ngram>gram.fst.txt
+        and saved there for later use.
+        Used only when the decoding method is
+        modified_beam_search_ngram_rescoring. It is always True for
+        modified_beam_search_ngram_fusion.""",
     )
 
     add_model_arguments(parser)
@@ -334,7 +366,7 @@ def decode_one_batch(
     batch: dict,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
-    ngram_lm: Optional[NgramLm] = None,
+    ngram_lm: Optional[Union[NgramLm, CompiledNgramLm]] = None,
     ngram_lm_scale: float = 1.0,
 ) -> Dict[str, List[List[str]]]:
     """Decode one batch and return the result in a dict. The dict has the
@@ -480,6 +512,17 @@ def decode_one_batch(
         )
         for hyp in sp.decode(hyp_tokens):
             hyps.append(hyp.split())
+    elif params.decoding_method == "modified_beam_search_ngram_fusion":
+        hyp_tokens = modified_beam_search_vectorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=params.beam_size,
+            ngram_lm=ngram_lm,
+            ngram_lm_scale=ngram_lm_scale,
+        )
+        for hyp in sp.decode(hyp_tokens):
+            hyps.append(hyp.split())
     else:
         batch_size = encoder_out.size(0)
 
@@ -529,7 +572,7 @@ def decode_dataset(
     sp: spm.SentencePieceProcessor,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
-    ngram_lm: Optional[NgramLm] = None,
+    ngram_lm: Optional[Union[NgramLm, CompiledNgramLm]] = None,
     ngram_lm_scale: float = 1.0,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
@@ -668,6 +711,7 @@ def main():
         "fast_beam_search_nbest_oracle",
         "modified_beam_search",
         "modified_beam_search_ngram_rescoring",
+        "modified_beam_search_ngram_fusion",
     )
     params.res_dir = params.exp_dir / params.decoding_method
 
@@ -807,13 +851,32 @@ def main():
     model.eval()
 
     lm_filename = f"{params.tokens_ngram}gram.fst.txt"
-    logging.info(f"lm filename: {lm_filename}")
-    ngram_lm = NgramLm(
-        str(params.lang_dir / lm_filename),
-        backoff_id=params.backoff_id,
-        is_binary=False,
+    compiled_lm_dir = params.lang_dir / f"{params.tokens_ngram}gram-compiled"
+    # Shallow fusion looks up the LM with tensors, which requires
+    # a CompiledNgramLm
+    use_compiled_ngram_lm = (
+        params.use_compiled_ngram_lm
+        or params.decoding_method == "modified_beam_search_ngram_fusion"
     )
-    logging.info(f"num states: {ngram_lm.lm.num_states}")
+    if use_compiled_ngram_lm and compiled_lm_dir.is_dir():
+        logging.info(f"Loading compiled LM from {compiled_lm_dir}")
+        ngram_lm = CompiledNgramLm.load(compiled_lm_dir)
+        assert ngram_lm.backoff_id == params.backoff_id, (
+            ngram_lm.backoff_id,
+            params.backoff_id,
+        )
+    else:
+        logging.info(f"lm filename: {lm_filename}")
+        ngram_lm = NgramLm(
+            str(params.lang_dir / lm_filename),
+            backoff_id=params.backoff_id,
+            is_binary=False,
+        )
+        if use_compiled_ngram_lm:
+            ngram_lm = CompiledNgramLm.from_ngram_lm(ngram_lm)
+            ngram_lm.save(compiled_lm_dir)
+            logging.info(f"Saved compiled LM to {compiled_lm_dir}")
+    logging.info(f"num states: {ngram_lm.num_states}")
 
     if "fast_beam_search" in params.decoding_method:
         if params.decoding_method == "fast_beam_search_nbest_LG":
@@ -54,6 +54,11 @@ Usage:
       --beam 4 \
       --max-contexts 4 \
       --max-states 8
+
+To split long streams into segments at endpoints with (1) or (2), add
+
+      --endpoint 1 \
+      --endpoint-rule2-min-trailing-silence 1.2
 """
 import argparse
 import logging
@@ -82,6 +87,7 @@ from icefall.checkpoint import (
     load_checkpoint,
 )
 from icefall.decode import one_best_decoding
+from icefall.endpoint import EndpointRule, Endpointer
 from icefall.utils import (
     AttributeDict,
     get_texts,
@@ -224,6 +230,41 @@ def get_parser():
         help="The number of streams that can be decoded in parallel",
     )
 
+    parser.add_argument(
+        "--endpoint",
+        type=str2bool,
+        default=False,
+        help="""If True, detect endpoints with Kaldi-style rules. At each
+        endpoint, the result so far is finalized as a segment and the
+        hypotheses and decoder context of the stream are reset, while the
+        encoder states are kept. Used only when --decoding-method is
+        greedy_search or modified_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-rule1-min-trailing-silence",
+        type=float,
+        default=2.4,
+        help="""An endpoint is detected after this many seconds of trailing
+        silence, even if nothing has been decoded.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-rule2-min-trailing-silence",
+        type=float,
+        default=1.2,
+        help="""An endpoint is detected after this many seconds of trailing
+        silence if something has been decoded.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-rule3-min-utterance-length",
+        type=float,
+        default=20.0,
+        help="""An endpoint is detected once a segment is this many seconds
+        long.""",
+    )
+
     add_model_arguments(parser)
 
     return parser
@@ -281,7 +322,10 @@ def greedy_search(
         for i, v in enumerate(y):
             if v != blank_id:
                 streams[i].hyp.append(v)
+                streams[i].num_trailing_blanks = 0
                 emitted = True
+            else:
+                streams[i].num_trailing_blanks += 1
         if emitted:
             # update decoder output
             decoder_input = torch.tensor(
@@ -398,9 +442,16 @@ def modified_beam_search(
                 new_token = topk_token_indexes[k]
                 if new_token != blank_id:
                     new_ys.append(new_token)
+                    num_trailing_blanks = 0
+                else:
+                    num_trailing_blanks = hyp.num_trailing_blanks + 1
 
                 new_log_prob = topk_log_probs[k]
-                new_hyp = Hypothesis(ys=new_ys, log_prob=new_log_prob)
+                new_hyp = Hypothesis(
+                    ys=new_ys,
+                    log_prob=new_log_prob,
+                    num_trailing_blanks=num_trailing_blanks,
+                )
                 B[i].add(new_hyp)
 
     for i in range(batch_size):
@@ -501,6 +552,7 @@ def decode_one_chunk(
     streams: List[Stream],
     params: AttributeDict,
     decoding_graph: Optional[k2.Fsa] = None,
+    endpointer: Optional[Endpointer] = None,
 ) -> List[int]:
     """
     Args:
@@ -513,6 +565,9 @@ def decode_one_chunk(
       decoding_graph:
         The decoding graph. Can be either a `k2.trivial_graph` or LG, Used
         only when --decoding_method is fast_beam_search.
+      endpointer:
+        If not None, it is used to detect endpoints of the streams that are
+        not finished.
 
     Returns:
        A list of indexes indicating the finished streams.
@@ -606,6 +661,23 @@ def decode_one_chunk(
         streams[i].states = s
 
     finished_streams = [i for i, stream in enumerate(streams) if stream.done]
+
+    if endpointer is not None:
+        for stream in streams:
+            if stream.done:
+                continue
+            # Each chunk of `params.subsampling_factor` feature frames
+            # produces one frame of encoder output
+            num_frames = (
+                stream.num_processed_frames - stream.segment_start_frame
+            ) // params.subsampling_factor
+            if endpointer(
+                contains_nonsilence=len(stream.decoding_result()) > 0,
+                num_trailing_blanks=stream.get_num_trailing_blanks(),
+                num_frames=num_frames,
+            ):
+                stream.finalize_segment()
+
     return finished_streams
 
 
@@ -634,6 +706,7 @@ def decode_dataset(
     params: AttributeDict,
     sp: spm.SentencePieceProcessor,
     decoding_graph: Optional[k2.Fsa] = None,
+    endpointer: Optional[Endpointer] = None,
 ):
     """Decode dataset.
 
@@ -649,6 +722,8 @@ def decode_dataset(
       decoding_graph:
         The decoding graph. Can be either a `k2.trivial_graph` or LG, Used
         only when --decoding_method is fast_beam_search.
+      endpointer:
+        If not None, it is used to split the streams into segments.
 
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
@@ -664,6 +739,7 @@ def decode_dataset(
     fbank = create_streaming_feature_extractor()
 
     decode_results = []
+    num_segments = 0
     streams = []
     for num, cut in enumerate(cuts):
         # Each utterance has a Stream.
@@ -698,6 +774,7 @@ def decode_dataset(
                 streams=streams,
                 params=params,
                 decoding_graph=decoding_graph,
+                endpointer=endpointer,
             )
 
             for i in sorted(finished_streams, reverse=True):
@@ -705,9 +782,10 @@ def decode_dataset(
                     (
                         streams[i].id,
                         streams[i].ground_truth.split(),
-                        sp.decode(streams[i].decoding_result()).split(),
+                        sp.decode(streams[i].final_result()).split(),
                     )
                 )
+                num_segments += len(streams[i].segments) + 1
                 del streams[i]
 
         if num % log_interval == 0:
@@ -719,6 +797,7 @@ def decode_dataset(
             streams=streams,
             params=params,
             decoding_graph=decoding_graph,
+            endpointer=endpointer,
         )
 
         for i in sorted(finished_streams, reverse=True):
@@ -726,11 +805,15 @@ def decode_dataset(
                 (
                     streams[i].id,
                     streams[i].ground_truth.split(),
-                    sp.decode(streams[i].decoding_result()).split(),
+                    sp.decode(streams[i].final_result()).split(),
                 )
             )
+            num_segments += len(streams[i].segments) + 1
             del streams[i]
 
+    if endpointer is not None:
+        logging.info(f"Number of segments: {num_segments}")
+
     if params.decoding_method == "greedy_search":
         key = "greedy_search"
     elif params.decoding_method == "fast_beam_search":
@@ -826,6 +909,13 @@ def main():
     if params.use_averaged_model:
         params.suffix += "-use-averaged-model"
 
+    if params.endpoint:
+        assert params.decoding_method in (
+            "greedy_search",
+            "modified_beam_search",
+        ), params.decoding_method
+        params.suffix += "-endpoint"
+
     setup_logger(f"{params.res_dir}/log-streaming-decode")
     logging.info("Decoding started")
 
@@ -934,6 +1024,36 @@ def main():
     else:
         decoding_graph = None
 
+    endpointer = None
+    if params.endpoint:
+        endpointer = Endpointer(
+            # 10 ms frame shift before subsampling
+            frame_shift=0.01 * params.subsampling_factor,
+            rules=[
+                EndpointRule(
+                    must_contain_nonsilence=False,
+                    min_trailing_silence=(
+                        params.endpoint_rule1_min_trailing_silence
+                    ),
+                    min_utterance_length=0.0,
+                ),
+                EndpointRule(
+                    must_contain_nonsilence=True,
+                    min_trailing_silence=(
+                        params.endpoint_rule2_min_trailing_silence
+                    ),
+                    min_utterance_length=0.0,
+                ),
+                EndpointRule(
+                    must_contain_nonsilence=False,
+                    min_trailing_silence=0.0,
+                    min_utterance_length=(
+                        params.endpoint_rule3_min_utterance_length
+                    ),
+                ),
+            ],
+        )
+
     num_param = sum([p.numel() for p in model.parameters()])
     logging.info(f"Number of model parameters: {num_param}")
 
@@ -952,6 +1072,7 @@ def main():
             params=params,
             sp=sp,
             decoding_graph=decoding_graph,
+            endpointer=endpointer,
         )
 
         save_results(
@@ -23,6 +23,7 @@ import k2
 import torch
 from model import Transducer
 
+from icefall.context_graph import ContextGraph
 from icefall.decode import Nbest, one_best_decoding
 from icefall.utils import get_texts
 
@@ -776,6 +777,28 @@ def get_hyps_shape(hyps: List[HypothesisList]) -> k2.RaggedShape:
     return ans
 
 
+def finalize_context_scores(
+    hyps: HypothesisList, context_graph: ContextGraph
+) -> HypothesisList:
+    """Take back the context scores of unfinished partial matches at the
+    end of an utterance.
+
+    The search in this file does not use context graphs, so no hypothesis
+    carries a context score and `hyps` is returned as it is. It is
+    provided so that the DecodeStream shared with the recipes that do
+    support context graphs can be used here.
+
+    Args:
+      hyps:
+        The hypotheses of an utterance.
+      context_graph:
+        The context graph used in the search.
+    Returns:
+      Return `hyps`.
+    """
+    return hyps
+
+
 def modified_beam_search(
     model: Transducer,
     encoder_out: torch.Tensor,
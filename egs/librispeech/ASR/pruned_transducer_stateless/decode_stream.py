@@ -15,14 +15,20 @@
 # limitations under the License.
 
 import math
-from typing import List, Optional, Tuple
+from dataclasses import fields
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 import k2
 import torch
-from beam_search import Hypothesis, HypothesisList
+from beam_search import Hypothesis, HypothesisList, finalize_context_scores
 
+from icefall.context_graph import ContextGraph
+from icefall.stream_pool import pack_state, unpack_state
 from icefall.utils import AttributeDict
 
+if TYPE_CHECKING:
+    from kaldifeat import OnlineFbank
+
 
 class DecodeStream(object):
     def __init__(
@@ -35,6 +41,10 @@ class DecodeStream(object):
     ) -> None:
         """
         Args:
+          params:
+            It's the return value of :func:`get_params`.
+          cut_id:
+            The cut id of the current stream.
           initial_states:
             Initial decode states of the model, e.g. the return value of
             `get_init_state` in conformer.py
@@ -50,18 +60,46 @@ class DecodeStream(object):
 
         self.params = params
         self.cut_id = cut_id
+        self.device = device
         self.LOG_EPS = math.log(1e-10)
 
         self.states = initial_states
+        # The cache of encoder_embed, see get_init_embed_state() in
+        # conformer.py. Used only with --cache-encoder-embed.
+        self.embed_states: Optional[List[torch.Tensor]] = None
 
-        # It contains a 2-D tensors representing the feature frames.
+        # It contains a 2-D tensors representing the feature frames that
+        # are not consumed yet. Its first row is the frame with index
+        # `self.features_offset` of the utterance.
         self.features: torch.Tensor = None
+        self.features_offset: int = 0
 
+        # Number of available frames, including the tail padding frames
+        # once the input is finished.
         self.num_frames: int = 0
         # how many frames have been processed. (before subsampling).
         # we only modify this value in `func:get_feature_frames`.
         self.num_processed_frames: int = 0
 
+        # Used only when features are computed incrementally from
+        # audio samples, see :func:`accept_waveform`.
+        self.online_fbank: Optional["OnlineFbank"] = None
+        # Number of frames fetched from `self.online_fbank`
+        self.num_fetched_frames: int = 0
+        self.sampling_rate: Optional[float] = None
+        self.max_feature_vectors: int = 0
+        # The frame of the utterance with index `self.fbank_frame_offset`
+        # is the first frame of `self.online_fbank`. It is not 0 only for
+        # a stream restored by :func:`load_state_dict`.
+        self.fbank_frame_offset: int = 0
+        # The audio samples starting from the first sample of the frame
+        # `self.waveform_tail_frame`. They are all that is needed to
+        # recreate the feature extractor, see :func:`load_state_dict`.
+        self.waveform_tail: Optional[torch.Tensor] = None
+        self.waveform_tail_frame: int = 0
+
+        # True if all features of the utterance are available
+        self._input_finished: bool = False
         self._done: bool = False
 
         # The transcript of current utterance.
@@ -79,16 +117,17 @@ class DecodeStream(object):
             params.right_context + 2
         ) * params.subsampling_factor + 3
 
-        if params.decoding_method == "greedy_search":
-            self.hyp = [params.blank_id] * params.context_size
-        elif params.decoding_method == "modified_beam_search":
-            self.hyps = HypothesisList()
-            self.hyps.add(
-                Hypothesis(
-                    ys=[params.blank_id] * params.context_size,
-                    log_prob=torch.zeros(1, dtype=torch.float32, device=device),
-                )
-            )
+        # The token IDs of the finalized segments of current utterance,
+        # see :func:`finalize_segment`.
+        self.segments: List[List[int]] = []
+        # The value of `self.done_frames` when the current segment starts
+        self.segment_start_frame: int = 0
+        # Number of trailing frames on which greedy search emits only
+        # blanks. Used only when decoding_method is greedy_search.
+        self.num_trailing_blanks: int = 0
+
+        if params.decoding_method in ("greedy_search", "modified_beam_search"):
+            self._init_search_state()
         elif params.decoding_method == "fast_beam_search":
             # The rnnt_decoding_stream for fast_beam_search.
             self.rnnt_decoding_stream: k2.RnntDecodingStream = (
@@ -99,6 +138,23 @@ class DecodeStream(object):
                 f"Unsupported decoding method: {params.decoding_method}"
             )
 
+    def _init_search_state(self) -> None:
+        """Set the search state to that of the start of an utterance."""
+        blanks = [self.params.blank_id] * self.params.context_size
+        if self.params.decoding_method == "greedy_search":
+            self.hyp = blanks
+        else:
+            self.hyps = HypothesisList()
+            self.hyps.add(
+                Hypothesis(
+                    ys=blanks,
+                    log_prob=torch.zeros(
+                        1, dtype=torch.float32, device=self.device
+                    ),
+                )
+            )
+        self.num_trailing_blanks = 0
+
     @property
     def done(self) -> bool:
         """Return True if all the features are processed."""
@@ -114,13 +170,141 @@ class DecodeStream(object):
     ) -> None:
         """Set features tensor of current utterance."""
         assert features.dim() == 2, features.dim()
+        assert self.online_fbank is None, "Don't mix it with accept_waveform"
         self.features = torch.nn.functional.pad(
             features,
             (0, 0, 0, self.pad_length),
             mode="constant",
             value=self.LOG_EPS,
         )
+        self.features_offset = 0
         self.num_frames = self.features.size(0)
+        self._input_finished = True
+
+    def accept_waveform(
+        self,
+        sampling_rate: float,
+        waveform: torch.Tensor,
+        max_feature_vectors: int = 1000,
+    ) -> None:
+        """Feed audio samples of the current utterance. Features are
+        computed incrementally, so the decoding of a chunk can start as
+        soon as enough samples for it have arrived.
+
+        Only frames that are not consumed by :func:`get_feature_frames`
+        are kept, so the memory used by a stream does not grow with the
+        length of the utterance.
+
+        Args:
+          sampling_rate:
+            The sampling rate of `waveform`. It must not change between
+            calls.
+          waveform:
+            A 1-D float32 tensor containing audio samples normalized
+            to [-1, 1].
+          max_feature_vectors:
+            Maximum number of frames kept inside the feature extractor.
+            Used only in the first call.
+        """
+        assert waveform.dim() == 1, waveform.dim()
+        assert not self._input_finished, "input_finished() has been called"
+        if self.online_fbank is None:
+            self.sampling_rate = sampling_rate
+            self.max_feature_vectors = max_feature_vectors
+            self.online_fbank = self._create_online_fbank()
+            self.waveform_tail = torch.zeros(0)
+
+        # Frames are fetched from the feature extractor after every
+        # piece so that none of them is dropped from its bounded buffer.
+        frame_shift = int(sampling_rate * 0.01)
+        piece_size = self.max_feature_vectors // 2 * frame_shift
+        waveform = waveform.cpu()
+        for start in range(0, waveform.numel(), piece_size):
+            piece = waveform[start : start + piece_size]  # noqa
+            self.online_fbank.accept_waveform(
+                sampling_rate=sampling_rate, waveform=piece
+            )
+            self._fetch_frames()
+            self._update_waveform_tail(piece)
+
+    def _create_online_fbank(self) -> "OnlineFbank":
+        # kaldifeat is required only by streams fed with audio samples
+        from kaldifeat import FbankOptions, OnlineFbank
+
+        opts = FbankOptions()
+        opts.device = "cpu"
+        opts.frame_opts.dither = 0
+        opts.frame_opts.snip_edges = False
+        opts.frame_opts.samp_freq = self.sampling_rate
+        opts.frame_opts.max_feature_vectors = self.max_feature_vectors
+        opts.mel_opts.num_bins = self.params.feature_dim
+        return OnlineFbank(opts)
+
+    def _update_waveform_tail(self, piece: torch.Tensor) -> None:
+        """Append `piece` to `self.waveform_tail` and drop the samples
+        that are not needed by the frames after the fetched ones."""
+        # With snip_edges=False, frame t starts at sample
+        # t * frame_shift + frame_shift / 2 - frame_length / 2, so the
+        # frames that are not fetched yet do not use the samples before
+        # the start of the last fetched frame. A restored extractor
+        # treats the last fetched frame as the first frame of an
+        # utterance and computes it differently, but it is not fetched
+        # again.
+        frame_shift = int(self.sampling_rate * 0.01)
+        tail_frame = max(self.num_fetched_frames - 1, 0)
+        drop = (tail_frame - self.waveform_tail_frame) * frame_shift
+        self.waveform_tail = torch.cat([self.waveform_tail, piece])[drop:]
+        self.waveform_tail_frame = tail_frame
+
+    def input_finished(self) -> None:
+        """Indicate that no more audio samples will be fed. The remaining
+        frames are flushed and the tail padding is appended."""
+        assert not self._input_finished, "input_finished() has been called"
+        if self.online_fbank is not None:
+            self.online_fbank.input_finished()
+            self._fetch_frames()
+            self.waveform_tail = None
+
+        padding = torch.full(
+            (self.pad_length, self.params.feature_dim),
+            self.LOG_EPS,
+            device=self.device,
+        )
+        self._append_frames(padding)
+        self._input_finished = True
+
+    def _fetch_frames(self) -> None:
+        """Move newly computed frames from the feature extractor to
+        `self.features`."""
+        offset = self.fbank_frame_offset
+        num_frames_ready = offset + self.online_fbank.num_frames_ready
+        if num_frames_ready == self.num_fetched_frames:
+            return
+        frames = [
+            self.online_fbank.get_frame(i - offset)
+            for i in range(self.num_fetched_frames, num_frames_ready)
+        ]
+        self.num_fetched_frames = num_frames_ready
+        self._append_frames(torch.cat(frames, dim=0).to(self.device))
+
+    def _append_frames(self, frames: torch.Tensor) -> None:
+        if self.features is None:
+            self.features = frames
+        else:
+            self.features = torch.cat([self.features, frames], dim=0)
+        self.num_frames += frames.size(0)
+
+    def is_ready(self, chunk_size: int) -> bool:
+        """Return True if there are enough frames to decode the next chunk.
+        It is always True for streams whose features are set by
+        :func:`set_features` and that are not done yet.
+        """
+        if self._done:
+            return False
+        if self._input_finished:
+            return True
+        chunk_length = chunk_size + self.pad_length
+        return self.num_processed_frames + chunk_length <= self.num_frames
 
     def get_feature_frames(self, chunk_size: int) -> Tuple[torch.Tensor, int]:
         """Consume chunk_size frames of features"""
@@ -130,15 +314,22 @@ class DecodeStream(object):
             self.num_frames - self.num_processed_frames, chunk_length
         )
 
-        ret_features = self.features[
-            self.num_processed_frames : self.num_processed_frames  # noqa
-            + ret_length
-        ]
+        start = self.num_processed_frames - self.features_offset
+        ret_features = self.features[start : start + ret_length]  # noqa
 
         self.num_processed_frames += chunk_size
-        if self.num_processed_frames >= self.num_frames:
+        if (
+            self._input_finished
+            and self.num_processed_frames >= self.num_frames
+        ):
             self._done = True
 
+        if self.online_fbank is not None:
+            # Drop consumed frames
+            start = self.num_processed_frames - self.features_offset
+            self.features = self.features[start:]
+            self.features_offset = self.num_processed_frames
+
         return ret_features, ret_length
 
     def decoding_result(self) -> List[int]:
@@ -151,3 +342,194 @@ class DecodeStream(object):
         else:
             assert self.params.decoding_method == "fast_beam_search"
             return self.hyp
+
+    def get_num_trailing_blanks(self) -> int:
+        """Return the number of trailing frames of the current segment on
+        which the best path emits only blanks."""
+        if self.params.decoding_method == "modified_beam_search":
+            best_hyp = self.hyps.get_most_probable(length_norm=True)
+            return getattr(best_hyp, "num_trailing_blanks", 0)
+        return self.num_trailing_blanks
+
+    def finalize_segment(
+        self, context_graph: Optional[ContextGraph] = None
+    ) -> List[int]:
+        """Finalize the decoding result of the current segment, e.g., when
+        an endpoint is detected, and start a new segment.
+
+        The search state, i.e., the hypotheses and the decoder context, is
+        reset, so that its size does not grow with the length of the
+        stream. The encoder state is kept.
+
+        Args:
+          context_graph:
+            If not None, the context graph used by modified_beam_search.
+            The context scores of unfinished partial matches are taken
+            back before the best hypothesis of the segment is selected.
+        Returns:
+          Return the token IDs of the finalized segment.
+        """
+        assert self.params.decoding_method in (
+            "greedy_search",
+            "modified_beam_search",
+        ), self.params.decoding_method
+        if (
+            context_graph is not None
+            and self.params.decoding_method == "modified_beam_search"
+        ):
+            self.hyps = finalize_context_scores(self.hyps, context_graph)
+        result = self.decoding_result()
+        self.segments.append(result)
+        self.segment_start_frame = int(self.done_frames)
+        self._init_search_state()
+        return result
+
+    def final_result(self) -> List[int]:
+        """Return the token IDs of all finalized segments and the current
+        one."""
+        return [t for s in self.segments for t in s] + self.decoding_result()
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the state of this stream, i.e., the encoder states, the
+        unconsumed feature frames, the state of the feature extractor and
+        the search state. It does not contain `params`.
+
+        It is not supported for fast_beam_search, since the state of
+        `k2.RnntDecodingStream` cannot be saved.
+        """
+        if self.params.decoding_method == "fast_beam_search":
+            raise ValueError(
+                "Saving the state of a stream is not supported for "
+                "fast_beam_search"
+            )
+
+        features = None
+        if self.features is not None:
+            start = self.num_processed_frames - self.features_offset
+            features = self.features[start:]
+
+        state_dict = {
+            "cut_id": self.cut_id,
+            "decoding_method": self.params.decoding_method,
+            "states": self.states,
+            "embed_states": self.embed_states,
+            "features": features,
+            "num_frames": self.num_frames,
+            "num_processed_frames": self.num_processed_frames,
+            "num_fetched_frames": self.num_fetched_frames,
+            "sampling_rate": self.sampling_rate,
+            "max_feature_vectors": self.max_feature_vectors,
+            "waveform_tail": self.waveform_tail,
+            "waveform_tail_frame": self.waveform_tail_frame,
+            "input_finished": self._input_finished,
+            "done": self._done,
+            "ground_truth": self.ground_truth,
+            "done_frames": int(self.done_frames),
+            "segments": [list(s) for s in self.segments],
+            "segment_start_frame": self.segment_start_frame,
+            "num_trailing_blanks": self.num_trailing_blanks,
+        }
+        if self.params.decoding_method == "greedy_search":
+            state_dict["hyp"] = list(self.hyp)
+        else:
+            hyps = []
+            for hyp in self.hyps:
+                hyp = {f.name: getattr(hyp, f.name) for f in fields(hyp)}
+                if hyp.pop("state_cost", None) is not None:
+                    raise ValueError("The LM state cannot be saved")
+                hyps.append(hyp)
+            state_dict["hyps"] = hyps
+        return state_dict
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restore the state returned by :func:`state_dict`. The stream
+        has to be created with the same `params`."""
+        assert state_dict["decoding_method"] == self.params.decoding_method, (
+            state_dict["decoding_method"],
+            self.params.decoding_method,
+        )
+
+        def to_device(x):
+            return x if x is None else x.to(self.device)
+
+        self.cut_id = state_dict["cut_id"]
+        self.states = [s.to(self.device) for s in state_dict["states"]]
+        if state_dict["embed_states"] is None:
+            self.embed_states = None
+        else:
+            self.embed_states = [
+                s.to(self.device) for s in state_dict["embed_states"]
+            ]
+
+        self.features = to_device(state_dict["features"])
+        self.num_frames = state_dict["num_frames"]
+        self.num_processed_frames = state_dict["num_processed_frames"]
+        self.features_offset = self.num_processed_frames
+
+        self.num_fetched_frames = state_dict["num_fetched_frames"]
+        self.sampling_rate = state_dict["sampling_rate"]
+        self.max_feature_vectors = state_dict["max_feature_vectors"]
+        self.waveform_tail = state_dict["waveform_tail"]
+        self.waveform_tail_frame = state_dict["waveform_tail_frame"]
+        self._input_finished = state_dict["input_finished"]
+        self._done = state_dict["done"]
+        self.online_fbank = None
+        if self.sampling_rate is not None and not self._input_finished:
+            # Recreate the feature extractor from the samples of the
+            # frames that are not fetched yet.
+            self.online_fbank = self._create_online_fbank()
+            self.online_fbank.accept_waveform(
+                sampling_rate=self.sampling_rate,
+                waveform=self.waveform_tail.cpu(),
+            )
+            self.fbank_frame_offset = self.waveform_tail_frame
+
+        self.ground_truth = state_dict["ground_truth"]
+        self.done_frames = state_dict["done_frames"]
+        self.segments = [list(s) for s in state_dict["segments"]]
+        self.segment_start_frame = state_dict["segment_start_frame"]
+        self.num_trailing_blanks = state_dict["num_trailing_blanks"]
+        if self.params.decoding_method == "greedy_search":
+            self.hyp = list(state_dict["hyp"])
+        else:
+            self.hyps = HypothesisList()
+            for hyp in state_dict["hyps"]:
+                hyp = dict(
+                    hyp,
+                    ys=list(hyp["ys"]),
+                    log_prob=hyp["log_prob"].to(self.device),
+                )
+                self.hyps.add(Hypothesis(**hyp))
+
+    def snapshot(self) -> bytes:
+        """Return the state of this stream as bytes, which can be kept in
+        memory, written to disk or sent to another process.
+        See :func:`from_snapshot`."""
+        return pack_state(self.state_dict())
+
+    @classmethod
+    def from_snapshot(
+        cls,
+        data: bytes,
+        params: AttributeDict,
+        device: torch.device = torch.device("cpu"),
+    ) -> "DecodeStream":
+        """Create a stream from the return value of :func:`snapshot`.
+
+        Args:
+          data:
+            The return value of :func:`snapshot`.
+          params:
+            The same `params` as the one of the saved stream.
+          device:
+            The device to run the restored stream.
+        """
+        state_dict = unpack_state(data)
+        stream = cls(
+            params=params,
+            cut_id=state_dict["cut_id"],
+            initial_states=state_dict["states"],
+            device=device,
+        )
+        stream.load_state_dict(state_dict)
+        return stream
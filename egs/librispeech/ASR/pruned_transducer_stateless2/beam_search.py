@@ -14,18 +14,378 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
 import warnings
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import k2
 import sentencepiece as spm
 import torch
 from model import Transducer
 
-from icefall import NgramLm, NgramLmStateCost
-from icefall.decode import Nbest, one_best_decoding
-from icefall.utils import add_eos, add_sos, get_texts
+from icefall import CompiledNgramLm, NgramLm, NgramLmStateCost
+from icefall.context_graph import ContextGraph
+from icefall.decode import Nbest, compute_rnn_lm_scores, one_best_decoding
+from icefall.utils import get_texts
+
+
+class DecoderOutputCache(object):
+    """A cache for the projected output of a stateless decoder, i.e.,
+    `model.joiner.decoder_proj(model.decoder(context))`.
+
+    The stateless decoder depends only on the last `context_size` tokens,
+    so its output can be reused across frames, hypotheses, utterances
+    and streams. The cache supports two modes:
+
+      - LRU mode (default): at most `max_size` entries are kept.
+        The least recently used entry is evicted when the cache is full.
+      - Precompute mode: the output for all `vocab_size**context_size`
+        contexts is computed once. It uses
+        `vocab_size**context_size * joiner_dim` floats, so it is suitable
+        only for small vocabularies and context sizes.
+
+    Caution:
+      The model must be in eval mode and must not be changed after
+      the cache is created.
+
+    Usage::
+
+        decoder_cache = DecoderOutputCache(model, max_size=10000)
+        hyps = greedy_search_batch(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            decoder_cache=decoder_cache,
+        )
+    """
+
+    def __init__(
+        self,
+        model: Transducer,
+        max_size: int = 100000,
+        precompute: bool = False,
+        precompute_batch_size: int = 10000,
+    ) -> None:
+        """
+        Args:
+          model:
+            The transducer model.
+          max_size:
+            Maximum number of entries in LRU mode. Not used in precompute
+            mode.
+          precompute:
+            True to compute the decoder output for all possible contexts
+            at construction time.
+          precompute_batch_size:
+            Number of contexts to process at a time in precompute mode.
+        """
+        assert max_size > 0, max_size
+        self.model = model
+        self.context_size = model.decoder.context_size
+        self.vocab_size = model.decoder.vocab_size
+        self.device = next(model.parameters()).device
+        self.max_size = max_size
+
+        # contexts are encoded as integers in base vocab_size
+        self._weights = torch.tensor(
+            [
+                self.vocab_size**i
+                for i in range(self.context_size - 1, -1, -1)
+            ],
+            dtype=torch.int64,
+            device=self.device,
+        )
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+        # Used only in precompute mode
+        self._table: Optional[torch.Tensor] = None
+
+        # Used only in LRU mode. It maps a context key to a row in _storage
+        self._slots: "OrderedDict[int, int]" = OrderedDict()
+        self._storage: Optional[torch.Tensor] = None
+
+        if precompute:
+            self._precompute(precompute_batch_size)
+
+    @torch.no_grad()
+    def _precompute(self, batch_size: int) -> None:
+        num_contexts = self.vocab_size**self.context_size
+        table = []
+        for start in range(0, num_contexts, batch_size):
+            end = min(start + batch_size, num_contexts)
+            keys = torch.arange(start, end, device=self.device)
+            contexts = torch.div(
+                keys.unsqueeze(1), self._weights, rounding_mode="floor"
+            )
+            contexts = contexts % self.vocab_size
+            table.append(self._compute(contexts))
+        self._table = torch.cat(table)
+
+    def _compute(self, contexts: torch.Tensor) -> torch.Tensor:
+        """Run the decoder and the decoder projection.
+
+        Args:
+          contexts:
+            A 2-D tensor of shape (N, context_size).
+        Returns:
+          Return a tensor of shape (N, joiner_dim).
+        """
+        decoder_out = self.model.decoder(contexts, need_pad=False)
+        decoder_out = self.model.joiner.decoder_proj(decoder_out)
+        return decoder_out.squeeze(1)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.num_hits + self.num_misses
+        return self.num_hits / total if total > 0 else 0.0
+
+    def __len__(self) -> int:
+        if self._table is not None:
+            return self._table.size(0)
+        return len(self._slots)
+
+    @torch.no_grad()
+    def __call__(self, contexts: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+          contexts:
+            A 2-D tensor of shape (N, context_size) containing the decoder
+            input, i.e., the last `context_size` tokens of each hypothesis.
+        Returns:
+          Return a tensor of shape (N, 1, joiner_dim), which is the same
+          as `model.joiner.decoder_proj(model.decoder(contexts, False))`.
+        """
+        assert contexts.ndim == 2, contexts.shape
+        assert contexts.size(1) == self.context_size, contexts.shape
+
+        contexts = contexts.to(device=self.device, dtype=torch.int64)
+        keys = (contexts * self._weights).sum(dim=1)
+
+        if self._table is not None:
+            self.num_hits += keys.numel()
+            return self._table[keys].unsqueeze(1)
+
+        keys_list = keys.tolist()
+        missing: Dict[int, int] = {}
+        for i, k in enumerate(keys_list):
+            if k in self._slots:
+                self._slots.move_to_end(k)
+            elif k not in missing:
+                missing[k] = i
+
+        self.num_misses += len(missing)
+        self.num_hits += len(keys_list) - len(missing)
+
+        if len(set(keys_list)) > self.max_size:
+            # Too many distinct contexts in a single call. Evicting entries
+            # would remove the ones we still need, so don't cache them.
+            return self._compute(contexts).unsqueeze(1)
+
+        if missing:
+            index = torch.tensor(list(missing.values()), device=self.device)
+            decoder_out = self._compute(contexts[index])
+            if self._storage is None:
+                self._storage = decoder_out.new_empty(
+                    (self.max_size, decoder_out.size(-1))
+                )
+
+            slots = []
+            for k in missing.keys():
+                if len(self._slots) < self.max_size:
+                    slot = len(self._slots)
+                else:
+                    _, slot = self._slots.popitem(last=False)
+                self._slots[k] = slot
+                slots.append(slot)
+            slots = torch.tensor(slots, device=self.device)
+            self._storage[slots] = decoder_out
+
+        slots = torch.tensor(
+            [self._slots[k] for k in keys_list], device=self.device
+        )
+        return self._storage[slots].unsqueeze(1)
+
+
+def compute_decoder_out(
+    model: Transducer,
+    decoder_input: torch.Tensor,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+) -> torch.Tensor:
+    """Compute `model.joiner.decoder_proj(model.decoder(decoder_input))`,
+    using `decoder_cache` if it is not None.
+
+    Args:
+      model:
+        The transducer model.
+      decoder_input:
+        A 2-D tensor of shape (N, context_size).
+      decoder_cache:
+        If not None, look up the decoder output from it.
+    Returns:
+      Return a tensor of shape (N, 1, joiner_dim).
+    """
+    if decoder_cache is not None:
+        return decoder_cache(decoder_input)
+    decoder_out = model.decoder(decoder_input, need_pad=False)
+    return model.joiner.decoder_proj(decoder_out)
+
+
+class BlankFrameSkipper(object):
+    """Remove encoder frames that are very likely to be blank before
+    running a search method, so that the per-frame search loop,
+    which runs the decoder and the joiner for every hypothesis, is
+    run only on the remaining frames.
+
+    The blank probability of a frame is computed with the initial
+    decoder context, i.e., `[blank_id] * context_size`, for all frames
+    at once. Two methods are supported:
+
+      - "joiner": Use the joiner. It gives the exact blank probability
+        seen by greedy search for frames where the context is the
+        initial one.
+      - "simple": Use `model.simple_am_proj` and `model.simple_lm_proj`,
+        which are trained with the simple loss. They are much cheaper
+        than the joiner, but less accurate.
+
+    At least one frame is kept for each utterance. The number of
+    skipped frames is accumulated in `num_skipped_frames` so that the
+    skip rate can be reported after decoding.
+
+    Usage::
+
+        skipper = BlankFrameSkipper(model, blank_threshold=0.95)
+        encoder_out, encoder_out_lens = skipper(encoder_out, encoder_out_lens)
+        hyps = greedy_search_batch(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+        )
+        logging.info(f"Skip rate: {skipper.skip_rate:.3f}")
+    """
+
+    def __init__(
+        self,
+        model: Transducer,
+        blank_threshold: float,
+        method: str = "joiner",
+    ) -> None:
+        """
+        Args:
+          model:
+            The transducer model.
+          blank_threshold:
+            Frames whose blank probability is larger than this value are
+            removed. It should be in the range (0, 1].
+          method:
+            Either "joiner" or "simple". See the class documentation.
+        """
+        assert 0 < blank_threshold <= 1, blank_threshold
+        assert method in ("joiner", "simple"), method
+
+        self.model = model
+        self.log_threshold = math.log(blank_threshold)
+        self.method = method
+
+        self.num_frames = 0
+        self.num_skipped_frames = 0
+
+    @property
+    def skip_rate(self) -> float:
+        if self.num_frames == 0:
+            return 0.0
+        return self.num_skipped_frames / self.num_frames
+
+    def blank_log_probs(self, encoder_out: torch.Tensor) -> torch.Tensor:
+        """Compute the log probability of blank for each frame.
+
+        Args:
+          encoder_out:
+            A tensor of shape (N, T, C) from the encoder.
+        Returns:
+          Return a tensor of shape (N, T).
+        """
+        model = self.model
+        blank_id = model.decoder.blank_id
+        context_size = model.decoder.context_size
+
+        decoder_input = torch.full(
+            (1, context_size),
+            blank_id,
+            device=encoder_out.device,
+            dtype=torch.int64,
+        )
+        decoder_out = model.decoder(decoder_input, need_pad=False)
+        # decoder_out: (1, 1, decoder_dim)
+
+        if self.method == "joiner":
+            decoder_out = model.joiner.decoder_proj(decoder_out)
+            encoder_out = model.joiner.encoder_proj(encoder_out)
+            logits = model.joiner(
+                encoder_out.unsqueeze(2),
+                decoder_out.unsqueeze(1).expand(*encoder_out.shape[:2], 1, -1),
+                project_input=False,
+            ).squeeze(2)
+        else:
+            logits = model.simple_am_proj(encoder_out) + model.simple_lm_proj(
+                decoder_out
+            )
+        # logits: (N, T, vocab_size)
+
+        return logits.log_softmax(dim=-1)[..., blank_id]
+
+    @torch.no_grad()
+    def __call__(
+        self, encoder_out: torch.Tensor, encoder_out_lens: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+          encoder_out:
+            A tensor of shape (N, T, C) from the encoder.
+          encoder_out_lens:
+            A 1-D tensor of shape (N,), containing number of valid frames in
+            encoder_out before padding.
+        Returns:
+          Return a tuple containing:
+            - encoder_out, of shape (N, T', C) with T' <= T, containing the
+              remaining frames of each utterance in their original order.
+            - encoder_out_lens, of shape (N,), containing the number of
+              remaining frames of each utterance.
+        """
+        assert encoder_out.ndim == 3, encoder_out.shape
+        N, T, C = encoder_out.shape
+
+        blank_log_probs = self.blank_log_probs(encoder_out)
+
+        valid = torch.arange(T, device=encoder_out.device).unsqueeze(
+            0
+        ) < encoder_out_lens.unsqueeze(1)
+        blank_log_probs = blank_log_probs.masked_fill(~valid, float("inf"))
+
+        keep = blank_log_probs <= self.log_threshold
+        # Keep the least blank frame of each utterance so that
+        # no utterance ends up empty
+        keep[torch.arange(N), blank_log_probs.argmin(dim=1)] = True
+        keep &= valid
+
+        new_lens = keep.sum(dim=1)
+
+        self.num_frames += int(encoder_out_lens.sum())
+        self.num_skipped_frames += int(encoder_out_lens.sum() - new_lens.sum())
+
+        # Position of each kept frame in the output
+        positions = keep.cumsum(dim=1) - 1
+        utt_indexes, frame_indexes = keep.nonzero(as_tuple=True)
+
+        ans = encoder_out.new_zeros(N, int(new_lens.max()), C)
+        ans[utt_indexes, positions[utt_indexes, frame_indexes]] = encoder_out[
+            utt_indexes, frame_indexes
+        ]
+
+        return ans, new_lens.to(encoder_out_lens.dtype)
 
 
 def fast_beam_search_one_best(
@@ -391,6 +751,7 @@ def fast_beam_search(
     max_states: int,
     max_contexts: int,
     temperature: float = 1.0,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> k2.Fsa:
     """It limits the maximum number of symbols per frame to 1.
 
@@ -412,6 +773,9 @@ def fast_beam_search(
         Max contexts pre stream per frame.
       temperature:
         Softmax temperature.
+      decoder_cache:
+        If not None, the decoder output is looked up from it instead of
+        running the decoder. See :class:`DecoderOutputCache`.
     Returns:
       Return an FsaVec with axes [utt][state][arc] containing the decoded
       lattice. Note: When the input graph is a TrivialGraph, the returned
@@ -445,8 +809,7 @@ def fast_beam_search(
         # `nn.Embedding()` in torch below v1.7.1 supports only torch.int64
         contexts = contexts.to(torch.int64)
         # decoder_out is of shape (shape.NumElements(), 1, decoder_out_dim)
-        decoder_out = model.decoder(contexts, need_pad=False)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+        decoder_out = compute_decoder_out(model, contexts, decoder_cache)
         # current_encoder_out is of shape
         # (shape.NumElements(), 1, joiner_dim)
         # fmt: off
@@ -554,6 +917,7 @@ def greedy_search_batch(
     model: Transducer,
     encoder_out: torch.Tensor,
     encoder_out_lens: torch.Tensor,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> List[List[int]]:
     """Greedy search in batch mode. It hardcodes --max-sym-per-frame=1.
     Args:
@@ -564,6 +928,9 @@ def greedy_search_batch(
       encoder_out_lens:
         A 1-D tensor of shape (N,), containing number of valid frames in
         encoder_out before padding.
+      decoder_cache:
+        If not None, the decoder output is looked up from it instead of
+        running the decoder. See :class:`DecoderOutputCache`.
     Returns:
       Return a list-of-list of token IDs containing the decoded results.
       len(ans) equals to encoder_out.size(0).
@@ -597,8 +964,7 @@ def greedy_search_batch(
         dtype=torch.int64,
     )  # (N, context_size)
 
-    decoder_out = model.decoder(decoder_input, need_pad=False)
-    decoder_out = model.joiner.decoder_proj(decoder_out)
+    decoder_out = compute_decoder_out(model, decoder_input, decoder_cache)
     # decoder_out: (N, 1, decoder_out_dim)
 
     encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
@@ -608,20 +974,19 @@ def greedy_search_batch(
         start = offset
         end = offset + batch_size
         current_encoder_out = encoder_out.data[start:end]
-        current_encoder_out = current_encoder_out.unsqueeze(1).unsqueeze(1)
-        # current_encoder_out's shape: (batch_size, 1, 1, encoder_out_dim)
+        # current_encoder_out's shape: (batch_size, encoder_out_dim)
         offset = end
 
         decoder_out = decoder_out[:batch_size]
 
-        logits = model.joiner(
-            current_encoder_out, decoder_out.unsqueeze(1), project_input=False
+        _, y, _ = model.joiner.topk(
+            current_encoder_out,
+            decoder_out.squeeze(1),
+            k=1,
+            blank_id=blank_id,
         )
-        # logits'shape (batch_size, 1, 1, vocab_size)
-
-        logits = logits.squeeze(1).squeeze(1)  # (batch_size, vocab_size)
-        assert logits.ndim == 2, logits.shape
-        y = logits.argmax(dim=1).tolist()
+        # y's shape: (batch_size, 1)
+        y = y.squeeze(1).tolist()
         emitted = False
         for i, v in enumerate(y):
             if v not in (blank_id, unk_id):
@@ -635,8 +1000,9 @@ def greedy_search_batch(
                 device=device,
                 dtype=torch.int64,
             )
-            decoder_out = model.decoder(decoder_input, need_pad=False)
-            decoder_out = model.joiner.decoder_proj(decoder_out)
+            decoder_out = compute_decoder_out(
+                model, decoder_input, decoder_cache
+            )
 
     sorted_ans = [h[context_size:] for h in hyps]
     ans = []
@@ -659,6 +1025,13 @@ class Hypothesis:
 
     state_cost: Optional[NgramLmStateCost] = None
 
+    # The state of the hypothesis in the context graph, if any
+    context_state: int = 0
+
+    # Number of trailing frames on which only blanks are emitted. Used
+    # for endpointing in streaming decoding.
+    num_trailing_blanks: int = 0
+
     @property
     def key(self) -> str:
         """Return a string representation of self.ys"""
@@ -800,12 +1173,94 @@ def get_hyps_shape(hyps: List[HypothesisList]) -> k2.RaggedShape:
     return ans
 
 
+def get_context_scores(
+    context_graph: ContextGraph,
+    context_states: torch.Tensor,
+    num_labels: int,
+    blank_id: int,
+    unk_id: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Return the next context states and the context scores of all
+    tokens for the given hypotheses.
+
+    Unlike :func:`ContextGraph.get_next_states_and_scores`, blank and unk
+    keep the context state unchanged and get a score of 0.
+
+    Args:
+      context_graph:
+        The context graph.
+      context_states:
+        A 1-D torch.int64 tensor of shape (num_hyps,) containing the
+        context state of each hypothesis.
+      num_labels:
+        The vocabulary size.
+      blank_id:
+        ID of the blank symbol.
+      unk_id:
+        ID of the unk symbol.
+    Returns:
+      Return a tuple containing two tensors of shape (num_hyps, num_labels):
+      the next context states and the scores.
+    """
+    # Look up each distinct context state only once
+    unique_states, inverse = torch.unique(context_states, return_inverse=True)
+    next_states, scores = context_graph.get_next_states_and_scores(
+        unique_states, num_labels=num_labels
+    )
+    next_states = next_states[inverse]
+    scores = scores[inverse]
+    for i in {blank_id, unk_id}:
+        next_states[:, i] = context_states
+        scores[:, i] = 0
+    return next_states, scores
+
+
+def finalize_context_scores(
+    hyps: HypothesisList, context_graph: ContextGraph
+) -> HypothesisList:
+    """Take back the context scores of unfinished partial matches at the
+    end of an utterance.
+
+    Caution:
+      `hyps` is not modified. Instead, a new HypothesisList is returned.
+
+    Args:
+      hyps:
+        The hypotheses of an utterance.
+      context_graph:
+        The context graph used in the search.
+    Returns:
+      Return a new HypothesisList with updated `log_prob`. The context
+      state of each hypothesis is reset to the root.
+    """
+    ans = HypothesisList()
+    if len(hyps) == 0:
+        return ans
+    hyps = list(hyps)
+    final_scores = context_graph.get_final_scores(
+        torch.tensor([hyp.context_state for hyp in hyps], dtype=torch.int64)
+    ).tolist()
+    for hyp, score in zip(hyps, final_scores):
+        ans.add(
+            Hypothesis(
+                ys=hyp.ys,
+                log_prob=hyp.log_prob + score,
+                state_cost=hyp.state_cost,
+                context_state=context_graph.root,
+                num_trailing_blanks=hyp.num_trailing_blanks,
+            )
+        )
+    return ans
+
+
 def modified_beam_search(
     model: Transducer,
     encoder_out: torch.Tensor,
     encoder_out_lens: torch.Tensor,
     beam: int = 4,
     temperature: float = 1.0,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    context_graph: Optional[ContextGraph] = None,
 ) -> List[List[int]]:
     """Beam search in batch mode with --max-sym-per-frame=1 being hardcoded.
 
@@ -821,6 +1276,13 @@ def modified_beam_search(
         Number of active paths during the beam search.
       temperature:
         Softmax temperature.
+      decoder_cache:
+        If not None, the decoder output is looked up from it instead of
+        running the decoder. See :class:`DecoderOutputCache`.
+      context_graph:
+        If not None, the context graph used for contextual biasing. The
+        context scores of all tokens are added to the log-probs before
+        the top-k, so they affect which tokens survive.
     Returns:
       Return a list-of-list of token IDs. ans[i] is the decoding results
       for the i-th utterance.
@@ -845,6 +1307,9 @@ def modified_beam_search(
     assert torch.all(encoder_out_lens > 0), encoder_out_lens
     assert N == batch_size_list[0], (N, batch_size_list)
 
+    # Number of tokens per hypothesis to consider at each frame
+    num_tokens = min(beam, model.decoder.vocab_size)
+
     B = [HypothesisList() for _ in range(N)]
     for i in range(N):
         B[i].add(
@@ -884,8 +1349,9 @@ def modified_beam_search(
             dtype=torch.int64,
         )  # (num_hyps, context_size)
 
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+        decoder_out = compute_decoder_out(
+            model, decoder_input, decoder_cache
+        ).unsqueeze(1)
         # decoder_out is of shape (num_hyps, 1, 1, joiner_dim)
 
         # Note: For torch 1.7.1 and below, it requires a torch.int64 tensor
@@ -896,39 +1362,72 @@ def modified_beam_search(
             index=hyps_shape.row_ids(1).to(torch.int64),
         )  # (num_hyps, 1, 1, encoder_out_dim)
 
-        logits = model.joiner(
-            current_encoder_out,
-            decoder_out,
-            project_input=False,
-        )  # (num_hyps, 1, 1, vocab_size)
-
-        logits = logits.squeeze(1).squeeze(1)  # (num_hyps, vocab_size)
-
-        log_probs = (logits / temperature).log_softmax(
-            dim=-1
-        )  # (num_hyps, vocab_size)
+        # The best `beam` paths of an utterance can only extend each
+        # hypothesis with one of its `beam` most probable tokens, so only
+        # those are computed.
+        if context_graph is None:
+            hyp_log_probs, hyp_tokens, _ = model.joiner.topk(
+                current_encoder_out.squeeze(1).squeeze(1),
+                decoder_out.squeeze(1).squeeze(1),
+                k=num_tokens,
+                blank_id=blank_id,
+                temperature=temperature,
+            )  # (num_hyps, num_tokens)
+        else:
+            logits = model.joiner(
+                current_encoder_out,
+                decoder_out,
+                project_input=False,
+            )  # (num_hyps, 1, 1, vocab_size)
+            logits = logits.squeeze(1).squeeze(1)  # (num_hyps, vocab_size)
+            hyp_log_probs = (logits / temperature).log_softmax(dim=-1)
+
+            context_states = torch.tensor(
+                [hyp.context_state for hyps in A for hyp in hyps],
+                device=device,
+                dtype=torch.int64,
+            )
+            next_context_states, context_scores = get_context_scores(
+                context_graph,
+                context_states,
+                num_labels=hyp_log_probs.size(1),
+                blank_id=blank_id,
+                unk_id=unk_id,
+            )
+            hyp_log_probs.add_(context_scores)
 
-        log_probs.add_(ys_log_probs)
+            hyp_log_probs, hyp_tokens = hyp_log_probs.topk(num_tokens, dim=1)
+            hyp_next_context_states = next_context_states.gather(
+                1, hyp_tokens
+            ).reshape(-1)
 
-        vocab_size = log_probs.size(-1)
+        hyp_log_probs.add_(ys_log_probs)
 
-        log_probs = log_probs.reshape(-1)
+        hyp_log_probs = hyp_log_probs.reshape(-1)
+        hyp_tokens = hyp_tokens.reshape(-1)
 
-        row_splits = hyps_shape.row_splits(1) * vocab_size
+        row_splits = hyps_shape.row_splits(1) * num_tokens
         log_probs_shape = k2.ragged.create_ragged_shape2(
-            row_splits=row_splits, cached_tot_size=log_probs.numel()
+            row_splits=row_splits, cached_tot_size=hyp_log_probs.numel()
         )
         ragged_log_probs = k2.RaggedTensor(
-            shape=log_probs_shape, value=log_probs
+            shape=log_probs_shape, value=hyp_log_probs
         )
+        row_splits = row_splits.tolist()
 
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                topk_hyp_indexes = (topk_indexes // vocab_size).tolist()
-                topk_token_indexes = (topk_indexes % vocab_size).tolist()
+                topk_hyp_indexes = (topk_indexes // num_tokens).tolist()
+            topk_token_indexes = hyp_tokens[
+                topk_indexes.to(torch.int64) + row_splits[i]
+            ].tolist()
+            if context_graph is not None:
+                topk_context_states = hyp_next_context_states[
+                    topk_indexes.to(torch.int64) + row_splits[i]
+                ].tolist()
 
             for k in range(len(topk_hyp_indexes)):
                 hyp_idx = topk_hyp_indexes[k]
@@ -941,9 +1440,13 @@ def modified_beam_search(
 
                 new_log_prob = topk_log_probs[k]
                 new_hyp = Hypothesis(ys=new_ys, log_prob=new_log_prob)
+                if context_graph is not None:
+                    new_hyp.context_state = topk_context_states[k]
                 B[i].add(new_hyp)
 
     B = B + finalized_B
+    if context_graph is not None:
+        B = [finalize_context_scores(b, context_graph) for b in B]
     best_hyps = [b.get_most_probable(length_norm=True) for b in B]
 
     sorted_ans = [h.ys[context_size:] for h in best_hyps]
@@ -955,6 +1458,415 @@ def modified_beam_search(
     return ans
 
 
+# Two independent polynomial rolling hashes are used to identify a token
+# sequence. Both moduli are below 2**31 so that `hash * multiplier` fits
+# into int64 without overflow.
+_HASH_MULTIPLIERS = (1000003, 999983)
+_HASH_MODULI = (2147483647, 2147483629)
+
+
+def _padded_argmax(
+    scores: torch.Tensor, row_splits: List[int], start: int, end: int
+) -> torch.Tensor:
+    """Return the index of the largest score of each row in the given range.
+
+    Args:
+      scores:
+        A 1-D tensor containing the scores of all hypotheses.
+      row_splits:
+        The row splits of the hypotheses, i.e., the hypotheses of the i-th
+        utterance are `scores[row_splits[i]:row_splits[i+1]]`.
+      start:
+        The first row to process.
+      end:
+        One past the last row to process.
+    Returns:
+      Return a 1-D tensor of shape (end - start,) containing indexes into
+      `scores`. If there are multiple maxima in a row, the first one is
+      returned.
+    """
+    num_rows = end - start
+    num_hyps = [row_splits[i + 1] - row_splits[i] for i in range(start, end)]
+    max_hyps = max(num_hyps)
+    device = scores.device
+
+    lens = torch.tensor(num_hyps, device=device)
+    offsets = torch.tensor(row_splits[start:end], device=device)
+    row_ids = torch.repeat_interleave(
+        torch.arange(num_rows, device=device), lens
+    )
+    col_ids = torch.arange(row_splits[start], row_splits[end], device=device)
+    col_ids = col_ids - offsets[row_ids]
+
+    padded = torch.full(
+        (num_rows, max_hyps),
+        float("-inf"),
+        dtype=scores.dtype,
+        device=device,
+    )
+    padded[row_ids, col_ids] = scores[row_splits[start] : row_splits[end]]
+    return padded.argmax(dim=1) + offsets
+
+
+def modified_beam_search_vectorized(
+    model: Transducer,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    beam: int = 4,
+    temperature: float = 1.0,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    ngram_lm: Optional[CompiledNgramLm] = None,
+    ngram_lm_scale: float = 0.0,
+    context_graph: Optional[ContextGraph] = None,
+) -> List[List[int]]:
+    """A vectorized version of :func:`modified_beam_search`.
+
+    It produces the same results as :func:`modified_beam_search`, but
+    all hypotheses are kept in tensors instead of Python objects:
+
+      - The top-k of all utterances in the batch is selected with a
+        single call to `torch.topk` on a padded score matrix.
+      - Hypotheses with identical token sequences are detected by
+        comparing rolling hashes of the sequences and merged with
+        `log-sum-exp` in the same order as :class:`HypothesisList` does.
+      - Instead of copying token lists, only the emitted token and
+        a back-pointer to the parent hypothesis are recorded for each
+        frame. The final results are obtained by tracing back the
+        back-pointers.
+
+    If `ngram_lm` is given, it also does shallow fusion with the n-gram LM:
+    the LM state of each hypothesis is kept in an integer tensor and the
+    scaled LM scores of all tokens are added to the log-probs of all
+    hypotheses before the top-k, so the LM affects which tokens survive.
+    The LM is treated as a deterministic backoff LM, see
+    :func:`CompiledNgramLm.get_next_states_and_costs_for_all_labels`.
+
+    If `context_graph` is given, the context state of each hypothesis is
+    kept in an integer tensor in the same way and the context scores are
+    added to the log-probs before the top-k.
+
+    Args:
+      model:
+        The transducer model.
+      encoder_out:
+        Output from the encoder. Its shape is (N, T, C).
+      encoder_out_lens:
+        A 1-D tensor of shape (N,), containing number of valid frames in
+        encoder_out before padding.
+      beam:
+        Number of active paths during the beam search.
+      temperature:
+        Softmax temperature.
+      decoder_cache:
+        If not None, the decoder output is looked up from it instead of
+        running the decoder. See :class:`DecoderOutputCache`.
+      ngram_lm:
+        If not None, an n-gram LM on tokens used for shallow fusion. Its
+        labels are token IDs.
+      ngram_lm_scale:
+        The scale of the n-gram LM scores. Used only if `ngram_lm` is
+        not None.
+      context_graph:
+        If not None, the context graph used for contextual biasing.
+    Returns:
+      Return a list-of-list of token IDs. ans[i] is the decoding results
+      for the i-th utterance.
+    """
+    assert encoder_out.ndim == 3, encoder_out.shape
+    assert encoder_out.size(0) >= 1, encoder_out.size(0)
+
+    packed_encoder_out = torch.nn.utils.rnn.pack_padded_sequence(
+        input=encoder_out,
+        lengths=encoder_out_lens.cpu(),
+        batch_first=True,
+        enforce_sorted=False,
+    )
+
+    blank_id = model.decoder.blank_id
+    unk_id = getattr(model, "unk_id", blank_id)
+    context_size = model.decoder.context_size
+    device = next(model.parameters()).device
+
+    batch_size_list = packed_encoder_out.batch_sizes.tolist()
+    N = encoder_out.size(0)
+    T = len(batch_size_list)
+    assert torch.all(encoder_out_lens > 0), encoder_out_lens
+    assert N == batch_size_list[0], (N, batch_size_list)
+
+    # State of the active hypotheses. Hypotheses of the same utterance
+    # are stored contiguously; row_splits[i] is the index of the first
+    # hypothesis of the i-th utterance (in packed order).
+    row_splits = list(range(N + 1))
+    # The last `context_size` tokens of each hypothesis
+    contexts = torch.full(
+        (N, context_size), blank_id, dtype=torch.int64, device=device
+    )
+    hyp_log_probs = torch.zeros(N, dtype=torch.float32, device=device)
+    if ngram_lm is not None:
+        # LM state of each hypothesis
+        lm_states = torch.full(
+            (N,), ngram_lm.start, dtype=torch.int64, device=device
+        )
+    if context_graph is not None:
+        context_states = torch.full(
+            (N,), context_graph.root, dtype=torch.int64, device=device
+        )
+    # Number of tokens in each hypothesis, including the initial blanks
+    ys_lens = torch.full((N,), context_size, dtype=torch.int64, device=device)
+    hashes = [
+        torch.zeros(N, dtype=torch.int64, device=device) for _ in range(2)
+    ]
+
+    # token_history[t, j] is the token emitted by the j-th hypothesis at
+    # frame t, or -1 if it emitted nothing; parent_history[t, j] is the
+    # index of its parent among the hypotheses at frame t - 1.
+    token_history = torch.empty((T, N * beam), dtype=torch.int64, device=device)
+    parent_history = torch.empty(
+        (T, N * beam), dtype=torch.int64, device=device
+    )
+
+    # best_hyps[i] is the index of the best hypothesis of the i-th utterance
+    # at its last frame
+    best_hyps = torch.empty(N, dtype=torch.int64, device=device)
+
+    encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
+    beam_range = torch.arange(beam, device=device)
+    # Number of tokens per hypothesis to consider at each frame
+    num_tokens = min(beam, model.decoder.vocab_size)
+
+    offset = 0
+    prev_batch_size = N
+    for t, batch_size in enumerate(batch_size_list):
+        start = offset
+        end = offset + batch_size
+        current_encoder_out = encoder_out.data[start:end]
+        current_encoder_out = current_encoder_out.unsqueeze(1).unsqueeze(1)
+        # current_encoder_out's shape is (batch_size, 1, 1, encoder_out_dim)
+        offset = end
+
+        if batch_size < prev_batch_size:
+            scores = hyp_log_probs
+            if context_graph is not None:
+                scores = scores + context_graph.get_final_scores(context_states)
+            scores = scores / ys_lens
+            best_hyps[batch_size:prev_batch_size] = _padded_argmax(
+                scores, row_splits, start=batch_size, end=prev_batch_size
+            )
+            prev_batch_size = batch_size
+
+        num_hyps = row_splits[batch_size]
+        row_splits = row_splits[: batch_size + 1]
+        contexts = contexts[:num_hyps]
+        hyp_log_probs = hyp_log_probs[:num_hyps]
+        ys_lens = ys_lens[:num_hyps]
+        hashes = [h[:num_hyps] for h in hashes]
+        if ngram_lm is not None:
+            lm_states = lm_states[:num_hyps]
+        if context_graph is not None:
+            context_states = context_states[:num_hyps]
+
+        hyps_per_utt = torch.tensor(
+            [row_splits[i + 1] - row_splits[i] for i in range(batch_size)],
+            device=device,
+        )
+        utt_offsets = torch.tensor(row_splits[:-1], device=device)
+        hyp_to_utt = torch.repeat_interleave(
+            torch.arange(batch_size, device=device), hyps_per_utt
+        )
+        hyp_pos = (
+            torch.arange(num_hyps, device=device) - utt_offsets[hyp_to_utt]
+        )
+        max_hyps = max(
+            row_splits[i + 1] - row_splits[i] for i in range(batch_size)
+        )
+
+        decoder_out = compute_decoder_out(
+            model, contexts, decoder_cache
+        ).unsqueeze(1)
+        # decoder_out is of shape (num_hyps, 1, 1, joiner_dim)
+
+        current_encoder_out = torch.index_select(
+            current_encoder_out, dim=0, index=hyp_to_utt
+        )  # (num_hyps, 1, 1, encoder_out_dim)
+
+        # Only the `beam` most probable tokens of each hypothesis can be
+        # among the best `beam` paths of an utterance
+        if ngram_lm is None and context_graph is None:
+            log_probs, hyp_tokens, _ = model.joiner.topk(
+                current_encoder_out.squeeze(1).squeeze(1),
+                decoder_out.squeeze(1).squeeze(1),
+                k=num_tokens,
+                blank_id=blank_id,
+                temperature=temperature,
+            )  # (num_hyps, num_tokens)
+        else:
+            logits = model.joiner(
+                current_encoder_out,
+                decoder_out,
+                project_input=False,
+            )  # (num_hyps, 1, 1, vocab_size)
+            logits = logits.squeeze(1).squeeze(1)  # (num_hyps, vocab_size)
+            log_probs = (logits / temperature).log_softmax(dim=-1)
+
+            if ngram_lm is not None:
+                # Look up each distinct LM state only once
+                unique_lm_states, inverse = torch.unique(
+                    lm_states, return_inverse=True
+                )
+                (
+                    next_lm_states,
+                    lm_costs,
+                ) = ngram_lm.get_next_states_and_costs_for_all_labels(
+                    unique_lm_states.clamp(min=0), num_labels=log_probs.size(1)
+                )
+                next_lm_states = next_lm_states[inverse]
+                lm_scores = (-ngram_lm_scale * lm_costs[inverse]).masked_fill_(
+                    next_lm_states < 0, float("-inf")
+                )
+                # blank and unk do not change the LM state
+                lm_scores[:, blank_id] = 0
+                lm_scores[:, unk_id] = 0
+                # Hypotheses that emitted a token unknown to the LM are dead
+                lm_scores.masked_fill_(
+                    (lm_states < 0).unsqueeze(1), float("-inf")
+                )
+                log_probs.add_(lm_scores)
+
+            if context_graph is not None:
+                next_context_states, context_scores = get_context_scores(
+                    context_graph,
+                    context_states,
+                    num_labels=log_probs.size(1),
+                    blank_id=blank_id,
+                    unk_id=unk_id,
+                )
+                log_probs.add_(context_scores)
+
+            log_probs, hyp_tokens = log_probs.topk(num_tokens, dim=1)
+            if ngram_lm is not None:
+                hyp_next_lm_states = next_lm_states.gather(1, hyp_tokens)
+            if context_graph is not None:
+                hyp_next_context_states = next_context_states.gather(
+                    1, hyp_tokens
+                )
+
+        log_probs.add_(hyp_log_probs.unsqueeze(1))
+        if ngram_lm is not None:
+            # So that the padding entries below are never selected
+            log_probs.clamp_(min=torch.finfo(log_probs.dtype).min)
+
+        padded_log_probs = torch.full(
+            (batch_size, max_hyps, num_tokens),
+            float("-inf"),
+            dtype=log_probs.dtype,
+            device=device,
+        )
+        padded_log_probs[hyp_to_utt, hyp_pos] = log_probs
+
+        topk_log_probs, topk_indexes = padded_log_probs.reshape(
+            batch_size, -1
+        ).topk(beam, dim=1)
+        # Both are of shape (batch_size, beam)
+
+        parents = torch.div(
+            topk_indexes, num_tokens, rounding_mode="floor"
+        ) + utt_offsets.unsqueeze(1)
+        tokens = hyp_tokens[parents, topk_indexes % num_tokens]
+        emitted = (tokens != blank_id) & (tokens != unk_id)
+        if ngram_lm is not None:
+            new_lm_states = torch.where(
+                emitted,
+                hyp_next_lm_states[parents, topk_indexes % num_tokens],
+                lm_states[parents],
+            )
+        if context_graph is not None:
+            new_context_states = hyp_next_context_states[
+                parents, topk_indexes % num_tokens
+            ]
+
+        new_ys_lens = ys_lens[parents] + emitted
+        new_hashes = []
+        for h, multiplier, modulus in zip(
+            hashes, _HASH_MULTIPLIERS, _HASH_MODULI
+        ):
+            h = h[parents]
+            new_hashes.append(
+                torch.where(emitted, (h * multiplier + tokens + 1) % modulus, h)
+            )
+
+        # Find duplicated hypotheses. first[i, k] is the index of the first
+        # hypothesis among topk of the i-th utterance that has the same token
+        # sequence as the k-th one.
+        same = new_ys_lens.unsqueeze(2) == new_ys_lens.unsqueeze(1)
+        for h in new_hashes:
+            same &= h.unsqueeze(2) == h.unsqueeze(1)
+        # same is of shape (batch_size, beam, beam)
+        first = torch.where(same, beam_range.reshape(1, beam, 1), beam).amin(
+            dim=1
+        )
+        is_first = first == beam_range
+
+        if not bool(is_first.all()):
+            # Merge duplicates in the same order as HypothesisList.add()
+            for k in range(1, beam):
+                dup = ~is_first[:, k]
+                if not bool(dup.any()):
+                    continue
+                utt = dup.nonzero().squeeze(1)
+                dst = first[utt, k]
+                topk_log_probs[utt, dst] = torch.logaddexp(
+                    topk_log_probs[utt, dst], topk_log_probs[utt, k]
+                )
+
+        keep = is_first.reshape(-1)
+
+        row_splits = [0] + torch.cumsum(is_first.sum(dim=1), dim=0).tolist()
+        num_new_hyps = row_splits[-1]
+
+        ctx = contexts[parents]  # (batch_size, beam, context_size)
+        shifted = torch.cat([ctx[:, :, 1:], tokens.unsqueeze(2)], dim=2)
+        contexts = torch.where(emitted.unsqueeze(2), shifted, ctx)
+        contexts = contexts.reshape(-1, context_size)[keep]
+
+        hyp_log_probs = topk_log_probs.reshape(-1)[keep]
+        ys_lens = new_ys_lens.reshape(-1)[keep]
+        hashes = [h.reshape(-1)[keep] for h in new_hashes]
+        if ngram_lm is not None:
+            lm_states = new_lm_states.reshape(-1)[keep]
+        if context_graph is not None:
+            context_states = new_context_states.reshape(-1)[keep]
+
+        token_history[t, :num_new_hyps] = torch.where(
+            emitted, tokens, -1
+        ).reshape(-1)[keep]
+        parent_history[t, :num_new_hyps] = parents.reshape(-1)[keep]
+
+    scores = hyp_log_probs
+    if context_graph is not None:
+        scores = scores + context_graph.get_final_scores(context_states)
+    scores = scores / ys_lens
+    best_hyps[:prev_batch_size] = _padded_argmax(
+        scores, row_splits, start=0, end=prev_batch_size
+    )
+
+    # Trace back the best hypothesis of each utterance
+    ys = torch.full((N, T), -1, dtype=torch.int64, device=device)
+    cur = best_hyps
+    for t in range(T - 1, -1, -1):
+        batch_size = batch_size_list[t]
+        index = cur[:batch_size]
+        ys[:batch_size, t] = token_history[t, index]
+        cur[:batch_size] = parent_history[t, index]
+
+    sorted_ans = [[y for y in row if y >= 0] for row in ys.tolist()]
+    ans = []
+    unsorted_indices = packed_encoder_out.unsorted_indices.tolist()
+    for i in range(N):
+        ans.append(sorted_ans[unsorted_indices[i]])
+
+    return ans
+
+
 def _deprecated_modified_beam_search(
     model: Transducer,
     encoder_out: torch.Tensor,
@@ -1376,6 +2288,8 @@ def fast_beam_search_with_nbest_rnn_rescoring(
     use_double_scores: bool = True,
     nbest_scale: float = 0.5,
     temperature: float = 1.0,
+    rnn_lm_prefix_tree: bool = False,
+    rnn_lm_max_tokens: int = 0,
 ) -> Dict[str, List[List[int]]]:
     """It limits the maximum number of symbols per frame to 1.
     A lattice is first obtained using fast beam search, num_path are selected
@@ -1422,6 +2336,12 @@ def fast_beam_search_with_nbest_rnn_rescoring(
         yields more unique paths.
       temperature:
         Softmax temperature.
+      rnn_lm_prefix_tree:
+        True to run the RNN LM once per unique prefix of the paths.
+        See :func:`icefall.decode.compute_rnn_lm_scores`.
+      rnn_lm_max_tokens:
+        If positive, the maximum number of tokens the RNN LM processes
+        at a time.
     Returns:
       Return the decoded result in a dict, where the key has the form
       'ngram_lm_scale_xx' and the value is the decoded results. `xx` is the
@@ -1508,22 +2428,15 @@ def fast_beam_search_with_nbest_rnn_rescoring(
     sos_id = sp.piece_to_id("sos_id")
     eos_id = sp.piece_to_id("eos_id")
 
-    sos_tokens = add_sos(tokens, sos_id)
-    tokens_eos = add_eos(tokens, eos_id)
-    sos_tokens_row_splits = sos_tokens.shape.row_splits(1)
-    sentence_lengths = sos_tokens_row_splits[1:] - sos_tokens_row_splits[:-1]
-
-    x_tokens = sos_tokens.pad(mode="constant", padding_value=blank_id)
-    y_tokens = tokens_eos.pad(mode="constant", padding_value=blank_id)
-
-    x_tokens = x_tokens.to(torch.int64)
-    y_tokens = y_tokens.to(torch.int64)
-    sentence_lengths = sentence_lengths.to(torch.int64)
-
-    rnn_lm_nll = rnn_lm_model(x=x_tokens, y=y_tokens, lengths=sentence_lengths)
-    assert rnn_lm_nll.ndim == 2
-    assert rnn_lm_nll.shape[0] == len(token_list)
-    rnn_lm_scores = -1 * rnn_lm_nll.sum(dim=1)
+    rnn_lm_scores = compute_rnn_lm_scores(
+        rnn_lm_model=rnn_lm_model,
+        token_ids=token_list,
+        sos_id=sos_id,
+        eos_id=eos_id,
+        blank_id=blank_id,
+        prefix_tree=rnn_lm_prefix_tree,
+        max_tokens=rnn_lm_max_tokens,
+    )
 
     ans: Dict[str, List[List[int]]] = {}
     for n_scale in ngram_lm_scale_list:
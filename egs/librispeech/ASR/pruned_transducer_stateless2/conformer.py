@@ -245,6 +245,31 @@ class Conformer(EncoderInterface):
 
         return init_states
 
+    @torch.jit.export
+    def get_init_embed_state(
+        self, x: torch.Tensor, right_context: int
+    ) -> List[torch.Tensor]:
+        """Return the initial cache of encoder_embed, which can be appended
+        to the states of :meth:`streaming_forward` so that the frames
+        shared by consecutive chunks are not subsampled again.
+
+        Args:
+          x:
+            The first frames of the streams, of shape
+            (batch_size, seq_len, feature_dim). It should be the input of
+            the first chunk, see :meth:`Conv2dSubsampling.get_init_state`.
+            Only the first (right_context + 2) * subsampling_factor + 3
+            frames are consumed.
+          right_context:
+            How many future frames the attention can see in current chunk.
+
+        Returns:
+          Return a list of 4 tensors, the first dimension of which is the
+          batch dimension.
+        """
+        num_frames = (right_context + 2) * self.subsampling_factor + 3
+        return self.encoder_embed.get_init_state(x, num_frames)
+
     @torch.jit.export
     def streaming_forward(
         self,
@@ -271,6 +296,12 @@ class Conformer(EncoderInterface):
             a shape of (encoder_layers, left_context, batch, attention_dim),
             the second element is the conv_cache which has a shape of
             (encoder_layers, cnn_module_kernel-1, batch, conv_dim).
+            It may have 4 more elements, the cache of encoder_embed (see
+            :meth:`get_init_embed_state`). In that case, `x` contains only
+            the chunk_size * subsampling_factor frames following the frames
+            of the previous chunk, i.e., without the
+            (right_context + 2) * subsampling_factor + 3 frames that are
+            shared with it, while `x_lens` is the same as without the cache.
             Note: states will be modified in this function.
           processed_lens:
             How many frames (after subsampling) have been processed for each sequence.
@@ -315,7 +346,7 @@ class Conformer(EncoderInterface):
             assert states is not None
             assert processed_lens is not None
             assert (
-                len(states) == 2
+                (len(states) == 2 or len(states) == 6)
                 and states[0].shape
                 == (self.encoder_layers, left_context, x.size(0), self.d_model)
                 and states[1].shape
@@ -325,7 +356,7 @@ class Conformer(EncoderInterface):
                     x.size(0),
                     self.d_model,
                 )
-            ), f"""The length of states MUST be equal to 2, and the shape of
+            ), f"""The length of states MUST be equal to 2 or 6, and the shape of
              first element should be {(self.encoder_layers, left_context, x.size(0), self.d_model)},
              given {states[0].shape}. the shape of second element should be
              {(self.encoder_layers, self.cnn_module_kernel - 1, x.size(0), self.d_model)},
@@ -345,11 +376,20 @@ class Conformer(EncoderInterface):
                 [processed_mask, src_key_padding_mask], dim=1
             )
 
-            embed = self.encoder_embed(x)
+            embed_states: List[Tensor] = []
+            if len(states) == 6:
+                embed, embed_states = self.encoder_embed.streaming_forward(
+                    x, states[2:]
+                )
+                # Keep the same number of frames as without the cache
+                embed = embed[:, : int(lengths.max())]
+            else:
+                embed = self.encoder_embed(x)
 
-            # cut off 1 frame on each size of embed as they see the padding
-            # value which causes a training and decoding mismatch.
-            embed = embed[:, 1:-1, :]
+                # cut off 1 frame on each size of embed as they see the
+                # padding value which causes a training and decoding
+                # mismatch.
+                embed = embed[:, 1:-1, :]
 
             embed, pos_enc = self.encoder_pos(embed, left_context)
             embed = embed.permute(1, 0, 2)  # (B, T, F) -> (T, B, F)
@@ -359,10 +399,11 @@ class Conformer(EncoderInterface):
                 pos_enc,
                 src_key_padding_mask=src_key_padding_mask,
                 warmup=warmup,
-                states=states,
+                states=states[:2],
                 left_context=left_context,
                 right_context=right_context,
             )  # (T, B, F)
+            states = states + embed_states
             if right_context > 0:
                 x = x[0:-right_context, ...]
                 lengths -= right_context
@@ -1619,6 +1660,132 @@ class Conv2dSubsampling(nn.Module):
         x = self.out_balancer(x)
         return x
 
+    @torch.jit.export
+    def get_init_state(
+        self, x: torch.Tensor, num_frames: int
+    ) -> List[torch.Tensor]:
+        """Return the initial cache of a stream for :meth:`streaming_forward`.
+
+        Args:
+          x:
+            The first T frames of the stream, of shape (N, T, idim), where
+            T >= num_frames. Only the first `num_frames` frames are
+            consumed. The other frames, e.g., those of the first chunk, are
+            only fed to the convolutions together with them, so that the
+            convolutions run on inputs of the same size as in
+            :meth:`forward` of a chunk. PyTorch may select another algorithm
+            for a much smaller input, which does not give bitwise identical
+            results.
+          num_frames:
+            The number of frames to consume. It requires num_frames % 4 == 3
+            and num_frames >= 11.
+
+        Returns:
+          Return the cache, a list of 4 tensors. The first 3 tensors are
+          the last 2 time steps of the input of each convolution and the
+          last one is the output of the convolutions for the last
+          (num_frames - 11) // 4 output frames, which are returned again by
+          the first call of :meth:`streaming_forward`.
+        """
+        assert num_frames % 4 == 3 and num_frames >= 11, num_frames
+        assert x.size(1) >= num_frames, (x.size(1), num_frames)
+
+        # (N, T, idim) -> (N, 1, T, idim) i.e., (N, C, H, W)
+        x = x.unsqueeze(1)
+        # The outputs of forward() for the first 3 frames are discarded
+        x = x[:, :, 3:]
+        # Number of consumed time steps of the input of each convolution
+        n = num_frames - 3
+        states = [x[:, :, n - 2 : n]]  # noqa
+        # Only the outputs of the first convolution that do not see its
+        # padding in the time axis are kept
+        x = self.conv[0](x)[:, :, 1:-1]
+        x = self.conv[2](self.conv[1](x))
+
+        n -= 2
+        states.append(x[:, :, n - 2 : n])  # noqa
+        x = self.conv[5](self.conv[4](self.conv[3](x)))
+
+        n = n // 2 - 1
+        states.append(x[:, :, n - 2 : n])  # noqa
+        n = n // 2 - 1
+        if x.size(2) < 3:
+            # No output frames without right context
+            x = x.new_zeros(
+                x.size(0),
+                self.conv[6].out_channels,
+                0,
+                (x.size(3) - 1) // 2,
+            )
+        else:
+            x = self.conv[8](self.conv[7](self.conv[6](x)))
+        states.append(x[:, :, :n])
+        return states
+
+    @torch.jit.export
+    def streaming_forward(
+        self, x: torch.Tensor, states: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """Subsample the frames of a stream chunk by chunk.
+
+        The time steps that the convolutions still need are kept in
+        `states`, so each input frame is fed to the convolutions only once.
+        The output for the whole stream is the same as that of
+        :meth:`forward` with its first and last frames removed, as these two
+        frames see the zero padding of the first convolution.
+
+        Like the chunks of the streaming encoder, each call returns again
+        the last R output frames of the previous call, where R is the
+        number of output frames cached by :meth:`get_init_state`. The
+        outputs of the convolutions for these frames are cached and
+        self.out is applied to all returned frames, so that it runs on
+        about the same number of frames as in :meth:`forward` of a chunk.
+
+        Args:
+          x:
+            Its shape is (N, T, idim). It contains the T frames following
+            those of the previous call, or those consumed by
+            :meth:`get_init_state`. It requires T % 4 == 0.
+          states:
+            The cache returned by :meth:`get_init_state` or by the previous
+            call.
+
+        Returns:
+          Return a tuple containing:
+            - A tensor of shape (N, R + T // 4, odim).
+            - The updated cache.
+        """
+        assert len(states) == 4, len(states)
+        assert x.size(1) % 4 == 0, x.size(1)
+        right_context = states[3].size(2)
+
+        # (N, T, idim) -> (N, 1, T, idim) i.e., (N, C, H, W)
+        x = x.unsqueeze(1)
+        x = torch.cat([states[0], x], dim=2)
+        new_states = [x[:, :, -2:]]
+        x = self.conv[0](x)[:, :, 1:-1]
+        x = self.conv[2](self.conv[1](x))
+
+        x = torch.cat([states[1], x], dim=2)
+        # The convolution has a kernel size of 3 and a stride of 2 and its
+        # input has an even number of time steps, so the last 2 of them
+        # are not consumed yet
+        new_states.append(x[:, :, -2:])
+        x = self.conv[5](self.conv[4](self.conv[3](x)))
+
+        x = torch.cat([states[2], x], dim=2)
+        new_states.append(x[:, :, -2:])
+        x = self.conv[8](self.conv[7](self.conv[6](x)))
+
+        x = torch.cat([states[3], x], dim=2)
+        new_states.append(x[:, :, x.size(2) - right_context :])  # noqa
+
+        b, c, t, f = x.size()
+        x = self.out(x.transpose(1, 2).contiguous().view(b, t, c * f))
+        x = self.out_norm(x)
+        x = self.out_balancer(x)
+        return x, new_states
+
 
 if __name__ == "__main__":
     feature_dim = 50
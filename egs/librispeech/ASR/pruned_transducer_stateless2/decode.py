@@ -105,12 +105,46 @@ Usage:
     --beam 20.0 \
     --max-contexts 8 \
     --max-states 64
+
+(9) skip blank frames before decoding (take greedy search as an example)
+./pruned_transducer_stateless2/decode.py \
+    --epoch 28 \
+    --avg 15 \
+    --exp-dir ./pruned_transducer_stateless2/exp \
+    --max-duration 600 \
+    --decoding-method greedy_search \
+    --blank-skip-threshold 0.95 \
+    --blank-skip-method joiner
+
+(10) boost a list of phrases (take modified beam search as an example)
+./pruned_transducer_stateless2/decode.py \
+    --epoch 28 \
+    --avg 15 \
+    --exp-dir ./pruned_transducer_stateless2/exp \
+    --max-duration 600 \
+    --decoding-method modified_beam_search \
+    --beam-size 4 \
+    --context-file ./contexts.txt \
+    --context-score 2.0
+
+(11) sort the cuts by length and overlap the encoder with the search
+./pruned_transducer_stateless2/decode.py \
+    --epoch 28 \
+    --avg 15 \
+    --exp-dir ./pruned_transducer_stateless2/exp \
+    --max-duration 600 \
+    --decoding-method modified_beam_search \
+    --beam-size 4 \
+    --bucket-by-cost 1 \
+    --max-batch-seconds 2.0 \
+    --pipeline-decode 1
 """
 
 
 import argparse
 import logging
 import math
+import time
 from collections import defaultdict
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
@@ -121,6 +155,8 @@ import torch
 import torch.nn as nn
 from asr_datamodule import LibriSpeechAsrDataModule
 from beam_search import (
+    BlankFrameSkipper,
+    DecoderOutputCache,
     beam_search,
     fast_beam_search_nbest,
     fast_beam_search_nbest_LG,
@@ -129,6 +165,7 @@ from beam_search import (
     greedy_search,
     greedy_search_batch,
     modified_beam_search,
+    modified_beam_search_vectorized,
 )
 from train import add_model_arguments, get_params, get_transducer_model
 
@@ -137,6 +174,12 @@ from icefall.checkpoint import (
     find_checkpoints,
     load_checkpoint,
 )
+from icefall.context_graph import ContextGraph, get_context_graph
+from icefall.decode_pipeline import (
+    CostBucketingSampler,
+    DecodeCostModel,
+    PipelinedDecoder,
+)
 from icefall.lexicon import Lexicon
 from icefall.utils import (
     AttributeDict,
@@ -189,6 +232,16 @@ def get_parser():
         help="The experiment dir",
     )
 
+    parser.add_argument(
+        "--avg-cache-dir",
+        type=str,
+        default=None,
+        help="""If not None, the averaged model is cached in this directory
+        and reused when decoding again with the same checkpoints.
+        It is recomputed if any of the checkpoints is modified.
+        """,
+    )
+
     parser.add_argument(
         "--bpe-model",
         type=str,
@@ -229,6 +282,101 @@ def get_parser():
         modified_beam_search.""",
     )
 
+    parser.add_argument(
+        "--vectorized-beam-search",
+        type=str2bool,
+        default=False,
+        help="""Used only when --decoding-method is modified_beam_search.
+        If True, use modified_beam_search_vectorized(), which keeps all
+        hypotheses in tensors. It produces the same results as
+        modified_beam_search() but runs faster for large beam sizes.""",
+    )
+
+    parser.add_argument(
+        "--decoder-cache-size",
+        type=int,
+        default=0,
+        help="""If positive, cache at most this number of decoder outputs,
+        indexed by the decoder context. Used only when --decoding-method is
+        greedy_search or modified_beam_search. 0 disables the cache.""",
+    )
+
+    parser.add_argument(
+        "--precompute-decoder-cache",
+        type=str2bool,
+        default=False,
+        help="""If True, precompute the decoder outputs for all possible
+        contexts, i.e., vocab_size**context_size of them. Use it only for
+        small vocabularies. Used only when --decoding-method is greedy_search
+        or modified_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--blank-skip-threshold",
+        type=float,
+        default=0.0,
+        help="""If positive, encoder frames whose blank probability is larger
+        than this value, e.g., 0.95, are removed before decoding. Used only
+        when --decoding-method is greedy_search with --max-sym-per-frame=1,
+        modified_beam_search or fast_beam_search*. 0 disables it.""",
+    )
+
+    parser.add_argument(
+        "--blank-skip-method",
+        type=str,
+        default="joiner",
+        choices=["joiner", "simple"],
+        help="""How to compute the blank probability used by
+        --blank-skip-threshold. joiner: use the joiner with the initial
+        decoder context. simple: use the simple_am_proj and simple_lm_proj
+        layers, which are cheaper but less accurate.""",
+    )
+
+    parser.add_argument(
+        "--bucket-by-cost",
+        type=str2bool,
+        default=False,
+        help="""If True, sort the cuts by length and form batches of cuts
+        with similar lengths. The padded duration of a batch is limited by
+        --max-duration and its decoding time, estimated from the previous
+        batches, is limited by --max-batch-seconds.""",
+    )
+
+    parser.add_argument(
+        "--max-batch-seconds",
+        type=float,
+        default=0.0,
+        help="""Maximum estimated decoding time of a batch in seconds.
+        Used only when --bucket-by-cost is True. 0 means no limit.""",
+    )
+
+    parser.add_argument(
+        "--pipeline-decode",
+        type=str2bool,
+        default=False,
+        help="""If True, load the features and run the encoder of the next
+        batches in background threads while the current batch is searched.""",
+    )
+
+    parser.add_argument(
+        "--context-file",
+        type=str,
+        default="",
+        help="""If not empty, a text file containing one phrase per line.
+        The phrases are boosted during decoding. Used only when
+        --decoding-method is modified_beam_search, fast_beam_search or
+        fast_beam_search_nbest.""",
+    )
+
+    parser.add_argument(
+        "--context-score",
+        type=float,
+        default=2.0,
+        help="""The bonus of each token of a phrase from --context-file.
+        The bonus of a partially matched phrase is taken back if the match
+        fails.""",
+    )
+
     parser.add_argument(
         "--beam",
         type=float,
@@ -331,44 +479,25 @@ def get_parser():
     return parser
 
 
-def decode_one_batch(
+def encode_one_batch(
     params: AttributeDict,
     model: nn.Module,
-    sp: spm.SentencePieceProcessor,
     batch: dict,
-    word_table: Optional[k2.SymbolTable] = None,
-    decoding_graph: Optional[k2.Fsa] = None,
-) -> Dict[str, List[List[str]]]:
-    """Decode one batch and return the result in a dict. The dict has the
-    following format:
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Run the encoder on one batch.
 
-        - key: It indicates the setting used for decoding. For example,
-               if greedy_search is used, it would be "greedy_search"
-               If beam search with a beam size of 7 is used, it would be
-               "beam_7"
-        - value: It contains the decoding result. `len(value)` equals to
-                 batch size. `value[i]` is the decoding result for the i-th
-                 utterance in the given batch.
     Args:
       params:
         It's the return value of :func:`get_params`.
       model:
         The neural model.
-      sp:
-        The BPE model.
       batch:
         It is the return value from iterating
         `lhotse.dataset.K2SpeechRecognitionDataset`. See its documentation
         for the format of the `batch`.
-      word_table:
-        The word symbol table.
-      decoding_graph:
-        The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
-        only when --decoding_method is fast_beam_search, fast_beam_search_nbest,
-        fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
     Returns:
-      Return the decoding result. See above description for the format of
-      the returned dict.
+      Return a tuple containing the encoder output of shape (N, T, C) and
+      its lengths of shape (N,).
     """
     device = model.device
     feature = batch["inputs"]
@@ -399,6 +528,81 @@ def decode_one_batch(
         encoder_out, encoder_out_lens = model.encoder(
             x=feature, x_lens=feature_lens
         )
+    return encoder_out, encoder_out_lens
+
+
+def decode_one_batch(
+    params: AttributeDict,
+    model: nn.Module,
+    sp: spm.SentencePieceProcessor,
+    batch: dict,
+    word_table: Optional[k2.SymbolTable] = None,
+    decoding_graph: Optional[k2.Fsa] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    blank_skipper: Optional[BlankFrameSkipper] = None,
+    context_graph: Optional[ContextGraph] = None,
+    encoder_out: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+) -> Dict[str, List[List[str]]]:
+    """Decode one batch and return the result in a dict. The dict has the
+    following format:
+
+        - key: It indicates the setting used for decoding. For example,
+               if greedy_search is used, it would be "greedy_search"
+               If beam search with a beam size of 7 is used, it would be
+               "beam_7"
+        - value: It contains the decoding result. `len(value)` equals to
+                 batch size. `value[i]` is the decoding result for the i-th
+                 utterance in the given batch.
+    Args:
+      params:
+        It's the return value of :func:`get_params`.
+      model:
+        The neural model.
+      sp:
+        The BPE model.
+      batch:
+        It is the return value from iterating
+        `lhotse.dataset.K2SpeechRecognitionDataset`. See its documentation
+        for the format of the `batch`.
+      word_table:
+        The word symbol table.
+      decoding_graph:
+        The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
+        only when --decoding_method is fast_beam_search, fast_beam_search_nbest,
+        fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
+      decoder_cache:
+        If not None, it is used to look up the decoder output. Used only
+        when --decoding_method is greedy_search or modified_beam_search.
+      blank_skipper:
+        If not None, it is used to remove blank frames from the encoder
+        output before decoding. Used only when --decoding_method is
+        greedy_search, modified_beam_search or fast_beam_search*.
+      context_graph:
+        If not None, the phrases in it are boosted. Used only when
+        --decoding_method is modified_beam_search. For fast_beam_search*,
+        it is compiled into `decoding_graph` instead.
+      encoder_out:
+        If not None, the return value of :func:`encode_one_batch` for this
+        batch. Otherwise, the encoder is run here.
+    Returns:
+      Return the decoding result. See above description for the format of
+      the returned dict.
+    """
+    if encoder_out is None:
+        encoder_out = encode_one_batch(params=params, model=model, batch=batch)
+    encoder_out, encoder_out_lens = encoder_out
+
+    if blank_skipper is not None and (
+        "fast_beam_search" in params.decoding_method
+        or params.decoding_method == "modified_beam_search"
+        or (
+            params.decoding_method == "greedy_search"
+            and params.max_sym_per_frame == 1
+        )
+    ):
+        encoder_out, encoder_out_lens = blank_skipper(
+            encoder_out, encoder_out_lens
+        )
 
     hyps = []
 
@@ -452,7 +656,7 @@ def decode_one_batch(
             max_contexts=params.max_contexts,
             max_states=params.max_states,
             num_paths=params.num_paths,
-            ref_texts=sp.encode(supervisions["text"]),
+            ref_texts=sp.encode(batch["supervisions"]["text"]),
             nbest_scale=params.nbest_scale,
         )
         for hyp in sp.decode(hyp_tokens):
@@ -465,15 +669,22 @@ def decode_one_batch(
             model=model,
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
+            decoder_cache=decoder_cache,
         )
         for hyp in sp.decode(hyp_tokens):
             hyps.append(hyp.split())
     elif params.decoding_method == "modified_beam_search":
-        hyp_tokens = modified_beam_search(
+        if params.vectorized_beam_search:
+            search = modified_beam_search_vectorized
+        else:
+            search = modified_beam_search
+        hyp_tokens = search(
             model=model,
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
             beam=params.beam_size,
+            decoder_cache=decoder_cache,
+            context_graph=context_graph,
         )
         for hyp in sp.decode(hyp_tokens):
             hyps.append(hyp.split())
@@ -534,6 +745,10 @@ def decode_dataset(
     sp: spm.SentencePieceProcessor,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    blank_skipper: Optional[BlankFrameSkipper] = None,
+    context_graph: Optional[ContextGraph] = None,
+    cost_model: Optional[DecodeCostModel] = None,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
 
@@ -552,6 +767,18 @@ def decode_dataset(
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding_method is fast_beam_search, fast_beam_search_nbest,
         fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
+      decoder_cache:
+        If not None, it is used to look up the decoder output. Used only
+        when --decoding_method is greedy_search or modified_beam_search.
+      blank_skipper:
+        If not None, it is used to remove blank frames from the encoder
+        output before decoding.
+      context_graph:
+        If not None, the phrases in it are boosted. Used only when
+        --decoding_method is modified_beam_search.
+      cost_model:
+        If not None, the time spent on the encoder and on the search of
+        each batch is added to it.
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
       is used, or it may be "beam_7" if beam size of 7 is used.
@@ -571,11 +798,25 @@ def decode_dataset(
     else:
         log_interval = 20
 
+    def encode(batch):
+        return encode_one_batch(params=params, model=model, batch=batch)
+
+    if params.pipeline_decode:
+        batches = PipelinedDecoder(dl, encode=encode, cost_model=cost_model)
+    else:
+        batches = ((batch, None) for batch in dl)
+
     results = defaultdict(list)
-    for batch_idx, batch in enumerate(dl):
+    for batch_idx, (batch, encoder_out) in enumerate(batches):
         texts = batch["supervisions"]["text"]
         cut_ids = [cut.id for cut in batch["supervisions"]["cut"]]
 
+        if encoder_out is None:
+            start = time.time()
+            encoder_out = encode(batch)
+            encoder_seconds = time.time() - start
+
+        start = time.time()
         hyps_dict = decode_one_batch(
             params=params,
             model=model,
@@ -583,8 +824,22 @@ def decode_dataset(
             word_table=word_table,
             decoding_graph=decoding_graph,
             batch=batch,
+            decoder_cache=decoder_cache,
+            blank_skipper=blank_skipper,
+            context_graph=context_graph,
+            encoder_out=encoder_out,
         )
 
+        if cost_model is not None and not params.pipeline_decode:
+            # PipelinedDecoder updates the cost model by itself
+            num_cuts, max_frames = batch["inputs"].shape[:2]
+            cost_model.update(
+                num_cuts=num_cuts,
+                max_frames=max_frames,
+                encoder_seconds=encoder_seconds,
+                search_seconds=time.time() - start,
+            )
+
         for name, hyps in hyps_dict.items():
             this_batch = []
             assert len(hyps) == len(texts)
@@ -697,6 +952,18 @@ def main():
         params.suffix += f"-context-{params.context_size}"
         params.suffix += f"-max-sym-per-frame-{params.max_sym_per_frame}"
 
+    if params.blank_skip_threshold > 0:
+        params.suffix += f"-blank-skip-{params.blank_skip_method}"
+        params.suffix += f"-{params.blank_skip_threshold}"
+
+    if params.context_file:
+        assert params.decoding_method in (
+            "modified_beam_search",
+            "fast_beam_search",
+            "fast_beam_search_nbest",
+        ), params.decoding_method
+        params.suffix += f"-context-score-{params.context_score}"
+
     setup_logger(f"{params.res_dir}/log-decode-{params.suffix}")
     logging.info("Decoding started")
 
@@ -740,7 +1007,11 @@ def main():
             )
         logging.info(f"averaging {filenames}")
         model.to(device)
-        model.load_state_dict(average_checkpoints(filenames, device=device))
+        model.load_state_dict(
+            average_checkpoints(
+                filenames, device=device, cache_dir=params.avg_cache_dir
+            )
+        )
     elif params.avg == 1:
         load_checkpoint(f"{params.exp_dir}/epoch-{params.epoch}.pt", model)
     else:
@@ -751,12 +1022,27 @@ def main():
                 filenames.append(f"{params.exp_dir}/epoch-{i}.pt")
         logging.info(f"averaging {filenames}")
         model.to(device)
-        model.load_state_dict(average_checkpoints(filenames, device=device))
+        model.load_state_dict(
+            average_checkpoints(
+                filenames, device=device, cache_dir=params.avg_cache_dir
+            )
+        )
 
     model.to(device)
     model.eval()
     model.device = device
 
+    context_graph = None
+    if params.context_file:
+        with open(params.context_file, encoding="utf-8") as f:
+            phrases = [line.strip() for line in f if line.strip()]
+        logging.info(
+            f"Loaded {len(phrases)} phrases from {params.context_file}"
+        )
+        context_graph = get_context_graph(
+            sp.encode(phrases), context_score=params.context_score
+        )
+
     if "fast_beam_search" in params.decoding_method:
         if params.decoding_method == "fast_beam_search_nbest_LG":
             lexicon = Lexicon(params.lang_dir)
@@ -767,6 +1053,11 @@ def main():
                 torch.load(lg_filename, map_location=device)
             )
             decoding_graph.scores *= params.ngram_lm_scale
+        elif context_graph is not None:
+            word_table = None
+            decoding_graph = context_graph.to_fsa(params.vocab_size).to(device)
+            # The phrases are boosted by the decoding graph instead
+            context_graph = None
         else:
             word_table = None
             decoding_graph = k2.trivial_graph(
@@ -776,6 +1067,14 @@ def main():
         decoding_graph = None
         word_table = None
 
+    decoder_cache = None
+    if params.decoder_cache_size > 0 or params.precompute_decoder_cache:
+        decoder_cache = DecoderOutputCache(
+            model,
+            max_size=max(params.decoder_cache_size, 1),
+            precompute=params.precompute_decoder_cache,
+        )
+
     num_param = sum([p.numel() for p in model.parameters()])
     logging.info(f"Number of model parameters: {num_param}")
 
@@ -790,9 +1089,35 @@ def main():
     test_other_dl = librispeech.test_dataloaders(test_other_cuts)
 
     test_sets = ["test-clean", "test-other"]
+    test_cuts = [test_clean_cuts, test_other_cuts]
     test_dl = [test_clean_dl, test_other_dl]
 
-    for test_set, test_dl in zip(test_sets, test_dl):
+    for test_set, test_cut, test_dl in zip(test_sets, test_cuts, test_dl):
+        cost_model = None
+        if params.bucket_by_cost:
+            cost_model = DecodeCostModel()
+            sampler = CostBucketingSampler(
+                test_cut,
+                max_duration=params.max_duration,
+                cost_model=cost_model,
+                max_batch_seconds=params.max_batch_seconds,
+            )
+            # The dataset of test_dl computes the features
+            test_dl = torch.utils.data.DataLoader(
+                test_dl.dataset,
+                batch_size=None,
+                sampler=sampler,
+                num_workers=test_dl.num_workers,
+            )
+
+        blank_skipper = None
+        if params.blank_skip_threshold > 0:
+            blank_skipper = BlankFrameSkipper(
+                model,
+                blank_threshold=params.blank_skip_threshold,
+                method=params.blank_skip_method,
+            )
+
         results_dict = decode_dataset(
             dl=test_dl,
             params=params,
@@ -800,6 +1125,10 @@ def main():
             sp=sp,
             word_table=word_table,
             decoding_graph=decoding_graph,
+            decoder_cache=decoder_cache,
+            blank_skipper=blank_skipper,
+            context_graph=context_graph,
+            cost_model=cost_model,
         )
 
         save_results(
@@ -808,6 +1137,16 @@ def main():
             results_dict=results_dict,
         )
 
+        if blank_skipper is not None:
+            logging.info(
+                f"{test_set}: skipped {blank_skipper.num_skipped_frames} of "
+                f"{blank_skipper.num_frames} frames "
+                f"(skip rate: {blank_skipper.skip_rate:.3f})"
+            )
+
+    if decoder_cache is not None:
+        logging.info(f"Decoder cache hit rate: {decoder_cache.hit_rate:.3f}")
+
     logging.info("Done!")
 
 
@@ -14,6 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import Optional, Tuple
+
 import torch
 import torch.nn as nn
 from scaling import ScaledLinear
@@ -21,6 +23,32 @@ from scaling import ScaledLinear
 from icefall.utils import is_jit_tracing
 
 
+@torch.jit.script
+def _output_topk(
+    x: torch.Tensor,
+    weight: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    k: int,
+    blank_id: int,
+    temperature: float,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # Top-k of the log-softmax output is the same as top-k of the logits,
+    # so only the normalizer and k values per row are needed, instead of
+    # a second (N, vocab_size) tensor for the log-softmax output.
+    x = torch.tanh(x)
+    if bias is None:
+        logits = torch.mm(x, weight.t())
+    else:
+        logits = torch.addmm(bias, x, weight.t())
+    if temperature != 1.0:
+        logits = logits / temperature
+    normalizer = torch.logsumexp(logits, dim=1)
+    values, indexes = logits.topk(k, dim=1)
+    values = values - normalizer.unsqueeze(1)
+    blank_log_probs = logits[:, blank_id] - normalizer
+    return values, indexes, blank_log_probs
+
+
 class Joiner(nn.Module):
     def __init__(
         self,
@@ -69,3 +97,67 @@ class Joiner(nn.Module):
         logit = self.output_linear(torch.tanh(logit))
 
         return logit
+
+    def _get_output_weight_and_bias(
+        self,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Return the weight and bias of `self.output_linear` with their
+        scales applied. They are cached until the parameters are changed.
+        """
+        params = list(self.output_linear.parameters())
+        version = tuple((p.data_ptr(), p._version) for p in params)
+        cache = getattr(self, "_output_cache", None)
+        if cache is None or cache[0] != version:
+            with torch.no_grad():
+                weight = self.output_linear.get_weight()
+                bias = self.output_linear.get_bias()
+            cache = (version, weight, bias)
+            self._output_cache = cache
+        return cache[1], cache[2]
+
+    @torch.no_grad()
+    def topk(
+        self,
+        encoder_out: torch.Tensor,
+        decoder_out: torch.Tensor,
+        k: int,
+        blank_id: int = 0,
+        temperature: float = 1.0,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """An inference-only version of `forward(..., project_input=False)`,
+        followed by `log_softmax` and `topk`. It does not return the full
+        output of shape (N, vocab_size), so it is cheaper for large
+        vocabularies.
+
+        Args:
+          encoder_out:
+            Output from `self.encoder_proj`. Its shape is (N, C).
+          decoder_out:
+            Output from `self.decoder_proj`. Its shape is (N, C).
+          k:
+            Number of tokens to return for each row. It should not be larger
+            than vocab_size.
+          blank_id:
+            ID of the blank token.
+          temperature:
+            Softmax temperature.
+        Returns:
+          Return a tuple containing:
+            - topk_log_probs, a tensor of shape (N, k), containing the k
+              largest log-probs of each row, in descending order.
+            - topk_indexes, a tensor of shape (N, k), containing the token
+              IDs of topk_log_probs.
+            - blank_log_probs, a tensor of shape (N,), containing the
+              log-prob of blank of each row.
+        """
+        assert encoder_out.ndim == decoder_out.ndim == 2
+        assert encoder_out.shape == decoder_out.shape
+        weight, bias = self._get_output_weight_and_bias()
+        return _output_topk(
+            encoder_out + decoder_out,
+            weight,
+            bias,
+            k,
+            blank_id,
+            temperature,
+        )
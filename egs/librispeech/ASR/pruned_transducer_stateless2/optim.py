@@ -47,6 +47,12 @@ class Eve(Optimizer):
             is conditional on RMS-value of parameter being > target_rms.
         target_rms (float, optional): target root-mean-square value of
            parameters, if they fall below this we will stop applying weight decay.
+        foreach (bool, optional): if True, use the multi-tensor implementation,
+           which updates all parameters of the same device, dtype and step
+           count with a few torch._foreach_* calls instead of a Python loop
+           over the parameters, and does not read the parameter norms back
+           to the host.  The results are the same as those of the loop.
+           (default: False)
 
 
     .. _Adam\: A Method for Stochastic Optimization:
@@ -65,6 +71,7 @@ class Eve(Optimizer):
         eps=1e-8,
         weight_decay=1e-3,
         target_rms=0.1,
+        foreach=False,
     ):
 
         if not 0.0 <= lr:
@@ -93,6 +100,9 @@ class Eve(Optimizer):
             target_rms=target_rms,
         )
         super(Eve, self).__init__(params, defaults)
+        # Not a group option, so that it is not overwritten when
+        # loading the state dict of an optimizer created without it
+        self.foreach = foreach
 
     def __setstate__(self, state):
         super(Eve, self).__setstate__(state)
@@ -111,6 +121,10 @@ class Eve(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
+            if self.foreach:
+                self._multi_tensor_step(group)
+                continue
+
             for p in group["params"]:
                 if p.grad is None:
                     continue
@@ -170,6 +184,76 @@ class Eve(Optimizer):
 
         return loss
 
+    def _multi_tensor_step(self, group: dict) -> None:
+        """The same as the loop in :meth:`step`, but using torch._foreach_*
+        operations on the parameters that have the same device, dtype and
+        step count."""
+        beta1, beta2 = group["betas"]
+        target_rms = group["target_rms"]
+        weight_decay = group["weight_decay"]
+
+        buckets = {}
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError("AdamW does not support sparse gradients")
+
+            state = self.state[p]
+            if len(state) == 0:
+                state["step"] = 0
+                state["exp_avg"] = torch.zeros_like(
+                    p, memory_format=torch.preserve_format
+                )
+                state["exp_avg_sq"] = torch.zeros_like(
+                    p, memory_format=torch.preserve_format
+                )
+            state["step"] += 1
+
+            key = (p.device, p.dtype, state["step"])
+            buckets.setdefault(key, []).append(p)
+
+        for (_, _, step), params in buckets.items():
+            grads = [p.grad for p in params]
+            exp_avgs = [self.state[p]["exp_avg"] for p in params]
+            exp_avg_sqs = [self.state[p]["exp_avg_sq"] for p in params]
+
+            bias_correction1 = 1 - beta1 ** step
+            bias_correction2 = 1 - beta2 ** step
+
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+            denoms = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_mul_(denoms, bias_correction2 ** -0.5)
+            torch._foreach_add_(denoms, group["eps"])
+
+            step_size = group["lr"] / bias_correction1
+
+            # avoid applying the weight-decay on "scaling factors"
+            # (which are scalar).
+            matrices = [p for p in params if p.numel() > 1]
+            if len(matrices) > 0:
+                norms = torch.stack(torch._foreach_norm(matrices))
+                thresholds = torch.tensor(
+                    [target_rms * (p.numel() ** 0.5) for p in matrices],
+                    dtype=norms.dtype,
+                    device=norms.device,
+                )
+                is_above_target_rms = norms > thresholds
+                # The factors stay on the device, so there is no
+                # synchronization with it
+                factors = 1 - (weight_decay * is_above_target_rms)
+                torch._foreach_mul_(matrices, factors.unbind(0))
+
+            torch._foreach_addcdiv_(params, exp_avgs, denoms, -step_size)
+
+            # Constrain the range of scalar weights
+            for p in params:
+                if p.numel() == 1:
+                    p.clamp_(min=-10, max=2)
+
 
 class LRScheduler(object):
     """
@@ -331,5 +415,42 @@ def _test_eden():
     print("state dict = ", scheduler.state_dict())
 
 
+def _bench_eve(num_steps: int = 50):
+    """Compare the time of a step of Eve with and without foreach on
+    parameters with the shapes of a 12-layer conformer."""
+    import time
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    shapes = []
+    for _ in range(12):
+        shapes += [(512, 512)] * 4 + [(2048, 512), (512, 2048)] * 2
+        shapes += [(512,)] * 12 + [(1024, 512), (512, 1, 31), (1,)] + [()] * 8
+
+    for foreach in (False, True):
+        torch.manual_seed(0)
+        params = [
+            torch.nn.Parameter(torch.randn(s, device=device) * 0.1)
+            for s in shapes
+        ]
+        for p in params:
+            p.grad = torch.randn_like(p)
+        optim = Eve(params, lr=0.003, foreach=foreach)
+
+        for i in range(num_steps + 5):
+            if i == 5:
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start = time.time()
+            optim.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        elapsed = (time.time() - start) / num_steps
+        print(
+            f"{len(params)} params on {device}, foreach={foreach}: "
+            f"{elapsed * 1000:.2f} ms per step"
+        )
+
+
 if __name__ == "__main__":
     _test_eden()
+    _bench_eve()
@@ -15,14 +15,23 @@
 # limitations under the License.
 
 import warnings
-from typing import List
+from typing import List, Optional
 
 import k2
 import torch
 import torch.nn as nn
-from beam_search import Hypothesis, HypothesisList, get_hyps_shape
+from beam_search import (
+    DecoderOutputCache,
+    Hypothesis,
+    HypothesisList,
+    compute_decoder_out,
+    finalize_context_scores,
+    get_context_scores,
+    get_hyps_shape,
+)
 from decode_stream import DecodeStream
 
+from icefall.context_graph import ContextGraph
 from icefall.decode import one_best_decoding
 from icefall.utils import get_texts
 
@@ -31,6 +40,7 @@ def greedy_search(
     model: nn.Module,
     encoder_out: torch.Tensor,
     streams: List[DecodeStream],
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> None:
     """Greedy search in batch mode. It hardcodes --max-sym-per-frame=1.
 
@@ -41,6 +51,9 @@ def greedy_search(
         Output from the encoder. Its shape is (N, T, C), where N >= 1.
       streams:
         A list of Stream objects.
+      decoder_cache:
+        If not None, the decoder output is looked up from it instead of
+        running the decoder. See :class:`DecoderOutputCache`.
     """
     assert len(streams) == encoder_out.size(0)
     assert encoder_out.ndim == 3
@@ -56,28 +69,28 @@ def greedy_search(
         dtype=torch.int64,
     )
     # decoder_out is of shape (N, 1, decoder_out_dim)
-    decoder_out = model.decoder(decoder_input, need_pad=False)
-    decoder_out = model.joiner.decoder_proj(decoder_out)
+    decoder_out = compute_decoder_out(model, decoder_input, decoder_cache)
 
     for t in range(T):
         # current_encoder_out's shape: (batch_size, 1, encoder_out_dim)
         current_encoder_out = encoder_out[:, t : t + 1, :]  # noqa
 
-        logits = model.joiner(
-            current_encoder_out.unsqueeze(2),
-            decoder_out.unsqueeze(1),
-            project_input=False,
+        _, y, _ = model.joiner.topk(
+            current_encoder_out.squeeze(1),
+            decoder_out.squeeze(1),
+            k=1,
+            blank_id=blank_id,
         )
-        # logits'shape (batch_size,  vocab_size)
-        logits = logits.squeeze(1).squeeze(1)
-
-        assert logits.ndim == 2, logits.shape
-        y = logits.argmax(dim=1).tolist()
+        # y's shape: (batch_size, 1)
+        y = y.squeeze(1).tolist()
         emitted = False
         for i, v in enumerate(y):
             if v != blank_id:
                 streams[i].hyp.append(v)
+                streams[i].num_trailing_blanks = 0
                 emitted = True
+            else:
+                streams[i].num_trailing_blanks += 1
         if emitted:
             # update decoder output
             decoder_input = torch.tensor(
@@ -85,11 +98,9 @@ def greedy_search(
                 device=device,
                 dtype=torch.int64,
             )
-            decoder_out = model.decoder(
-                decoder_input,
-                need_pad=False,
+            decoder_out = compute_decoder_out(
+                model, decoder_input, decoder_cache
             )
-            decoder_out = model.joiner.decoder_proj(decoder_out)
 
 
 def modified_beam_search(
@@ -97,6 +108,8 @@ def modified_beam_search(
     encoder_out: torch.Tensor,
     streams: List[DecodeStream],
     num_active_paths: int = 4,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    context_graph: Optional[ContextGraph] = None,
 ) -> None:
     """Beam search in batch mode with --max-sym-per-frame=1 being hardcoded.
 
@@ -110,6 +123,13 @@ def modified_beam_search(
         A list of stream objects.
       num_active_paths:
         Number of active paths during the beam search.
+      decoder_cache:
+        If not None, the decoder output is looked up from it instead of
+        running the decoder. See :class:`DecoderOutputCache`.
+      context_graph:
+        If not None, the context graph used for contextual biasing. The
+        context scores of unfinished partial matches are taken back once
+        a stream is done.
     """
     assert encoder_out.ndim == 3, encoder_out.shape
     assert len(streams) == encoder_out.size(0)
@@ -122,6 +142,9 @@ def modified_beam_search(
 
     B = [stream.hyps for stream in streams]
 
+    # Number of tokens per hypothesis to consider at each frame
+    num_tokens = min(num_active_paths, model.decoder.vocab_size)
+
     for t in range(T):
         current_encoder_out = encoder_out[:, t].unsqueeze(1).unsqueeze(1)
         # current_encoder_out's shape: (batch_size, 1, 1, encoder_out_dim)
@@ -141,8 +164,9 @@ def modified_beam_search(
             dtype=torch.int64,
         )  # (num_hyps, context_size)
 
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+        decoder_out = compute_decoder_out(
+            model, decoder_input, decoder_cache
+        ).unsqueeze(1)
         # decoder_out is of shape (num_hyps, 1, 1, decoder_output_dim)
 
         # Note: For torch 1.7.1 and below, it requires a torch.int64 tensor
@@ -153,28 +177,56 @@ def modified_beam_search(
             index=hyps_shape.row_ids(1).to(torch.int64),
         )  # (num_hyps, encoder_out_dim)
 
-        logits = model.joiner(
-            current_encoder_out, decoder_out, project_input=False
-        )
-        # logits is of shape (num_hyps, 1, 1, vocab_size)
-
-        logits = logits.squeeze(1).squeeze(1)
-
-        log_probs = logits.log_softmax(dim=-1)  # (num_hyps, vocab_size)
+        # Only the `num_active_paths` most probable tokens of each
+        # hypothesis can be among the best paths of a stream
+        if context_graph is None:
+            hyp_log_probs, hyp_tokens, _ = model.joiner.topk(
+                current_encoder_out.squeeze(1).squeeze(1),
+                decoder_out.squeeze(1).squeeze(1),
+                k=num_tokens,
+                blank_id=blank_id,
+            )  # (num_hyps, num_tokens)
+        else:
+            logits = model.joiner(
+                current_encoder_out,
+                decoder_out,
+                project_input=False,
+            )  # (num_hyps, 1, 1, vocab_size)
+            logits = logits.squeeze(1).squeeze(1)  # (num_hyps, vocab_size)
+            hyp_log_probs = logits.log_softmax(dim=-1)
+
+            context_states = torch.tensor(
+                [hyp.context_state for hyps in A for hyp in hyps],
+                device=device,
+                dtype=torch.int64,
+            )
+            next_context_states, context_scores = get_context_scores(
+                context_graph,
+                context_states,
+                num_labels=hyp_log_probs.size(1),
+                blank_id=blank_id,
+                unk_id=blank_id,
+            )
+            hyp_log_probs.add_(context_scores)
 
-        log_probs.add_(ys_log_probs)
+            hyp_log_probs, hyp_tokens = hyp_log_probs.topk(num_tokens, dim=1)
+            hyp_next_context_states = next_context_states.gather(
+                1, hyp_tokens
+            ).reshape(-1)
 
-        vocab_size = log_probs.size(-1)
+        hyp_log_probs.add_(ys_log_probs)
 
-        log_probs = log_probs.reshape(-1)
+        hyp_log_probs = hyp_log_probs.reshape(-1)
+        hyp_tokens = hyp_tokens.reshape(-1)
 
-        row_splits = hyps_shape.row_splits(1) * vocab_size
+        row_splits = hyps_shape.row_splits(1) * num_tokens
         log_probs_shape = k2.ragged.create_ragged_shape2(
-            row_splits=row_splits, cached_tot_size=log_probs.numel()
+            row_splits=row_splits, cached_tot_size=hyp_log_probs.numel()
         )
         ragged_log_probs = k2.RaggedTensor(
-            shape=log_probs_shape, value=log_probs
+            shape=log_probs_shape, value=hyp_log_probs
         )
+        row_splits = row_splits.tolist()
 
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(
@@ -183,8 +235,14 @@ def modified_beam_search(
 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                topk_hyp_indexes = (topk_indexes // vocab_size).tolist()
-                topk_token_indexes = (topk_indexes % vocab_size).tolist()
+                topk_hyp_indexes = (topk_indexes // num_tokens).tolist()
+            topk_token_indexes = hyp_tokens[
+                topk_indexes.to(torch.int64) + row_splits[i]
+            ].tolist()
+            if context_graph is not None:
+                topk_context_states = hyp_next_context_states[
+                    topk_indexes.to(torch.int64) + row_splits[i]
+                ].tolist()
 
             for k in range(len(topk_hyp_indexes)):
                 hyp_idx = topk_hyp_indexes[k]
@@ -194,12 +252,23 @@ def modified_beam_search(
                 new_token = topk_token_indexes[k]
                 if new_token != blank_id:
                     new_ys.append(new_token)
+                    num_trailing_blanks = 0
+                else:
+                    num_trailing_blanks = hyp.num_trailing_blanks + 1
 
                 new_log_prob = topk_log_probs[k]
-                new_hyp = Hypothesis(ys=new_ys, log_prob=new_log_prob)
+                new_hyp = Hypothesis(
+                    ys=new_ys,
+                    log_prob=new_log_prob,
+                    num_trailing_blanks=num_trailing_blanks,
+                )
+                if context_graph is not None:
+                    new_hyp.context_state = topk_context_states[k]
                 B[i].add(new_hyp)
 
     for i in range(batch_size):
+        if context_graph is not None and streams[i].done:
+            B[i] = finalize_context_scores(B[i], context_graph)
         streams[i].hyps = B[i]
 
 
@@ -211,6 +280,7 @@ def fast_beam_search_one_best(
     beam: float,
     max_states: int,
     max_contexts: int,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> None:
     """It limits the maximum number of symbols per frame to 1.
 
@@ -233,6 +303,9 @@ def fast_beam_search_one_best(
         Max states per stream per frame.
       max_contexts:
         Max contexts pre stream per frame.
+      decoder_cache:
+        If not None, the decoder output is looked up from it instead of
+        running the decoder. See :class:`DecoderOutputCache`.
     """
     assert encoder_out.ndim == 3
     B, T, C = encoder_out.shape
@@ -260,8 +333,7 @@ def fast_beam_search_one_best(
         # `nn.Embedding()` in torch below v1.7.1 supports only torch.int64
         contexts = contexts.to(torch.int64)
         # decoder_out is of shape (shape.NumElements(), 1, decoder_out_dim)
-        decoder_out = model.decoder(contexts, need_pad=False)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+        decoder_out = compute_decoder_out(model, contexts, decoder_cache)
         # current_encoder_out is of shape
         # (shape.NumElements(), 1, joiner_dim)
         # fmt: off
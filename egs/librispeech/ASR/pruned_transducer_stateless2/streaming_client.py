@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A client for ./pruned_transducer_stateless2/streaming_server.py
+
+Usage:
+./pruned_transducer_stateless2/streaming_client.py \
+        --server-addr localhost \
+        --server-port 6006 \
+        /path/to/foo.wav \
+        /path/to/bar.wav
+
+Each wave file is sent over its own connection, concurrently.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import struct
+
+import torchaudio
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--server-addr",
+        type=str,
+        default="localhost",
+        help="Address of the server",
+    )
+
+    parser.add_argument(
+        "--server-port",
+        type=int,
+        default=6006,
+        help="Port of the server",
+    )
+
+    parser.add_argument(
+        "--samples-per-message",
+        type=int,
+        default=4000,
+        help="Number of audio samples sent in each message",
+    )
+
+    parser.add_argument(
+        "sound_files",
+        type=str,
+        nargs="+",
+        help="The input sound file(s) to transcribe. "
+        "Supported formats are those supported by torchaudio.load(). "
+        "For example, wav and flac are supported. "
+        "The sample rate has to be 16kHz.",
+    )
+
+    return parser
+
+
+async def transcribe(
+    filename: str, addr: str, port: int, samples_per_message: int
+) -> str:
+    wave, sample_rate = torchaudio.load(filename)
+    assert sample_rate == 16000, sample_rate
+    wave = wave[0].contiguous()
+
+    reader, writer = await asyncio.open_connection(addr, port)
+
+    async def send():
+        for start in range(0, wave.numel(), samples_per_message):
+            data = wave[start : start + samples_per_message].numpy().tobytes()
+            writer.write(struct.pack("<i", len(data)) + data)
+            await writer.drain()
+        writer.write(struct.pack("<i", 0))
+        await writer.drain()
+
+    sender = asyncio.create_task(send())
+
+    text = ""
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        msg = json.loads(line)
+        text = msg["text"]
+        logging.info(f"{filename}: {text}")
+        if msg["final"]:
+            break
+
+    await sender
+    writer.close()
+    return text
+
+
+async def run(args):
+    results = await asyncio.gather(
+        *[
+            transcribe(
+                f,
+                args.server_addr,
+                args.server_port,
+                args.samples_per_message,
+            )
+            for f in args.sound_files
+        ]
+    )
+    for f, text in zip(args.sound_files, results):
+        logging.info(f"{f}:\n{text}\n")
+
+
+def main():
+    args = get_parser().parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    formatter = (
+        "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    )
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
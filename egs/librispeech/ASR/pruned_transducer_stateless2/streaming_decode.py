@@ -26,6 +26,16 @@ Usage:
         --exp-dir ./pruned_transducer_stateless2/exp \
         --decoding_method greedy_search \
         --num-decode-streams 1000
+
+To avoid subsampling the feature frames shared by consecutive chunks
+again, add
+
+        --cache-encoder-embed 1
+
+To split long streams into segments at endpoints, add
+
+        --endpoint 1 \
+        --endpoint-rule2-min-trailing-silence 1.2
 """
 
 import argparse
@@ -40,8 +50,8 @@ import sentencepiece as spm
 import torch
 import torch.nn as nn
 from asr_datamodule import LibriSpeechAsrDataModule
+from beam_search import DecoderOutputCache
 from decode_stream import DecodeStream
-from kaldifeat import Fbank, FbankOptions
 from lhotse import CutSet
 from streaming_beam_search import (
     fast_beam_search_one_best,
@@ -56,10 +66,13 @@ from icefall.checkpoint import (
     find_checkpoints,
     load_checkpoint,
 )
+from icefall.context_graph import ContextGraph, get_context_graph
+from icefall.endpoint import EndpointRule, Endpointer
 from icefall.utils import (
     AttributeDict,
     setup_logger,
     store_transcripts,
+    str2bool,
     write_error_stats,
 )
 
@@ -194,6 +207,88 @@ def get_parser():
         help="The number of streams that can be decoded parallel.",
     )
 
+    parser.add_argument(
+        "--decoder-cache-size",
+        type=int,
+        default=0,
+        help="""If positive, cache at most this number of decoder outputs,
+        indexed by the decoder context. The cache is shared by all streams.
+        0 disables the cache.""",
+    )
+
+    parser.add_argument(
+        "--precompute-decoder-cache",
+        type=str2bool,
+        default=False,
+        help="""If True, precompute the decoder outputs for all possible
+        contexts, i.e., vocab_size**context_size of them. Use it only for
+        small vocabularies.""",
+    )
+
+    parser.add_argument(
+        "--context-file",
+        type=str,
+        default="",
+        help="""If not empty, a text file containing one phrase per line.
+        The phrases are boosted during decoding. Used only when
+        --decoding-method is modified_beam_search or fast_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--context-score",
+        type=float,
+        default=2.0,
+        help="""The bonus of each token of a phrase from --context-file.
+        The bonus of a partially matched phrase is taken back if the match
+        fails.""",
+    )
+
+    parser.add_argument(
+        "--endpoint",
+        type=str2bool,
+        default=False,
+        help="""If True, detect endpoints with Kaldi-style rules. At each
+        endpoint, the result so far is finalized as a segment and the
+        hypotheses and decoder context of the stream are reset, while the
+        encoder state is kept. Used only when --decoding-method is
+        greedy_search or modified_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-rule1-min-trailing-silence",
+        type=float,
+        default=2.4,
+        help="""An endpoint is detected after this many seconds of trailing
+        silence, even if nothing has been decoded.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-rule2-min-trailing-silence",
+        type=float,
+        default=1.2,
+        help="""An endpoint is detected after this many seconds of trailing
+        silence if something has been decoded.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-rule3-min-utterance-length",
+        type=float,
+        default=20.0,
+        help="""An endpoint is detected once a segment is this many seconds
+        long.""",
+    )
+
+    parser.add_argument(
+        "--cache-encoder-embed",
+        type=str2bool,
+        default=False,
+        help="""If True, keep the cache of the convolutions of encoder_embed
+        in the state of each stream, so that the feature frames shared by
+        consecutive chunks are not subsampled again. The results are the
+        same as without the cache, up to rounding if PyTorch selects other
+        convolution algorithms for the smaller inputs.""",
+    )
+
     add_model_arguments(parser)
 
     return parser
@@ -203,6 +298,9 @@ def decode_one_chunk(
     params: AttributeDict,
     model: nn.Module,
     decode_streams: List[DecodeStream],
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    context_graph: Optional[ContextGraph] = None,
+    endpointer: Optional[Endpointer] = None,
 ) -> List[int]:
     """Decode one chunk frames of features for each decode_streams and
     return the indexes of finished streams in a List.
@@ -214,6 +312,14 @@ def decode_one_chunk(
         The neural model.
       decode_streams:
         A List of DecodeStream, each belonging to a utterance.
+      decoder_cache:
+        If not None, it is used to look up the decoder output.
+      context_graph:
+        If not None, the phrases in it are boosted. Used only when
+        --decoding_method is modified_beam_search.
+      endpointer:
+        If not None, it is used to detect endpoints of the streams that are
+        not finished.
     Returns:
       Return a List containing which DecodeStreams are finished.
     """
@@ -253,10 +359,43 @@ def decode_one_chunk(
             value=LOG_EPS,
         )
 
+    if params.cache_encoder_embed:
+        # The first `shared_length` frames of a chunk are the last ones of
+        # the previous chunk and their contribution is in the cache of
+        # encoder_embed, so only the frames following them are fed to the
+        # model. For a new stream, they initialize the cache.
+        shared_length = decode_streams[0].pad_length
+        new_streams = [
+            i for i, s in enumerate(decode_streams) if s.embed_states is None
+        ]
+        if len(new_streams) > 0:
+            embed_states = model.encoder.get_init_embed_state(
+                features[new_streams], right_context=params.right_context
+            )
+            for j, i in enumerate(new_streams):
+                decode_streams[i].embed_states = [x[j] for x in embed_states]
+
+        chunk_length = params.decode_chunk_size * params.subsampling_factor
+        features = features[
+            :, shared_length : shared_length + chunk_length  # noqa
+        ]
+        if features.size(1) < chunk_length:
+            features = torch.nn.functional.pad(
+                features,
+                (0, 0, 0, chunk_length - features.size(1)),
+                mode="constant",
+                value=LOG_EPS,
+            )
+
     states = [
         torch.stack([x[0] for x in states], dim=2),
         torch.stack([x[1] for x in states], dim=2),
     ]
+    if params.cache_encoder_embed:
+        states += [
+            torch.stack([s.embed_states[k] for s in decode_streams])
+            for k in range(4)
+        ]
     processed_lens = torch.tensor(processed_lens, device=device)
 
     encoder_out, encoder_out_lens, states = model.encoder.streaming_forward(
@@ -272,7 +411,10 @@ def decode_one_chunk(
 
     if params.decoding_method == "greedy_search":
         greedy_search(
-            model=model, encoder_out=encoder_out, streams=decode_streams
+            model=model,
+            encoder_out=encoder_out,
+            streams=decode_streams,
+            decoder_cache=decoder_cache,
         )
     elif params.decoding_method == "fast_beam_search":
         processed_lens = processed_lens + encoder_out_lens
@@ -284,6 +426,7 @@ def decode_one_chunk(
             beam=params.beam,
             max_states=params.max_states,
             max_contexts=params.max_contexts,
+            decoder_cache=decoder_cache,
         )
     elif params.decoding_method == "modified_beam_search":
         modified_beam_search(
@@ -291,30 +434,81 @@ def decode_one_chunk(
             streams=decode_streams,
             encoder_out=encoder_out,
             num_active_paths=params.num_active_paths,
+            decoder_cache=decoder_cache,
+            context_graph=context_graph,
         )
     else:
         raise ValueError(
             f"Unsupported decoding method: {params.decoding_method}"
         )
 
+    embed_states = [torch.unbind(x, dim=0) for x in states[2:]]
     states = [torch.unbind(states[0], dim=2), torch.unbind(states[1], dim=2)]
 
     finished_streams = []
     for i in range(len(decode_streams)):
         decode_streams[i].states = [states[0][i], states[1][i]]
+        if params.cache_encoder_embed:
+            decode_streams[i].embed_states = [x[i] for x in embed_states]
         decode_streams[i].done_frames += encoder_out_lens[i]
         if decode_streams[i].done:
             finished_streams.append(i)
+        elif endpointer is not None:
+            stream = decode_streams[i]
+            if endpointer(
+                contains_nonsilence=len(stream.decoding_result()) > 0,
+                num_trailing_blanks=stream.get_num_trailing_blanks(),
+                num_frames=int(stream.done_frames) - stream.segment_start_frame,
+            ):
+                stream.finalize_segment(context_graph)
 
     return finished_streams
 
 
+def feed_audio(
+    params: AttributeDict,
+    decode_streams: List[DecodeStream],
+    audios: Dict[str, torch.Tensor],
+) -> None:
+    """Feed audio samples to each stream until it has enough frames for the
+    next chunk, as if the audio were arriving in real time.
+
+    Args:
+      params:
+        It's the return value of :func:`get_params`.
+      decode_streams:
+        A List of DecodeStream, each belonging to a utterance.
+      audios:
+        A dict mapping a stream id to its audio samples that have not been
+        fed yet. Entries are removed once all samples of a stream are fed.
+    """
+    chunk_size = params.decode_chunk_size * params.subsampling_factor
+    # 10 ms frame shift
+    samples_per_chunk = chunk_size * 160
+
+    for stream in decode_streams:
+        while not stream.is_ready(chunk_size) and stream.id in audios:
+            samples = audios[stream.id]
+            stream.accept_waveform(
+                sampling_rate=16000, waveform=samples[:samples_per_chunk]
+            )
+            samples = samples[samples_per_chunk:]
+            if samples.numel() == 0:
+                stream.input_finished()
+                del audios[stream.id]
+            else:
+                audios[stream.id] = samples
+
+
 def decode_dataset(
     cuts: CutSet,
     params: AttributeDict,
     model: nn.Module,
     sp: spm.SentencePieceProcessor,
     decoding_graph: Optional[k2.Fsa] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    context_graph: Optional[ContextGraph] = None,
+    endpointer: Optional[Endpointer] = None,
 ) -> Dict[str, List[Tuple[List[str], List[str]]]]:
     """Decode dataset.
 
@@ -330,6 +524,13 @@ def decode_dataset(
       decoding_graph:
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding_method is fast_beam_search.
+      decoder_cache:
+        If not None, it is used to look up the decoder output.
+      context_graph:
+        If not None, the phrases in it are boosted. Used only when
+        --decoding_method is modified_beam_search.
+      endpointer:
+        If not None, it is used to split the streams into segments.
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
       is used, or it may be "beam_7" if beam size of 7 is used.
@@ -339,18 +540,14 @@ def decode_dataset(
     """
     device = model.device
 
-    opts = FbankOptions()
-    opts.device = device
-    opts.frame_opts.dither = 0
-    opts.frame_opts.snip_edges = False
-    opts.frame_opts.samp_freq = 16000
-    opts.mel_opts.num_bins = 80
-
     log_interval = 50
 
     decode_results = []
+    num_segments = 0
     # Contain decode streams currently running.
     decode_streams = []
+    # Audio samples of the running streams that have not been fed yet
+    audios = {}
     initial_states = model.encoder.get_init_state(
         params.left_context, device=device
     )
@@ -375,25 +572,30 @@ def decode_dataset(
 
         samples = torch.from_numpy(audio).squeeze(0)
 
-        fbank = Fbank(opts)
-        feature = fbank(samples.to(device))
-        decode_stream.set_features(feature)
+        audios[decode_stream.id] = samples
         decode_stream.ground_truth = cut.supervisions[0].text
 
         decode_streams.append(decode_stream)
 
         while len(decode_streams) >= params.num_decode_streams:
+            feed_audio(params, decode_streams, audios)
             finished_streams = decode_one_chunk(
-                params=params, model=model, decode_streams=decode_streams
+                params=params,
+                model=model,
+                decode_streams=decode_streams,
+                decoder_cache=decoder_cache,
+                context_graph=context_graph,
+                endpointer=endpointer,
             )
             for i in sorted(finished_streams, reverse=True):
                 decode_results.append(
                     (
                         decode_streams[i].id,
                         decode_streams[i].ground_truth.split(),
-                        sp.decode(decode_streams[i].decoding_result()).split(),
+                        sp.decode(decode_streams[i].final_result()).split(),
                     )
                 )
+                num_segments += len(decode_streams[i].segments) + 1
                 del decode_streams[i]
 
         if num % log_interval == 0:
@@ -401,19 +603,29 @@ def decode_dataset(
 
     # decode final chunks of last sequences
     while len(decode_streams):
+        feed_audio(params, decode_streams, audios)
         finished_streams = decode_one_chunk(
-            params=params, model=model, decode_streams=decode_streams
+            params=params,
+            model=model,
+            decode_streams=decode_streams,
+            decoder_cache=decoder_cache,
+            context_graph=context_graph,
+            endpointer=endpointer,
         )
         for i in sorted(finished_streams, reverse=True):
             decode_results.append(
                 (
                     decode_streams[i].id,
                     decode_streams[i].ground_truth.split(),
-                    sp.decode(decode_streams[i].decoding_result()).split(),
+                    sp.decode(decode_streams[i].final_result()).split(),
                 )
             )
+            num_segments += len(decode_streams[i].segments) + 1
             del decode_streams[i]
 
+    if endpointer is not None:
+        logging.info(f"Number of segments: {num_segments}")
+
     if params.decoding_method == "greedy_search":
         key = "greedy_search"
     elif params.decoding_method == "fast_beam_search":
@@ -506,6 +718,20 @@ def main():
         params.suffix += f"-max-contexts-{params.max_contexts}"
         params.suffix += f"-max-states-{params.max_states}"
 
+    if params.context_file:
+        assert params.decoding_method in (
+            "modified_beam_search",
+            "fast_beam_search",
+        ), params.decoding_method
+        params.suffix += f"-context-score-{params.context_score}"
+
+    if params.endpoint:
+        assert params.decoding_method in (
+            "greedy_search",
+            "modified_beam_search",
+        ), params.decoding_method
+        params.suffix += "-endpoint"
+
     setup_logger(f"{params.res_dir}/log-decode-{params.suffix}")
     logging.info("Decoding started")
 
@@ -563,9 +789,65 @@ def main():
     model.eval()
     model.device = device
 
+    context_graph = None
+    if params.context_file:
+        with open(params.context_file, encoding="utf-8") as f:
+            phrases = [line.strip() for line in f if line.strip()]
+        logging.info(
+            f"Loaded {len(phrases)} phrases from {params.context_file}"
+        )
+        context_graph = get_context_graph(
+            sp.encode(phrases), context_score=params.context_score
+        )
+
     decoding_graph = None
     if params.decoding_method == "fast_beam_search":
-        decoding_graph = k2.trivial_graph(params.vocab_size - 1, device=device)
+        if context_graph is not None:
+            decoding_graph = context_graph.to_fsa(params.vocab_size).to(device)
+            # The phrases are boosted by the decoding graph instead
+            context_graph = None
+        else:
+            decoding_graph = k2.trivial_graph(
+                params.vocab_size - 1, device=device
+            )
+
+    endpointer = None
+    if params.endpoint:
+        endpointer = Endpointer(
+            # 10 ms frame shift before subsampling
+            frame_shift=0.01 * params.subsampling_factor,
+            rules=[
+                EndpointRule(
+                    must_contain_nonsilence=False,
+                    min_trailing_silence=(
+                        params.endpoint_rule1_min_trailing_silence
+                    ),
+                    min_utterance_length=0.0,
+                ),
+                EndpointRule(
+                    must_contain_nonsilence=True,
+                    min_trailing_silence=(
+                        params.endpoint_rule2_min_trailing_silence
+                    ),
+                    min_utterance_length=0.0,
+                ),
+                EndpointRule(
+                    must_contain_nonsilence=False,
+                    min_trailing_silence=0.0,
+                    min_utterance_length=(
+                        params.endpoint_rule3_min_utterance_length
+                    ),
+                ),
+            ],
+        )
+
+    decoder_cache = None
+    if params.decoder_cache_size > 0 or params.precompute_decoder_cache:
+        decoder_cache = DecoderOutputCache(
+            model,
+            max_size=max(params.decoder_cache_size, 1),
+            precompute=params.precompute_decoder_cache,
+        )
 
     num_param = sum([p.numel() for p in model.parameters()])
     logging.info(f"Number of model parameters: {num_param}")
@@ -585,6 +867,9 @@ def main():
             model=model,
             sp=sp,
             decoding_graph=decoding_graph,
+            decoder_cache=decoder_cache,
+            context_graph=context_graph,
+            endpointer=endpointer,
         )
 
         save_results(
@@ -593,6 +878,9 @@ def main():
             results_dict=results_dict,
         )
 
+    if decoder_cache is not None:
+        logging.info(f"Decoder cache hit rate: {decoder_cache.hit_rate:.3f}")
+
     logging.info("Done!")
 
 
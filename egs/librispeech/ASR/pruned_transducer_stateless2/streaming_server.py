@@ -0,0 +1,807 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A streaming ASR server that decodes audio from many concurrent clients
+in batches.
+
+Usage:
+./pruned_transducer_stateless2/streaming_server.py \
+        --epoch 28 \
+        --avg 15 \
+        --left-context 32 \
+        --decode-chunk-size 8 \
+        --right-context 0 \
+        --exp-dir ./pruned_transducer_stateless2/exp \
+        --decoding_method greedy_search \
+        --max-batch-size 50 \
+        --port 6006
+
+Then use ./pruned_transducer_stateless2/streaming_client.py to send
+audio to it.
+
+The protocol is a plain TCP one. The client sends messages, each of which
+is a 4-byte little-endian integer N followed by N bytes of float32 samples
+(16 kHz, normalized to [-1, 1]). A message with N == 0 indicates the end
+of the audio. For every decoded chunk, the server sends back a line of JSON
+of the form {"text": "...", "final": false}. The last line has
+"final": true, after which the server closes the connection.
+
+The encoder states of the --max-active-streams most recently decoded
+streams are kept in preallocated slots, and the others in their streams.
+With --max-idle-seconds, streams that receive no audio for that long are
+swapped out of memory as snapshots, which are kept in host memory, or on
+disk in --swap-dir once they exceed --max-host-memory-mb. They are restored
+when audio arrives, so that many mostly idle streams can be connected at
+the same time.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import k2
+import sentencepiece as spm
+import torch
+import torch.nn as nn
+from beam_search import DecoderOutputCache
+from decode_stream import DecodeStream
+from streaming_beam_search import (
+    fast_beam_search_one_best,
+    greedy_search,
+    modified_beam_search,
+)
+from streaming_decode import get_parser
+from torch.nn.utils.rnn import pad_sequence
+from train import get_params, get_transducer_model
+
+from icefall.checkpoint import (
+    average_checkpoints,
+    find_checkpoints,
+    load_checkpoint,
+)
+from icefall.stream_pool import StreamPool
+from icefall.utils import AttributeDict, setup_logger
+
+LOG_EPS = math.log(1e-10)
+
+
+class StatePool(object):
+    """Preallocated encoder states for at most `max_streams` streams.
+
+    Each stream owns a slot, i.e., an index along the batch axis of the
+    pooled state tensors. The states of a batch of streams are obtained
+    with a single `index_select` per state tensor and written back with
+    a single `index_copy_`, instead of stacking and unbinding per-stream
+    tensors on every chunk.
+    """
+
+    def __init__(
+        self, init_states: List[torch.Tensor], max_streams: int
+    ) -> None:
+        """
+        Args:
+          init_states:
+            The initial states of a single stream, e.g., the return value of
+            `model.encoder.get_init_state()`. The i-th state has the shape
+            (encoder_layers, X_i, encoder_dim).
+          max_streams:
+            Maximum number of streams that can be active at the same time.
+        """
+        assert max_streams > 0, max_streams
+        self.init_states = init_states
+        self.max_streams = max_streams
+        # The batch axis is 2, which is what streaming_forward() expects
+        self.states = [
+            s.unsqueeze(2).repeat(1, 1, max_streams, 1).contiguous()
+            for s in init_states
+        ]
+        self._free_slots = list(range(max_streams - 1, -1, -1))
+
+    @property
+    def num_free_slots(self) -> int:
+        return len(self._free_slots)
+
+    def allocate(self) -> int:
+        """Return a free slot, whose states are reset to the initial ones."""
+        if not self._free_slots:
+            raise RuntimeError(
+                f"All {self.max_streams} slots of the state pool are in use"
+            )
+        slot = self._free_slots.pop()
+        for pool, init in zip(self.states, self.init_states):
+            pool[:, :, slot].copy_(init)
+        return slot
+
+    def free(self, slot: int) -> None:
+        assert 0 <= slot < self.max_streams, slot
+        assert slot not in self._free_slots, slot
+        self._free_slots.append(slot)
+
+    def gather(self, slots: torch.Tensor) -> List[torch.Tensor]:
+        """Return the states of the given slots, batched along axis 2."""
+        return [pool.index_select(2, slots) for pool in self.states]
+
+    def scatter(self, slots: torch.Tensor, states: List[torch.Tensor]) -> None:
+        """Write the batched `states` back to the given slots."""
+        for pool, s in zip(self.states, states):
+            pool.index_copy_(2, slots, s)
+
+
+class EngineStream(object):
+    """A stream handled by :class:`StreamingEngine`.
+
+    Audio is fed with :func:`StreamingEngine.accept_waveform` and
+    :func:`StreamingEngine.input_finished`. Decoding results are put into
+    `self.results` as tuples `(token_ids, is_final)`.
+    """
+
+    def __init__(
+        self,
+        stream_id: int,
+        decode_stream: DecodeStream,
+        chunk_size: int,
+    ) -> None:
+        """
+        Args:
+          stream_id:
+            ID of this stream.
+          decode_stream:
+            It computes features incrementally and keeps the search state
+            of this stream.
+          chunk_size:
+            Number of feature frames (before subsampling) consumed per chunk.
+        """
+        self.id = stream_id
+        # None while the stream is swapped out
+        self.decode_stream: Optional[DecodeStream] = decode_stream
+        self.chunk_size = chunk_size
+
+        # The slot in the :class:`StatePool` owned by this stream, or -1.
+        # Without a slot, the encoder states are kept in
+        # `self.decode_stream.states`.
+        self.slot = -1
+
+        self.results: asyncio.Queue = asyncio.Queue()
+
+        # Used for scheduling streams in a round robin fashion
+        self.num_scheduled_chunks = 0
+
+    @property
+    def is_ready(self) -> bool:
+        """True if there are enough frames for the next chunk."""
+        if self.decode_stream is None:
+            return False
+        return self.decode_stream.is_ready(self.chunk_size)
+
+    @property
+    def done(self) -> bool:
+        if self.decode_stream is None:
+            return False
+        return self.decode_stream.done
+
+
+class StreamingEngine(object):
+    """Decode many streams concurrently in batches.
+
+    Streams are created with :func:`create_stream`. Whenever a stream has
+    enough audio for a new chunk, it is scheduled in the next batch, which
+    contains at most `max_batch_size` streams. The encoder states of the
+    recently decoded streams are kept in a :class:`StatePool`. A stream
+    gives up its slot when a slot is needed and it is the least recently
+    decoded one.
+
+    If `max_idle_seconds` is not None, streams that have been idle for
+    `max_idle_seconds` are swapped out of memory by a :class:`StreamPool`,
+    and restored when audio for them arrives.
+
+    A stream that will not be finished, e.g., since its client has
+    disconnected, has to be removed with :func:`remove_stream`.
+
+    Usage::
+
+        engine = StreamingEngine(params, model)
+        asyncio.create_task(engine.run())
+
+        stream = engine.create_stream()
+        engine.accept_waveform(stream, samples)
+        engine.input_finished(stream)
+        while True:
+            token_ids, is_final = await stream.results.get()
+            if is_final:
+                break
+    """
+
+    def __init__(
+        self,
+        params: AttributeDict,
+        model: nn.Module,
+        decoding_graph: Optional[k2.Fsa] = None,
+        decoder_cache: Optional[DecoderOutputCache] = None,
+        max_batch_size: int = 50,
+        max_streams: int = 500,
+        max_idle_seconds: Optional[float] = None,
+        max_host_bytes: Optional[int] = None,
+        swap_dir: Optional[Path] = None,
+    ) -> None:
+        """
+        Args:
+          params:
+            It is returned by :func:`get_params`, merged with the command line
+            arguments of streaming_decode.py.
+          model:
+            The neural model.
+          decoding_graph:
+            The decoding graph. Used only when --decoding_method is
+            fast_beam_search.
+          decoder_cache:
+            If not None, it caches the decoder outputs shared by all streams.
+          max_batch_size:
+            Maximum number of streams decoded in a batch.
+          max_streams:
+            Number of slots of the state pool.
+          max_idle_seconds:
+            If not None, streams that have been idle for this number of
+            seconds are swapped out.
+          max_host_bytes:
+            Maximum number of bytes of swapped out streams kept in host
+            memory. The others are written to `swap_dir`. None means no
+            limit.
+          swap_dir:
+            The directory for swapped out streams. Used only if
+            `max_host_bytes` is not None.
+        """
+        if max_idle_seconds is not None:
+            assert (
+                params.decoding_method != "fast_beam_search"
+            ), "Swapping out streams is not supported for fast_beam_search"
+        self.params = params
+        self.model = model
+        self.decoding_graph = decoding_graph
+        self.decoder_cache = decoder_cache
+        self.max_batch_size = min(max_batch_size, max_streams)
+        self.device = next(model.parameters()).device
+
+        self.init_states = model.encoder.get_init_state(
+            params.left_context, device=self.device
+        )
+        self.state_pool = StatePool(self.init_states, max_streams=max_streams)
+        # IDs of the streams owning a slot, the least recently decoded
+        # one first
+        self._slot_owners: "OrderedDict[int, None]" = OrderedDict()
+
+        self.chunk_size = params.decode_chunk_size * params.subsampling_factor
+
+        self.streams: Dict[int, EngineStream] = {}
+        self._next_stream_id = 0
+        # The streams in the batch being decoded in the worker thread
+        self._decoding: List[EngineStream] = []
+        self._wakeup = asyncio.Event()
+
+        self.max_idle_seconds = max_idle_seconds
+        self.stream_pool = StreamPool(
+            snapshot=self._swap_out,
+            restore=self._swap_in,
+            max_host_bytes=max_host_bytes,
+            swap_dir=swap_dir,
+        )
+
+        # A single worker thread so that neural network computation runs
+        # outside of the event loop, one batch at a time.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def create_stream(self) -> EngineStream:
+        decode_stream = DecodeStream(
+            params=self.params,
+            cut_id=str(self._next_stream_id),
+            initial_states=self.init_states,
+            decoding_graph=self.decoding_graph,
+            device=self.device,
+        )
+        stream = EngineStream(
+            stream_id=self._next_stream_id,
+            decode_stream=decode_stream,
+            chunk_size=self.chunk_size,
+        )
+        self.streams[stream.id] = stream
+        self._next_stream_id += 1
+        if self.max_idle_seconds is not None:
+            self.stream_pool.add(stream.id, decode_stream)
+        return stream
+
+    def accept_waveform(
+        self, stream: EngineStream, samples: torch.Tensor
+    ) -> None:
+        self._swap_in_if_needed(stream)
+        stream.decode_stream.accept_waveform(
+            sampling_rate=16000, waveform=samples
+        )
+        self._wakeup.set()
+
+    def input_finished(self, stream: EngineStream) -> None:
+        self._swap_in_if_needed(stream)
+        stream.decode_stream.input_finished()
+        self._wakeup.set()
+
+    def remove_stream(self, stream: EngineStream) -> None:
+        """Remove a stream that will not be decoded to the end, e.g., since
+        its client has disconnected, and free its slot and its snapshot.
+        It does nothing if the stream has already been removed."""
+        if stream.id not in self.streams:
+            return
+        del self.streams[stream.id]
+        # A stream in the batch being decoded is freed after the batch
+        if all(s is not stream for s in self._decoding):
+            self._free_stream(stream)
+
+    def _free_stream(self, stream: EngineStream) -> None:
+        """Free the resources of a stream that is no longer in
+        `self.streams`."""
+        if stream.slot >= 0:
+            self.state_pool.free(stream.slot)
+            del self._slot_owners[stream.id]
+            stream.slot = -1
+        if stream.id in self.stream_pool:
+            self.stream_pool.remove(stream.id)
+
+    def _acquire_slots(self, streams: List[EngineStream]) -> None:
+        """Move the encoder states of the given streams into the state
+        pool. If no slot is free, the least recently decoded stream that is
+        not in `streams` gives up its slot."""
+        stream_ids = set(s.id for s in streams)
+        for s in streams:
+            if s.slot < 0:
+                if self.state_pool.num_free_slots == 0:
+                    for stream_id in self._slot_owners:
+                        if stream_id not in stream_ids:
+                            break
+                    self._release_slot(self.streams[stream_id])
+                s.slot = self.state_pool.allocate()
+                slots = torch.tensor([s.slot], device=self.device)
+                self.state_pool.scatter(
+                    slots, [x.unsqueeze(2) for x in s.decode_stream.states]
+                )
+                # The encoder states are kept in the state pool
+                s.decode_stream.states = self.init_states
+            self._slot_owners[s.id] = None
+            self._slot_owners.move_to_end(s.id)
+
+    def _release_slot(self, stream: EngineStream) -> None:
+        """Move the encoder states of a stream out of the state pool."""
+        slots = torch.tensor([stream.slot], device=self.device)
+        stream.decode_stream.states = [
+            x.squeeze(2) for x in self.state_pool.gather(slots)
+        ]
+        self.state_pool.free(stream.slot)
+        stream.slot = -1
+        del self._slot_owners[stream.id]
+
+    def _swap_out(self, decode_stream: DecodeStream) -> bytes:
+        """Return the snapshot of a stream, which includes its encoder
+        states. Called by `self.stream_pool`."""
+        stream = self.streams[int(decode_stream.id)]
+        if stream.slot >= 0:
+            self._release_slot(stream)
+        stream.decode_stream = None
+        return decode_stream.snapshot()
+
+    def _swap_in(self, data: bytes) -> DecodeStream:
+        """Restore a stream from its snapshot. Called by
+        `self.stream_pool`."""
+        decode_stream = DecodeStream.from_snapshot(
+            data, params=self.params, device=self.device
+        )
+        self.streams[int(decode_stream.id)].decode_stream = decode_stream
+        return decode_stream
+
+    def _swap_in_if_needed(self, stream: EngineStream) -> None:
+        """Restore the stream if it has been swapped out, and mark it as
+        recently used."""
+        if self.max_idle_seconds is not None:
+            self.stream_pool.get(stream.id)
+
+    def _swap_out_idle_streams(self) -> None:
+        """Swap out the streams that have been idle for
+        `self.max_idle_seconds`. It is called only between batches."""
+        if self.max_idle_seconds is None:
+            return
+        # A ready stream is kept, since it would not be swapped in again
+        # if no more audio arrives for it.
+        stream_ids = self.stream_pool.evict_idle(
+            self.max_idle_seconds,
+            keep=lambda stream_id: self.streams[stream_id].is_ready,
+        )
+        if stream_ids:
+            logging.info(
+                f"Swapped out {len(stream_ids)} idle streams. "
+                f"Snapshots in host memory: {self.stream_pool.num_in_host}, "
+                f"on disk: {self.stream_pool.num_on_disk}"
+            )
+
+    def _get_ready_streams(self) -> List[EngineStream]:
+        ready = [s for s in self.streams.values() if s.is_ready]
+        # Streams that have been served less go first
+        ready.sort(key=lambda s: s.num_scheduled_chunks)
+        return ready[: self.max_batch_size]
+
+    def _prepare_batch(
+        self, streams: List[EngineStream]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Get the features of the next chunk of the given streams. It runs
+        in the event loop thread since it reads the feature extractors."""
+        features = []
+        feature_lens = []
+        for s in streams:
+            feat, feat_len = s.decode_stream.get_feature_frames(s.chunk_size)
+            features.append(feat)
+            feature_lens.append(feat_len)
+            s.num_scheduled_chunks += 1
+
+        feature_lens = torch.tensor(feature_lens, device=self.device)
+        features = pad_sequence(
+            features, batch_first=True, padding_value=LOG_EPS
+        ).to(self.device)
+
+        # See decode_one_chunk() in streaming_decode.py
+        tail_length = (
+            7 + (2 + self.params.right_context) * self.params.subsampling_factor
+        )
+        if features.size(1) < tail_length:
+            pad_length = tail_length - features.size(1)
+            feature_lens += pad_length
+            features = torch.nn.functional.pad(
+                features,
+                (0, 0, 0, pad_length),
+                mode="constant",
+                value=LOG_EPS,
+            )
+        return features, feature_lens
+
+    @torch.no_grad()
+    def _decode_batch(
+        self,
+        streams: List[EngineStream],
+        features: torch.Tensor,
+        feature_lens: torch.Tensor,
+    ) -> None:
+        """Run the encoder and the search on a batch. It runs in the
+        worker thread."""
+        params = self.params
+        model = self.model
+        decode_streams = [s.decode_stream for s in streams]
+
+        slots = torch.tensor([s.slot for s in streams], device=self.device)
+        states = self.state_pool.gather(slots)
+        processed_lens = torch.tensor(
+            [s.done_frames for s in decode_streams], device=self.device
+        )
+
+        encoder_out, encoder_out_lens, states = model.encoder.streaming_forward(
+            x=features,
+            x_lens=feature_lens,
+            states=states,
+            left_context=params.left_context,
+            right_context=params.right_context,
+            processed_lens=processed_lens,
+        )
+        self.state_pool.scatter(slots, states)
+
+        encoder_out = model.joiner.encoder_proj(encoder_out)
+
+        if params.decoding_method == "greedy_search":
+            greedy_search(
+                model=model,
+                encoder_out=encoder_out,
+                streams=decode_streams,
+                decoder_cache=self.decoder_cache,
+            )
+        elif params.decoding_method == "fast_beam_search":
+            processed_lens = processed_lens + encoder_out_lens
+            fast_beam_search_one_best(
+                model=model,
+                encoder_out=encoder_out,
+                processed_lens=processed_lens,
+                streams=decode_streams,
+                beam=params.beam,
+                max_states=params.max_states,
+                max_contexts=params.max_contexts,
+                decoder_cache=self.decoder_cache,
+            )
+        elif params.decoding_method == "modified_beam_search":
+            modified_beam_search(
+                model=model,
+                streams=decode_streams,
+                encoder_out=encoder_out,
+                num_active_paths=params.num_active_paths,
+                decoder_cache=self.decoder_cache,
+            )
+        else:
+            raise ValueError(
+                f"Unsupported decoding method: {params.decoding_method}"
+            )
+
+        encoder_out_lens = encoder_out_lens.tolist()
+        for s, n in zip(decode_streams, encoder_out_lens):
+            s.done_frames += n
+
+    async def run(self) -> None:
+        """Keep decoding ready streams. It never returns."""
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.max_idle_seconds is None:
+                await self._wakeup.wait()
+            else:
+                # Wake up periodically to swap out idle streams
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), timeout=self.max_idle_seconds
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+
+            while True:
+                self._swap_out_idle_streams()
+                streams = self._get_ready_streams()
+                if not streams:
+                    break
+
+                features, feature_lens = self._prepare_batch(streams)
+                self._acquire_slots(streams)
+                self._decoding = streams
+                try:
+                    await loop.run_in_executor(
+                        self._executor,
+                        self._decode_batch,
+                        streams,
+                        features,
+                        feature_lens,
+                    )
+                finally:
+                    self._decoding = []
+
+                for s in streams:
+                    if s.id not in self.streams:
+                        # It was removed while the batch was being decoded
+                        self._free_stream(s)
+                        continue
+                    result = s.decode_stream.decoding_result()
+                    s.results.put_nowait((result, s.done))
+                    if s.done:
+                        del self.streams[s.id]
+                        self._free_stream(s)
+
+
+async def handle_connection(
+    engine: StreamingEngine,
+    sp: spm.SentencePieceProcessor,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    stream = engine.create_stream()
+    peer = writer.get_extra_info("peername")
+    logging.info(f"Stream {stream.id} from {peer} started")
+
+    async def send_results():
+        while True:
+            token_ids, is_final = await stream.results.get()
+            msg = {"text": sp.decode(token_ids), "final": is_final}
+            writer.write((json.dumps(msg) + "\n").encode("utf-8"))
+            await writer.drain()
+            if is_final:
+                break
+
+    sender = asyncio.create_task(send_results())
+    try:
+        while True:
+            header = await reader.readexactly(4)
+            (num_bytes,) = struct.unpack("<i", header)
+            if num_bytes == 0:
+                engine.input_finished(stream)
+                break
+            data = await reader.readexactly(num_bytes)
+            samples = torch.frombuffer(bytearray(data), dtype=torch.float32)
+            engine.accept_waveform(stream, samples)
+        await sender
+    except (asyncio.IncompleteReadError, ConnectionError, OSError):
+        logging.info(f"Stream {stream.id}: client disconnected")
+    finally:
+        sender.cancel()
+        if not stream.done:
+            engine.remove_stream(stream)
+        writer.close()
+        logging.info(f"Stream {stream.id} finished")
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=6006,
+        help="The port the server listens on",
+    )
+
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=50,
+        help="Maximum number of streams decoded in a batch",
+    )
+
+    parser.add_argument(
+        "--max-active-streams",
+        type=int,
+        default=500,
+        help="""Number of streams whose encoder states are kept in the
+        preallocated state pool. It also limits the batch size.
+        """,
+    )
+
+    parser.add_argument(
+        "--max-idle-seconds",
+        type=float,
+        default=0,
+        help="""If positive, streams that receive no audio for this number
+        of seconds are swapped out of memory. Not supported for
+        fast_beam_search.
+        """,
+    )
+
+    parser.add_argument(
+        "--max-host-memory-mb",
+        type=int,
+        default=0,
+        help="""If positive, swapped out streams that exceed this amount of
+        host memory are written to --swap-dir.
+        Used only if --max-idle-seconds is positive.
+        """,
+    )
+
+    parser.add_argument(
+        "--swap-dir",
+        type=str,
+        default="",
+        help="""The directory for swapped out streams.
+        Required if --max-host-memory-mb is positive.
+        """,
+    )
+
+
+async def serve(
+    engine: StreamingEngine, sp: spm.SentencePieceProcessor, port: int
+) -> None:
+    server = await asyncio.start_server(
+        lambda r, w: handle_connection(engine, sp, r, w), "0.0.0.0", port
+    )
+    logging.info(f"Listening on port {port}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), engine.run())
+
+
+@torch.no_grad()
+def main():
+    parser = get_parser()
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    args.exp_dir = Path(args.exp_dir)
+
+    params = get_params()
+    params.update(vars(args))
+
+    setup_logger(f"{params.exp_dir}/streaming/log-server")
+    logging.info("Server started")
+
+    device = torch.device("cpu")
+    if torch.cuda.is_available():
+        device = torch.device("cuda", 0)
+
+    logging.info(f"Device: {device}")
+
+    sp = spm.SentencePieceProcessor()
+    sp.load(params.bpe_model)
+
+    # <blk> and <unk> is defined in local/train_bpe_model.py
+    params.blank_id = sp.piece_to_id("<blk>")
+    params.unk_id = sp.piece_to_id("<unk>")
+    params.vocab_size = sp.get_piece_size()
+    # Decoding in streaming requires causal convolution
+    params.causal_convolution = True
+
+    logging.info(params)
+
+    logging.info("About to create model")
+    model = get_transducer_model(params)
+
+    if params.iter > 0:
+        filenames = find_checkpoints(params.exp_dir, iteration=-params.iter)[
+            : params.avg
+        ]
+        if len(filenames) == 0:
+            raise ValueError(
+                f"No checkpoints found for"
+                f" --iter {params.iter}, --avg {params.avg}"
+            )
+        elif len(filenames) < params.avg:
+            raise ValueError(
+                f"Not enough checkpoints ({len(filenames)}) found for"
+                f" --iter {params.iter}, --avg {params.avg}"
+            )
+        logging.info(f"averaging {filenames}")
+        model.to(device)
+        model.load_state_dict(average_checkpoints(filenames, device=device))
+    elif params.avg == 1:
+        load_checkpoint(f"{params.exp_dir}/epoch-{params.epoch}.pt", model)
+    else:
+        start = params.epoch - params.avg + 1
+        filenames = []
+        for i in range(start, params.epoch + 1):
+            if start >= 0:
+                filenames.append(f"{params.exp_dir}/epoch-{i}.pt")
+        logging.info(f"averaging {filenames}")
+        model.to(device)
+        model.load_state_dict(average_checkpoints(filenames, device=device))
+
+    model.to(device)
+    model.eval()
+    model.device = device
+
+    decoding_graph = None
+    if params.decoding_method == "fast_beam_search":
+        decoding_graph = k2.trivial_graph(params.vocab_size - 1, device=device)
+
+    decoder_cache = None
+    if params.decoder_cache_size > 0 or params.precompute_decoder_cache:
+        decoder_cache = DecoderOutputCache(
+            model,
+            max_size=max(params.decoder_cache_size, 1),
+            precompute=params.precompute_decoder_cache,
+        )
+
+    max_idle_seconds = None
+    max_host_bytes = None
+    if params.max_idle_seconds > 0:
+        max_idle_seconds = params.max_idle_seconds
+        if params.max_host_memory_mb > 0:
+            assert params.swap_dir, "Please provide --swap-dir"
+            max_host_bytes = params.max_host_memory_mb * 1024 * 1024
+
+    async def start():
+        engine = StreamingEngine(
+            params=params,
+            model=model,
+            decoding_graph=decoding_graph,
+            decoder_cache=decoder_cache,
+            max_batch_size=params.max_batch_size,
+            max_streams=params.max_active_streams,
+            max_idle_seconds=max_idle_seconds,
+            max_host_bytes=max_host_bytes,
+            swap_dir=params.swap_dir or None,
+        )
+        await serve(engine, sp, params.port)
+
+    asyncio.run(start())
+
+
+if __name__ == "__main__":
+    main()
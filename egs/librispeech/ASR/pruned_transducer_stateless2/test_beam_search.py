@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./pruned_transducer_stateless2/test_beam_search.py
+"""
+
+import math
+
+import numpy as np
+import torch
+from beam_search import (
+    BlankFrameSkipper,
+    DecoderOutputCache,
+    greedy_search_batch,
+    modified_beam_search,
+    modified_beam_search_vectorized,
+)
+from decoder import Decoder
+from joiner import Joiner
+
+from icefall import CompiledNgramLm, ContextGraph
+
+
+class _Model(torch.nn.Module):
+    def __init__(self, vocab_size: int, context_size: int, unk_id: int):
+        super().__init__()
+        self.decoder = Decoder(
+            vocab_size=vocab_size,
+            decoder_dim=32,
+            blank_id=0,
+            context_size=context_size,
+        )
+        self.joiner = Joiner(
+            encoder_dim=16,
+            decoder_dim=32,
+            joiner_dim=24,
+            vocab_size=vocab_size,
+        )
+        self.simple_am_proj = torch.nn.Linear(16, vocab_size)
+        self.simple_lm_proj = torch.nn.Linear(32, vocab_size)
+        self.unk_id = unk_id
+
+
+def test_modified_beam_search_vectorized():
+    torch.manual_seed(20221024)
+    for vocab_size in [5, 50]:
+        for context_size in [1, 2]:
+            model = _Model(vocab_size, context_size, unk_id=2)
+            model.eval()
+            for beam in [1, 4, 5]:
+                N = 5
+                encoder_out_lens = torch.randint(1, 30, (N,))
+                encoder_out = torch.randn(N, encoder_out_lens.max(), 16) * 3
+                with torch.no_grad():
+                    expected = modified_beam_search(
+                        model=model,
+                        encoder_out=encoder_out,
+                        encoder_out_lens=encoder_out_lens,
+                        beam=beam,
+                    )
+                    hyps = modified_beam_search_vectorized(
+                        model=model,
+                        encoder_out=encoder_out,
+                        encoder_out_lens=encoder_out_lens,
+                        beam=beam,
+                    )
+                assert hyps == expected, (hyps, expected)
+
+
+def test_decoder_output_cache():
+    torch.manual_seed(20221024)
+    vocab_size = 10
+    context_size = 2
+    model = _Model(vocab_size, context_size, unk_id=2)
+    model.eval()
+
+    contexts = torch.randint(0, vocab_size, (50, context_size))
+    with torch.no_grad():
+        expected = model.decoder(contexts, need_pad=False)
+        expected = model.joiner.decoder_proj(expected)
+
+    for cache in [
+        DecoderOutputCache(model, max_size=8),
+        DecoderOutputCache(model, max_size=1000),
+        DecoderOutputCache(model, precompute=True),
+    ]:
+        for start in range(0, 50, 5):
+            out = cache(contexts[start : start + 5])
+            assert torch.allclose(out, expected[start : start + 5], atol=1e-5)
+        # more distinct contexts than max_size in a single call
+        out = cache(contexts)
+        assert torch.allclose(out, expected, atol=1e-5)
+        assert len(cache) <= max(cache.max_size, vocab_size**context_size)
+
+    N = 5
+    encoder_out_lens = torch.randint(1, 30, (N,))
+    encoder_out = torch.randn(N, encoder_out_lens.max(), 16) * 3
+    cache = DecoderOutputCache(model, max_size=100)
+    with torch.no_grad():
+        for search in [greedy_search_batch, modified_beam_search]:
+            expected = search(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+            )
+            hyps = search(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                decoder_cache=cache,
+            )
+            assert hyps == expected, (hyps, expected)
+    assert cache.num_hits > 0
+
+
+def test_blank_frame_skipper():
+    torch.manual_seed(20221024)
+    model = _Model(vocab_size=10, context_size=2, unk_id=2)
+    model.eval()
+
+    N = 5
+    encoder_out_lens = torch.randint(1, 30, (N,))
+    encoder_out = torch.randn(N, encoder_out_lens.max(), 16) * 3
+
+    for method in ["joiner", "simple"]:
+        # A threshold of 1 keeps all frames
+        skipper = BlankFrameSkipper(model, blank_threshold=1.0, method=method)
+        out, out_lens = skipper(encoder_out, encoder_out_lens)
+        assert torch.equal(out_lens, encoder_out_lens)
+        for i in range(N):
+            n = encoder_out_lens[i]
+            assert torch.equal(out[i, :n], encoder_out[i, :n])
+        assert skipper.skip_rate == 0
+
+        skipper = BlankFrameSkipper(model, blank_threshold=0.3, method=method)
+        with torch.no_grad():
+            blank_log_probs = skipper.blank_log_probs(encoder_out)
+        out, out_lens = skipper(encoder_out, encoder_out_lens)
+        assert torch.all(out_lens > 0)
+        assert skipper.num_frames == encoder_out_lens.sum()
+        assert skipper.num_skipped_frames == (encoder_out_lens - out_lens).sum()
+        assert skipper.skip_rate > 0
+
+        for i in range(N):
+            n = encoder_out_lens[i]
+            p = blank_log_probs[i, :n]
+            keep = p <= math.log(0.3)
+            keep[p.argmin()] = True
+            assert torch.equal(out[i, : out_lens[i]], encoder_out[i, :n][keep])
+
+        with torch.no_grad():
+            hyps = greedy_search_batch(
+                model=model,
+                encoder_out=out,
+                encoder_out_lens=out_lens,
+            )
+        assert len(hyps) == N
+
+
+def test_joiner_topk():
+    torch.manual_seed(20221024)
+    joiner = Joiner(
+        encoder_dim=16, decoder_dim=32, joiner_dim=24, vocab_size=10
+    )
+    joiner.eval()
+
+    encoder_out = joiner.encoder_proj(torch.randn(6, 16))
+    decoder_out = joiner.decoder_proj(torch.randn(6, 32))
+    with torch.no_grad():
+        logits = joiner(encoder_out, decoder_out, project_input=False)
+
+    for temperature in [1.0, 2.0]:
+        log_probs = (logits / temperature).log_softmax(dim=-1)
+        expected_values, expected_indexes = log_probs.topk(3, dim=-1)
+
+        values, indexes, blank_log_probs = joiner.topk(
+            encoder_out, decoder_out, k=3, blank_id=0, temperature=temperature
+        )
+        assert torch.equal(indexes, expected_indexes)
+        assert torch.allclose(values, expected_values, atol=1e-5)
+        assert torch.allclose(blank_log_probs, log_probs[:, 0], atol=1e-5)
+
+    # The cached output weight is updated when the parameters change
+    with torch.no_grad():
+        joiner.output_linear.weight.mul_(2)
+        logits = joiner(encoder_out, decoder_out, project_input=False)
+    _, indexes, _ = joiner.topk(encoder_out, decoder_out, k=1)
+    assert torch.equal(indexes.squeeze(1), logits.argmax(dim=-1))
+
+
+def _unigram_lm(costs: torch.Tensor) -> CompiledNgramLm:
+    # State 0 is the start state. All labels go to state 1, which loops.
+    # Transitions to state 0 are ignored, so state 1 is needed.
+    num_labels = costs.numel()
+    labels = np.arange(num_labels, dtype=np.int64)
+    return CompiledNgramLm(
+        arc_keys=np.concatenate([labels, num_labels + labels]),
+        arc_next_states=np.ones(2 * num_labels, dtype=np.int32),
+        arc_costs=np.concatenate([costs.numpy()] * 2).astype(np.float32),
+        backoff_states=np.array([[0], [1]], dtype=np.int32),
+        backoff_costs=np.zeros((2, 1), dtype=np.float64),
+        num_labels=num_labels,
+        backoff_id=num_labels,
+    )
+
+
+def test_modified_beam_search_ngram_fusion():
+    torch.manual_seed(20221024)
+    vocab_size = 10
+    model = _Model(vocab_size, context_size=2, unk_id=2)
+    model.eval()
+
+    N = 5
+    encoder_out_lens = torch.randint(1, 30, (N,))
+    encoder_out = torch.randn(N, encoder_out_lens.max(), 16) * 3
+
+    ngram_lm = _unigram_lm(torch.rand(vocab_size))
+    with torch.no_grad():
+        expected = modified_beam_search_vectorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=4,
+        )
+        # An LM with scale 0 changes nothing
+        hyps = modified_beam_search_vectorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=4,
+            ngram_lm=ngram_lm,
+            ngram_lm_scale=0.0,
+        )
+        assert hyps == expected, (hyps, expected)
+
+        # An LM that strongly prefers token 5
+        costs = torch.full((vocab_size,), 100.0)
+        costs[5] = 0
+        hyps = modified_beam_search_vectorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=4,
+            ngram_lm=_unigram_lm(costs),
+            ngram_lm_scale=1.0,
+        )
+        for hyp in hyps:
+            assert set(hyp) <= {5}, hyps
+
+
+def test_modified_beam_search_context_graph():
+    torch.manual_seed(20221024)
+    vocab_size = 10
+    model = _Model(vocab_size, context_size=2, unk_id=2)
+    model.eval()
+
+    N = 5
+    encoder_out_lens = torch.randint(2, 30, (N,))
+    encoder_out = torch.randn(N, encoder_out_lens.max(), 16) * 3
+
+    with torch.no_grad():
+        expected = modified_beam_search_vectorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=4,
+        )
+        # A context graph with score 0 changes nothing
+        hyps = modified_beam_search_vectorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=4,
+            context_graph=ContextGraph([[7, 8]], context_score=0.0),
+        )
+        assert hyps == expected, (hyps, expected)
+
+        # A strongly boosted phrase
+        hyps = modified_beam_search_vectorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=4,
+            context_graph=ContextGraph([[7, 8]], context_score=100.0),
+        )
+        for hyp in hyps:
+            assert hyp[:2] == [7, 8], hyps
+            # Unfinished matches are not rewarded
+            assert hyp[-1] != 7, hyps
+
+
+def main():
+    test_modified_beam_search_vectorized()
+    test_decoder_output_cache()
+    test_blank_frame_skipper()
+    test_joiner_topk()
+    test_modified_beam_search_ngram_fusion()
+    test_modified_beam_search_context_graph()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./pruned_transducer_stateless2/test_conformer.py
+"""
+
+import torch
+from conformer import Conformer, Conv2dSubsampling
+
+
+def test_conv2d_subsampling_streaming():
+    torch.manual_seed(20221018)
+    model = Conv2dSubsampling(80, 256)
+    model.eval()
+
+    # The batch size is larger than 1 so that PyTorch selects the same
+    # convolution algorithms for a chunk and for the frames of a chunk
+    # that are not cached.
+    N = 2
+    num_chunks = 5
+    for chunk_size, right_context in [(16, 4), (8, 2), (16, 0)]:
+        shared_length = (right_context + 2) * 4 + 3
+        x = torch.randn(N, num_chunks * chunk_size * 4 + shared_length, 80)
+
+        with torch.no_grad():
+            states = model.get_init_state(
+                x[:, : chunk_size * 4 + shared_length], shared_length
+            )
+            for i in range(num_chunks):
+                start = i * chunk_size * 4
+                end = start + chunk_size * 4 + shared_length
+                expected = model(x[:, start:end])[:, 1:-1]
+
+                y, states = model.streaming_forward(
+                    x[:, start + shared_length : end], states  # noqa
+                )
+                assert torch.equal(y, expected), (chunk_size, right_context, i)
+
+
+def test_conformer_streaming_forward_cached():
+    torch.manual_seed(20221018)
+    model = Conformer(
+        num_features=80,
+        d_model=64,
+        nhead=4,
+        dim_feedforward=128,
+        num_encoder_layers=2,
+        causal=True,
+    )
+    model.eval()
+
+    N = 2
+    chunk_size = 8
+    left_context = 16
+    right_context = 2
+    shared_length = (right_context + 2) * 4 + 3
+    x = torch.randn(N, 6 * chunk_size * 4 + shared_length, 80)
+
+    states = [
+        s.unsqueeze(2).expand(-1, -1, N, -1).clone()
+        for s in model.get_init_state(left_context, torch.device("cpu"))
+    ]
+    cached_states = [s.clone() for s in states]
+    processed_lens = torch.zeros(N, dtype=torch.int64)
+
+    with torch.no_grad():
+        cached_states += model.get_init_embed_state(
+            x[:, : chunk_size * 4 + shared_length], right_context
+        )
+        for i in range(6):
+            start = i * chunk_size * 4
+            end = start + chunk_size * 4 + shared_length
+            x_lens = torch.full((N,), end - start, dtype=torch.int64)
+
+            y, y_lens, states = model.streaming_forward(
+                x=x[:, start:end],
+                x_lens=x_lens,
+                states=states,
+                processed_lens=processed_lens,
+                left_context=left_context,
+                right_context=right_context,
+            )
+            cached_y, cached_y_lens, cached_states = model.streaming_forward(
+                x=x[:, start + shared_length : end],  # noqa
+                x_lens=x_lens,
+                states=cached_states,
+                processed_lens=processed_lens,
+                left_context=left_context,
+                right_context=right_context,
+            )
+            assert len(cached_states) == 6
+            assert torch.equal(y_lens, cached_y_lens)
+            assert torch.equal(y, cached_y), i
+            for s, cached_s in zip(states, cached_states):
+                assert torch.equal(s, cached_s)
+            processed_lens += y_lens
+
+
+def main():
+    test_conv2d_subsampling_streaming()
+    test_conformer_streaming_forward_cached()
+
+
+if __name__ == "__main__":
+    main()
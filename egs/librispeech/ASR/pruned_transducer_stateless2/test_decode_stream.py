@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./pruned_transducer_stateless2/test_decode_stream.py
+"""
+
+import pytest
+
+# Features of streams fed with audio samples are computed by kaldifeat
+pytest.importorskip("kaldifeat")
+
+import torch  # noqa: E402
+from decode_stream import DecodeStream  # noqa: E402
+
+from icefall.utils import AttributeDict  # noqa: E402
+
+
+def _get_params(decoding_method: str) -> AttributeDict:
+    return AttributeDict(
+        {
+            "decoding_method": decoding_method,
+            "blank_id": 0,
+            "context_size": 2,
+            "right_context": 2,
+            "subsampling_factor": 4,
+            "feature_dim": 80,
+        }
+    )
+
+
+def test_snapshot_with_waveform():
+    chunk_size = 16
+    params = _get_params("modified_beam_search")
+    states = [torch.rand(2, 5, 8)]
+    waveform = torch.rand(16000 * 3) * 2 - 1
+    pieces = waveform.split(1234)
+
+    def decode(snapshot_every: int) -> torch.Tensor:
+        stream = DecodeStream(params, cut_id="a", initial_states=states)
+        frames = []
+        for i, piece in enumerate(pieces):
+            stream.accept_waveform(16000, piece)
+            if i == len(pieces) - 1:
+                stream.input_finished()
+            if snapshot_every > 0 and i % snapshot_every == 0:
+                stream = DecodeStream.from_snapshot(stream.snapshot(), params)
+            while stream.is_ready(chunk_size):
+                frames.append(stream.get_feature_frames(chunk_size)[0])
+        assert stream.done
+        return torch.cat(frames)
+
+    expected = decode(snapshot_every=0)
+    for snapshot_every in [1, 3]:
+        frames = decode(snapshot_every=snapshot_every)
+        assert frames.shape == expected.shape
+        assert torch.allclose(frames, expected, atol=1e-4)
+
+
+def main():
+    test_snapshot_with_waveform()
+
+
+if __name__ == "__main__":
+    main()
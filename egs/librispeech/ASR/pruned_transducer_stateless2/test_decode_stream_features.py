@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./pruned_transducer_stateless2/test_decode_stream_features.py
+"""
+
+import torch
+from beam_search import Hypothesis, HypothesisList
+from decode_stream import DecodeStream
+
+from icefall.context_graph import ContextGraph
+from icefall.utils import AttributeDict
+
+
+def _get_params(decoding_method: str) -> AttributeDict:
+    return AttributeDict(
+        {
+            "decoding_method": decoding_method,
+            "blank_id": 0,
+            "context_size": 2,
+            "right_context": 2,
+            "subsampling_factor": 4,
+            "feature_dim": 80,
+        }
+    )
+
+
+def test_snapshot_with_features():
+    chunk_size = 16
+    for decoding_method in ["greedy_search", "modified_beam_search"]:
+        params = _get_params(decoding_method)
+        # Views of batched states, as in streaming_decode.py
+        states = torch.rand(2, 5, 3, 8).unbind(2)
+        stream = DecodeStream(params, cut_id="a", initial_states=states)
+        stream.set_features(torch.rand(100, 80))
+        stream.get_feature_frames(chunk_size)
+        stream.done_frames += torch.tensor(4)
+        if decoding_method == "greedy_search":
+            stream.hyp.append(5)
+        else:
+            stream.hyps.add(
+                Hypothesis(ys=[0, 0, 5], log_prob=torch.tensor([-1.0]))
+            )
+        stream.finalize_segment()
+
+        # Consumed frames are not saved
+        features = stream.state_dict()["features"]
+        assert features.size(0) == stream.num_frames - chunk_size
+
+        data = stream.snapshot()
+
+        restored = DecodeStream.from_snapshot(data, params)
+        assert restored.id == "a"
+        assert restored.done_frames == 4
+        assert restored.segments == stream.segments
+        assert restored.decoding_result() == stream.decoding_result()
+        for a, b in zip(restored.states, states):
+            assert torch.equal(a, b)
+
+        while not stream.done:
+            a, a_len = stream.get_feature_frames(chunk_size)
+            b, b_len = restored.get_feature_frames(chunk_size)
+            assert a_len == b_len
+            assert torch.equal(a, b)
+        assert restored.done
+
+
+def test_finalize_segment_with_context_graph():
+    params = _get_params("modified_beam_search")
+    states = [torch.rand(2, 5, 8)]
+    context_graph = ContextGraph([[7, 8]], context_score=3.0)
+    # The context state after token 7, i.e., a partial match of [7, 8]
+    next_states, _ = context_graph.get_next_states_and_scores(
+        torch.tensor([context_graph.root]), num_labels=10
+    )
+    partial_state = next_states[0, 7].item()
+
+    for graph in [None, context_graph]:
+        stream = DecodeStream(params, cut_id="a", initial_states=states)
+        stream.hyps = HypothesisList()
+        stream.hyps.add(
+            Hypothesis(
+                ys=[0, 0, 7],
+                log_prob=torch.tensor([-1.0]),
+                context_state=partial_state,
+            )
+        )
+        stream.hyps.add(Hypothesis(ys=[0, 0, 5], log_prob=torch.tensor([-2.0])))
+        result = stream.finalize_segment(graph)
+        if graph is None:
+            assert result == [7]
+        else:
+            # The bonus of the partial match is taken back
+            assert result == [5]
+        assert stream.decoding_result() == []
+
+
+def main():
+    test_snapshot_with_features()
+    test_finalize_segment_with_context_graph()
+
+
+if __name__ == "__main__":
+    main()
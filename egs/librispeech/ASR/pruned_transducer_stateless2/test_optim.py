@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./pruned_transducer_stateless2/test_optim.py
+"""
+
+import copy
+
+import torch
+from optim import Eve
+
+
+def _get_params(device: torch.device, dtype: torch.dtype):
+    shapes = [(20, 30), (30,), (1,), (4, 5, 6), (), (50, 2)]
+    return [
+        torch.nn.Parameter(torch.randn(s, device=device, dtype=dtype) * 0.2)
+        for s in shapes
+    ]
+
+
+def _check_eve_foreach(device: torch.device, dtype: torch.dtype):
+    torch.manual_seed(20221018)
+    params = _get_params(device, dtype)
+    foreach_params = copy.deepcopy(params)
+
+    def get_groups(params):
+        # target_rms is close to the rms of the parameters, so the weight
+        # decay is switched on and off during the steps
+        return [
+            {"params": params[:3]},
+            {"params": params[3:], "lr": 0.01, "target_rms": 0.2},
+        ]
+
+    optimizer = Eve(get_groups(params), lr=0.003)
+    foreach_optimizer = Eve(get_groups(foreach_params), lr=0.003, foreach=True)
+
+    for step in range(300):
+        for i, (p, q) in enumerate(zip(params, foreach_params)):
+            if (step + i) % 7 == 0:
+                # Parameters without gradients are skipped, so the
+                # parameters have different step counts
+                p.grad = None
+                q.grad = None
+            else:
+                p.grad = torch.randn_like(p) + p.detach()
+                q.grad = p.grad.clone()
+
+        optimizer.step()
+        foreach_optimizer.step()
+
+        for p, q in zip(params, foreach_params):
+            assert torch.equal(p, q), (step, (p - q).abs().max())
+            state = optimizer.state[p]
+            foreach_state = foreach_optimizer.state[q]
+            if len(state) == 0:
+                assert len(foreach_state) == 0
+                continue
+            assert state["step"] == foreach_state["step"]
+            assert torch.equal(state["exp_avg"], foreach_state["exp_avg"])
+            assert torch.equal(state["exp_avg_sq"], foreach_state["exp_avg_sq"])
+
+
+def test_eve_foreach():
+    devices = [torch.device("cpu")]
+    if torch.cuda.is_available():
+        devices.append(torch.device("cuda", 0))
+
+    for device in devices:
+        for dtype in (torch.float32, torch.float64):
+            _check_eve_foreach(device, dtype)
+
+
+def test_eve_foreach_state_dict():
+    params = _get_params(torch.device("cpu"), torch.float32)
+    optimizer = Eve(params)
+    for p in params:
+        p.grad = torch.ones_like(p)
+    optimizer.step()
+
+    foreach_optimizer = Eve(copy.deepcopy(params), foreach=True)
+    foreach_optimizer.load_state_dict(optimizer.state_dict())
+    assert foreach_optimizer.foreach is True
+
+
+def main():
+    test_eve_foreach()
+    test_eve_foreach_state_dict()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./pruned_transducer_stateless2/test_streaming_server.py
+"""
+
+import asyncio
+import socket
+import struct
+
+import pytest
+
+# DecodeStream computes features with kaldifeat
+pytest.importorskip("kaldifeat")
+
+import torch  # noqa: E402
+from streaming_decode import get_parser  # noqa: E402
+from streaming_server import StreamingEngine, handle_connection  # noqa: E402
+from train import get_params, get_transducer_model  # noqa: E402
+
+
+class DummySp(object):
+    def decode(self, token_ids):
+        return " ".join(map(str, token_ids))
+
+
+def _get_engine(**kwargs) -> StreamingEngine:
+    params = get_params()
+    params.update(vars(get_parser().parse_args([])))
+    params.vocab_size = 50
+    params.blank_id = 0
+    params.unk_id = 2
+    params.context_size = 2
+    params.dynamic_chunk_training = True
+    params.short_chunk_size = 25
+    params.num_left_chunks = 4
+    params.causal_convolution = True
+    params.num_encoder_layers = 2
+    params.encoder_dim = 64
+    params.nhead = 4
+    params.dim_feedforward = 128
+    params.decoder_dim = 64
+    params.joiner_dim = 64
+    params.decoding_method = "greedy_search"
+    params.decode_chunk_size = 16
+    params.left_context = 32
+    params.right_context = 0
+
+    model = get_transducer_model(params).eval()
+    model.device = torch.device("cpu")
+    return StreamingEngine(params, model, **kwargs)
+
+
+async def _reset_connection_mid_stream(engine: StreamingEngine) -> None:
+    runner = asyncio.create_task(engine.run())
+    server = await asyncio.start_server(
+        lambda r, w: handle_connection(engine, DummySp(), r, w),
+        "127.0.0.1",
+        0,
+    )
+    port = server.sockets[0].getsockname()[1]
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    data = (torch.rand(16000) - 0.5).numpy().tobytes()
+    writer.write(struct.pack("<i", len(data)) + data)
+    await writer.drain()
+
+    # Wait until the first chunk is decoded, so the stream owns a slot
+    await reader.readline()
+    assert len(engine.streams) == 1
+
+    # Close the connection with a RST instead of a FIN
+    writer.get_extra_info("socket").setsockopt(
+        socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+    )
+    writer.close()
+
+    for _ in range(100):
+        if len(engine.streams) == 0:
+            break
+        await asyncio.sleep(0.05)
+
+    server.close()
+    await server.wait_closed()
+    runner.cancel()
+
+
+def test_reset_connection():
+    engine = _get_engine(max_streams=4, max_idle_seconds=10)
+    asyncio.run(_reset_connection_mid_stream(engine))
+    assert len(engine.streams) == 0
+    assert engine.state_pool.num_free_slots == 4
+    assert len(engine._slot_owners) == 0
+    assert len(engine.stream_pool) == 0
+
+
+def main():
+    test_reset_connection()
+
+
+if __name__ == "__main__":
+    main()
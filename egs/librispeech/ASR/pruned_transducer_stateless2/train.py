@@ -62,7 +62,6 @@ from pathlib import Path
 from shutil import copyfile
 from typing import Any, Dict, Optional, Tuple, Union
 
-import k2
 import optim
 import sentencepiece as spm
 import torch
@@ -83,14 +82,20 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.tensorboard import SummaryWriter
 
 from icefall import diagnostics
-from icefall.checkpoint import load_checkpoint, remove_checkpoints
+from icefall.checkpoint import (
+    AsyncCheckpointWriter,
+    load_checkpoint,
+    remove_checkpoints,
+)
 from icefall.checkpoint import save_checkpoint as save_checkpoint_impl
 from icefall.checkpoint import save_checkpoint_with_global_batch_idx
+from icefall.dataset.targets import BpeTargets, get_token_ids
 from icefall.dist import cleanup_dist, setup_dist
 from icefall.env import get_env_info
 from icefall.utils import (
     AttributeDict,
     MetricsTracker,
+    TensorMetricsTracker,
     display_and_save_batch,
     setup_logger,
     str2bool,
@@ -310,6 +315,36 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--check-finite-loss",
+        type=str2bool,
+        default=True,
+        help="""If True, check whether the losses of a batch are finite and
+        save the batch if they are not. It synchronizes with the GPU in
+        every step. If False, inf/nan losses are dropped silently.
+        """,
+    )
+
+    parser.add_argument(
+        "--async-checkpoint",
+        type=str2bool,
+        default=False,
+        help="""If True, checkpoints are written to disk by a background
+        thread so that training does not wait for the disk write.
+        """,
+    )
+
+    parser.add_argument(
+        "--eve-foreach",
+        type=str2bool,
+        default=False,
+        help="""If True, the optimizer updates the parameters with
+        multi-tensor (torch._foreach_*) operations instead of a loop over
+        the parameters. The results are the same, but it launches fewer
+        kernels and does not synchronize with the GPU.
+        """,
+    )
+
     parser.add_argument(
         "--use-fp16",
         type=str2bool,
@@ -520,6 +555,7 @@ def save_checkpoint(
     sampler: Optional[CutSampler] = None,
     scaler: Optional[GradScaler] = None,
     rank: int = 0,
+    checkpoint_writer: Optional[AsyncCheckpointWriter] = None,
 ) -> None:
     """Save model, optimizer, scheduler and training stats to file.
 
@@ -534,11 +570,20 @@ def save_checkpoint(
        The sampler for the training dataset.
       scaler:
         The scaler used for mix precision training.
+      checkpoint_writer:
+        If not None, the checkpoint is written by it in the background.
     """
     if rank != 0:
         return
     filename = params.exp_dir / f"epoch-{params.cur_epoch}.pt"
-    save_checkpoint_impl(
+    if checkpoint_writer is not None:
+        save_impl = checkpoint_writer.save
+        copy_impl = checkpoint_writer.copyfile
+    else:
+        save_impl = save_checkpoint_impl
+        copy_impl = copyfile
+
+    save_impl(
         filename=filename,
         model=model,
         params=params,
@@ -551,11 +596,11 @@ def save_checkpoint(
 
     if params.best_train_epoch == params.cur_epoch:
         best_train_filename = params.exp_dir / "best-train-loss.pt"
-        copyfile(src=filename, dst=best_train_filename)
+        copy_impl(src=filename, dst=best_train_filename)
 
     if params.best_valid_epoch == params.cur_epoch:
         best_valid_filename = params.exp_dir / "best-valid-loss.pt"
-        copyfile(src=filename, dst=best_valid_filename)
+        copy_impl(src=filename, dst=best_valid_filename)
 
 
 def compute_loss(
@@ -593,9 +638,9 @@ def compute_loss(
     supervisions = batch["supervisions"]
     feature_lens = supervisions["num_frames"].to(device)
 
-    texts = batch["supervisions"]["text"]
-    y = sp.encode(texts, out_type=int)
-    y = k2.RaggedTensor(y).to(device)
+    # The token IDs are computed in dataloader workers
+    # if --targets-in-workers is true
+    y = get_token_ids(batch, sp, device)
 
     with torch.set_grad_enabled(is_training):
         simple_loss, pruned_loss = model(
@@ -611,7 +656,15 @@ def compute_loss(
         simple_loss_is_finite = torch.isfinite(simple_loss)
         pruned_loss_is_finite = torch.isfinite(pruned_loss)
         is_finite = simple_loss_is_finite & pruned_loss_is_finite
-        if not torch.all(is_finite):
+        if not params.check_finite_loss:
+            # Drop inf/nan losses without synchronizing with the GPU
+            simple_loss = torch.where(
+                simple_loss_is_finite, simple_loss, simple_loss.new_zeros(())
+            )
+            pruned_loss = torch.where(
+                pruned_loss_is_finite, pruned_loss, pruned_loss.new_zeros(())
+            )
+        elif not torch.all(is_finite):
             logging.info(
                 "Not all losses are finite!\n"
                 f"simple_loss: {simple_loss}\n"
@@ -649,30 +702,30 @@ def compute_loss(
 
     assert loss.requires_grad == is_training
 
-    info = MetricsTracker()
+    # The values are kept on the GPU to avoid synchronizing with it in
+    # every step. They are copied to the CPU only when they are logged.
+    info = TensorMetricsTracker()
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         # info["frames"] is an approximate number for two reasons:
         # (1) The acutal subsampling factor is ((lens - 1) // 2 - 1) // 2
         # (2) If some utterances in the batch lead to inf/nan loss, they
         #     are filtered out.
-        info["frames"] = (
-            (feature_lens // params.subsampling_factor).sum().item()
-        )
+        info["frames"] = (feature_lens // params.subsampling_factor).sum()
 
     # `utt_duration` and `utt_pad_proportion` would be normalized by `utterances`  # noqa
     info["utterances"] = feature.size(0)
     # averaged input duration in frames over utterances
-    info["utt_duration"] = feature_lens.sum().item()
+    info["utt_duration"] = feature_lens.sum()
     # averaged padding proportion over utterances
     info["utt_pad_proportion"] = (
-        ((feature.size(1) - feature_lens) / feature.size(1)).sum().item()
-    )
+        (feature.size(1) - feature_lens) / feature.size(1)
+    ).sum()
 
     # Note: We use reduction=sum while computing the loss.
-    info["loss"] = loss.detach().cpu().item()
-    info["simple_loss"] = simple_loss.detach().cpu().item()
-    info["pruned_loss"] = pruned_loss.detach().cpu().item()
+    info["loss"] = loss.detach()
+    info["simple_loss"] = simple_loss.detach()
+    info["pruned_loss"] = pruned_loss.detach()
 
     return loss, info
 
@@ -687,7 +740,7 @@ def compute_validation_loss(
     """Run the validation process."""
     model.eval()
 
-    tot_loss = MetricsTracker()
+    tot_loss = TensorMetricsTracker()
 
     for batch_idx, batch in enumerate(valid_dl):
         loss, loss_info = compute_loss(
@@ -703,6 +756,7 @@ def compute_validation_loss(
     if world_size > 1:
         tot_loss.reduce(loss.device)
 
+    tot_loss = tot_loss.to_metrics_tracker()
     loss_value = tot_loss["loss"] / tot_loss["frames"]
     if loss_value < params.best_valid_loss:
         params.best_valid_epoch = params.cur_epoch
@@ -723,6 +777,7 @@ def train_one_epoch(
     tb_writer: Optional[SummaryWriter] = None,
     world_size: int = 1,
     rank: int = 0,
+    checkpoint_writer: Optional[AsyncCheckpointWriter] = None,
 ) -> None:
     """Train the model for one epoch.
 
@@ -752,10 +807,12 @@ def train_one_epoch(
       rank:
         The rank of the node in DDP training. If no DDP is used, it should
         be set to 0.
+      checkpoint_writer:
+        If not None, checkpoints are written by it in the background.
     """
     model.train()
 
-    tot_loss = MetricsTracker()
+    tot_loss = TensorMetricsTracker()
 
     for batch_idx, batch in enumerate(train_dl):
         params.batch_idx_train += 1
@@ -792,29 +849,46 @@ def train_one_epoch(
             params.batch_idx_train > 0
             and params.batch_idx_train % params.save_every_n == 0
         ):
-            save_checkpoint_with_global_batch_idx(
-                out_dir=params.exp_dir,
-                global_batch_idx=params.batch_idx_train,
-                model=model,
-                params=params,
-                optimizer=optimizer,
-                scheduler=scheduler,
-                sampler=train_dl.sampler,
-                scaler=scaler,
-                rank=rank,
-            )
-            remove_checkpoints(
-                out_dir=params.exp_dir,
-                topk=params.keep_last_k,
-                rank=rank,
-            )
+            if checkpoint_writer is not None:
+                checkpoint_writer.save_with_global_batch_idx(
+                    out_dir=params.exp_dir,
+                    global_batch_idx=params.batch_idx_train,
+                    model=model,
+                    params=params,
+                    optimizer=optimizer,
+                    scheduler=scheduler,
+                    sampler=train_dl.sampler,
+                    scaler=scaler,
+                    keep_last_k=params.keep_last_k,
+                    rank=rank,
+                )
+            else:
+                save_checkpoint_with_global_batch_idx(
+                    out_dir=params.exp_dir,
+                    global_batch_idx=params.batch_idx_train,
+                    model=model,
+                    params=params,
+                    optimizer=optimizer,
+                    scheduler=scheduler,
+                    sampler=train_dl.sampler,
+                    scaler=scaler,
+                    rank=rank,
+                )
+                remove_checkpoints(
+                    out_dir=params.exp_dir,
+                    topk=params.keep_last_k,
+                    rank=rank,
+                )
 
         if batch_idx % params.log_interval == 0:
+            # Copy the metrics from the GPU only when they are logged
+            cur_loss_info = loss_info.to_metrics_tracker()
+            cur_tot_loss = tot_loss.to_metrics_tracker()
             cur_lr = scheduler.get_last_lr()[0]
             logging.info(
                 f"Epoch {params.cur_epoch}, "
-                f"batch {batch_idx}, loss[{loss_info}], "
-                f"tot_loss[{tot_loss}], batch size: {batch_size}, "
+                f"batch {batch_idx}, loss[{cur_loss_info}], "
+                f"tot_loss[{cur_tot_loss}], batch size: {batch_size}, "
                 f"lr: {cur_lr:.2e}"
             )
 
@@ -823,10 +897,10 @@ def train_one_epoch(
                     "train/learning_rate", cur_lr, params.batch_idx_train
                 )
 
-                loss_info.write_summary(
+                cur_loss_info.write_summary(
                     tb_writer, "train/current_", params.batch_idx_train
                 )
-                tot_loss.write_summary(
+                cur_tot_loss.write_summary(
                     tb_writer, "train/tot_", params.batch_idx_train
                 )
 
@@ -846,6 +920,7 @@ def train_one_epoch(
                     tb_writer, "train/valid_", params.batch_idx_train
                 )
 
+    tot_loss = tot_loss.to_metrics_tracker()
     loss_value = tot_loss["loss"] / tot_loss["frames"]
     params.train_loss = loss_value
     if params.train_loss < params.best_train_loss:
@@ -915,7 +990,11 @@ def run(rank, world_size, args):
         model = DDP(model, device_ids=[rank])
     model.device = device
 
-    optimizer = Eve(model.parameters(), lr=params.initial_lr)
+    optimizer = Eve(
+        model.parameters(),
+        lr=params.initial_lr,
+        foreach=params.eve_foreach,
+    )
 
     scheduler = Eden(optimizer, params.lr_batches, params.lr_epochs)
 
@@ -961,13 +1040,19 @@ def run(rank, world_size, args):
     else:
         sampler_state_dict = None
 
+    targets_fn = None
+    if params.targets_in_workers:
+        targets_fn = BpeTargets(params.bpe_model)
+
     train_dl = librispeech.train_dataloaders(
-        train_cuts, sampler_state_dict=sampler_state_dict
+        train_cuts,
+        sampler_state_dict=sampler_state_dict,
+        targets_fn=targets_fn,
     )
 
     valid_cuts = librispeech.dev_clean_cuts()
     valid_cuts += librispeech.dev_other_cuts()
-    valid_dl = librispeech.valid_dataloaders(valid_cuts)
+    valid_dl = librispeech.valid_dataloaders(valid_cuts, targets_fn=targets_fn)
 
     if params.start_batch <= 0 and not params.print_diagnostics:
         scan_pessimistic_batches_for_oom(
@@ -984,6 +1069,10 @@ def run(rank, world_size, args):
         logging.info("Loading grad scaler state dict")
         scaler.load_state_dict(checkpoints["grad_scaler"])
 
+    checkpoint_writer = None
+    if params.async_checkpoint and rank == 0:
+        checkpoint_writer = AsyncCheckpointWriter()
+
     for epoch in range(params.start_epoch, params.num_epochs):
         scheduler.step_epoch(epoch)
         fix_random_seed(params.seed + epoch)
@@ -1006,6 +1095,7 @@ def run(rank, world_size, args):
             tb_writer=tb_writer,
             world_size=world_size,
             rank=rank,
+            checkpoint_writer=checkpoint_writer,
         )
 
         if params.print_diagnostics:
@@ -1020,8 +1110,12 @@ def run(rank, world_size, args):
             sampler=train_dl.sampler,
             scaler=scaler,
             rank=rank,
+            checkpoint_writer=checkpoint_writer,
         )
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+
     logging.info("Done!")
 
     if world_size > 1:
@@ -401,6 +401,26 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--rnn-lm-prefix-tree",
+        type=str2bool,
+        default=False,
+        help="""True to run the RNN LM once per unique prefix of the n-best
+        paths during rescoring, reusing hidden states across paths that
+        share a prefix.
+        """,
+    )
+
+    parser.add_argument(
+        "--rnn-lm-max-tokens",
+        type=int,
+        default=0,
+        help="""If positive, maximum number of tokens, including padding,
+        the RNN LM processes at a time during rescoring. Use it to bound
+        memory usage for long utterances.
+        """,
+    )
+
     add_model_arguments(parser)
 
     return parser
@@ -609,6 +629,8 @@ def decode_one_batch(
             use_double_scores=True,
             nbest_scale=params.nbest_scale,
             temperature=params.temperature,
+            rnn_lm_prefix_tree=params.rnn_lm_prefix_tree,
+            rnn_lm_max_tokens=params.rnn_lm_max_tokens,
         )
     else:
         batch_size = encoder_out.size(0)
@@ -26,6 +26,11 @@ Usage:
         --exp-dir ./pruned_transducer_stateless5/exp \
         --decoding_method greedy_search \
         --num-decode-streams 200
+
+To split long streams into segments at endpoints, add
+
+        --endpoint 1 \
+        --endpoint-rule2-min-trailing-silence 1.2
 """
 
 import argparse
@@ -57,6 +62,7 @@ from icefall.checkpoint import (
     find_checkpoints,
     load_checkpoint,
 )
+from icefall.endpoint import EndpointRule, Endpointer
 from icefall.utils import (
     AttributeDict,
     setup_logger,
@@ -207,6 +213,41 @@ def get_parser():
         help="The number of streams that can be decoded parallel.",
     )
 
+    parser.add_argument(
+        "--endpoint",
+        type=str2bool,
+        default=False,
+        help="""If True, detect endpoints with Kaldi-style rules. At each
+        endpoint, the result so far is finalized as a segment and the
+        hypotheses and decoder context of the stream are reset, while the
+        encoder state is kept. Used only when --decoding-method is
+        greedy_search or modified_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-rule1-min-trailing-silence",
+        type=float,
+        default=2.4,
+        help="""An endpoint is detected after this many seconds of trailing
+        silence, even if nothing has been decoded.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-rule2-min-trailing-silence",
+        type=float,
+        default=1.2,
+        help="""An endpoint is detected after this many seconds of trailing
+        silence if something has been decoded.""",
+    )
+
+    parser.add_argument(
+        "--endpoint-rule3-min-utterance-length",
+        type=float,
+        default=20.0,
+        help="""An endpoint is detected once a segment is this many seconds
+        long.""",
+    )
+
     add_model_arguments(parser)
 
     return parser
@@ -216,6 +257,7 @@ def decode_one_chunk(
     params: AttributeDict,
     model: nn.Module,
     decode_streams: List[DecodeStream],
+    endpointer: Optional[Endpointer] = None,
 ) -> List[int]:
     """Decode one chunk frames of features for each decode_streams and
     return the indexes of finished streams in a List.
@@ -227,6 +269,9 @@ def decode_one_chunk(
         The neural model.
       decode_streams:
         A List of DecodeStream, each belonging to a utterance.
+      endpointer:
+        If not None, it is used to detect endpoints of the streams that are
+        not finished.
     Returns:
       Return a List containing which DecodeStreams are finished.
     """
@@ -318,6 +363,14 @@ def decode_one_chunk(
         decode_streams[i].done_frames += encoder_out_lens[i]
         if decode_streams[i].done:
             finished_streams.append(i)
+        elif endpointer is not None:
+            stream = decode_streams[i]
+            if endpointer(
+                contains_nonsilence=len(stream.decoding_result()) > 0,
+                num_trailing_blanks=stream.get_num_trailing_blanks(),
+                num_frames=int(stream.done_frames) - stream.segment_start_frame,
+            ):
+                stream.finalize_segment()
 
     return finished_streams
 
@@ -328,6 +381,7 @@ def decode_dataset(
     model: nn.Module,
     sp: spm.SentencePieceProcessor,
     decoding_graph: Optional[k2.Fsa] = None,
+    endpointer: Optional[Endpointer] = None,
 ) -> Dict[str, List[Tuple[List[str], List[str]]]]:
     """Decode dataset.
 
@@ -343,6 +397,8 @@ def decode_dataset(
       decoding_graph:
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding_method is fast_beam_search.
+      endpointer:
+        If not None, it is used to split the streams into segments.
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
       is used, or it may be "beam_7" if beam size of 7 is used.
@@ -362,6 +418,7 @@ def decode_dataset(
     log_interval = 50
 
     decode_results = []
+    num_segments = 0
     # Contain decode streams currently running.
     decode_streams = []
     initial_states = model.encoder.get_init_state(
@@ -397,16 +454,20 @@ def decode_dataset(
 
         while len(decode_streams) >= params.num_decode_streams:
             finished_streams = decode_one_chunk(
-                params=params, model=model, decode_streams=decode_streams
+                params=params,
+                model=model,
+                decode_streams=decode_streams,
+                endpointer=endpointer,
             )
             for i in sorted(finished_streams, reverse=True):
                 decode_results.append(
                     (
                         decode_streams[i].id,
                         decode_streams[i].ground_truth.split(),
-                        sp.decode(decode_streams[i].decoding_result()).split(),
+                        sp.decode(decode_streams[i].final_result()).split(),
                     )
                 )
+                num_segments += len(decode_streams[i].segments) + 1
                 del decode_streams[i]
 
         if num % log_interval == 0:
@@ -415,18 +476,25 @@ def decode_dataset(
     # decode final chunks of last sequences
     while len(decode_streams):
         finished_streams = decode_one_chunk(
-            params=params, model=model, decode_streams=decode_streams
+            params=params,
+            model=model,
+            decode_streams=decode_streams,
+            endpointer=endpointer,
         )
         for i in sorted(finished_streams, reverse=True):
             decode_results.append(
                 (
                     decode_streams[i].id,
                     decode_streams[i].ground_truth.split(),
-                    sp.decode(decode_streams[i].decoding_result()).split(),
+                    sp.decode(decode_streams[i].final_result()).split(),
                 )
             )
+            num_segments += len(decode_streams[i].segments) + 1
             del decode_streams[i]
 
+    if endpointer is not None:
+        logging.info(f"Number of segments: {num_segments}")
+
     if params.decoding_method == "greedy_search":
         key = "greedy_search"
     elif params.decoding_method == "fast_beam_search":
@@ -520,6 +588,13 @@ def main():
     if params.use_averaged_model:
         params.suffix += "-use-averaged-model"
 
+    if params.endpoint:
+        assert params.decoding_method in (
+            "greedy_search",
+            "modified_beam_search",
+        ), params.decoding_method
+        params.suffix += "-endpoint"
+
     setup_logger(f"{params.res_dir}/log-decode-{params.suffix}")
     logging.info("Decoding started")
 
@@ -630,6 +705,36 @@ def main():
     if params.decoding_method == "fast_beam_search":
         decoding_graph = k2.trivial_graph(params.vocab_size - 1, device=device)
 
+    endpointer = None
+    if params.endpoint:
+        endpointer = Endpointer(
+            # 10 ms frame shift before subsampling
+            frame_shift=0.01 * params.subsampling_factor,
+            rules=[
+                EndpointRule(
+                    must_contain_nonsilence=False,
+                    min_trailing_silence=(
+                        params.endpoint_rule1_min_trailing_silence
+                    ),
+                    min_utterance_length=0.0,
+                ),
+                EndpointRule(
+                    must_contain_nonsilence=True,
+                    min_trailing_silence=(
+                        params.endpoint_rule2_min_trailing_silence
+                    ),
+                    min_utterance_length=0.0,
+                ),
+                EndpointRule(
+                    must_contain_nonsilence=False,
+                    min_trailing_silence=0.0,
+                    min_utterance_length=(
+                        params.endpoint_rule3_min_utterance_length
+                    ),
+                ),
+            ],
+        )
+
     num_param = sum([p.numel() for p in model.parameters()])
     logging.info(f"Number of model parameters: {num_param}")
 
@@ -648,6 +753,7 @@ def main():
             model=model,
             sp=sp,
             decoding_graph=decoding_graph,
+            endpointer=endpointer,
         )
 
         save_results(
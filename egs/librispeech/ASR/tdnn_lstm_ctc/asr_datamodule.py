@@ -21,7 +21,7 @@ import inspect
 import logging
 from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Optional
 
 import torch
 from lhotse import CutSet, Fbank, FbankConfig, load_manifest, load_manifest_lazy
@@ -41,6 +41,7 @@ from lhotse.dataset.input_strategies import (  # noqa F401 For AudioSamples
 from lhotse.utils import fix_random_seed
 from torch.utils.data import DataLoader
 
+from icefall.dataset.targets import TargetsDataset
 from icefall.utils import str2bool
 
 
@@ -208,10 +209,21 @@ class LibriSpeechAsrDataModule:
             help="AudioSamples or PrecomputedFeatures",
         )
 
+        group.add_argument(
+            "--targets-in-workers",
+            type=str2bool,
+            default=False,
+            help="When enabled, training targets, e.g., BPE token IDs or "
+            "supervision graphs, are computed in the dataloader workers "
+            "and shipped with each batch. Supported by conformer_ctc, "
+            "conformer_mmi and pruned_transducer_stateless2.",
+        )
+
     def train_dataloaders(
         self,
         cuts_train: CutSet,
         sampler_state_dict: Optional[Dict[str, Any]] = None,
+        targets_fn: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
     ) -> DataLoader:
         """
         Args:
@@ -219,6 +231,10 @@ class LibriSpeechAsrDataModule:
             CutSet for training.
           sampler_state_dict:
             The state dict for the training sampler.
+          targets_fn:
+            If not None, it is called with `batch["supervisions"]` in the
+            dataloader workers and its return value is saved in
+            `batch["targets"]`. See :mod:`icefall.dataset.targets`.
         """
         transforms = []
         if self.args.enable_musan:
@@ -305,6 +321,14 @@ class LibriSpeechAsrDataModule:
                 return_cuts=self.args.return_cuts,
             )
 
+        if targets_fn is not None:
+            train = TargetsDataset(train, targets_fn)
+        elif self.args.targets_in_workers:
+            logging.warning(
+                "--targets-in-workers is not supported by this recipe. "
+                "Targets are computed in the training process."
+            )
+
         if self.args.bucketing_sampler:
             logging.info("Using DynamicBucketingSampler.")
             train_sampler = DynamicBucketingSampler(
@@ -332,18 +356,25 @@ class LibriSpeechAsrDataModule:
         seed = torch.randint(0, 100000, ()).item()
         worker_init_fn = _SeedWorkers(seed)
 
+        # With targets_fn, workers are kept alive across epochs, so that
+        # what targets_fn caches in them, e.g., compiled graphs, is reused.
         train_dl = DataLoader(
             train,
             sampler=train_sampler,
             batch_size=None,
             num_workers=self.args.num_workers,
-            persistent_workers=False,
+            persistent_workers=targets_fn is not None
+            and self.args.num_workers > 0,
             worker_init_fn=worker_init_fn,
         )
 
         return train_dl
 
-    def valid_dataloaders(self, cuts_valid: CutSet) -> DataLoader:
+    def valid_dataloaders(
+        self,
+        cuts_valid: CutSet,
+        targets_fn: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+    ) -> DataLoader:
         transforms = []
         if self.args.concatenate_cuts:
             transforms = [
@@ -366,6 +397,10 @@ class LibriSpeechAsrDataModule:
                 cut_transforms=transforms,
                 return_cuts=self.args.return_cuts,
             )
+
+        if targets_fn is not None:
+            validate = TargetsDataset(validate, targets_fn)
+
         valid_sampler = DynamicBucketingSampler(
             cuts_valid,
             max_duration=self.args.max_duration,
@@ -377,7 +412,7 @@ class LibriSpeechAsrDataModule:
             sampler=valid_sampler,
             batch_size=None,
             num_workers=2,
-            persistent_workers=False,
+            persistent_workers=targets_fn is not None,
         )
 
         return valid_dl
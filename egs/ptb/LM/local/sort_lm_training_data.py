@@ -27,6 +27,7 @@ Sentence length equals to the number of BPE tokens in a sentence.
 import argparse
 import logging
 from pathlib import Path
+from typing import Tuple
 
 import k2
 import numpy as np
@@ -56,15 +57,45 @@ def get_args():
     return parser.parse_args()
 
 
-def main():
-    args = get_args()
-    in_lm_data = Path(args.in_lm_data)
-    out_lm_data = Path(args.out_lm_data)
-    assert in_lm_data.is_file(), f"{in_lm_data}"
-    if out_lm_data.is_file():
-        logging.warning(f"{out_lm_data} exists - skipping")
-        return
-    data = torch.load(in_lm_data)
+def compute_sentence_lengths(
+    words: k2.RaggedTensor, sentences: k2.RaggedTensor
+) -> torch.Tensor:
+    """Compute the number of BPE tokens of each sentence.
+
+    Args:
+      words:
+        A ragged tensor with 2 axes [word][token].
+      sentences:
+        A ragged tensor with 2 axes [sentence][word].
+    Returns:
+      Return a 1-D tensor of dtype torch.int32 containing the number of
+      tokens of each sentence.
+    """
+    words_row_splits = words.shape.row_splits(1)
+    word_lengths = (words_row_splits[1:] - words_row_splits[:-1]).to(
+        torch.int64
+    )
+
+    sentence_ids = sentences.shape.row_ids(1).to(torch.int64)
+    token_counts = word_lengths[sentences.values.to(torch.int64)]
+
+    sentence_lengths = torch.zeros(sentences.dim0, dtype=torch.int64)
+    sentence_lengths.index_add_(0, sentence_ids, token_counts)
+    return sentence_lengths.to(torch.int32)
+
+
+def sort_lm_data(data: dict) -> Tuple[dict, torch.Tensor]:
+    """Sort sentences by length in descending order.
+
+    Args:
+      data:
+        A dict with keys "words", "sentences" and "sentence_lengths".
+        See ./prepare_lm_training_data.py
+    Returns:
+      Return a tuple containing:
+        - a dict of the same format as `data` with sentences sorted
+        - the indexes used for sorting
+    """
     words2bpe = data["words"]
     sentences = data["sentences"]
     sentence_lengths = data["sentence_lengths"]
@@ -86,26 +117,34 @@ def main():
         sorted_sentences.dim0,
     )
 
-    cur = None
-    for i in range(num_sentences):
-        word_ids = sorted_sentences[i]
-        token_ids = words2bpe[word_ids]
-        if isinstance(token_ids, k2.RaggedTensor):
-            token_ids = token_ids.values
-        if cur is not None:
-            assert cur >= token_ids.numel(), (cur, token_ids.numel())
-
-        cur = token_ids.numel()
-        assert cur == sorted_sentence_lengths[i]
+    lengths = compute_sentence_lengths(words2bpe, sorted_sentences)
+    assert torch.equal(lengths, sorted_sentence_lengths)
+    assert torch.all(lengths[:-1] >= lengths[1:])
 
+    data = dict(data)
     data["sentences"] = sorted_sentences
     data["sentence_lengths"] = sorted_sentence_lengths
-    torch.save(data, args.out_lm_data)
-    logging.info(f"Saved to {args.out_lm_data}")
-
-    statistics = Path(args.out_statistics)
-
-    # Write statistics
+    return data, indices
+
+
+def write_statistics(
+    filename: str,
+    sorted_sentences: k2.RaggedTensor,
+    sentence_lengths: torch.Tensor,
+    indices: torch.Tensor,
+):
+    """
+    Args:
+      filename:
+        The file to write.
+      sorted_sentences:
+        A ragged tensor with 2 axes [sentence][word], sorted by length.
+      sentence_lengths:
+        Number of tokens of each sentence, before sorting.
+      indices:
+        The indexes that sort `sentence_lengths` in descending order.
+    """
+    num_sentences = sorted_sentences.dim0
     num_words = sorted_sentences.numel()
     num_tokens = sentence_lengths.sum().item()
     max_sentence_length = sentence_lengths[indices[0]]
@@ -119,7 +158,7 @@ def main():
 
     histogram = np.stack((bins[:-1], hist)).transpose()
 
-    with open(statistics, "w") as f:
+    with open(filename, "w") as f:
         f.write(f"num_sentences: {num_sentences}\n")
         f.write(f"num_words: {num_words}\n")
         f.write(f"num_tokens: {num_tokens}\n")
@@ -134,6 +173,30 @@ def main():
             )
 
 
+def main():
+    args = get_args()
+    in_lm_data = Path(args.in_lm_data)
+    out_lm_data = Path(args.out_lm_data)
+    assert in_lm_data.is_file(), f"{in_lm_data}"
+    if out_lm_data.is_file():
+        logging.warning(f"{out_lm_data} exists - skipping")
+        return
+    data = torch.load(in_lm_data)
+    sentence_lengths = data["sentence_lengths"]
+
+    data, indices = sort_lm_data(data)
+
+    torch.save(data, args.out_lm_data)
+    logging.info(f"Saved to {args.out_lm_data}")
+
+    write_statistics(
+        args.out_statistics,
+        sorted_sentences=data["sentences"],
+        sentence_lengths=sentence_lengths,
+        indices=indices,
+    )
+
+
 if __name__ == "__main__":
     formatter = (
         "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
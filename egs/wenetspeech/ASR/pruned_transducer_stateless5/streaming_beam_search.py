@@ -15,14 +15,21 @@
 # limitations under the License.
 
 import warnings
-from typing import List
+from typing import List, Optional
 
 import k2
 import torch
 import torch.nn as nn
-from beam_search import Hypothesis, HypothesisList, get_hyps_shape
+from beam_search import (
+    Hypothesis,
+    HypothesisList,
+    finalize_context_scores,
+    get_context_scores,
+    get_hyps_shape,
+)
 from decode_stream import DecodeStream
 
+from icefall.context_graph import ContextGraph
 from icefall.decode import one_best_decoding
 from icefall.utils import get_texts
 
@@ -63,16 +70,14 @@ def greedy_search(
         current_encoder_out = encoder_out[:, t : t + 1, :]  # noqa
         # print(current_encoder_out.shape)
 
-        logits = model.joiner(
-            current_encoder_out.unsqueeze(2),
-            decoder_out.unsqueeze(1),
-            project_input=False,
+        _, y, _ = model.joiner.topk(
+            current_encoder_out.squeeze(1),
+            decoder_out.squeeze(1),
+            k=1,
+            blank_id=blank_id,
         )
-        # logits'shape (batch_size,  vocab_size)
-        logits = logits.squeeze(1).squeeze(1)
-
-        assert logits.ndim == 2, logits.shape
-        y = logits.argmax(dim=1).tolist()
+        # y's shape: (batch_size, 1)
+        y = y.squeeze(1).tolist()
         emitted = False
         for i, v in enumerate(y):
             if v != blank_id:
@@ -97,6 +102,7 @@ def modified_beam_search(
     encoder_out: torch.Tensor,
     streams: List[DecodeStream],
     num_active_paths: int = 4,
+    context_graph: Optional[ContextGraph] = None,
 ) -> None:
     """Beam search in batch mode with --max-sym-per-frame=1 being hardcoded.
     Args:
@@ -109,6 +115,10 @@ def modified_beam_search(
         A list of stream objects.
       num_active_paths:
         Number of active paths during the beam search.
+      context_graph:
+        If not None, the context graph used for contextual biasing. The
+        context scores of unfinished partial matches are taken back once
+        a stream is done.
     """
     assert encoder_out.ndim == 3, encoder_out.shape
     assert len(streams) == encoder_out.size(0)
@@ -121,6 +131,9 @@ def modified_beam_search(
 
     B = [stream.hyps for stream in streams]
 
+    # Number of tokens per hypothesis to consider at each frame
+    num_tokens = min(num_active_paths, model.decoder.vocab_size)
+
     for t in range(T):
         current_encoder_out = encoder_out[:, t].unsqueeze(1).unsqueeze(1)
         # current_encoder_out's shape: (batch_size, 1, 1, encoder_out_dim)
@@ -152,30 +165,55 @@ def modified_beam_search(
             index=hyps_shape.row_ids(1).to(torch.int64),
         )  # (num_hyps, encoder_out_dim)
 
-        logits = model.joiner(
-            current_encoder_out,
-            decoder_out.unsqueeze(1),
-            project_input=False,
-        )
-        # logits is of shape (num_hyps, 1, 1, vocab_size)
-
-        logits = logits.squeeze(1).squeeze(1)
-
-        log_probs = logits.log_softmax(dim=-1)  # (num_hyps, vocab_size)
+        # Only the `num_active_paths` most probable tokens of each
+        # hypothesis can be among the best paths of a stream
+        if context_graph is None:
+            hyp_log_probs, hyp_tokens, _ = model.joiner.topk(
+                current_encoder_out.squeeze(1).squeeze(1),
+                decoder_out.squeeze(1),
+                k=num_tokens,
+                blank_id=blank_id,
+            )  # (num_hyps, num_tokens)
+        else:
+            logits = model.joiner(
+                current_encoder_out.squeeze(1).squeeze(1),
+                decoder_out.squeeze(1),
+                project_input=False,
+            )  # (num_hyps, vocab_size)
+            hyp_log_probs = logits.log_softmax(dim=-1)
+
+            context_states = torch.tensor(
+                [hyp.context_state for hyps in A for hyp in hyps],
+                device=device,
+                dtype=torch.int64,
+            )
+            next_context_states, context_scores = get_context_scores(
+                context_graph,
+                context_states,
+                num_labels=hyp_log_probs.size(1),
+                blank_id=blank_id,
+                unk_id=blank_id,
+            )
+            hyp_log_probs.add_(context_scores)
 
-        log_probs.add_(ys_log_probs)
+            hyp_log_probs, hyp_tokens = hyp_log_probs.topk(num_tokens, dim=1)
+            hyp_next_context_states = next_context_states.gather(
+                1, hyp_tokens
+            ).reshape(-1)
 
-        vocab_size = log_probs.size(-1)
+        hyp_log_probs.add_(ys_log_probs)
 
-        log_probs = log_probs.reshape(-1)
+        hyp_log_probs = hyp_log_probs.reshape(-1)
+        hyp_tokens = hyp_tokens.reshape(-1)
 
-        row_splits = hyps_shape.row_splits(1) * vocab_size
+        row_splits = hyps_shape.row_splits(1) * num_tokens
         log_probs_shape = k2.ragged.create_ragged_shape2(
-            row_splits=row_splits, cached_tot_size=log_probs.numel()
+            row_splits=row_splits, cached_tot_size=hyp_log_probs.numel()
         )
         ragged_log_probs = k2.RaggedTensor(
-            shape=log_probs_shape, value=log_probs
+            shape=log_probs_shape, value=hyp_log_probs
         )
+        row_splits = row_splits.tolist()
 
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(
@@ -184,8 +222,14 @@ def modified_beam_search(
 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                topk_hyp_indexes = (topk_indexes // vocab_size).tolist()
-                topk_token_indexes = (topk_indexes % vocab_size).tolist()
+                topk_hyp_indexes = (topk_indexes // num_tokens).tolist()
+            topk_token_indexes = hyp_tokens[
+                topk_indexes.to(torch.int64) + row_splits[i]
+            ].tolist()
+            if context_graph is not None:
+                topk_context_states = hyp_next_context_states[
+                    topk_indexes.to(torch.int64) + row_splits[i]
+                ].tolist()
 
             for k in range(len(topk_hyp_indexes)):
                 hyp_idx = topk_hyp_indexes[k]
@@ -198,9 +242,13 @@ def modified_beam_search(
 
                 new_log_prob = topk_log_probs[k]
                 new_hyp = Hypothesis(ys=new_ys, log_prob=new_log_prob)
+                if context_graph is not None:
+                    new_hyp.context_state = topk_context_states[k]
                 B[i].add(new_hyp)
 
     for i in range(batch_size):
+        if context_graph is not None and streams[i].done:
+            B[i] = finalize_context_scores(B[i], context_graph)
         streams[i].hyps = B[i]
 
 
@@ -9,6 +9,7 @@ from . import (
 )
 
 from .checkpoint import (
+    AsyncCheckpointWriter,
     average_checkpoints,
     find_checkpoints,
     load_checkpoint,
@@ -42,6 +43,7 @@ from .env import (
 from .utils import (
     AttributeDict,
     MetricsTracker,
+    TensorMetricsTracker,
     add_eos,
     add_sos,
     concat,
@@ -66,4 +68,10 @@ from .utils import (
     write_error_stats,
 )
 
-from .ngram_lm import NgramLm, NgramLmStateCost
+from .ngram_lm import CompiledNgramLm, NgramLm, NgramLmStateCost
+
+from .context_graph import ContextGraph, get_context_graph
+
+from .endpoint import EndpointRule, Endpointer, get_default_endpoint_rules
+
+from .stream_pool import StreamPool, pack_state, unpack_state
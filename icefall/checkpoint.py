@@ -16,12 +16,21 @@
 # limitations under the License.
 
 
+import atexit
+import contextlib
+import copy
 import glob
+import hashlib
 import logging
 import os
+import pickle
+import queue
 import re
+import shutil
+import threading
+import zipfile
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -74,6 +83,29 @@ def save_checkpoint(
 
     logging.info(f"Saving checkpoint to {filename}")
 
+    checkpoint = _make_checkpoint(
+        model=model,
+        model_avg=model_avg,
+        params=params,
+        optimizer=optimizer,
+        scheduler=scheduler,
+        scaler=scaler,
+        sampler=sampler,
+    )
+
+    torch.save(checkpoint, filename)
+
+
+def _make_checkpoint(
+    model: Union[nn.Module, DDP],
+    model_avg: Optional[nn.Module] = None,
+    params: Optional[Dict[str, Any]] = None,
+    optimizer: Optional[Optimizer] = None,
+    scheduler: Optional[LRSchedulerType] = None,
+    scaler: Optional[GradScaler] = None,
+    sampler: Optional[CutSampler] = None,
+) -> Dict[str, Any]:
+    """Return the dict saved by :func:`save_checkpoint`."""
     if isinstance(model, DDP):
         model = model.module
 
@@ -93,7 +125,7 @@ def save_checkpoint(
             assert k not in checkpoint
             checkpoint[k] = v
 
-    torch.save(checkpoint, filename)
+    return checkpoint
 
 
 def load_checkpoint(
@@ -146,47 +178,268 @@ def load_checkpoint(
     return checkpoint
 
 
+class _LazyTensor(object):
+    """A tensor in a checkpoint whose data has not been read yet."""
+
+    def __init__(
+        self,
+        key: str,
+        dtype: torch.dtype,
+        storage_offset: int,
+        size: Tuple[int, ...],
+        stride: Tuple[int, ...],
+    ):
+        self.key = key
+        self.dtype = dtype
+        self.storage_offset = storage_offset
+        self.size = tuple(size)
+        self.stride = tuple(stride)
+
+    @property
+    def identity(self) -> Tuple:
+        """Two lazy tensors with the same identity share their data."""
+        return (self.key, self.storage_offset, self.size, self.stride)
+
+
+class _LazyCheckpoint(object):
+    """Read a checkpoint saved by `torch.save()` without reading its tensors.
+
+    Only the pickled structure of the checkpoint is loaded. Tensors in it
+    are replaced by :class:`_LazyTensor`, whose data is read from the zip
+    archive by :func:`load_tensor` when needed. So reading the model from
+    a checkpoint does not read the optimizer state, etc.
+    """
+
+    def __init__(self, filename: Union[str, Path]):
+        self.zip_file = zipfile.ZipFile(filename)
+        try:
+            pickle_file = [
+                n for n in self.zip_file.namelist() if n.endswith("/data.pkl")
+            ]
+            assert len(pickle_file) == 1, pickle_file
+            self.prefix = pickle_file[0][: -len("data.pkl")]
+
+            with self.zip_file.open(pickle_file[0]) as f:
+                unpickler = _LazyUnpickler(f)
+                self.checkpoint = unpickler.load()
+        except BaseException:
+            self.zip_file.close()
+            raise
+
+    def close(self) -> None:
+        self.zip_file.close()
+
+    def load_tensor(self, t: _LazyTensor) -> Tensor:
+        """Read the data of the given lazy tensor from disk."""
+        data = bytearray(self.zip_file.read(f"{self.prefix}data/{t.key}"))
+        if len(data) == 0:
+            storage = torch.empty(0, dtype=t.dtype)
+        else:
+            storage = torch.frombuffer(data, dtype=t.dtype)
+        return storage.as_strided(t.size, t.stride, t.storage_offset)
+
+
+class _LazyUnpickler(pickle.Unpickler):
+    def find_class(self, mod_name, name):
+        if type(name) is str and "Storage" in name:
+            # The dtype of a storage, e.g., torch.FloatStorage
+            if name == "UntypedStorage":
+                return torch.uint8
+            return getattr(torch, name).dtype
+        if mod_name == "torch._utils" and name == "_rebuild_tensor_v2":
+            return _rebuild_lazy_tensor
+        if mod_name == "torch._utils" and name == "_rebuild_tensor_v3":
+            return _rebuild_lazy_tensor_v3
+        if mod_name == "torch._utils" and name == "_rebuild_parameter":
+            return _rebuild_lazy_parameter
+        if mod_name == "torch.tensor":
+            mod_name = "torch._tensor"
+        return super().find_class(mod_name, name)
+
+    def persistent_load(self, saved_id):
+        typename, dtype, key, location, numel = saved_id
+        assert typename in ("storage", b"storage"), typename
+        return (key, dtype)
+
+
+def _rebuild_lazy_tensor(
+    storage, storage_offset, size, stride, requires_grad, *args
+):
+    key, dtype = storage
+    return _LazyTensor(
+        key=key,
+        dtype=dtype,
+        storage_offset=storage_offset,
+        size=size,
+        stride=stride,
+    )
+
+
+def _rebuild_lazy_tensor_v3(
+    storage, storage_offset, size, stride, requires_grad, hooks, dtype, *args
+):
+    key, _ = storage
+    return _LazyTensor(
+        key=key,
+        dtype=dtype,
+        storage_offset=storage_offset,
+        size=size,
+        stride=stride,
+    )
+
+
+def _rebuild_lazy_parameter(data, requires_grad, *args):
+    return data
+
+
+@contextlib.contextmanager
+def _open_checkpoint(
+    filename: Union[str, Path]
+) -> Iterator[Tuple[Dict[str, Any], Any]]:
+    """Open a checkpoint for reading its tensors lazily. The checkpoint
+    file is closed when the context exits.
+
+    Returns:
+      Return a tuple containing:
+        - the checkpoint in which tensors may be :class:`_LazyTensor`
+        - a function that converts a value of the checkpoint to a tensor
+    """
+    if zipfile.is_zipfile(filename):
+        try:
+            ckpt = _LazyCheckpoint(filename)
+        except Exception as e:
+            logging.warning(
+                f"Failed to read {filename} lazily: {e}. Load it fully"
+            )
+        else:
+
+            def load_tensor(t):
+                if isinstance(t, _LazyTensor):
+                    return ckpt.load_tensor(t)
+                return t
+
+            try:
+                yield ckpt.checkpoint, load_tensor
+            finally:
+                ckpt.close()
+            return
+
+    # For the legacy format
+    yield torch.load(filename, map_location="cpu"), lambda t: t
+
+
+def _get_identity(t: Union[Tensor, _LazyTensor]) -> Any:
+    if isinstance(t, _LazyTensor):
+        return t.identity
+    return t.data_ptr()
+
+
+def _averaged_model_cache_filename(
+    cache_dir: Union[str, Path], filenames: List[Union[str, Path]], tag: str
+) -> Path:
+    """Return the cache filename for an averaged model, which depends on the
+    given checkpoints and their modification time."""
+    h = hashlib.sha1(tag.encode())
+    for f in filenames:
+        st = os.stat(f)
+        h.update(f"{Path(f).resolve()}:{st.st_mtime_ns}:{st.st_size}".encode())
+    return Path(cache_dir) / f"{tag}-{h.hexdigest()[:16]}.pt"
+
+
+def _load_cached_average(
+    cache_dir: Optional[Union[str, Path]],
+    filenames: List[Union[str, Path]],
+    tag: str,
+    device: torch.device,
+) -> Tuple[Optional[Path], Optional[Dict[str, Tensor]]]:
+    if cache_dir is None:
+        return None, None
+    cache_file = _averaged_model_cache_filename(cache_dir, filenames, tag)
+    if cache_file.is_file():
+        logging.info(f"Loading averaged model from {cache_file}")
+        return cache_file, torch.load(cache_file, map_location=device)
+    return cache_file, None
+
+
+def _save_cached_average(
+    cache_file: Optional[Path], state_dict: Dict[str, Tensor]
+) -> None:
+    if cache_file is None:
+        return
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_file.with_suffix(f".tmp{os.getpid()}")
+    torch.save(state_dict, tmp)
+    os.replace(tmp, cache_file)
+    logging.info(f"Saved averaged model to {cache_file}")
+
+
 def average_checkpoints(
-    filenames: List[Path], device: torch.device = torch.device("cpu")
+    filenames: List[Path],
+    device: torch.device = torch.device("cpu"),
+    cache_dir: Optional[Union[str, Path]] = None,
 ) -> dict:
     """Average a list of checkpoints.
 
+    Only the model is read from the checkpoints, one tensor at a time,
+    and the sum is accumulated in float64.
+
     Args:
       filenames:
         Filenames of the checkpoints to be averaged. We assume all
         checkpoints are saved by :func:`save_checkpoint`.
       device:
         Move checkpoints to this device before averaging.
+      cache_dir:
+        If not None, the averaged model is saved in this directory and
+        reused as long as the given checkpoints are not modified.
     Returns:
       Return a dict (i.e., state_dict) which is the average of all
       model state dicts contained in the checkpoints.
     """
-    n = len(filenames)
-
-    avg = torch.load(filenames[0], map_location=device)["model"]
-
-    # Identify shared parameters. Two parameters are said to be shared
-    # if they have the same data_ptr
-    uniqued: Dict[int, str] = dict()
-
-    for k, v in avg.items():
-        v_data_ptr = v.data_ptr()
-        if v_data_ptr in uniqued:
-            continue
-        uniqued[v_data_ptr] = k
-
-    uniqued_names = list(uniqued.values())
-
-    for i in range(1, n):
-        state_dict = torch.load(filenames[i], map_location=device)["model"]
-        for k in uniqued_names:
-            avg[k] += state_dict[k]
+    cache_file, avg = _load_cached_average(
+        cache_dir, filenames, tag="avg", device=device
+    )
+    if avg is not None:
+        return avg
 
-    for k in uniqued_names:
-        if avg[k].is_floating_point():
-            avg[k] /= n
-        else:
-            avg[k] //= n
+    n = len(filenames)
+    with contextlib.ExitStack() as stack:
+        checkpoints = [
+            stack.enter_context(_open_checkpoint(f)) for f in filenames
+        ]
+        state_dicts = [c["model"] for c, _ in checkpoints]
+
+        avg = dict()
+
+        # Identify shared parameters. Two parameters are said to be shared
+        # if they have the same data
+        uniqued: Dict[Any, str] = dict()
+
+        for k, v in state_dicts[0].items():
+            identity = _get_identity(v)
+            if identity in uniqued:
+                avg[k] = avg[uniqued[identity]]
+                continue
+            uniqued[identity] = k
+
+            tensors = (
+                load_tensor(s[k])
+                for s, (_, load_tensor) in zip(state_dicts, checkpoints)
+            )
+            t = next(tensors)
+            dtype = t.dtype
+            if t.is_floating_point():
+                acc = t.to(torch.float64)
+                for t in tensors:
+                    acc += t
+                avg[k] = (acc / n).to(device=device, dtype=dtype)
+            else:
+                acc = t.to(torch.int64)
+                for t in tensors:
+                    acc += t
+                avg[k] = (acc // n).to(device=device, dtype=dtype)
+
+    _save_cached_average(cache_file, avg)
 
     return avg
 
@@ -347,6 +600,250 @@ def remove_checkpoints(
         os.remove(c)
 
 
+class AsyncCheckpointWriter(object):
+    """Save checkpoints on a background thread.
+
+    Calling :meth:`save` copies all tensors of the checkpoint to CPU
+    buffers, which are pinned and reused for CUDA tensors, and returns
+    immediately. The checkpoint is then written by a background thread to
+    a temporary file, which is renamed to the given filename once it has
+    been written completely. Removing old checkpoints and copying files are
+    queued after the pending saves, so they see the files written by them.
+
+    All pending work is finished by :meth:`close`, which is also called
+    when the program exits.
+
+    Usage::
+
+        writer = AsyncCheckpointWriter()
+        writer.save_with_global_batch_idx(
+            out_dir=params.exp_dir,
+            global_batch_idx=params.batch_idx_train,
+            model=model,
+            optimizer=optimizer,
+            keep_last_k=params.keep_last_k,
+            rank=rank,
+        )
+        ...
+        writer.close()
+    """
+
+    def __init__(self, pin_memory: bool = True):
+        """
+        Args:
+          pin_memory:
+            True to copy CUDA tensors to pinned CPU buffers, which makes
+            the copy asynchronous.
+        """
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+        # Pinned buffers, indexed by the position of the tensor in the
+        # checkpoint. They are reused by the next checkpoint, which is
+        # snapshotted only after the previous one has been written.
+        self._buffers: Dict[str, Tensor] = {}
+
+        self._queue = queue.Queue()
+        self._error = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except Exception as e:  # noqa
+                logging.exception("Failed to write checkpoint")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise RuntimeError("Failed to write checkpoint") from e
+
+    def _snapshot(
+        self, obj: Any, key: str = "", memo: Optional[dict] = None
+    ) -> Any:
+        """Return a copy of `obj` in which every tensor is moved to CPU.
+
+        Tensors sharing the same memory, e.g., tied weights, are copied
+        only once and are still shared in the copy.
+        """
+        if memo is None:
+            memo = dict()
+
+        if isinstance(obj, Tensor):
+            identity = (
+                obj.device,
+                obj.data_ptr(),
+                obj.dtype,
+                tuple(obj.shape),
+                obj.stride(),
+            )
+            if identity in memo:
+                return memo[identity]
+
+            if obj.is_cuda and self.pin_memory:
+                buf = self._buffers.get(key)
+                if (
+                    buf is None
+                    or buf.shape != obj.shape
+                    or buf.dtype != obj.dtype
+                ):
+                    buf = torch.empty(
+                        obj.shape, dtype=obj.dtype, pin_memory=True
+                    )
+                    self._buffers[key] = buf
+                buf.copy_(obj.detach(), non_blocking=True)
+            else:
+                buf = obj.detach().to("cpu", copy=True)
+            memo[identity] = buf
+            return buf
+        elif isinstance(obj, dict):
+            ans = copy.copy(obj)
+            for k, v in obj.items():
+                ans[k] = self._snapshot(v, f"{key}/{k}", memo)
+            return ans
+        elif isinstance(obj, (list, tuple)):
+            values = [
+                self._snapshot(v, f"{key}/{i}", memo) for i, v in enumerate(obj)
+            ]
+            if isinstance(obj, list):
+                return values
+            elif hasattr(obj, "_fields"):
+                # namedtuple
+                return type(obj)(*values)
+            return type(obj)(values)
+        return obj
+
+    def save(
+        self,
+        filename: Path,
+        model: Union[nn.Module, DDP],
+        model_avg: Optional[nn.Module] = None,
+        params: Optional[Dict[str, Any]] = None,
+        optimizer: Optional[Optimizer] = None,
+        scheduler: Optional[LRSchedulerType] = None,
+        scaler: Optional[GradScaler] = None,
+        sampler: Optional[CutSampler] = None,
+        rank: int = 0,
+    ) -> None:
+        """Save training information to a file in the background.
+
+        See :func:`save_checkpoint` for the meaning of the arguments.
+        """
+        if rank != 0:
+            return
+        assert not self._closed
+
+        # The pinned buffers may still be used by the previous checkpoint
+        self.wait()
+
+        logging.info(f"Saving checkpoint to {filename} in the background")
+
+        checkpoint = self._snapshot(
+            _make_checkpoint(
+                model=model,
+                model_avg=model_avg,
+                params=params,
+                optimizer=optimizer,
+                scheduler=scheduler,
+                scaler=scaler,
+                sampler=sampler,
+            )
+        )
+
+        event = None
+        if self.pin_memory:
+            event = torch.cuda.Event()
+            event.record()
+
+        def write():
+            if event is not None:
+                event.synchronize()
+            filename_tmp = Path(f"{filename}.tmp")
+            torch.save(checkpoint, filename_tmp)
+            os.replace(filename_tmp, filename)
+
+        self._queue.put(write)
+
+    def save_with_global_batch_idx(
+        self,
+        out_dir: Path,
+        global_batch_idx: int,
+        model: Union[nn.Module, DDP],
+        model_avg: Optional[nn.Module] = None,
+        params: Optional[Dict[str, Any]] = None,
+        optimizer: Optional[Optimizer] = None,
+        scheduler: Optional[LRSchedulerType] = None,
+        scaler: Optional[GradScaler] = None,
+        sampler: Optional[CutSampler] = None,
+        keep_last_k: int = 0,
+        rank: int = 0,
+    ) -> None:
+        """Save training info after processing given number of batches
+        in the background.
+
+        See :func:`save_checkpoint_with_global_batch_idx` for the meaning
+        of the arguments. If `keep_last_k` is positive, only the latest
+        `keep_last_k` checkpoints are kept after this one is written.
+        """
+        if rank != 0:
+            return
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        self.save(
+            filename=out_dir / f"checkpoint-{global_batch_idx}.pt",
+            model=model,
+            model_avg=model_avg,
+            params=params,
+            optimizer=optimizer,
+            scheduler=scheduler,
+            scaler=scaler,
+            sampler=sampler,
+        )
+        if keep_last_k > 0:
+            self.remove_checkpoints(out_dir, topk=keep_last_k)
+
+    def remove_checkpoints(self, out_dir: Path, topk: int, rank: int = 0):
+        """Like :func:`remove_checkpoints`, but it runs after all
+        pending checkpoints have been written.
+        """
+        if rank != 0:
+            return
+        self._queue.put(lambda: remove_checkpoints(out_dir, topk=topk))
+
+    def copyfile(self, src: Path, dst: Path, rank: int = 0):
+        """Copy `src` to `dst` after all pending checkpoints have been
+        written, e.g., to save the best checkpoint.
+        """
+        if rank != 0:
+            return
+        self._queue.put(lambda: shutil.copyfile(src, dst))
+
+    def wait(self) -> None:
+        """Block until all pending work is finished."""
+        self._queue.join()
+        self._check_error()
+
+    def close(self) -> None:
+        """Finish all pending work and stop the background thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        atexit.unregister(self.close)
+        self._check_error()
+
+
 def update_averaged_model(
     params: Dict[str, Tensor],
     model_cur: Union[nn.Module, DDP],
@@ -385,6 +882,7 @@ def average_checkpoints_with_averaged_model(
     filename_start: str,
     filename_end: str,
     device: torch.device = torch.device("cpu"),
+    cache_dir: Optional[Union[str, Path]] = None,
 ) -> Dict[str, Tensor]:
     """Average model parameters over the range with given
     start model (excluded) and end model.
@@ -416,19 +914,39 @@ def average_checkpoints_with_averaged_model(
         is saved by :func:`save_checkpoint`.
       device:
         Move checkpoints to this device before averaging.
+      cache_dir:
+        If not None, the averaged model is saved in this directory and
+        reused as long as the given checkpoints are not modified.
     """
-    state_dict_start = torch.load(filename_start, map_location=device)
-    state_dict_end = torch.load(filename_end, map_location=device)
-
-    batch_idx_train_start = state_dict_start["batch_idx_train"]
-    batch_idx_train_end = state_dict_end["batch_idx_train"]
-    interval = batch_idx_train_end - batch_idx_train_start
-    assert interval > 0, interval
-    weight_end = batch_idx_train_end / interval
-    weight_start = 1 - weight_end
-
-    model_end = state_dict_end["model_avg"]
-    model_start = state_dict_start["model_avg"]
+    filenames = [filename_start, filename_end]
+    cache_file, avg = _load_cached_average(
+        cache_dir, filenames, tag="avg-model-avg", device=device
+    )
+    if avg is not None:
+        return avg
+
+    # Only the averaged models are read from the checkpoints
+    with contextlib.ExitStack() as stack:
+        state_dict_start, load_tensor_start = stack.enter_context(
+            _open_checkpoint(filename_start)
+        )
+        state_dict_end, load_tensor_end = stack.enter_context(
+            _open_checkpoint(filename_end)
+        )
+
+        batch_idx_train_start = state_dict_start["batch_idx_train"]
+        batch_idx_train_end = state_dict_end["batch_idx_train"]
+        interval = batch_idx_train_end - batch_idx_train_start
+        assert interval > 0, interval
+        weight_end = batch_idx_train_end / interval
+        weight_start = 1 - weight_end
+
+        model_end = _load_state_dict(
+            state_dict_end["model_avg"], load_tensor_end, device
+        )
+        model_start = _load_state_dict(
+            state_dict_start["model_avg"], load_tensor_start, device
+        )
     avg = model_end
 
     # scale the weight to avoid overflow
@@ -440,9 +958,26 @@ def average_checkpoints_with_averaged_model(
         scaling_factor=weight_end,
     )
 
+    _save_cached_average(cache_file, avg)
+
     return avg
 
 
+def _load_state_dict(
+    state_dict: Dict[str, Any], load_tensor, device: torch.device
+) -> Dict[str, Tensor]:
+    """Read all tensors of a lazily loaded state dict, keeping shared
+    tensors shared."""
+    ans = dict()
+    loaded: Dict[Any, Tensor] = dict()
+    for k, v in state_dict.items():
+        identity = _get_identity(v)
+        if identity not in loaded:
+            loaded[identity] = load_tensor(v).to(device)
+        ans[k] = loaded[identity]
+    return ans
+
+
 def average_state_dict(
     state_dict_1: Dict[str, Tensor],
     state_dict_2: Dict[str, Tensor],
@@ -0,0 +1,371 @@
+# Copyright    2026  agent
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Contextual biasing, a.k.a. hotword boosting, for transducer search.
+
+A list of phrases, each given as a list of token IDs, is compiled into
+a token-level Aho-Corasick trie, i.e., a prefix trie with failure links.
+Each hypothesis of a search keeps its current trie node, called its
+context state, and receives a bonus of `context_score` for every token
+that extends a partial match. If a partial match fails, the bonus it has
+received so far is taken back, except for the bonus of the phrases that
+it has fully matched, e.g., "NEW YORK" keeps its bonus if "NEW YORK CITY"
+is also a phrase and the next word is not "CITY". Once a match reaches a
+leaf of the trie, i.e., it cannot be extended any further, its bonus is
+kept and the context state goes back to the root.
+
+All lookups are done on tensors for a batch of context states and all
+tokens at once, so the bonus can be added to the log-probs of all
+hypotheses before the top-k of a search.
+
+Usage::
+
+    context_graph = get_context_graph(sp.encode(phrases), context_score=2.0)
+    hyps = modified_beam_search(
+        model=model,
+        encoder_out=encoder_out,
+        encoder_out_lens=encoder_out_lens,
+        context_graph=context_graph,
+    )
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import k2
+import torch
+
+
+class ContextGraph(object):
+    def __init__(self, token_ids: List[List[int]], context_score: float):
+        """
+        Args:
+          token_ids:
+            The token IDs of each phrase. Empty phrases are ignored.
+          context_score:
+            The bonus of each matched token.
+        """
+        self.context_score = context_score
+
+        # Build the trie. Node 0 is the root.
+        children: List[Dict[int, int]] = [{}]
+        parent = [0]
+        depth = [0]
+        is_end = [False]
+        for phrase in token_ids:
+            node = 0
+            for token in phrase:
+                if token not in children[node]:
+                    children[node][token] = len(children)
+                    children.append({})
+                    parent.append(node)
+                    depth.append(depth[node] + 1)
+                    is_end.append(False)
+                node = children[node][token]
+            if node != 0:
+                is_end[node] = True
+
+        num_nodes = len(children)
+        node_scores = [d * context_score for d in depth]
+
+        # Compute failure links in breadth-first order, so that the
+        # failure links and ancestors of a node are known before the node
+        # itself is visited.
+        fail = [0] * num_nodes
+        # kept_scores[n] is the bonus that is kept when a partial match
+        # leaves n, i.e., the largest total bonus of non-overlapping
+        # phrases within the tokens leading to n. It equals node_scores[n]
+        # if a phrase ends at n.
+        kept_scores = [0.0] * num_nodes
+        queue = list(children[0].values())
+        for node in queue:
+            kept_scores[node] = kept_scores[parent[node]]
+            # Phrases that are suffixes of the tokens leading to node
+            f = node
+            while f != 0:
+                if is_end[f]:
+                    start = node
+                    for _ in range(depth[f]):
+                        start = parent[start]
+                    kept_scores[node] = max(
+                        kept_scores[node], kept_scores[start] + node_scores[f]
+                    )
+                f = fail[f]
+            for token, child in children[node].items():
+                f = fail[node]
+                while f != 0 and token not in children[f]:
+                    f = fail[f]
+                fail[child] = children[f].get(token, 0)
+                if fail[child] == child:
+                    fail[child] = 0
+                queue.append(child)
+
+        # kept_scores_before[n][j] is the kept score of the j-th ancestor
+        # of n, i.e., of the tokens leading to n without the last j ones.
+        # Entries with j > depth[n] are not used.
+        max_depth = max(depth)
+        kept_scores_before = []
+        for node in range(num_nodes):
+            row = [0.0] * (max_depth + 1)
+            ancestor = node
+            for j in range(depth[node] + 1):
+                row[j] = kept_scores[ancestor]
+                ancestor = parent[ancestor]
+            kept_scores_before.append(row)
+
+        # fail_closure[n] contains n, fail[n], fail[fail[n]], ..., 0,
+        # padded with -1
+        closures = []
+        for node in range(num_nodes):
+            closure = [node]
+            while closure[-1] != 0:
+                closure.append(fail[closure[-1]])
+            closures.append(closure)
+        max_len = max(len(c) for c in closures)
+        fail_closure = torch.full((num_nodes, max_len), -1, dtype=torch.int64)
+        for node, closure in enumerate(closures):
+            fail_closure[node, : len(closure)] = torch.tensor(closure)
+
+        # Arcs of the trie, sorted by `node * num_labels + token`
+        arcs = [
+            (node, token, child)
+            for node in range(num_nodes)
+            for token, child in children[node].items()
+        ]
+        self.num_labels = max((a[1] for a in arcs), default=-1) + 1
+        arc_keys = torch.tensor(
+            [a[0] * self.num_labels + a[1] for a in arcs], dtype=torch.int64
+        )
+        arc_next_states = torch.tensor([a[2] for a in arcs], dtype=torch.int64)
+        arc_keys, order = arc_keys.sort()
+
+        self.num_nodes = num_nodes
+        self._tensors = {
+            "arc_keys": arc_keys,
+            "arc_next_states": arc_next_states[order],
+            "fail_closure": fail_closure,
+            "depth": torch.tensor(depth, dtype=torch.int64),
+            "node_scores": torch.tensor(node_scores, dtype=torch.float32),
+            "kept_scores": torch.tensor(kept_scores, dtype=torch.float32),
+            "kept_scores_before": torch.tensor(
+                kept_scores_before, dtype=torch.float32
+            ),
+            # The root is not a leaf, so an empty graph never matches
+            "is_leaf": torch.tensor(
+                [n != 0 and not c for n, c in enumerate(children)],
+                dtype=torch.bool,
+            ),
+        }
+        self._device_tensors: Dict[torch.device, Dict[str, torch.Tensor]] = {}
+
+    @property
+    def root(self) -> int:
+        return 0
+
+    def _tensors_on(self, device: torch.device) -> Dict[str, torch.Tensor]:
+        if device.type == "cpu":
+            return self._tensors
+        if device not in self._device_tensors:
+            self._device_tensors[device] = {
+                k: v.to(device) for k, v in self._tensors.items()
+            }
+        return self._device_tensors[device]
+
+    def get_next_states_and_scores(
+        self, states: torch.Tensor, num_labels: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Look up the transitions of the given context states for all
+        labels 0, 1, ..., num_labels - 1.
+
+        Args:
+          states:
+            A 1-D torch.int64 tensor of shape (N,) containing context
+            states. It can be on any device.
+          num_labels:
+            Number of labels, usually the vocabulary size.
+        Returns:
+          Return a tuple containing:
+            - next_states, a 2-D torch.int64 tensor of shape (N, num_labels)
+            - scores, a 2-D torch.float32 tensor of shape (N, num_labels),
+              containing the bonus of each transition. It is negative if a
+              partial match fails.
+        """
+        assert states.ndim == 1, states.shape
+        device = states.device
+        t = self._tensors_on(device)
+        states = states.to(torch.int64)
+        N = states.numel()
+
+        next_states = torch.zeros(
+            (N, num_labels), dtype=torch.int64, device=device
+        )
+        num_arcs = t["arc_keys"].numel()
+        if num_arcs > 0:
+            labels = torch.arange(num_labels, device=device)
+            valid_labels = labels < self.num_labels
+            found = torch.zeros(
+                (N, num_labels), dtype=torch.bool, device=device
+            )
+            closure = t["fail_closure"][states]
+            for k in range(closure.size(1)):
+                s = closure[:, k : k + 1]  # noqa
+                if not bool((s >= 0).any()):
+                    break
+                keys = s * self.num_labels + labels
+                index = torch.searchsorted(t["arc_keys"], keys)
+                index = index.clamp_(max=num_arcs - 1)
+                match = (
+                    (t["arc_keys"][index] == keys)
+                    & (s >= 0)
+                    & valid_labels
+                    & ~found
+                )
+                next_states = torch.where(
+                    match, t["arc_next_states"][index], next_states
+                )
+                found |= match
+
+        node_scores = t["node_scores"]
+        kept_scores = t["kept_scores"]
+        cur_scores = node_scores[states].unsqueeze(1)
+
+        # A leaf cannot be extended, so keep its bonus and go back to
+        # the root. Otherwise, the bonus of next_states is still pending.
+        is_leaf = t["is_leaf"][next_states]
+        scores = torch.where(
+            is_leaf, kept_scores[next_states], node_scores[next_states]
+        )
+        # Take back the pending bonus of states, except for the phrases it
+        # has matched before the tokens it shares with next_states, i.e.,
+        # all but the last token leading to next_states. So no token is
+        # boosted twice, and nothing is kept if next_states is a child.
+        num_shared = (t["depth"][next_states] - 1).clamp_(min=0)
+        scores = (
+            scores
+            - cur_scores
+            + t["kept_scores_before"][states.unsqueeze(1), num_shared]
+        )
+        next_states = next_states.masked_fill(is_leaf, 0)
+        return next_states, scores
+
+    def get_final_scores(self, states: torch.Tensor) -> torch.Tensor:
+        """Return the scores to add to hypotheses at the end of an
+        utterance, which take back the bonus of unfinished partial matches
+        except for the phrases they have matched.
+
+        Args:
+          states:
+            A 1-D torch.int64 tensor of context states.
+        Returns:
+          Return a 1-D torch.float32 tensor with the same shape as `states`.
+        """
+        t = self._tensors_on(states.device)
+        states = states.to(torch.int64)
+        return t["kept_scores"][states] - t["node_scores"][states]
+
+    def to_fsa(self, vocab_size: int) -> k2.Fsa:
+        """Convert the context graph to an acceptor that can be used in
+        place of `k2.trivial_graph(vocab_size - 1)` by fast_beam_search.
+
+        It accepts every token sequence, like the trivial graph, and its
+        scores are the bonuses of the context graph. It has
+        `num_nodes * (vocab_size - 1) + num_nodes` arcs, so it is suitable
+        for short phrase lists only.
+
+        Args:
+          vocab_size:
+            The vocabulary size. Token 0 is the blank and is not included.
+        Returns:
+          Return an FSA with `num_nodes + 1` states.
+        """
+        states = torch.arange(self.num_nodes)
+        next_states, scores = self.get_next_states_and_scores(
+            states, vocab_size
+        )
+        # Drop the blank
+        next_states = next_states[:, 1:]
+        scores = scores[:, 1:]
+        labels = torch.arange(1, vocab_size).expand_as(next_states)
+        src_states = states.unsqueeze(1).expand_as(next_states)
+
+        # The final arc of each state comes first, so that the arcs are
+        # sorted by label
+        final_state = self.num_nodes
+        column = states.unsqueeze(1)
+        arcs = torch.stack(
+            [
+                torch.cat([column, src_states], dim=1),
+                torch.cat(
+                    [torch.full_like(column, final_state), next_states], dim=1
+                ),
+                torch.cat([torch.full_like(column, -1), labels], dim=1),
+            ],
+            dim=2,
+        ).reshape(-1, 3)
+        # Partial matches are not rewarded at the end
+        arc_scores = torch.cat(
+            [self.get_final_scores(states).unsqueeze(1), scores], dim=1
+        ).reshape(-1)
+
+        arcs = torch.cat(
+            [
+                arcs.to(torch.int32),
+                arc_scores.contiguous().view(torch.int32).unsqueeze(1),
+            ],
+            dim=1,
+        )
+        return k2.Fsa(arcs)
+
+
+_CONTEXT_GRAPH_CACHE: "OrderedDict[str, ContextGraph]" = OrderedDict()
+
+
+def get_context_graph(
+    token_ids: List[List[int]],
+    context_score: float,
+    max_cache_size: int = 100,
+) -> ContextGraph:
+    """Return a ContextGraph for the given phrases.
+
+    Compiled graphs are cached by the hash of the phrases and the score,
+    so the same list of phrases is compiled only once.
+
+    Args:
+      token_ids:
+        The token IDs of each phrase.
+      context_score:
+        The bonus of each matched token.
+      max_cache_size:
+        Maximum number of graphs in the cache. The least recently used one
+        is removed when it is full.
+    """
+    h = hashlib.sha1(str(context_score).encode())
+    for phrase in token_ids:
+        h.update((",".join(map(str, phrase)) + ";").encode())
+    key = h.hexdigest()
+
+    context_graph = _CONTEXT_GRAPH_CACHE.get(key)
+    if context_graph is not None:
+        _CONTEXT_GRAPH_CACHE.move_to_end(key)
+        return context_graph
+
+    context_graph = ContextGraph(token_ids, context_score)
+    _CONTEXT_GRAPH_CACHE[key] = context_graph
+    while len(_CONTEXT_GRAPH_CACHE) > max_cache_size:
+        _CONTEXT_GRAPH_CACHE.popitem(last=False)
+    return context_graph
@@ -0,0 +1,195 @@
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compute training targets, i.e., BPE token IDs or supervision graphs,
+in dataloader workers instead of in the training process.
+
+Usage::
+
+    targets_fn = BpeTargets(params.bpe_model)
+    train_dl = librispeech.train_dataloaders(train_cuts, targets_fn=targets_fn)
+
+    for batch in train_dl:
+        y = get_token_ids(batch, sp, device)  # falls back to sp.encode()
+
+The callables in this file are picklable and create their BPE model or
+graph compiler lazily, so each worker process has its own copy.
+"""
+
+from typing import Any, Callable, Dict, List, Optional
+
+import k2
+import sentencepiece as spm
+import torch
+
+from icefall.bpe_graph_compiler import BpeCtcTrainingGraphCompiler
+from icefall.graph_compiler import CtcTrainingGraphCompiler
+from icefall.mmi_graph_compiler import MmiTrainingGraphCompiler
+from icefall.utils import encode_supervisions
+
+
+class TargetsDataset(torch.utils.data.Dataset):
+    """Wrap a lhotse dataset, e.g., K2SpeechRecognitionDataset, and add
+    the return value of `targets_fn(batch["supervisions"])` to each batch
+    under the key "targets".
+    """
+
+    def __init__(
+        self,
+        dataset: torch.utils.data.Dataset,
+        targets_fn: Callable[[Dict[str, Any]], Dict[str, Any]],
+    ):
+        self.dataset = dataset
+        self.targets_fn = targets_fn
+
+    def __getitem__(self, cuts) -> Dict[str, Any]:
+        batch = self.dataset[cuts]
+        batch["targets"] = self.targets_fn(batch["supervisions"])
+        return batch
+
+
+def _list_to_ragged_dict(ids: List[List[int]]) -> Dict[str, torch.Tensor]:
+    row_splits = torch.zeros(len(ids) + 1, dtype=torch.int32)
+    row_splits[1:] = torch.tensor([len(i) for i in ids]).cumsum(0)
+    values = torch.tensor([t for i in ids for t in i], dtype=torch.int32)
+    return {"values": values, "row_splits": row_splits}
+
+
+def _ragged_dict_to_ragged(d: Dict[str, torch.Tensor]) -> k2.RaggedTensor:
+    shape = k2.ragged.create_ragged_shape2(
+        row_splits=d["row_splits"], cached_tot_size=d["values"].numel()
+    )
+    return k2.RaggedTensor(shape, d["values"])
+
+
+class BpeTargets(object):
+    def __init__(self, bpe_model: str):
+        """
+        Args:
+          bpe_model:
+            Path to the BPE model. The token IDs of the transcripts,
+            in the order of `batch["supervisions"]["text"]`, are returned
+            under the key "token_ids".
+        """
+        self.bpe_model = str(bpe_model)
+        self.sp = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["sp"] = None
+        return state
+
+    def __call__(self, supervisions: Dict[str, Any]) -> Dict[str, Any]:
+        if self.sp is None:
+            self.sp = spm.SentencePieceProcessor()
+            self.sp.load(self.bpe_model)
+        y = self.sp.encode(supervisions["text"], out_type=int)
+        return {"token_ids": _list_to_ragged_dict(y)}
+
+
+class GraphTargets(object):
+    def __init__(
+        self,
+        make_graph_compiler: Callable[[], Any],
+        subsampling_factor: int,
+    ):
+        """
+        Args:
+          make_graph_compiler:
+            A picklable callable, e.g., a functools.partial, that returns
+            a CPU graph compiler. It can be a BpeCtcTrainingGraphCompiler,
+            a CtcTrainingGraphCompiler or a MmiTrainingGraphCompiler.
+          subsampling_factor:
+            It is passed to :func:`icefall.utils.encode_supervisions`.
+            Graphs are returned in the order of the texts returned by it,
+            under the key "graphs". The texts are returned under the key
+            "texts".
+        """
+        self.make_graph_compiler = make_graph_compiler
+        self.subsampling_factor = subsampling_factor
+        self.graph_compiler = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["graph_compiler"] = None
+        return state
+
+    def __call__(self, supervisions: Dict[str, Any]) -> Dict[str, Any]:
+        if self.graph_compiler is None:
+            self.graph_compiler = self.make_graph_compiler()
+        graph_compiler = self.graph_compiler
+
+        _, texts = encode_supervisions(
+            supervisions, subsampling_factor=self.subsampling_factor
+        )
+        if isinstance(graph_compiler, BpeCtcTrainingGraphCompiler):
+            graphs = graph_compiler.compile(graph_compiler.texts_to_ids(texts))
+        elif isinstance(graph_compiler, MmiTrainingGraphCompiler):
+            graphs, _ = graph_compiler.compile(texts, replicate_den=False)
+        elif isinstance(graph_compiler, CtcTrainingGraphCompiler):
+            # The word IDs are taken from the cuts if they are tokenized
+            word_ids = graph_compiler.word_tokenizer.supervisions_to_word_ids(
+                supervisions, texts
+            )
+            graphs = graph_compiler.compile(texts, word_ids)
+        else:
+            graphs = graph_compiler.compile(texts)
+
+        # k2.Fsa is shipped to the training process as a dict of tensors
+        return {"texts": texts, "graphs": graphs.as_dict()}
+
+
+def get_token_ids(
+    batch: Dict[str, Any],
+    sp: spm.SentencePieceProcessor,
+    device: torch.device,
+) -> k2.RaggedTensor:
+    """Return the token IDs of `batch["supervisions"]["text"]`.
+
+    They are taken from the batch if they have been computed by
+    :class:`BpeTargets` in dataloader workers; otherwise they are
+    computed with `sp`.
+    """
+    targets = batch.get("targets", {})
+    if "token_ids" in targets:
+        return _ragged_dict_to_ragged(targets["token_ids"]).to(device)
+    y = sp.encode(batch["supervisions"]["text"], out_type=int)
+    return k2.RaggedTensor(y).to(device)
+
+
+def get_graphs(
+    batch: Dict[str, Any],
+    texts: List[str],
+    device: torch.device,
+) -> Optional[k2.Fsa]:
+    """Return the supervision graphs computed by :class:`GraphTargets`
+    in dataloader workers, or None if there are none.
+
+    Args:
+      batch:
+        A batch from the dataloader.
+      texts:
+        The texts returned by :func:`icefall.utils.encode_supervisions`.
+        They are used to check that graphs are in the expected order.
+      device:
+        The returned graphs are moved to this device.
+    """
+    targets = batch.get("targets", {})
+    if "graphs" not in targets:
+        return None
+    assert targets["texts"] == texts, (targets["texts"], texts)
+    return k2.Fsa.from_dict(targets["graphs"]).to(device)
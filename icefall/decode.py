@@ -986,6 +986,235 @@ def rescore_with_attention_decoder(
     return ans
 
 
+def _rnn_lm_scores_padded(
+    rnn_lm_model: torch.nn.Module,
+    token_ids: List[List[int]],
+    sos_id: int,
+    eos_id: int,
+    blank_id: int,
+    max_tokens: int,
+) -> torch.Tensor:
+    """Compute RNN LM scores by running the model over padded batches.
+    See :func:`compute_rnn_lm_scores` for the meaning of the arguments."""
+    device = next(rnn_lm_model.parameters()).device
+    num_paths = len(token_ids)
+    ans = torch.zeros(num_paths, dtype=torch.float32, device=device)
+
+    # Sort paths by length so that paths in a batch have similar lengths
+    # and padding is reduced.
+    indexes = sorted(range(num_paths), key=lambda i: len(token_ids[i]))
+    start = 0
+    while start < num_paths:
+        # +1 for SOS/EOS. Since paths are sorted, the last path in a batch
+        # is the longest one.
+        end = start + 1 if max_tokens > 0 else num_paths
+        while (
+            end < num_paths
+            and (end + 1 - start) * (len(token_ids[indexes[end]]) + 1)
+            <= max_tokens
+        ):
+            end += 1
+
+        batch = [token_ids[i] for i in indexes[start:end]]
+        tokens = k2.RaggedTensor(batch).to(device)
+
+        sos_tokens = add_sos(tokens, sos_id)
+        tokens_eos = add_eos(tokens, eos_id)
+        sos_tokens_row_splits = sos_tokens.shape.row_splits(1)
+        sentence_lengths = (
+            sos_tokens_row_splits[1:] - sos_tokens_row_splits[:-1]
+        )
+
+        x_tokens = sos_tokens.pad(mode="constant", padding_value=blank_id)
+        y_tokens = tokens_eos.pad(mode="constant", padding_value=blank_id)
+
+        x_tokens = x_tokens.to(torch.int64)
+        y_tokens = y_tokens.to(torch.int64)
+        sentence_lengths = sentence_lengths.to(torch.int64)
+
+        rnn_lm_nll = rnn_lm_model(
+            x=x_tokens, y=y_tokens, lengths=sentence_lengths
+        )
+        assert rnn_lm_nll.ndim == 2
+        assert rnn_lm_nll.shape[0] == len(batch)
+
+        dest = torch.tensor(indexes[start:end], device=device)
+        ans[dest] = -1 * rnn_lm_nll.sum(dim=1)
+        start = end
+
+    return ans
+
+
+def _rnn_lm_scores_prefix_tree(
+    rnn_lm_model: torch.nn.Module,
+    token_ids: List[List[int]],
+    sos_id: int,
+    eos_id: int,
+    max_tokens: int,
+) -> torch.Tensor:
+    """Compute RNN LM scores by running the model once per unique prefix.
+    See :func:`compute_rnn_lm_scores` for the meaning of the arguments."""
+    device = next(rnn_lm_model.parameters()).device
+
+    # Build a prefix tree. Node 0 is the root, i.e., the SOS token.
+    # A node at depth d represents SOS followed by the first d tokens
+    # of the paths passing through it.
+    children: List[Dict[int, int]] = [dict()]
+    depth_nodes: List[List[int]] = [[0]]  # nodes of each depth
+    node_token = [sos_id]
+    node_parent = [-1]
+    path_to_node = []
+    for path in token_ids:
+        node = 0
+        for d, t in enumerate(path):
+            next_node = children[node].get(t)
+            if next_node is None:
+                next_node = len(node_token)
+                children[node][t] = next_node
+                children.append(dict())
+                node_token.append(t)
+                node_parent.append(node)
+                if len(depth_nodes) == d + 1:
+                    depth_nodes.append([])
+                depth_nodes[d + 1].append(next_node)
+            node = next_node
+        path_to_node.append(node)
+
+    num_nodes = len(node_token)
+    # node_scores[i] is the log-prob of the tokens represented by node i
+    node_scores = torch.zeros(num_nodes, dtype=torch.float32, device=device)
+    # eos_scores[i] is node_scores[i] plus the log-prob of EOS after node i
+    eos_scores = torch.zeros(num_nodes, dtype=torch.float32, device=device)
+    # Position of each node within its depth. Nodes of each depth are
+    # sorted by the position of their parents, so the children of a
+    # contiguous range of nodes are also contiguous.
+    node_pos = [0] * num_nodes
+    for nodes in depth_nodes:
+        nodes.sort(key=lambda n: node_pos[node_parent[n]])
+        for i, n in enumerate(nodes):
+            node_pos[n] = i
+
+    max_batch_size = max_tokens if max_tokens > 0 else num_nodes
+
+    # LSTM states (h, c) of the nodes at the previous depth. The root
+    # starts from the initial states.
+    prev_states = rnn_lm_model.get_init_states(1, device)
+    for d, nodes in enumerate(depth_nodes):
+        nodes_t = torch.tensor(nodes, device=device)
+        tokens = torch.tensor(
+            [node_token[n] for n in nodes], dtype=torch.int64, device=device
+        )
+        if d > 0:
+            parent_pos = torch.tensor(
+                [node_pos[node_parent[n]] for n in nodes], device=device
+            )
+        else:
+            parent_pos = torch.zeros(1, dtype=torch.int64, device=device)
+
+        h_list = []
+        c_list = []
+        # Children of the nodes in this depth
+        next_nodes = depth_nodes[d + 1] if d + 1 < len(depth_nodes) else []
+        next_parent_pos = torch.tensor(
+            [node_pos[node_parent[n]] for n in next_nodes],
+            dtype=torch.int64,
+            device=device,
+        )
+        next_tokens = torch.tensor(
+            [node_token[n] for n in next_nodes],
+            dtype=torch.int64,
+            device=device,
+        )
+        next_nodes_t = torch.tensor(next_nodes, device=device)
+
+        for start in range(0, len(nodes), max_batch_size):
+            end = min(start + max_batch_size, len(nodes))
+            p = parent_pos[start:end]
+            log_probs, h, c = rnn_lm_model.score_token(
+                tokens[start:end],
+                prev_states[0].index_select(1, p),
+                prev_states[1].index_select(1, p),
+            )
+            h_list.append(h)
+            c_list.append(c)
+
+            chunk_nodes = nodes_t[start:end]
+            eos_scores[chunk_nodes] = (
+                node_scores[chunk_nodes] + log_probs[:, eos_id]
+            )
+
+            begin = torch.searchsorted(next_parent_pos, start).item()
+            finish = torch.searchsorted(next_parent_pos, end).item()
+            if finish > begin:
+                local = next_parent_pos[begin:finish] - start
+                node_scores[next_nodes_t[begin:finish]] = (
+                    node_scores[chunk_nodes[local]]
+                    + log_probs[local, next_tokens[begin:finish]]
+                )
+
+        prev_states = (torch.cat(h_list, dim=1), torch.cat(c_list, dim=1))
+
+    path_to_node = torch.tensor(path_to_node, device=device)
+    return eos_scores[path_to_node]
+
+
+def compute_rnn_lm_scores(
+    rnn_lm_model: torch.nn.Module,
+    token_ids: List[List[int]],
+    sos_id: int,
+    eos_id: int,
+    blank_id: int,
+    prefix_tree: bool = False,
+    max_tokens: int = 0,
+) -> torch.Tensor:
+    """Compute the RNN LM log-probabilities of the given token sequences.
+    SOS is prepended and EOS is appended to each sequence.
+
+    Args:
+      rnn_lm_model:
+        A rnn-lm model. See :class:`icefall.rnn_lm.model.RnnLmModel`.
+      token_ids:
+        A list of token sequences, e.g., paths in an n-best list.
+      sos_id:
+        The token ID for SOS.
+      eos_id:
+        The token ID for EOS.
+      blank_id:
+        The token ID used for padding.
+      prefix_tree:
+        If True, sequences are arranged in a prefix tree and the RNN LM
+        runs once per unique prefix, one step at a time, so that paths
+        sharing a prefix also share its computation. The hidden states
+        of only two depths of the tree are kept in memory.
+        If False, the RNN LM runs over the padded sequences.
+      max_tokens:
+        If positive, it bounds the number of tokens, including padding,
+        processed by the RNN LM at a time. For the prefix tree, it is the
+        number of tree nodes processed in a step.
+        If not positive, all tokens are processed at once.
+    Returns:
+      Return a 1-D float32 tensor of shape (len(token_ids),) containing
+      the log-probabilities of the sequences.
+    """
+    if prefix_tree:
+        return _rnn_lm_scores_prefix_tree(
+            rnn_lm_model=rnn_lm_model,
+            token_ids=token_ids,
+            sos_id=sos_id,
+            eos_id=eos_id,
+            max_tokens=max_tokens,
+        )
+    else:
+        return _rnn_lm_scores_padded(
+            rnn_lm_model=rnn_lm_model,
+            token_ids=token_ids,
+            sos_id=sos_id,
+            eos_id=eos_id,
+            blank_id=blank_id,
+            max_tokens=max_tokens,
+        )
+
+
 def rescore_with_rnn_lm(
     lattice: k2.Fsa,
     num_paths: int,
@@ -1001,6 +1230,8 @@ def rescore_with_rnn_lm(
     attention_scale: Optional[float] = None,
     rnn_lm_scale: Optional[float] = None,
     use_double_scores: bool = True,
+    rnn_lm_prefix_tree: bool = False,
+    rnn_lm_max_tokens: int = 0,
 ) -> Dict[str, k2.Fsa]:
     """This function extracts `num_paths` paths from the given lattice and uses
     an attention decoder to rescore them. The path with the highest score is
@@ -1035,6 +1266,12 @@ def rescore_with_rnn_lm(
         Optional. It specifies the scale for attention decoder scores.
       rnn_lm_scale:
         Optional. It specifies the scale for RNN LM scores.
+      rnn_lm_prefix_tree:
+        True to run the RNN LM once per unique prefix of the paths.
+        See :func:`compute_rnn_lm_scores`.
+      rnn_lm_max_tokens:
+        If positive, the maximum number of tokens the RNN LM processes
+        at a time. See :func:`compute_rnn_lm_scores`.
     Returns:
       A dict of FsaVec, whose key contains a string
       ngram_lm_scale_attention_scale and the value is the
@@ -1096,23 +1333,15 @@ def rescore_with_rnn_lm(
     attention_scores = -nll.sum(dim=1)
 
     # Now for RNN LM
-    sos_tokens = add_sos(tokens, sos_id)
-    tokens_eos = add_eos(tokens, eos_id)
-    sos_tokens_row_splits = sos_tokens.shape.row_splits(1)
-    sentence_lengths = sos_tokens_row_splits[1:] - sos_tokens_row_splits[:-1]
-
-    x_tokens = sos_tokens.pad(mode="constant", padding_value=blank_id)
-    y_tokens = tokens_eos.pad(mode="constant", padding_value=blank_id)
-
-    x_tokens = x_tokens.to(torch.int64)
-    y_tokens = y_tokens.to(torch.int64)
-    sentence_lengths = sentence_lengths.to(torch.int64)
-
-    rnn_lm_nll = rnn_lm_model(x=x_tokens, y=y_tokens, lengths=sentence_lengths)
-    assert rnn_lm_nll.ndim == 2
-    assert rnn_lm_nll.shape[0] == len(token_ids)
-
-    rnn_lm_scores = -1 * rnn_lm_nll.sum(dim=1)
+    rnn_lm_scores = compute_rnn_lm_scores(
+        rnn_lm_model=rnn_lm_model,
+        token_ids=token_ids,
+        sos_id=sos_id,
+        eos_id=eos_id,
+        blank_id=blank_id,
+        prefix_tree=rnn_lm_prefix_tree,
+        max_tokens=rnn_lm_max_tokens,
+    )
 
     ngram_lm_scale_list = DEFAULT_LM_SCALE
     attention_scale_list = DEFAULT_LM_SCALE
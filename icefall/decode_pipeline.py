@@ -0,0 +1,326 @@
+# Copyright    2026  agent
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Utilities for offline decoding of a whole test set.
+
+  - :class:`CostBucketingSampler` sorts the cuts by length, so that a batch
+    contains little padding, and limits the size of a batch by its padded
+    duration and by the decoding time estimated by :class:`DecodeCostModel`.
+  - :class:`PipelinedDecoder` loads the features and runs the encoder of
+    the next batches in background threads, while the search of the current
+    batch runs in the calling thread.
+
+Usage::
+
+    cost_model = DecodeCostModel()
+    sampler = CostBucketingSampler(
+        cuts,
+        max_duration=600,
+        cost_model=cost_model,
+        max_batch_seconds=2.0,
+    )
+    dl = DataLoader(test_dl.dataset, batch_size=None, sampler=sampler)
+    for batch, (encoder_out, encoder_out_lens) in PipelinedDecoder(
+        dl, encode=encode, cost_model=cost_model
+    ):
+        ...  # search
+"""
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+import torch
+from lhotse import CutSet
+
+
+class DecodeCostModel(object):
+    """Estimate the time to decode a batch.
+
+    The time is modeled as `num_cuts * max_frames * seconds_per_frame`, i.e.,
+    it is proportional to the number of padded frames of the batch. The
+    `seconds_per_frame` of the encoder and of the search are measured while
+    decoding and smoothed with an exponential moving average. Since the
+    search time depends on the decoding method and its options, e.g., the
+    beam size, the model should be used for one setting only.
+    """
+
+    def __init__(self, momentum: float = 0.9):
+        """
+        Args:
+          momentum:
+            The momentum of the moving average of the measurements.
+        """
+        assert 0 <= momentum < 1, momentum
+        self.momentum = momentum
+        self.encoder_seconds_per_frame: Optional[float] = None
+        self.search_seconds_per_frame: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _average(self, old: Optional[float], new: float) -> float:
+        if old is None:
+            return new
+        return self.momentum * old + (1 - self.momentum) * new
+
+    def update(
+        self,
+        num_cuts: int,
+        max_frames: int,
+        encoder_seconds: float,
+        search_seconds: float,
+    ) -> None:
+        """Add a measurement.
+
+        Args:
+          num_cuts:
+            Number of cuts in the batch.
+          max_frames:
+            Number of feature frames of the longest cut in the batch.
+          encoder_seconds:
+            Time spent on the encoder.
+          search_seconds:
+            Time spent on the search.
+        """
+        num_frames = max(num_cuts * max_frames, 1)
+        with self._lock:
+            self.encoder_seconds_per_frame = self._average(
+                self.encoder_seconds_per_frame, encoder_seconds / num_frames
+            )
+            self.search_seconds_per_frame = self._average(
+                self.search_seconds_per_frame, search_seconds / num_frames
+            )
+
+    def estimate(self, num_cuts: int, max_frames: int) -> Optional[float]:
+        """Return the estimated time in seconds to decode a batch, or None
+        if nothing has been measured yet.
+
+        The encoder and the search of different batches run in parallel,
+        so the larger one of the two is returned.
+        """
+        with self._lock:
+            if self.encoder_seconds_per_frame is None:
+                return None
+            seconds_per_frame = max(
+                self.encoder_seconds_per_frame, self.search_seconds_per_frame
+            )
+        return num_cuts * max_frames * seconds_per_frame
+
+
+class CostBucketingSampler(object):
+    def __init__(
+        self,
+        cuts: CutSet,
+        max_duration: float,
+        cost_model: Optional[DecodeCostModel] = None,
+        max_batch_seconds: float = 0.0,
+        frame_shift: float = 0.01,
+    ):
+        """A sampler that returns batches of cuts with similar lengths.
+
+        The cuts are sorted by duration in decreasing order, so the longest
+        cut of a batch is its first one, and the batches are formed from
+        consecutive cuts. A batch is closed if adding the next cut would
+        exceed either of the following limits:
+
+          - Its padded duration, i.e., the number of cuts multiplied by the
+            duration of the longest cut, exceeds `max_duration`.
+          - Its decoding time estimated by `cost_model` exceeds
+            `max_batch_seconds`.
+
+        The batches are computed lazily, so the later batches use the
+        measurements of the earlier ones.
+
+        Args:
+          cuts:
+            The cuts to decode.
+          max_duration:
+            Maximum padded duration of a batch in seconds.
+          cost_model:
+            If not None, it is used to limit the decoding time of a batch.
+          max_batch_seconds:
+            Maximum estimated decoding time of a batch in seconds. Used only
+            if `cost_model` is not None. 0 means no limit.
+          frame_shift:
+            Frame shift of the features in seconds.
+        """
+        assert max_duration > 0, max_duration
+        self.cuts = cuts
+        self.max_duration = max_duration
+        self.cost_model = cost_model
+        self.max_batch_seconds = max_batch_seconds
+        self.frame_shift = frame_shift
+
+    def _fits(self, num_cuts: int, max_duration: float) -> bool:
+        if num_cuts * max_duration > self.max_duration:
+            return False
+        if self.cost_model is not None and self.max_batch_seconds > 0:
+            seconds = self.cost_model.estimate(
+                num_cuts=num_cuts,
+                max_frames=int(max_duration / self.frame_shift),
+            )
+            if seconds is not None and seconds > self.max_batch_seconds:
+                return False
+        return True
+
+    def __iter__(self) -> Iterator[CutSet]:
+        cuts = sorted(self.cuts, key=lambda c: c.duration, reverse=True)
+        batch = []
+        for cut in cuts:
+            if batch and not self._fits(len(batch) + 1, batch[0].duration):
+                yield CutSet.from_cuts(batch)
+                batch = []
+            batch.append(cut)
+        if batch:
+            yield CutSet.from_cuts(batch)
+
+
+class _End(object):
+    pass
+
+
+class _Error(object):
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class PipelinedDecoder(object):
+    def __init__(
+        self,
+        dl: torch.utils.data.DataLoader,
+        encode: Callable[[dict], Any],
+        cost_model: Optional[DecodeCostModel] = None,
+        num_prefetch: int = 2,
+    ):
+        """Iterate over the batches of a dataloader together with their
+        encoder outputs.
+
+        Three stages run at the same time: a thread fetches the batches
+        from the dataloader, another thread runs `encode` on them, and the
+        calling thread runs the search on the batches returned by the
+        iterator. Most of the work of the encoder is done by PyTorch
+        operators, which release the GIL, so the encoder of the next batch
+        runs while the current batch is in the Python search loop.
+
+        Args:
+          dl:
+            The dataloader.
+          encode:
+            A function that takes a batch and returns the encoder output.
+            It runs with gradient computation disabled.
+          cost_model:
+            If not None, the time spent on the encoder and on the search of
+            each batch is added to it.
+          num_prefetch:
+            Number of batches that can be waiting for each of the stages.
+        """
+        assert num_prefetch >= 1, num_prefetch
+        self.dl = dl
+        self.encode = encode
+        self.cost_model = cost_model
+        self.num_prefetch = num_prefetch
+
+    def __len__(self) -> int:
+        return len(self.dl)
+
+    @staticmethod
+    def _put(q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        """Put an item into a queue unless `stop` is set. Return False if
+        the item is dropped."""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _load(self, out: queue.Queue, stop: threading.Event) -> None:
+        try:
+            for batch in self.dl:
+                if not self._put(out, batch, stop):
+                    return
+        except BaseException as e:  # noqa
+            self._put(out, _Error(e), stop)
+            return
+        self._put(out, _End(), stop)
+
+    def _encode(
+        self, inp: queue.Queue, out: queue.Queue, stop: threading.Event
+    ) -> None:
+        # The grad mode is thread local
+        with torch.no_grad():
+            while not stop.is_set():
+                try:
+                    batch = inp.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if isinstance(batch, (_End, _Error)):
+                    self._put(out, batch, stop)
+                    return
+                try:
+                    start = time.time()
+                    encoder_out = self.encode(batch)
+                    seconds = time.time() - start
+                except BaseException as e:  # noqa
+                    self._put(out, _Error(e), stop)
+                    return
+                if not self._put(out, (batch, encoder_out, seconds), stop):
+                    return
+
+    def __iter__(self) -> Iterator[Tuple[dict, Any]]:
+        stop = threading.Event()
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        encoded = queue.Queue(maxsize=self.num_prefetch)
+        threads = [
+            threading.Thread(
+                target=self._load, args=(batches, stop), daemon=True
+            ),
+            threading.Thread(
+                target=self._encode,
+                args=(batches, encoded, stop),
+                daemon=True,
+            ),
+        ]
+        for t in threads:
+            t.start()
+
+        try:
+            while True:
+                item = encoded.get()
+                if isinstance(item, _End):
+                    break
+                if isinstance(item, _Error):
+                    raise item.exception
+
+                batch, encoder_out, encoder_seconds = item
+                start = time.time()
+                yield batch, encoder_out
+                search_seconds = time.time() - start
+
+                if self.cost_model is not None:
+                    num_cuts, max_frames = batch["inputs"].shape[:2]
+                    self.cost_model.update(
+                        num_cuts=num_cuts,
+                        max_frames=max_frames,
+                        encoder_seconds=encoder_seconds,
+                        search_seconds=search_seconds,
+                    )
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
@@ -0,0 +1,147 @@
+# Copyright    2026  agent
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Endpoint detection for streaming decoding, following the rules of Kaldi's
+online endpointing (see kaldi/src/online2/online-endpoint.h).
+
+For transducer models, silence is the run of trailing frames on which the
+best path emits only blanks. An endpoint is detected if any of the rules
+is satisfied. Once an endpoint is detected, the decoding result so far is
+finalized as a segment and the search state of the stream is reset, while
+the encoder state is kept.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass
+class EndpointRule:
+    # If True, the rule applies only if a non-blank token has been decoded
+    # in the current segment
+    must_contain_nonsilence: bool
+
+    # Minimum duration of the trailing silence, in seconds
+    min_trailing_silence: float
+
+    # Minimum duration of the current segment, in seconds. It includes the
+    # trailing silence.
+    min_utterance_length: float
+
+    def is_satisfied(
+        self,
+        contains_nonsilence: bool,
+        trailing_silence: float,
+        utterance_length: float,
+    ) -> bool:
+        """Return True if the rule is satisfied.
+
+        Args:
+          contains_nonsilence:
+            True if a non-blank token has been decoded in the current
+            segment.
+          trailing_silence:
+            Duration of the trailing silence, in seconds.
+          utterance_length:
+            Duration of the current segment, in seconds.
+        """
+        return (
+            (contains_nonsilence or not self.must_contain_nonsilence)
+            and trailing_silence >= self.min_trailing_silence
+            and utterance_length >= self.min_utterance_length
+        )
+
+
+def get_default_endpoint_rules() -> List[EndpointRule]:
+    """Return the default rules:
+
+    - rule 1: 2.4 seconds of trailing silence, even if nothing has been
+      decoded.
+    - rule 2: 1.2 seconds of trailing silence after something has been
+      decoded.
+    - rule 3: the segment is 20 seconds long, no matter what has been
+      decoded.
+    """
+    return [
+        EndpointRule(
+            must_contain_nonsilence=False,
+            min_trailing_silence=2.4,
+            min_utterance_length=0.0,
+        ),
+        EndpointRule(
+            must_contain_nonsilence=True,
+            min_trailing_silence=1.2,
+            min_utterance_length=0.0,
+        ),
+        EndpointRule(
+            must_contain_nonsilence=False,
+            min_trailing_silence=0.0,
+            min_utterance_length=20.0,
+        ),
+    ]
+
+
+class Endpointer(object):
+    def __init__(
+        self,
+        frame_shift: float,
+        rules: Optional[List[EndpointRule]] = None,
+    ):
+        """
+        Args:
+          frame_shift:
+            The duration of a frame of the encoder output, in seconds,
+            e.g., 0.04 for a model with a subsampling factor of 4 and a
+            frame shift of 10 ms.
+          rules:
+            The endpoint rules. If None, the rules returned by
+            :func:`get_default_endpoint_rules` are used.
+        """
+        assert frame_shift > 0, frame_shift
+        if rules is None:
+            rules = get_default_endpoint_rules()
+        self.frame_shift = frame_shift
+        self.rules = rules
+
+    def __call__(
+        self,
+        contains_nonsilence: bool,
+        num_trailing_blanks: int,
+        num_frames: int,
+    ) -> bool:
+        """Return True if an endpoint is detected.
+
+        Args:
+          contains_nonsilence:
+            True if a non-blank token has been decoded in the current
+            segment.
+          num_trailing_blanks:
+            Number of trailing frames of the current segment on which
+            the best path emits only blanks.
+          num_frames:
+            Number of frames of the current segment.
+        """
+        trailing_silence = num_trailing_blanks * self.frame_shift
+        utterance_length = num_frames * self.frame_shift
+        return any(
+            rule.is_satisfied(
+                contains_nonsilence=contains_nonsilence,
+                trailing_silence=trailing_silence,
+                utterance_length=utterance_length,
+            )
+            for rule in self.rules
+        )
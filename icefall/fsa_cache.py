@@ -0,0 +1,296 @@
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A cache for per-utterance FSAs, e.g., training graphs.
+
+Training graphs depend only on the transcript of an utterance, which
+never changes across epochs, so there is no need to compile them again
+and again. Each cached FSA is indexed by its key, which is the sequence of
+word IDs of the transcript.
+
+Cached FSAs are kept in memory and evicted in least-recently-used order
+once the total number of arcs exceeds a given limit. If a cache directory
+is given, every compiled FSA is also written to disk, so that later epochs
+and later runs can load it from there instead of compiling it again.
+
+On disk, FSAs are grouped into shards. A shard "shard-*.bin" is the
+concatenation of the output of `torch.save()` for the `k2.Fsa.as_dict()` of
+each FSA, and its index "shard-*.idx" contains a line
+"<digest of key> <offset> <size>" for each FSA, so that a single FSA can be
+read without reading the whole shard.
+"""
+
+import hashlib
+import io
+import logging
+import multiprocessing.util
+import os
+import uuid
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+import k2
+import torch
+
+
+def fsa_fingerprint(*fsas: k2.Fsa) -> str:
+    """Return a hash of the tensors contained in the given FSAs.
+
+    It is used to tell apart caches of graphs compiled with different
+    topologies or lexicons.
+    """
+    h = hashlib.sha1()
+    for fsa in fsas:
+        d = fsa.as_dict()
+        for name in sorted(d.keys()):
+            value = d[name]
+            if isinstance(value, torch.Tensor):
+                h.update(name.encode())
+                h.update(value.contiguous().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def _key_to_digest(key: Tuple[int, ...]) -> str:
+    return hashlib.sha1(",".join(map(str, key)).encode()).hexdigest()
+
+
+def _flush_at_exit(ref: "weakref.ref[FsaCache]") -> None:
+    cache = ref()
+    if cache is not None:
+        cache.flush()
+
+
+class FsaCache(object):
+    def __init__(
+        self,
+        max_num_arcs: int,
+        device: Union[str, torch.device] = "cpu",
+        cache_dir: Optional[Union[str, Path]] = None,
+        shard_size: int = 1000,
+    ):
+        """
+        Args:
+          max_num_arcs:
+            Maximum total number of arcs of the FSAs kept in memory.
+          device:
+            The device of the returned FSAs.
+          cache_dir:
+            If not None, compiled FSAs are also saved in this directory,
+            which should be specific to the graph compiler, see
+            :func:`fsa_fingerprint`. Shards in it are used, including
+            those written later by other processes, e.g., other dataloader
+            workers. FSAs not yet written are flushed at process exit.
+          shard_size:
+            Number of FSAs in each shard written to `cache_dir`.
+        """
+        self.max_num_arcs = max_num_arcs
+        self.device = torch.device(device)
+        self.shard_size = shard_size
+
+        # key -> Fsa, in least-recently-used order
+        self.fsas: "OrderedDict[Tuple[int, ...], k2.Fsa]" = OrderedDict()
+        self.num_arcs = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+        self.cache_dir = None
+        # digest of key -> (filename of the shard containing it,
+        #                   offset in the shard, size in bytes)
+        self.disk_index: Dict[str, Tuple[Path, int, int]] = {}
+        self.pending: Dict[str, dict] = {}
+
+        # Index files that have been read
+        self._index_files: Set[Path] = set()
+
+        if cache_dir is not None:
+            self.cache_dir = Path(cache_dir)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._read_new_index_files()
+            logging.info(
+                f"Found {len(self.disk_index)} cached FSAs in {self.cache_dir}"
+            )
+            # FSAs not yet written are flushed when the process exits,
+            # including dataloader worker processes.
+            multiprocessing.util.Finalize(
+                self,
+                _flush_at_exit,
+                args=(weakref.ref(self),),
+                exitpriority=0,
+            )
+
+    def _read_new_index_files(self) -> None:
+        """Add the FSAs of the shards written since the last call, e.g., by
+        other processes, to `self.disk_index`."""
+        for index_file in sorted(self.cache_dir.glob("shard-*.idx")):
+            if index_file in self._index_files:
+                continue
+            self._index_files.add(index_file)
+            shard = index_file.with_suffix(".bin")
+            with open(index_file) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) != 3:
+                        # An index of an older format without offsets
+                        break
+                    digest, offset, size = fields
+                    self.disk_index[digest] = (shard, int(offset), int(size))
+
+    def _put(self, key: Tuple[int, ...], fsa: k2.Fsa) -> None:
+        if key in self.fsas:
+            return
+        self.fsas[key] = fsa
+        self.num_arcs += fsa.num_arcs
+        while self.num_arcs > self.max_num_arcs and len(self.fsas) > 1:
+            _, evicted = self.fsas.popitem(last=False)
+            self.num_arcs -= evicted.num_arcs
+
+    def _load_from_disk(
+        self, keys: List[Tuple[int, ...]]
+    ) -> Dict[Tuple[int, ...], k2.Fsa]:
+        """Load FSAs of the given keys from disk, if they are there."""
+        ans = {}
+        shard_to_keys: Dict[Path, List[Tuple[int, ...]]] = {}
+        for key in keys:
+            entry = self.disk_index.get(_key_to_digest(key))
+            if entry is not None:
+                shard_to_keys.setdefault(entry[0], []).append(key)
+
+        for shard, shard_keys in shard_to_keys.items():
+            # Only the requested FSAs are read, in the order of their offsets
+            entries = sorted(
+                (self.disk_index[_key_to_digest(key)][1:], key)
+                for key in shard_keys
+            )
+            try:
+                with open(shard, "rb") as f:
+                    for (offset, size), key in entries:
+                        f.seek(offset)
+                        fsa_dict = torch.load(
+                            io.BytesIO(f.read(size)), map_location="cpu"
+                        )
+                        fsa = k2.Fsa.from_dict(fsa_dict)
+                        ans[key] = fsa.to(self.device)
+                        self._put(key, ans[key])
+            except Exception as e:
+                logging.warning(f"Failed to load {shard}: {e}")
+        return ans
+
+    def _save_to_disk(self, key: Tuple[int, ...], fsa: k2.Fsa) -> None:
+        digest = _key_to_digest(key)
+        if digest in self.disk_index or digest in self.pending:
+            return
+        self.pending[digest] = fsa.to("cpu").as_dict()
+        if len(self.pending) >= self.shard_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write FSAs not yet saved to `cache_dir` as a new shard."""
+        if self.cache_dir is None or not self.pending:
+            return
+
+        # Shard names have to be unique among processes sharing
+        # the same `cache_dir`, e.g., in DDP training.
+        name = f"shard-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        shard = self.cache_dir / f"{name}.bin"
+        index_file = self.cache_dir / f"{name}.idx"
+
+        entries = []
+        tmp = self.cache_dir / f"{name}.bin.tmp"
+        with open(tmp, "wb") as f:
+            for digest, fsa_dict in self.pending.items():
+                buf = io.BytesIO()
+                torch.save(fsa_dict, buf)
+                entries.append((digest, f.tell(), buf.tell()))
+                f.write(buf.getvalue())
+        os.replace(tmp, shard)
+
+        # The index file is written last so that a shard is used
+        # only if it has been written completely
+        tmp = self.cache_dir / f"{name}.idx.tmp"
+        with open(tmp, "w") as f:
+            for digest, offset, size in entries:
+                f.write(f"{digest} {offset} {size}\n")
+        os.replace(tmp, index_file)
+        self._index_files.add(index_file)
+
+        for digest, offset, size in entries:
+            self.disk_index[digest] = (shard, offset, size)
+
+        self.pending = {}
+
+    def get_or_compile(
+        self,
+        keys: Sequence[Tuple[int, ...]],
+        compile_fn: Callable[[List[Tuple[int, ...]]], k2.Fsa],
+    ) -> k2.Fsa:
+        """Return an FsaVec containing the FSA of each key.
+
+        Args:
+          keys:
+            The key of each FSA, e.g., the word IDs of each transcript.
+          compile_fn:
+            It is called with keys that are not in the cache and it should
+            return an FsaVec containing their FSAs, in the same order.
+        Returns:
+          Return an FsaVec with `len(keys)` FSAs.
+        """
+        keys = [tuple(k) for k in keys]
+
+        # FSAs of this batch, in case some of them are evicted
+        # before the batch is assembled
+        fsas = {k: self.fsas[k] for k in keys if k in self.fsas}
+
+        missing = list(dict.fromkeys(k for k in keys if k not in fsas))
+        if missing and self.cache_dir is not None:
+            self._read_new_index_files()
+            if self.disk_index:
+                fsas.update(self._load_from_disk(missing))
+                missing = [k for k in missing if k not in fsas]
+
+        self.num_misses += len(missing)
+        self.num_hits += len(keys) - len(missing)
+
+        if missing:
+            fsa_vec = compile_fn(missing)
+            assert fsa_vec.shape[0] == len(missing), (
+                fsa_vec.shape[0],
+                len(missing),
+            )
+            for i, key in enumerate(missing):
+                fsa = fsa_vec[i]
+                fsas[key] = fsa
+                self._put(key, fsa)
+                if self.cache_dir is not None:
+                    self._save_to_disk(key, fsa)
+
+        for key in keys:
+            if key in self.fsas:
+                self.fsas.move_to_end(key)
+
+        return k2.create_fsa_vec([fsas[k] for k in keys])
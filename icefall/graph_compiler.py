@@ -15,11 +15,13 @@
 # limitations under the License.
 
 
-from typing import List
+from pathlib import Path
+from typing import List, Optional, Union
 
 import k2
 import torch
 
+from icefall.fsa_cache import FsaCache, fsa_fingerprint
 from icefall.lexicon import Lexicon
 
 
@@ -29,6 +31,8 @@ class CtcTrainingGraphCompiler(object):
         lexicon: Lexicon,
         device: torch.device,
         oov: str = "<UNK>",
+        cache_max_num_arcs: int = 0,
+        cache_dir: Optional[Union[str, Path]] = None,
     ):
         """
         Args:
@@ -39,6 +43,14 @@ class CtcTrainingGraphCompiler(object):
           oov:
             Out of vocabulary word. When a word in the transcript
             does not exist in the lexicon, it is replaced with `oov`.
+          cache_max_num_arcs:
+            If positive, the graph of each utterance returned by
+            :meth:`compile` is cached, keyed by its word IDs, and at most
+            this number of arcs are kept in memory.
+          cache_dir:
+            If not None and `cache_max_num_arcs` is positive, compiled
+            graphs are also saved in a subdirectory of it and reused
+            by later runs. See :class:`icefall.fsa_cache.FsaCache`.
         """
         L_inv = lexicon.L_inv.to(device)
         assert L_inv.requires_grad is False
@@ -48,6 +60,7 @@ class CtcTrainingGraphCompiler(object):
         self.L_inv = k2.arc_sort(L_inv)
         self.oov_id = lexicon.word_table[oov]
         self.word_table = lexicon.word_table
+        self.word_tokenizer = lexicon.word_tokenizer(oov)
 
         max_token_id = max(lexicon.tokens)
         ctc_topo = k2.ctc_topo(max_token_id, modified=False)
@@ -55,7 +68,21 @@ class CtcTrainingGraphCompiler(object):
         self.ctc_topo = ctc_topo.to(device)
         self.device = device
 
-    def compile(self, texts: List[str]) -> k2.Fsa:
+        self.cache = None
+        if cache_max_num_arcs > 0:
+            if cache_dir is not None:
+                cache_dir = Path(cache_dir) / fsa_fingerprint(
+                    self.ctc_topo, self.L_inv
+                )
+            self.cache = FsaCache(
+                cache_max_num_arcs, device=device, cache_dir=cache_dir
+            )
+
+    def compile(
+        self,
+        texts: List[str],
+        word_ids_list: Optional[List[List[int]]] = None,
+    ) -> k2.Fsa:
         """Build decoding graphs by composing ctc_topo with
         given transcripts.
 
@@ -66,12 +93,35 @@ class CtcTrainingGraphCompiler(object):
             looks like:
 
                 ['hello icefall', 'CTC training with k2']
+          word_ids_list:
+            If not None, it contains the word IDs of `texts`, e.g., from
+            `WordTokenizer.supervisions_to_word_ids()`, and `texts` are not
+            converted again.
+
+        Returns:
+          An FsaVec, the composition result of `self.ctc_topo` and the
+          transcript FSA.
+        """
+        if word_ids_list is None:
+            word_ids_list = self.texts_to_ids(texts)
+        assert len(word_ids_list) == len(texts)
+        if self.cache is None:
+            return self.compile_word_ids(word_ids_list)
+        return self.cache.get_or_compile(word_ids_list, self.compile_word_ids)
+
+    def compile_word_ids(self, word_ids_list: List[List[int]]) -> k2.Fsa:
+        """Build decoding graphs by composing ctc_topo with
+        transcripts given as word IDs.
 
+        Args:
+          word_ids_list:
+            A list-of-list of word IDs, e.g., the return value of
+            :meth:`texts_to_ids`.
         Returns:
           An FsaVec, the composition result of `self.ctc_topo` and the
           transcript FSA.
         """
-        transcript_fsa = self.convert_transcript_to_fsa(texts)
+        transcript_fsa = self.word_ids_to_transcript_fsa(word_ids_list)
 
         # NOTE: k2.compose runs on CUDA only when treat_epsilons_specially
         # is False, so we add epsilon self-loops here
@@ -101,16 +151,7 @@ class CtcTrainingGraphCompiler(object):
         Returns:
           Return a list-of-list of word IDs.
         """
-        word_ids_list = []
-        for text in texts:
-            word_ids = []
-            for word in text.split():
-                if word in self.word_table:
-                    word_ids.append(self.word_table[word])
-                else:
-                    word_ids.append(self.oov_id)
-            word_ids_list.append(word_ids)
-        return word_ids_list
+        return self.word_tokenizer.texts_to_word_ids(texts)
 
     def convert_transcript_to_fsa(self, texts: List[str]) -> k2.Fsa:
         """Convert a list of transcript texts to an FsaVec.
@@ -126,16 +167,22 @@ class CtcTrainingGraphCompiler(object):
         Returns:
           Return an FsaVec, whose `shape[0]` equals to `len(texts)`.
         """
-        word_ids_list = []
-        for text in texts:
-            word_ids = []
-            for word in text.split():
-                if word in self.word_table:
-                    word_ids.append(self.word_table[word])
-                else:
-                    word_ids.append(self.oov_id)
-            word_ids_list.append(word_ids)
+        return self.word_ids_to_transcript_fsa(self.texts_to_ids(texts))
+
+    def word_ids_to_transcript_fsa(
+        self, word_ids_list: List[List[int]]
+    ) -> k2.Fsa:
+        """Convert a list-of-list of word IDs to an FsaVec.
 
+        Args:
+          word_ids_list:
+            A list-of-list of word IDs, e.g., the return value of
+            :meth:`texts_to_ids`.
+        Returns:
+          Return an FsaVec, whose `shape[0]` equals to `len(word_ids_list)`.
+        """
+        # k2.linear_fsa() requires a list-of-list
+        word_ids_list = [list(word_ids) for word_ids in word_ids_list]
         word_fsa = k2.linear_fsa(word_ids_list, self.device)
 
         word_fsa_with_self_loops = k2.add_epsilon_self_loops(word_fsa)
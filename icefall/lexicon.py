@@ -24,6 +24,8 @@ from typing import List, Tuple
 import k2
 import torch
 
+from icefall.word_tokenizer import WordTokenizer
+
 
 def read_lexicon(filename: str) -> List[Tuple[str, List[str]]]:
     """Read a lexicon from `filename`.
@@ -186,6 +188,9 @@ class Lexicon(object):
         self.L_inv = L_inv
         self.disambig_pattern = disambig_pattern
 
+        # Indexed by the OOV word
+        self._word_tokenizers = {}
+
     @property
     def tokens(self) -> List[int]:
         """Return a list of token IDs excluding those from
@@ -204,6 +209,23 @@ class Lexicon(object):
         ans.sort()
         return ans
 
+    def word_tokenizer(self, oov: str = "<UNK>") -> WordTokenizer:
+        """Return the tokenizer that converts transcripts to word IDs,
+        replacing words not in the lexicon with `oov`.
+
+        The tokenizer is created once per OOV word and shared by all users
+        of this lexicon, e.g., graph compilers, so that they share the
+        memoized word IDs.
+        """
+        if oov not in self._word_tokenizers:
+            self._word_tokenizers[oov] = WordTokenizer(
+                self.word_table,
+                oov=oov,
+                # Only UniqLexicon has it
+                ragged_lexicon=getattr(self, "ragged_lexicon", None),
+            )
+        return self._word_tokenizers[oov]
+
 
 class UniqLexicon(Lexicon):
     def __init__(
@@ -245,21 +267,7 @@ class UniqLexicon(Lexicon):
         Returns:
           Return a ragged int tensor with 2 axes [utterance][token_id]
         """
-        oov_id = self.word_table[oov]
-
-        word_ids_list = []
-        for text in texts:
-            word_ids = []
-            for word in text.split():
-                if word in self.word_table:
-                    word_ids.append(self.word_table[word])
-                else:
-                    word_ids.append(oov_id)
-            word_ids_list.append(word_ids)
-        ragged_indexes = k2.RaggedTensor(word_ids_list, dtype=torch.int32)
-        ans = self.ragged_lexicon.index(ragged_indexes)
-        ans = ans.remove_axis(ans.num_axes - 2)
-        return ans
+        return self.word_tokenizer(oov).texts_to_token_ids(texts)
 
     def words_to_token_ids(self, words: List[str]) -> k2.RaggedTensor:
         """Convert a list of words to a ragged tensor containing token IDs.
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 import k2
 import torch
@@ -13,6 +13,7 @@ def _compute_mmi_loss_exact_optimized(
     graph_compiler: MmiTrainingGraphCompiler,
     den_scale: float = 1.0,
     beam_size: float = 8.0,
+    num_graphs: Optional[k2.Fsa] = None,
 ) -> torch.Tensor:
     """
     The function name contains `exact`, which means it uses a version of
@@ -33,11 +34,16 @@ def _compute_mmi_loss_exact_optimized(
         Used to build num_graphs and den_graphs
       den_scale:
         The scale applied to the denominator tot_scores.
+      num_graphs:
+        If not None, it contains the numerator graphs of `texts` compiled
+        beforehand, e.g., in dataloader workers.
     Returns:
       Return a scalar loss. It is the sum over utterances in a batch,
       without normalization.
     """
-    num_graphs, den_graphs = graph_compiler.compile(texts, replicate_den=False)
+    num_graphs, den_graphs = graph_compiler.compile(
+        texts, replicate_den=False, num=num_graphs
+    )
 
     device = num_graphs.device
 
@@ -102,6 +108,7 @@ def _compute_mmi_loss_exact_non_optimized(
     graph_compiler: MmiTrainingGraphCompiler,
     den_scale: float = 1.0,
     beam_size: float = 8.0,
+    num_graphs: Optional[k2.Fsa] = None,
 ) -> torch.Tensor:
     """
     See :func:`_compute_mmi_loss_exact_optimized` for the meaning
@@ -112,7 +119,9 @@ def _compute_mmi_loss_exact_non_optimized(
     Note:
       It uses less memory at the cost of speed. It is slower.
     """
-    num_graphs, den_graphs = graph_compiler.compile(texts, replicate_den=True)
+    num_graphs, den_graphs = graph_compiler.compile(
+        texts, replicate_den=True, num=num_graphs
+    )
 
     # TODO: pass output_beam as function argument
     num_lats = k2.intersect_dense(
@@ -142,6 +151,7 @@ def _compute_mmi_loss_pruned(
     graph_compiler: MmiTrainingGraphCompiler,
     den_scale: float = 1.0,
     beam_size: float = 8.0,
+    num_graphs: Optional[k2.Fsa] = None,
 ) -> torch.Tensor:
     """
     See :func:`_compute_mmi_loss_exact_optimized` for the meaning
@@ -153,7 +163,9 @@ def _compute_mmi_loss_pruned(
       It uses the least amount of memory, but the loss is not exact due
       to pruning.
     """
-    num_graphs, den_graphs = graph_compiler.compile(texts, replicate_den=False)
+    num_graphs, den_graphs = graph_compiler.compile(
+        texts, replicate_den=False, num=num_graphs
+    )
 
     num_lats = k2.intersect_dense(num_graphs, dense_fsa_vec, output_beam=10.0)
 
@@ -206,6 +218,7 @@ class LFMMILoss(nn.Module):
         self,
         dense_fsa_vec: k2.DenseFsaVec,
         texts: List[str],
+        num_graphs: Optional[k2.Fsa] = None,
     ) -> torch.Tensor:
         """
         Args:
@@ -213,6 +226,9 @@ class LFMMILoss(nn.Module):
             It contains the neural network output.
           texts:
             A list of strings. Each string contains space(s) separated words.
+          num_graphs:
+            If not None, it contains the numerator graphs of `texts`
+            compiled beforehand, e.g., in dataloader workers.
         Returns:
           Return a scalar loss. It is the sum over utterances in a batch,
           without normalization.
@@ -229,4 +245,5 @@ class LFMMILoss(nn.Module):
             graph_compiler=self.graph_compiler,
             den_scale=self.den_scale,
             beam_size=self.beam_size,
+            num_graphs=num_graphs,
         )
@@ -1,10 +1,11 @@
 import logging
 from pathlib import Path
-from typing import Iterable, List, Tuple, Union
+from typing import Iterable, List, Optional, Tuple, Union
 
 import k2
 import torch
 
+from icefall.fsa_cache import FsaCache, fsa_fingerprint
 from icefall.lexicon import UniqLexicon
 
 
@@ -17,6 +18,8 @@ class MmiTrainingGraphCompiler(object):
         oov: str = "<UNK>",
         sos_id: int = 1,
         eos_id: int = 1,
+        cache_max_num_arcs: int = 0,
+        cache_dir: Optional[Union[str, Path]] = None,
     ):
         """
         Args:
@@ -39,6 +42,14 @@ class MmiTrainingGraphCompiler(object):
           oov:
             Out of vocabulary word. When a word in the transcript
             does not exist in the lexicon, it is replaced with `oov`.
+          cache_max_num_arcs:
+            If positive, the numerator graph of each utterance returned by
+            :meth:`compile` is cached, keyed by its word IDs, and at most
+            this number of arcs are kept in memory.
+          cache_dir:
+            If not None and `cache_max_num_arcs` is positive, compiled
+            numerator graphs are also saved in a subdirectory of it and
+            reused by later runs. See :class:`icefall.fsa_cache.FsaCache`.
         """
         self.lang_dir = Path(lang_dir)
         self.lexicon = UniqLexicon(lang_dir, uniq_filename=uniq_filename)
@@ -47,11 +58,22 @@ class MmiTrainingGraphCompiler(object):
         self.L_inv = self.lexicon.L_inv.to(self.device)
 
         self.oov_id = self.lexicon.word_table[oov]
+        self.word_tokenizer = self.lexicon.word_tokenizer(oov)
         self.sos_id = sos_id
         self.eos_id = eos_id
 
         self.build_ctc_topo_P()
 
+        self.cache = None
+        if cache_max_num_arcs > 0:
+            if cache_dir is not None:
+                cache_dir = Path(cache_dir) / fsa_fingerprint(
+                    self.ctc_topo_P, self.L_inv
+                )
+            self.cache = FsaCache(
+                cache_max_num_arcs, device=self.device, cache_dir=cache_dir
+            )
+
     def build_ctc_topo_P(self):
         """Built ctc_topo_P, the composition result of
         ctc_topo and P, where P is a pre-trained bigram
@@ -100,7 +122,10 @@ class MmiTrainingGraphCompiler(object):
         logging.info(f"ctc_topo_P num_arcs: {self.ctc_topo_P.num_arcs}")
 
     def compile(
-        self, texts: Iterable[str], replicate_den: bool = True
+        self,
+        texts: Iterable[str],
+        replicate_den: bool = True,
+        num: Optional[k2.Fsa] = None,
     ) -> Tuple[k2.Fsa, k2.Fsa]:
         """Create numerator and denominator graphs from transcripts
         and the bigram phone LM.
@@ -116,6 +141,10 @@ class MmiTrainingGraphCompiler(object):
             If True, the returned den_graph is replicated to match the number
             of FSAs in the returned num_graph; if False, the returned den_graph
             contains only a single FSA
+          num:
+            If not None, it is the numerator graph of `texts` that has
+            been compiled elsewhere, e.g., in a dataloader worker, and it is
+            returned as it is.
         Returns:
           A tuple (num_graph, den_graph), where
 
@@ -126,7 +155,35 @@ class MmiTrainingGraphCompiler(object):
               with the same shape of the `num_graph` if replicate_den is
               True; otherwise, it is an FsaVec containing only a single FSA.
         """
-        transcript_fsa = self.build_transcript_fsa(texts)
+        if num is None:
+            word_ids_list = self.texts_to_word_ids(texts)
+            if self.cache is None:
+                num = self.compile_num(word_ids_list)
+            else:
+                num = self.cache.get_or_compile(word_ids_list, self.compile_num)
+
+        ctc_topo_P_vec = k2.create_fsa_vec([self.ctc_topo_P])
+        if replicate_den:
+            indexes = torch.zeros(
+                len(texts), dtype=torch.int32, device=self.device
+            )
+            den = k2.index_fsa(ctc_topo_P_vec, indexes)
+        else:
+            den = ctc_topo_P_vec
+
+        return num, den
+
+    def compile_num(self, word_ids_list: List[List[int]]) -> k2.Fsa:
+        """Create numerator graphs from transcripts given as word IDs.
+
+        Args:
+          word_ids_list:
+            A list-of-list of word IDs, e.g., the return value of
+            :meth:`texts_to_word_ids`.
+        Returns:
+          Return an FsaVec with shape `(len(word_ids_list), None, None)`.
+        """
+        transcript_fsa = self.word_ids_to_transcript_fsa(word_ids_list)
 
         # remove word IDs from transcript_fsa since it is not needed
         del transcript_fsa.aux_labels
@@ -153,16 +210,7 @@ class MmiTrainingGraphCompiler(object):
 
         num = k2.arc_sort(num)
 
-        ctc_topo_P_vec = k2.create_fsa_vec([self.ctc_topo_P])
-        if replicate_den:
-            indexes = torch.zeros(
-                len(texts), dtype=torch.int32, device=self.device
-            )
-            den = k2.index_fsa(ctc_topo_P_vec, indexes)
-        else:
-            den = ctc_topo_P_vec
-
-        return num, den
+        return num
 
     def build_transcript_fsa(self, texts: List[str]) -> k2.Fsa:
         """Convert transcripts to an FsaVec with the help of a lexicon
@@ -178,16 +226,29 @@ class MmiTrainingGraphCompiler(object):
           Return an FST (FsaVec) corresponding to the transcript.
           Its `labels` is token IDs and `aux_labels` is word IDs.
         """
-        word_ids_list = []
-        for text in texts:
-            word_ids = []
-            for word in text.split():
-                if word in self.lexicon.word_table:
-                    word_ids.append(self.lexicon.word_table[word])
-                else:
-                    word_ids.append(self.oov_id)
-            word_ids_list.append(word_ids)
+        return self.word_ids_to_transcript_fsa(self.texts_to_word_ids(texts))
 
+    def texts_to_word_ids(self, texts: Iterable[str]) -> List[List[int]]:
+        """Convert a list of texts to a list-of-list of word IDs.
+
+        Args:
+          texts:
+            Each element is a transcript containing words separated by space(s).
+            Words not in the lexicon are replaced with the OOV word.
+        Returns:
+          Return a list-of-list of word IDs.
+        """
+        return self.word_tokenizer.texts_to_word_ids(texts)
+
+    def word_ids_to_transcript_fsa(
+        self, word_ids_list: List[List[int]]
+    ) -> k2.Fsa:
+        """Convert a list-of-list of word IDs to an FsaVec.
+
+        See :meth:`build_transcript_fsa` for the returned FsaVec.
+        """
+        # k2.linear_fsa() requires a list-of-list
+        word_ids_list = [list(word_ids) for word_ids in word_ids_list]
         fsa = k2.linear_fsa(word_ids_list, self.device)
         fsa = k2.add_epsilon_self_loops(fsa)
 
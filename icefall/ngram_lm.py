@@ -15,9 +15,12 @@
 # limitations under the License.
 
 from collections import defaultdict
-from typing import List, Optional, Tuple
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
 
 import kaldifst
+import numpy as np
+import torch
 
 
 class NgramLm:
@@ -48,6 +51,14 @@ class NgramLm:
         self.lm = lm
         self.backoff_id = backoff_id
 
+    @property
+    def start(self) -> int:
+        return self.lm.start
+
+    @property
+    def num_states(self) -> int:
+        return self.lm.num_states
+
     def _process_backoff_arcs(
         self,
         state: int,
@@ -132,9 +143,425 @@ class NgramLm:
         return next_states, next_costs
 
 
+class CompiledNgramLm:
+    """An array-backed version of :class:`NgramLm`.
+
+    All arcs are stored in flat arrays sorted by `(state, ilabel)`, so
+    finding the arc leaving `state` with a given label is a binary search
+    over the integer key `state * num_labels + ilabel`. The backoff closure
+    of each state, i.e., the states reachable from it via backoff arcs and
+    the accumulated backoff costs, is precomputed. Results of
+    :func:`get_next_state_and_cost` are cached per `(state, label)`.
+
+    It gives the same results as :class:`NgramLm` and can be used in its
+    place, e.g., with :class:`NgramLmStateCost`. In addition,
+    :func:`get_next_states_and_costs` looks up a batch of
+    `(state, label)` pairs given as tensors, and
+    :func:`get_next_states_and_costs_for_all_labels` looks up all labels
+    of a batch of states, on CPU or GPU, for shallow fusion.
+
+    Use :func:`save` to dump the arrays into a directory, which can be
+    loaded with memory mapping by :func:`load`.
+
+    Usage::
+
+        ngram_lm = CompiledNgramLm.from_ngram_lm(NgramLm("G.fst.txt", 500))
+        ngram_lm.save("G-compiled")
+        ngram_lm = CompiledNgramLm.load("G-compiled")
+    """
+
+    _ARRAY_NAMES = (
+        "arc_keys",
+        "arc_next_states",
+        "arc_costs",
+        "backoff_states",
+        "backoff_costs",
+        "meta",
+    )
+
+    def __init__(
+        self,
+        arc_keys: np.ndarray,
+        arc_next_states: np.ndarray,
+        arc_costs: np.ndarray,
+        backoff_states: np.ndarray,
+        backoff_costs: np.ndarray,
+        num_labels: int,
+        backoff_id: int,
+        start: int = 0,
+    ):
+        """
+        Args:
+          arc_keys:
+            A 1-D np.int64 array of shape (num_arcs,). It contains
+            `state * num_labels + ilabel` of each arc in ascending order.
+          arc_next_states:
+            A 1-D np.int32 array of shape (num_arcs,) containing the next
+            state of each arc.
+          arc_costs:
+            A 1-D np.float32 array of shape (num_arcs,) containing the cost
+            of each arc.
+          backoff_states:
+            A 2-D np.int32 array of shape (num_states, K). Row `s` contains
+            `s` followed by the states reachable from `s` via backoff arcs,
+            padded with -1.
+          backoff_costs:
+            A 2-D np.float64 array of shape (num_states, K) containing the
+            cost of reaching the corresponding entry in `backoff_states`.
+          num_labels:
+            1 + the largest ilabel in the LM.
+          backoff_id:
+            ID of the backoff symbol.
+          start:
+            The start state of the LM.
+        """
+        self.arc_keys = arc_keys
+        self.arc_next_states = arc_next_states
+        self.arc_costs = arc_costs
+        self.backoff_states = backoff_states
+        self.backoff_costs = backoff_costs
+        self.num_labels = num_labels
+        self.backoff_id = backoff_id
+        self.start = start
+
+        # np.ndarray and torch.Tensor share the same memory
+        self._arc_keys = torch.from_numpy(arc_keys)
+        self._arc_next_states = torch.from_numpy(arc_next_states)
+        self._arc_costs = torch.from_numpy(arc_costs)
+        self._backoff_states = torch.from_numpy(backoff_states)
+        self._backoff_costs = torch.from_numpy(backoff_costs)
+
+        self._cache: Dict[Tuple[int, int], Tuple[List[int], List[float]]] = {}
+
+        # Copies of the above tensors on devices other than CPU
+        self._device_tensors: Dict[torch.device, Dict[str, torch.Tensor]] = {}
+
+    @property
+    def num_states(self) -> int:
+        return self.backoff_states.shape[0]
+
+    @property
+    def num_arcs(self) -> int:
+        return self.arc_keys.shape[0]
+
+    @staticmethod
+    def from_ngram_lm(ngram_lm: NgramLm) -> "CompiledNgramLm":
+        return CompiledNgramLm.from_fst(ngram_lm.lm, ngram_lm.backoff_id)
+
+    @staticmethod
+    def from_fst(
+        lm: kaldifst.StdVectorFst, backoff_id: int
+    ) -> "CompiledNgramLm":
+        """Build a CompiledNgramLm from an FST.
+
+        Args:
+          lm:
+            The n-gram LM in FST format.
+          backoff_id:
+            ID of the backoff symbol.
+        """
+        num_states = lm.num_states
+        states = []
+        ilabels = []
+        next_states = []
+        costs = []
+        for state in range(num_states):
+            arc_iter = kaldifst.ArcIterator(lm, state)
+            while not arc_iter.done:
+                arc = arc_iter.value
+                states.append(state)
+                ilabels.append(arc.ilabel)
+                next_states.append(arc.nextstate)
+                costs.append(arc.weight.value)
+                arc_iter.next()
+
+        states = np.array(states, dtype=np.int64)
+        ilabels = np.array(ilabels, dtype=np.int64)
+        num_labels = int(ilabels.max()) + 1 if ilabels.size > 0 else 1
+
+        arc_keys = states * num_labels + ilabels
+        order = np.argsort(arc_keys, kind="stable")
+        arc_keys = np.ascontiguousarray(arc_keys[order])
+        arc_next_states = np.array(next_states, dtype=np.int32)[order]
+        arc_costs = np.array(costs, dtype=np.float32)[order]
+
+        # Compute the backoff closure of all states
+        backoff_next = np.full(num_states, -1, dtype=np.int64)
+        backoff_cost = np.zeros(num_states, dtype=np.float64)
+        if backoff_id < num_labels:
+            is_backoff = (arc_keys % num_labels) == backoff_id
+            backoff_arcs = np.nonzero(is_backoff)[0]
+            backoff_next[
+                arc_keys[backoff_arcs] // num_labels
+            ] = arc_next_states[backoff_arcs]
+            backoff_cost[arc_keys[backoff_arcs] // num_labels] = arc_costs[
+                backoff_arcs
+            ]
+
+        closure_states = [np.arange(num_states, dtype=np.int64)]
+        closure_costs = [np.zeros(num_states, dtype=np.float64)]
+        cur = closure_states[0]
+        cur_cost = closure_costs[0]
+        while True:
+            valid = cur >= 0
+            nxt = np.where(valid, backoff_next[np.maximum(cur, 0)], -1)
+            if not (nxt >= 0).any():
+                break
+            assert len(closure_states) <= num_states, "Loop in backoff arcs"
+            # Note: The order of the addition is the same as the one in
+            # NgramLm._process_backoff_arcs()
+            cur_cost = np.where(
+                nxt >= 0,
+                backoff_cost[np.maximum(cur, 0)] + cur_cost,
+                np.inf,
+            )
+            cur = nxt
+            closure_states.append(cur)
+            closure_costs.append(cur_cost)
+
+        backoff_states = np.stack(closure_states, axis=1).astype(np.int32)
+        backoff_costs = np.stack(closure_costs, axis=1)
+
+        return CompiledNgramLm(
+            arc_keys=arc_keys,
+            arc_next_states=arc_next_states,
+            arc_costs=arc_costs,
+            backoff_states=backoff_states,
+            backoff_costs=backoff_costs,
+            num_labels=num_labels,
+            backoff_id=backoff_id,
+            start=lm.start,
+        )
+
+    def save(self, dirname: Union[str, Path]) -> None:
+        """Save the arrays into the given directory. Each array is saved
+        to a separate `.npy` file, so they can be memory mapped by
+        :func:`load`."""
+        dirname = Path(dirname)
+        dirname.mkdir(parents=True, exist_ok=True)
+        meta = np.array(
+            [self.num_labels, self.backoff_id, self.start], dtype=np.int64
+        )
+        for name in self._ARRAY_NAMES:
+            array = meta if name == "meta" else getattr(self, name)
+            np.save(dirname / f"{name}.npy", array)
+
+    @staticmethod
+    def load(dirname: Union[str, Path], mmap: bool = True) -> "CompiledNgramLm":
+        """Load a CompiledNgramLm saved by :func:`save`.
+
+        Args:
+          dirname:
+            The directory passed to :func:`save`.
+          mmap:
+            True to memory map the arrays instead of reading them into
+            memory.
+        """
+        dirname = Path(dirname)
+        # Use copy-on-write so that the arrays are writable, which is
+        # required by torch.from_numpy()
+        mmap_mode = "c" if mmap else None
+        arrays = {
+            name: np.load(dirname / f"{name}.npy", mmap_mode=mmap_mode)
+            for name in CompiledNgramLm._ARRAY_NAMES
+        }
+        num_labels, backoff_id, start = arrays.pop("meta").tolist()
+        return CompiledNgramLm(
+            **arrays,
+            num_labels=num_labels,
+            backoff_id=backoff_id,
+            start=start,
+        )
+
+    def get_next_state_and_cost(
+        self,
+        state: int,
+        label: int,
+    ) -> Tuple[List[int], List[float]]:
+        """Same as :func:`NgramLm.get_next_state_and_cost`."""
+        key = (state, label)
+        ans = self._cache.get(key)
+        if ans is not None:
+            return ans
+
+        next_states = []
+        next_costs = []
+        if 0 <= label < self.num_labels:
+            for s, c in zip(
+                self.backoff_states[state], self.backoff_costs[state]
+            ):
+                if s < 0:
+                    break
+                arc_key = int(s) * self.num_labels + label
+                i = np.searchsorted(self.arc_keys, arc_key)
+                if i == self.num_arcs or self.arc_keys[i] != arc_key:
+                    continue
+                ns = int(self.arc_next_states[i])
+                # Same as NgramLm, transitions to state 0 are ignored
+                if ns:
+                    next_states.append(ns)
+                    next_costs.append(float(c) + float(self.arc_costs[i]))
+
+        ans = (next_states, next_costs)
+        self._cache[key] = ans
+        return ans
+
+    def get_next_states_and_costs(
+        self,
+        states: torch.Tensor,
+        labels: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The batched version of :func:`get_next_state_and_cost`.
+
+        Args:
+          states:
+            A 1-D torch.int64 tensor of shape (N,) on CPU.
+          labels:
+            A 1-D torch.int64 tensor of shape (N,) on CPU.
+        Returns:
+          Return a tuple containing:
+            - next_states, a 2-D torch.int64 tensor of shape (N, K). Entries
+              that do not correspond to a transition are set to -1.
+            - next_costs, a 2-D torch.float64 tensor of shape (N, K). Entries
+              that do not correspond to a transition are set to inf.
+          The non-negative entries of `next_states[i]` and the
+          corresponding entries of `next_costs[i]` are the same as the
+          return value of `get_next_state_and_cost(states[i], labels[i])`.
+        """
+        assert states.ndim == labels.ndim == 1, (states.shape, labels.shape)
+        states = states.to(torch.int64)
+        labels = labels.to(torch.int64).unsqueeze(1)
+
+        closure_states = self._backoff_states[states].to(torch.int64)
+        closure_costs = self._backoff_costs[states]
+
+        keys = closure_states * self.num_labels + labels
+        index = torch.searchsorted(self._arc_keys, keys)
+        index = index.clamp_(max=max(self.num_arcs - 1, 0))
+
+        next_states = self._arc_next_states[index].to(torch.int64)
+        found = (
+            (self._arc_keys[index] == keys)
+            & (closure_states >= 0)
+            & (labels >= 0)
+            & (labels < self.num_labels)
+            & (next_states != 0)
+        )
+        next_costs = closure_costs + self._arc_costs[index].to(torch.float64)
+
+        next_states = torch.where(
+            found, next_states, torch.full_like(next_states, -1)
+        )
+        next_costs = torch.where(
+            found, next_costs, torch.full_like(next_costs, float("inf"))
+        )
+        return next_states, next_costs
+
+    def _tensors_on(self, device: torch.device) -> Dict[str, torch.Tensor]:
+        """Return the arrays as tensors on the given device. Copies on
+        devices other than CPU are cached."""
+        if device.type == "cpu":
+            return {
+                "arc_keys": self._arc_keys,
+                "arc_next_states": self._arc_next_states,
+                "arc_costs": self._arc_costs,
+                "backoff_states": self._backoff_states,
+                "backoff_costs": self._backoff_costs,
+            }
+        if device not in self._device_tensors:
+            self._device_tensors[device] = {
+                k: v.to(device)
+                for k, v in self._tensors_on(torch.device("cpu")).items()
+            }
+        return self._device_tensors[device]
+
+    def get_next_states_and_costs_for_all_labels(
+        self,
+        states: torch.Tensor,
+        num_labels: Optional[int] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Look up the transitions of the given states for all labels at
+        once, treating the LM as a deterministic backoff LM.
+
+        Unlike :func:`get_next_state_and_cost`, which follows all backoff
+        paths, it returns a single transition for each (state, label): the
+        one taken from the first state in the backoff closure of `state`
+        that has an arc with `label`, i.e., the highest order n-gram.
+        So each hypothesis of a search can keep a single LM state.
+
+        Args:
+          states:
+            A 1-D torch.int64 tensor of shape (N,). It can be on any device.
+          num_labels:
+            Number of labels to look up, i.e., labels 0, 1, ...,
+            num_labels - 1. Labels that are not in the LM have no
+            transitions. Defaults to `self.num_labels`.
+        Returns:
+          Return a tuple containing:
+            - next_states, a 2-D torch.int64 tensor of shape
+              (N, num_labels). Entries without a transition are set to -1.
+            - next_costs, a 2-D torch.float32 tensor of shape
+              (N, num_labels). Entries without a transition are set to inf.
+        """
+        assert states.ndim == 1, states.shape
+        if num_labels is None:
+            num_labels = self.num_labels
+
+        device = states.device
+        t = self._tensors_on(device)
+        states = states.to(torch.int64)
+
+        closure_states = t["backoff_states"][states].to(torch.int64)
+        closure_costs = t["backoff_costs"][states]
+        # Both are of shape (N, K)
+
+        labels = torch.arange(num_labels, device=device)
+        valid_labels = labels < self.num_labels
+
+        next_states = torch.full(
+            (states.numel(), num_labels), -1, dtype=torch.int64, device=device
+        )
+        next_costs = torch.full(
+            (states.numel(), num_labels),
+            float("inf"),
+            dtype=torch.float64,
+            device=device,
+        )
+        for k in range(closure_states.size(1)):
+            s = closure_states[:, k : k + 1]  # noqa
+            if not bool((s >= 0).any()):
+                break
+            keys = s * self.num_labels + labels
+            index = torch.searchsorted(t["arc_keys"], keys)
+            index = index.clamp_(max=max(self.num_arcs - 1, 0))
+            ns = t["arc_next_states"][index].to(torch.int64)
+            # Same as get_next_state_and_cost(), transitions to state 0
+            # are ignored
+            found = (
+                (t["arc_keys"][index] == keys)
+                & (s >= 0)
+                & valid_labels
+                & (ns != 0)
+                & (next_states < 0)
+            )
+            next_states = torch.where(found, ns, next_states)
+            next_costs = torch.where(
+                found,
+                closure_costs[:, k : k + 1]  # noqa
+                + t["arc_costs"][index].to(torch.float64),
+                next_costs,
+            )
+
+        return next_states, next_costs.to(torch.float32)
+
+
 class NgramLmStateCost:
-    def __init__(self, ngram_lm: NgramLm, state_cost: Optional[dict] = None):
-        assert ngram_lm.lm.start == 0, ngram_lm.lm.start
+    def __init__(
+        self,
+        ngram_lm: Union[NgramLm, CompiledNgramLm],
+        state_cost: Optional[dict] = None,
+    ):
+        assert ngram_lm.start == 0, ngram_lm.start
         self.ngram_lm = ngram_lm
         if state_cost is not None:
             self.state_cost = state_cost
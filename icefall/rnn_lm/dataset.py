@@ -14,9 +14,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Tuple
+from pathlib import Path
+from typing import List, Sequence, Tuple
 
 import k2
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
@@ -24,6 +26,48 @@ from torch.utils.data.distributed import DistributedSampler
 from icefall.utils import AttributeDict, add_eos, add_sos
 
 
+def compute_batch_boundaries(
+    sentence_lengths: Sequence[int],
+    max_sent_len: int,
+    batch_size: int,
+) -> List[Tuple[int, int]]:
+    """Split sentences sorted by length in descending order into batches.
+
+    Args:
+      sentence_lengths:
+        Number of tokens of each sentence.
+      max_sent_len:
+        Maximum sentence length. It is used to change the batch size
+        dynamically. In general, we try to keep the product of
+        "max_sent_len in a batch" and "num_of_sent in a batch" being
+        a constant.
+      batch_size:
+        The expected batch size. It is changed dynamically according
+        to the "max_sent_len".
+    Returns:
+      Return a list of (start, end) pairs. Sentences in [start, end) are
+      in the same batch.
+    """
+    assert batch_size > 0, batch_size
+    assert max_sent_len > 1, max_sent_len
+    ans = []
+    num_sentences = len(sentence_lengths)
+    cur = 0
+    while cur < num_sentences:
+        sz = int(sentence_lengths[cur]) // max_sent_len + 1
+        # Assume the current sentence has 3 * max_sent_len tokens,
+        # in the worst case, the subsequent sentences also have
+        # this number of tokens, we should reduce the batch size
+        # so that this batch will not contain too many tokens
+        actual_batch_size = batch_size // sz + 1
+        actual_batch_size = min(actual_batch_size, batch_size)
+        end = cur + actual_batch_size
+        end = min(end, num_sentences)
+        ans.append((cur, end))
+        cur = end
+    return ans
+
+
 class LmDataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -61,25 +105,15 @@ class LmDataset(torch.utils.data.Dataset):
 
         sentence_lengths = sentence_lengths.tolist()
 
-        assert batch_size > 0, batch_size
-        assert max_sent_len > 1, max_sent_len
-        batch_indexes = []
-        num_sentences = sentences.dim0
-        cur = 0
-        while cur < num_sentences:
-            sz = sentence_lengths[cur] // max_sent_len + 1
-            # Assume the current sentence has 3 * max_sent_len tokens,
-            # in the worst case, the subsequent sentences also have
-            # this number of tokens, we should reduce the batch size
-            # so that this batch will not contain too many tokens
-            actual_batch_size = batch_size // sz + 1
-            actual_batch_size = min(actual_batch_size, batch_size)
-            end = cur + actual_batch_size
-            end = min(end, num_sentences)
-            this_batch_indexes = torch.arange(cur, end).tolist()
-            batch_indexes.append(this_batch_indexes)
-            cur = end
-        assert batch_indexes[-1][-1] == num_sentences - 1
+        batch_indexes = [
+            torch.arange(start, end).tolist()
+            for start, end in compute_batch_boundaries(
+                sentence_lengths,
+                max_sent_len=max_sent_len,
+                batch_size=batch_size,
+            )
+        ]
+        assert batch_indexes[-1][-1] == sentences.dim0 - 1
 
         self.batch_indexes = k2.RaggedTensor(batch_indexes)
 
@@ -115,6 +149,97 @@ class LmDataset(torch.utils.data.Dataset):
         return sentence_tokens
 
 
+class ShardedLmDataset(torch.utils.data.Dataset):
+    """LM training data stored in shards that are memory mapped.
+
+    The data is a directory containing the following files for each
+    shard `i`, written by `../local/prepare_lm_training_shards.py`:
+
+      - shard-{i:05d}-tokens.npy, a 1-D np.int32 array containing the BPE
+        tokens of all sentences of the shard, concatenated. Sentences
+        are sorted by length in descending order within the shard.
+      - shard-{i:05d}-offsets.npy, a 1-D np.int64 array of shape
+        (num_sentences + 1,). Tokens of the j-th sentence are
+        tokens[offsets[j]:offsets[j+1]].
+
+    Batches never cross shard boundaries. Only the offsets are read
+    in the constructor; tokens of a batch are read when the batch
+    is accessed, so memory usage does not depend on the corpus size
+    and each DDP rank touches only the batches it is assigned.
+    """
+
+    def __init__(self, lm_dir: str, max_sent_len: int, batch_size: int):
+        """
+        Args:
+          lm_dir:
+            The directory containing the shards.
+          max_sent_len:
+            Maximum sentence length. See :class:`LmDataset`.
+          batch_size:
+            The expected batch size. See :class:`LmDataset`.
+        """
+        super().__init__()
+        lm_dir = Path(lm_dir)
+        self.tokens_files = sorted(lm_dir.glob("shard-*-tokens.npy"))
+        assert len(self.tokens_files) > 0, f"No shards found in {lm_dir}"
+        self.offsets_files = [
+            f.with_name(f.name.replace("-tokens.npy", "-offsets.npy"))
+            for f in self.tokens_files
+        ]
+
+        batch_indexes = []
+        for i, f in enumerate(self.offsets_files):
+            offsets = np.load(f, mmap_mode="r")
+            sentence_lengths = np.diff(offsets)
+            for start, end in compute_batch_boundaries(
+                sentence_lengths,
+                max_sent_len=max_sent_len,
+                batch_size=batch_size,
+            ):
+                batch_indexes.append((i, start, end))
+
+        # Each row is (shard_index, start, end)
+        self.batch_indexes = torch.tensor(batch_indexes, dtype=torch.int64)
+
+        # They are opened lazily so that each dataloader worker
+        # maps the files by itself.
+        self._tokens = None
+        self._offsets = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        state["_offsets"] = None
+        return state
+
+    def _open(self) -> None:
+        self._tokens = [np.load(f, mmap_mode="r") for f in self.tokens_files]
+        self._offsets = [np.load(f, mmap_mode="r") for f in self.offsets_files]
+
+    def __len__(self) -> int:
+        """Return number of batches in this dataset"""
+        return self.batch_indexes.size(0)
+
+    def __getitem__(self, i: int) -> k2.RaggedTensor:
+        """Get the i'th batch in this dataset
+        Return a ragged tensor with 2 axes [sentence][token].
+        """
+        assert 0 <= i < len(self), i
+        if self._tokens is None:
+            self._open()
+
+        shard, start, end = self.batch_indexes[i].tolist()
+        offsets = self._offsets[shard][start : end + 1]
+        tokens = self._tokens[shard][offsets[0] : offsets[-1]]
+
+        row_splits = torch.from_numpy((offsets - offsets[0]).astype(np.int32))
+        values = torch.from_numpy(np.array(tokens, dtype=np.int32))
+        shape = k2.ragged.create_ragged_shape2(
+            row_splits=row_splits, cached_tot_size=values.numel()
+        )
+        return k2.RaggedTensor(shape, values)
+
+
 class LmDatasetCollate:
     def __init__(self, sos_id: int, eos_id: int, blank_id: int):
         """
@@ -177,6 +302,8 @@ def get_dataloader(
       filename:
         Path to the file containing LM data. The file is assumed to
         be generated by `../local/sort_lm_training_data.py`.
+        If it is a directory, it is assumed to contain shards generated
+        by `../local/prepare_lm_training_shards.py`.
       is_distributed:
         True if using DDP training. False otherwise.
       params:
@@ -184,19 +311,26 @@ def get_dataloader(
     Returns:
       Return a dataloader containing the LM data.
     """
-    lm_data = torch.load(filename)
-
-    words = lm_data["words"]
-    sentences = lm_data["sentences"]
-    sentence_lengths = lm_data["sentence_lengths"]
-
-    dataset = LmDataset(
-        sentences=sentences,
-        words=words,
-        sentence_lengths=sentence_lengths,
-        max_sent_len=params.max_sent_len,
-        batch_size=params.batch_size,
-    )
+    if Path(filename).is_dir():
+        dataset = ShardedLmDataset(
+            lm_dir=filename,
+            max_sent_len=params.max_sent_len,
+            batch_size=params.batch_size,
+        )
+    else:
+        lm_data = torch.load(filename)
+
+        words = lm_data["words"]
+        sentences = lm_data["sentences"]
+        sentence_lengths = lm_data["sentence_lengths"]
+
+        dataset = LmDataset(
+            sentences=sentences,
+            words=words,
+            sentence_lengths=sentence_lengths,
+            max_sent_len=params.max_sent_len,
+            batch_size=params.batch_size,
+        )
     if is_distributed:
         sampler = DistributedSampler(dataset, shuffle=True, drop_last=False)
     else:
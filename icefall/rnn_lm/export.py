@@ -17,6 +17,17 @@
 
 # This script converts several saved checkpoints
 # to a single one using model averaging.
+#
+# With --jit true, the saved cpu_jit.pt also supports step-wise
+# inference, e.g., for shallow fusion during beam search:
+#
+#   model = torch.jit.load("cpu_jit.pt")
+#   h, c = model.get_init_states(batch_size, torch.device("cpu"))
+#   log_probs, h, c = model.score_token(tokens, h, c)
+#
+# where tokens has shape (batch_size,) and log_probs has shape
+# (batch_size, vocab_size). Use model.predict_batch() to feed several
+# tokens per stream at once.
 
 import argparse
 import logging
@@ -146,6 +157,9 @@ def main():
     if params.jit:
         logging.info("Using torch.jit.script")
         model = torch.jit.script(model)
+        # Make sure the step-wise API works with the scripted model
+        h, c = model.get_init_states(1, torch.device("cpu"))
+        model.score_token(torch.tensor([0]), h, c)
         filename = params.exp_dir / "cpu_jit.pt"
         model.save(str(filename))
         logging.info(f"Saved to {filename}")
@@ -15,6 +15,7 @@
 # limitations under the License.
 
 import logging
+from typing import Tuple
 
 import torch
 import torch.nn.functional as F
@@ -65,6 +66,8 @@ class RnnLmModel(torch.nn.Module):
         )
 
         self.vocab_size = vocab_size
+        self.num_layers = num_layers
+        self.hidden_dim = hidden_dim
         if tie_weights:
             logging.info("Tying weights")
             assert embedding_dim == hidden_dim, (embedding_dim, hidden_dim)
@@ -118,3 +121,83 @@ class RnnLmModel(torch.nn.Module):
         nll_loss = nll_loss.reshape(batch_size, -1)
 
         return nll_loss
+
+    @torch.jit.export
+    def get_init_states(
+        self, batch_size: int, device: torch.device
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the initial states for :func:`score_token` and
+        :func:`predict_batch`.
+
+        Args:
+          batch_size:
+            Number of streams.
+          device:
+            The device of the returned states.
+        Returns:
+          Return a tuple (h, c). Both are zero tensors of shape
+          (num_layers, batch_size, hidden_dim).
+        """
+        h = torch.zeros(
+            self.num_layers, batch_size, self.hidden_dim, device=device
+        )
+        c = torch.zeros(
+            self.num_layers, batch_size, self.hidden_dim, device=device
+        )
+        return h, c
+
+    @torch.jit.export
+    def predict_batch(
+        self, x: torch.Tensor, h: torch.Tensor, c: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Feed a chunk of tokens to each stream and return the next-token
+        log-probs after every token.
+
+        Args:
+          x:
+            A 2-D tensor of shape (N, L) containing token IDs. There is
+            no padding, i.e., every stream consumes L tokens.
+          h:
+            The hidden states of shape (num_layers, N, hidden_dim) before
+            consuming `x`.
+          c:
+            The cell states of shape (num_layers, N, hidden_dim) before
+            consuming `x`.
+        Returns:
+          Return a tuple containing:
+            - log_probs, a tensor of shape (N, L, vocab_size). log_probs[n][i]
+              is the distribution of the token following x[n][i].
+            - h, the hidden states after consuming `x`
+            - c, the cell states after consuming `x`
+        """
+        assert x.ndim == 2, x.ndim
+        embedding = self.input_embedding(x)
+        rnn_out, (h, c) = self.rnn(embedding, (h, c))
+        log_probs = self.output_linear(rnn_out).log_softmax(dim=-1)
+        return log_probs, h, c
+
+    @torch.jit.export
+    def score_token(
+        self, x: torch.Tensor, h: torch.Tensor, c: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Feed one token to each stream. It is :func:`predict_batch` with
+        L == 1 and is intended for step-by-step decoding, e.g., shallow
+        fusion in beam search, where states are kept per hypothesis.
+
+        Args:
+          x:
+            A 1-D tensor of shape (N,) containing token IDs.
+          h:
+            The hidden states of shape (num_layers, N, hidden_dim).
+          c:
+            The cell states of shape (num_layers, N, hidden_dim).
+        Returns:
+          Return a tuple containing:
+            - log_probs, a tensor of shape (N, vocab_size), the distribution
+              of the next token
+            - h, the hidden states after consuming `x`
+            - c, the cell states after consuming `x`
+        """
+        assert x.ndim == 1, x.ndim
+        log_probs, h, c = self.predict_batch(x.unsqueeze(1), h, c)
+        return log_probs.squeeze(1), h, c
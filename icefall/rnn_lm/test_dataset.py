@@ -15,9 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import tempfile
+from pathlib import Path
+
 import k2
+import numpy as np
 import torch
-from rnn_lm.dataset import LmDataset, LmDatasetCollate
+from rnn_lm.dataset import LmDataset, LmDatasetCollate, ShardedLmDataset
 
 
 def main():
@@ -67,5 +71,38 @@ def main():
     # I've checked the output manually; the output is as expected.
 
 
+def test_sharded_lm_dataset():
+    shards = [
+        [[3, 6, 2, 8, 9], [5, 6, 7], [2, 8], [5]],
+        [[1, 2, 3, 4, 5, 6], [7]],
+    ]
+    with tempfile.TemporaryDirectory() as lm_dir:
+        for i, sentences in enumerate(shards):
+            tokens = np.array(sum(sentences, []), dtype=np.int32)
+            offsets = np.cumsum([0] + [len(s) for s in sentences])
+            prefix = Path(lm_dir) / f"shard-{i:05d}"
+            np.save(f"{prefix}-tokens.npy", tokens)
+            np.save(f"{prefix}-offsets.npy", offsets.astype(np.int64))
+
+        dataset = ShardedLmDataset(lm_dir, max_sent_len=3, batch_size=2)
+        sentences = []
+        for i in range(len(dataset)):
+            batch = dataset[i]
+            assert isinstance(batch, k2.RaggedTensor)
+            sentences += batch.tolist()
+        assert sentences == sum(shards, [])
+
+        collate_fn = LmDatasetCollate(sos_id=1, eos_id=-1, blank_id=0)
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=1, collate_fn=collate_fn, num_workers=2
+        )
+        num_batches = 0
+        for x, y, lengths in dataloader:
+            assert x.size(0) == lengths.numel()
+            num_batches += 1
+        assert num_batches == len(dataset)
+
+
 if __name__ == "__main__":
     main()
+    test_sharded_lm_dataset()
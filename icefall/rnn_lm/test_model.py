@@ -59,9 +59,50 @@ def test_rnn_lm_model_tie_weights():
     assert model.input_embedding.weight is model.output_linear.weight
 
 
+def test_rnn_lm_model_score_token():
+    vocab_size = 6
+    model = RnnLmModel(
+        vocab_size=vocab_size, embedding_dim=10, hidden_dim=10, num_layers=2
+    )
+    model.eval()
+    x = torch.tensor(
+        [
+            [1, 3, 2, 5],
+            [1, 2, 4, 4],
+        ]
+    )
+    y = torch.tensor(
+        [
+            [3, 2, 5, 1],
+            [2, 4, 4, 1],
+        ]
+    )
+    lengths = torch.tensor([4, 4])
+    nll_loss = model(x, y, lengths)
+
+    for m in [model, torch.jit.script(model)]:
+        h, c = m.get_init_states(batch_size=2, device=torch.device("cpu"))
+        nll = []
+        for i in range(x.size(1)):
+            log_probs, h, c = m.score_token(x[:, i], h, c)
+            nll.append(-log_probs.gather(1, y[:, i : i + 1]))
+        nll = torch.cat(nll, dim=1)
+        assert torch.allclose(nll, nll_loss, atol=1e-5)
+
+        # Feed the first two tokens at once and the remaining one by one
+        h, c = m.get_init_states(batch_size=2, device=torch.device("cpu"))
+        log_probs, h, c = m.predict_batch(x[:, :2], h, c)
+        nll = -log_probs.gather(2, y[:, :2].unsqueeze(2)).squeeze(2)
+        assert torch.allclose(nll, nll_loss[:, :2], atol=1e-5)
+        log_probs, h, c = m.score_token(x[:, 2], h, c)
+        nll = -log_probs.gather(1, y[:, 2:3])
+        assert torch.allclose(nll, nll_loss[:, 2:3], atol=1e-5)
+
+
 def main():
     test_rnn_lm_model()
     test_rnn_lm_model_tie_weights()
+    test_rnn_lm_model_score_token()
 
 
 if __name__ == "__main__":
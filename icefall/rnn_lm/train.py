@@ -124,14 +124,16 @@ def get_parser():
         "--lm-data",
         type=str,
         default="data/lm_training_bpe_500/sorted_lm_data.pt",
-        help="LM training data",
+        help="""LM training data. It is either a file generated by
+        local/sort_lm_training_data.py or a directory of memory mapped
+        shards generated by local/prepare_lm_training_shards.py""",
     )
 
     parser.add_argument(
         "--lm-data-valid",
         type=str,
         default="data/lm_training_bpe_500/sorted_lm_data-valid.pt",
-        help="LM validation data",
+        help="""LM validation data. See also --lm-data""",
     )
 
     parser.add_argument(
@@ -14,6 +14,11 @@
 #
 # The data structure is based on: kaldi/egs/wsj/s5/utils/lang/make_phone_lm.py
 # The smoothing algorithm is based on: http://www.speech.sri.com/projects/srilm/manpages/ngram-discount.7.html
+#
+# There are two backends producing identical ARPA files. The default one,
+# "array", stores the n-grams as arrays of word ids, counts shards of the
+# input in parallel (see -num-jobs) and computes the probabilities with NumPy.
+# The other one, "dict", is the original pure Python implementation.
 
 import sys
 import os
@@ -21,7 +26,10 @@ import re
 import io
 import math
 import argparse
-from collections import Counter, defaultdict
+import multiprocessing
+from collections import Counter, defaultdict, deque
+
+import numpy as np
 
 
 parser = argparse.ArgumentParser(description="""
@@ -32,6 +40,10 @@ parser.add_argument("-ngram-order", type=int, default=4, choices=[2, 3, 4, 5, 6,
 parser.add_argument("-text", type=str, default=None, help="Path to the corpus file")
 parser.add_argument("-lm", type=str, default=None, help="Path to output arpa file for language models")
 parser.add_argument("-verbose", type=int, default=0, choices=[0, 1, 2, 3, 4, 5], help="Verbose level")
+parser.add_argument("-backend", type=str, default="array", choices=["array", "dict"],
+                    help="The array backend is faster and uses less memory. Both write the same arpa file")
+parser.add_argument("-num-jobs", type=int, default=1, help="Number of processes counting the n-grams. "
+                    "Used only by the array backend")
 args = parser.parse_args()
 
 default_encoding = "latin-1"  # For encoding-agnostic scripts, we assume byte stream as input.
@@ -362,9 +374,329 @@ class NgramCounts:
         print('\\end\\', file=fout)
 
 
+def ngram_keys(rows, vocab_size):
+    # Returns a 1-D array with a sortable key for each row of 'rows', which is
+    # an int32 array of shape (num_ngrams, n) containing word ids. The ids are
+    # packed into an int64 if they fit, otherwise the rows are viewed as byte
+    # strings.
+    n = rows.shape[1]
+    if vocab_size ** n < 2 ** 63:
+        keys = np.zeros(rows.shape[0], dtype=np.int64)
+        for k in range(n):
+            keys = keys * vocab_size + rows[:, k]
+        return keys
+    rows = np.ascontiguousarray(rows)
+    return rows.view(np.dtype((np.void, rows.dtype.itemsize * n))).reshape(-1)
+
+
+def unique_ngrams(rows, vocab_size):
+    # Returns (index, inverse), where rows[index] are the unique rows and index
+    # points to their first occurrences, and rows == rows[index][inverse].
+    _, index, inverse = np.unique(ngram_keys(rows, vocab_size), return_index=True, return_inverse=True)
+    return index, inverse.reshape(-1)
+
+
+def lookup_ngrams(rows, queries, vocab_size):
+    # Returns the indexes of 'queries' in 'rows'. All queries must be present.
+    keys = ngram_keys(rows, vocab_size)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    query_keys = ngram_keys(queries, vocab_size)
+    pos = np.minimum(np.searchsorted(keys, query_keys), max(len(keys) - 1, 0))
+    assert len(query_keys) == 0 or np.all(keys[pos] == query_keys)
+    return order[pos]
+
+
+def sequential_segment_sum(values, starts):
+    # Returns the sums of values[starts[i]:starts[i+1]], where the values are
+    # added one by one from left to right, as the python loops of NgramCounts
+    # do, so that the results are identical. It is vectorized over the
+    # segments instead of over the values of a segment.
+    lengths = np.diff(np.append(starts, len(values)))
+    order = np.argsort(-lengths, kind='stable')
+    sorted_starts = starts[order]
+    sorted_lengths = lengths[order]
+    sums = np.zeros(len(starts))
+    max_length = int(sorted_lengths[0]) if len(starts) > 0 else 0
+    # num_active[k] is the number of segments longer than k
+    num_active = np.searchsorted(-sorted_lengths, -np.arange(max_length), side='left')
+    for k in range(max_length):
+        n = num_active[k]
+        sums[:n] += values[sorted_starts[:n] + k]
+    ans = np.empty_like(sums)
+    ans[order] = sums
+    return ans
+
+
+def count_shard(job):
+    # Counts the n-grams of a list of lines. It runs in a worker process.
+    # Returns (words, tables), where words[i] is the word with id i in this
+    # shard, and tables[n] is a tuple (ngrams, counts, first) for the
+    # (n+1)-grams: 'ngrams' is an int32 array of shape (num_ngrams, n+1)
+    # containing the unique (n+1)-grams, 'counts' their counts and 'first' the
+    # keys of their first occurrences, i.e., (shard_index << 40) plus the
+    # position in the shard.
+    shard_index, lines, ngram_order, bos_symbol, eos_symbol = job
+    word_to_id = dict()
+    ids = []
+    line_ends = []
+    for line in lines:
+        if line == '':
+            words = [bos_symbol, eos_symbol]
+        else:
+            words = [bos_symbol] + whitespace.split(line) + [eos_symbol]
+        ids.extend(word_to_id.setdefault(w, len(word_to_id)) for w in words)
+        line_ends.append(len(ids))
+
+    ids = np.array(ids, dtype=np.int32)
+    line_ends = np.array(line_ends, dtype=np.int64)
+    # The end of the line containing each position
+    ends = np.repeat(line_ends, np.diff(line_ends, prepend=0))
+    positions = np.arange(len(ids), dtype=np.int64)
+
+    tables = []
+    for n in range(1, ngram_order + 1):
+        starts = positions[positions + n <= ends]
+        ngrams = np.stack([ids[starts + k] for k in range(n)], axis=1)
+        index, inverse = unique_ngrams(ngrams, len(word_to_id))
+        counts = np.bincount(inverse, minlength=len(index)).astype(np.int64)
+        first = (shard_index << 40) + starts[index]
+        tables.append((ngrams[index], counts, first))
+    return list(word_to_id.keys()), tables
+
+
+class ArrayNgramCounts:
+    # It computes the same language model as NgramCounts, but the n-grams of
+    # each order are stored as arrays of word ids instead of dicts, and the
+    # probabilities and back-off weights are computed with NumPy.
+    #
+    # self.ngrams[n] is an int32 array of shape (num_ngrams, n+1) containing
+    # the (n+1)-grams, self.counts[n] their raw counts, and self.first[n] the
+    # keys of their first occurrences in the input, which are used to write
+    # the n-grams in the order of NgramCounts, i.e., histories in the order of
+    # their first occurrences and then words in the order of theirs.
+    def __init__(self, ngram_order, bos_symbol='<s>', eos_symbol='</s>', num_jobs=1, lines_per_shard=100000):
+        assert ngram_order >= 2
+        assert num_jobs >= 1
+
+        self.ngram_order = ngram_order
+        self.bos_symbol = bos_symbol
+        self.eos_symbol = eos_symbol
+        self.num_jobs = num_jobs
+        self.lines_per_shard = lines_per_shard
+
+        self.words = []  # word id -> word
+        self.word_to_id = dict()
+
+        self.ngrams = [np.zeros((0, n + 1), dtype=np.int32) for n in range(ngram_order)]
+        self.counts = [np.zeros(0, dtype=np.int64) for n in range(ngram_order)]
+        self.first = [np.zeros(0, dtype=np.int64) for n in range(ngram_order)]
+
+        # Counted shards that are not merged into the arrays above yet, and
+        # the number of their highest order n-grams
+        self.pending = []
+        self.num_pending = 0
+
+        self.d = []  # list of discounting factor for each order of ngram
+
+    def add_raw_counts_from_lines(self, lines):
+        # 'lines' is an iterable of lines, which are already stripped.
+        def jobs():
+            shard = []
+            for line in lines:
+                shard.append(line)
+                if len(shard) == self.lines_per_shard:
+                    yield shard
+                    shard = []
+            if shard:
+                yield shard
+
+        lines_processed = 0
+        if self.num_jobs == 1:
+            for i, shard in enumerate(jobs()):
+                lines_processed += len(shard)
+                self.add_shard(count_shard((i, shard, self.ngram_order, self.bos_symbol, self.eos_symbol)))
+        else:
+            with multiprocessing.Pool(self.num_jobs) as pool:
+                # At most 2 * num_jobs shards are read but not merged yet
+                results = deque()
+                for i, shard in enumerate(jobs()):
+                    lines_processed += len(shard)
+                    job = (i, shard, self.ngram_order, self.bos_symbol, self.eos_symbol)
+                    results.append(pool.apply_async(count_shard, (job,)))
+                    if len(results) >= 2 * self.num_jobs:
+                        self.add_shard(results.popleft().get())
+                while results:
+                    self.add_shard(results.popleft().get())
+        self.merge()
+        self.sort()
+        return lines_processed
+
+    def add_raw_counts_from_standard_input(self):
+        infile = io.TextIOWrapper(sys.stdin.buffer, encoding=default_encoding)  # byte stream as input
+        lines_processed = self.add_raw_counts_from_lines(line.strip(strip_chars) for line in infile)
+        if lines_processed == 0 or args.verbose > 0:
+            print("make_phone_lm.py: processed {0} lines of input".format(lines_processed), file=sys.stderr)
+
+    def add_raw_counts_from_file(self, filename):
+        with open(filename, encoding=default_encoding) as fp:
+            lines_processed = self.add_raw_counts_from_lines(line.strip(strip_chars) for line in fp)
+        if lines_processed == 0 or args.verbose > 0:
+            print("make_phone_lm.py: processed {0} lines of input".format(lines_processed), file=sys.stderr)
+
+    def add_shard(self, result):
+        # Adds the return value of count_shard(). Shards must be added in the
+        # order of the input.
+        words, tables = result
+        local_to_global = np.zeros(len(words), dtype=np.int32)
+        for i, w in enumerate(words):
+            if w not in self.word_to_id:
+                self.word_to_id[w] = len(self.words)
+                self.words.append(w)
+            local_to_global[i] = self.word_to_id[w]
+
+        self.pending.append([(local_to_global[ngrams], counts, first) for ngrams, counts, first in tables])
+        self.num_pending += len(tables[-1][1])
+        # Merge when the highest order n-grams of the pending shards are as
+        # many as the merged ones, so that a merge costs at most about twice
+        # the size of the pending shards and the total cost of the merges is
+        # linear in the number of n-grams counted in the shards. The unigrams
+        # are bounded by the vocabulary, so they would trigger a merge of the
+        # whole arrays for nearly every shard.
+        if self.num_pending >= len(self.counts[-1]):
+            self.merge()
+
+    def merge(self):
+        # Merges the pending shards with the counted n-grams by sorting the
+        # n-grams and reducing the counts of equal ones.
+        if not self.pending:
+            return
+        vocab_size = len(self.words)
+        for n in range(self.ngram_order):
+            tables = [(self.ngrams[n], self.counts[n], self.first[n])] + [p[n] for p in self.pending]
+            ngrams = np.concatenate([t[0] for t in tables])
+            counts = np.concatenate([t[1] for t in tables])
+            first = np.concatenate([t[2] for t in tables])
+            # The n-grams are concatenated in the order of the input, so the
+            # first occurrence of an n-gram in 'ngrams' is its first one.
+            index, inverse = unique_ngrams(ngrams, vocab_size)
+            self.ngrams[n] = ngrams[index]
+            self.counts[n] = np.bincount(inverse, weights=counts, minlength=len(index)).astype(np.int64)
+            self.first[n] = first[index]
+        self.pending = []
+        self.num_pending = 0
+
+    def sort(self):
+        # Sorts the n-grams of each order in the order NgramCounts writes them,
+        # and sets self.hist_starts[n], the index of the first n-gram of each
+        # history.
+        vocab_size = len(self.words)
+        self.hist_starts = []
+        for n in range(self.ngram_order):
+            hist_index, hist = unique_ngrams(self.ngrams[n][:, :-1], vocab_size)
+            hist_first = np.full(len(hist_index), np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(hist_first, hist, self.first[n])
+            order = np.lexsort((self.first[n], hist_first[hist]))
+            self.ngrams[n] = self.ngrams[n][order]
+            self.counts[n] = self.counts[n][order]
+            self.first[n] = self.first[n][order]
+            hist = hist[order]
+            self.hist_starts.append(np.flatnonzero(np.diff(hist, prepend=-1)))
+
+        # self.suffixes[n][i] is the index of the n-gram self.ngrams[n][i, 1:]
+        # in self.ngrams[n-1].
+        self.suffixes = [None]
+        for n in range(1, self.ngram_order):
+            self.suffixes.append(lookup_ngrams(self.ngrams[n - 1], self.ngrams[n][:, 1:], vocab_size))
+
+    def cal_discounting_constants(self):
+        # See NgramCounts.cal_discounting_constants()
+        self.d = [0]
+        for n in range(1, self.ngram_order):
+            n1 = int(np.count_nonzero(self.counts[n] == 1))
+            n2 = int(np.count_nonzero(self.counts[n] == 2))
+            assert n1 + 2 * n2 > 0
+            self.d.append(max(0.1, n1 * 1.0) / (n1 + 2 * n2))
+
+    def cal_f(self):
+        # See NgramCounts.cal_f()
+        self.f = []
+        for n in range(self.ngram_order):
+            counts = self.counts[n]
+            starts = self.hist_starts[n]
+            lengths = np.diff(np.append(starts, len(counts)))
+            total_count = np.repeat(np.add.reduceat(counts, starts), lengths)
+            raw_f = np.maximum(counts - self.d[n], 0) * 1.0 / total_count
+            if n == self.ngram_order - 1:
+                self.f.append(raw_f)
+                continue
+
+            # The number of unique words preceding each n-gram
+            n_star_z = np.bincount(self.suffixes[n + 1], minlength=len(counts))
+            n_star_star = np.repeat(np.add.reduceat(n_star_z, starts), lengths)
+            # patterns begin with <s>, they do not have "modified count", so use raw count instead
+            f = np.maximum(n_star_z - self.d[n], 0) * 1.0 / np.maximum(n_star_star, 1)
+            self.f.append(np.where(n_star_star != 0, f, raw_f))
+
+    def cal_bow(self):
+        # See NgramCounts.cal_bow(). self.bow[n] is NaN for n-grams without
+        # back-off weights.
+        vocab_size = len(self.words)
+        eos = self.word_to_id.get(self.eos_symbol, -1)
+        self.bow = []
+        for n in range(self.ngram_order - 1):
+            # Sums over the words following each history of order n + 1
+            starts = self.hist_starts[n + 1]
+            sum_z1_f_a_z = sequential_segment_sum(self.f[n + 1], starts)
+            sum_z1_f_z = sequential_segment_sum(self.f[n][self.suffixes[n + 1]], starts)
+
+            bow = np.full(len(self.counts[n]), np.nan)
+            has_bow = self.ngrams[n][:, -1] != eos
+            hist = lookup_ngrams(self.ngrams[n + 1][starts, :-1], self.ngrams[n][has_bow], vocab_size)
+            sum_z1_f_a_z = sum_z1_f_a_z[hist]
+            sum_z1_f_z = sum_z1_f_z[hist]
+            valid = sum_z1_f_z < 1
+            bow[np.flatnonzero(has_bow)[valid]] = (1.0 - sum_z1_f_a_z[valid]) / (1.0 - sum_z1_f_z[valid])
+            self.bow.append(bow)
+        self.bow.append(np.full(len(self.counts[-1]), np.nan))
+
+    def print_as_arpa(self, fout=None):
+        # print as ARPA format, to standard output if fout is None.
+        if fout is None:
+            fout = io.TextIOWrapper(sys.stdout.buffer, encoding='latin-1')
+            self.print_as_arpa(fout)
+            # Do not close standard output when fout is deleted
+            fout.detach()
+            return
+
+        print('\\data\\', file=fout)
+        for hist_len in range(self.ngram_order):
+            print('ngram {0}={1}'.format(hist_len + 1, len(self.counts[hist_len])), file=fout)
+
+        print('', file=fout)
+
+        words = self.words
+        for hist_len in range(self.ngram_order):
+            print('\\{0}-grams:'.format(hist_len + 1), file=fout)
+            for ngram, prob, bow in zip(self.ngrams[hist_len].tolist(), self.f[hist_len].tolist(),
+                                        self.bow[hist_len].tolist()):
+                if prob == 0:  # f(<s>) is always 0
+                    prob = 1e-99
+
+                line = '{0}\t{1}'.format('%.7f' % math.log10(prob), ' '.join([words[w] for w in ngram]))
+                if not math.isnan(bow):
+                    line += '\t{0}'.format('%.7f' % math.log10(bow))
+                print(line, file=fout)
+            print('', file=fout)
+        print('\\end\\', file=fout)
+
+
 if __name__ == "__main__":
 
-    ngram_counts = NgramCounts(args.ngram_order)
+    if args.backend == "array":
+        ngram_counts = ArrayNgramCounts(args.ngram_order, num_jobs=args.num_jobs)
+    else:
+        ngram_counts = NgramCounts(args.ngram_order)
 
     if args.text is None:
         ngram_counts.add_raw_counts_from_standard_input()
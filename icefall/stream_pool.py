@@ -0,0 +1,284 @@
+# Copyright    2026  agent
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Snapshots of streaming decoding states and a pool that swaps idle streams
+out of memory.
+
+  - :func:`pack_state` and :func:`unpack_state` convert the state of a
+    stream, e.g., the return value of `DecodeStream.state_dict()`, to and
+    from bytes. The bytes can be kept in memory, written to disk or sent
+    to another process.
+  - :class:`StreamPool` keeps the recently used streams resident. Idle
+    streams are evicted to host memory as snapshots and, if a budget for
+    host memory is given, further to files on disk. An evicted stream is
+    restored when it is accessed again.
+
+Usage::
+
+    pool = StreamPool(
+        snapshot=lambda s: s.snapshot(),
+        restore=lambda data: DecodeStream.from_snapshot(data, params),
+        max_host_bytes=2 * 1024**3,
+        swap_dir="swap",
+    )
+    pool.add(stream.id, stream)
+    ...
+    pool.evict_idle(max_idle_seconds=10)
+    ...
+    stream = pool.get(stream_id)  # restored if it was evicted
+"""
+
+import io
+import itertools
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional
+
+import torch
+
+
+def _copy_tensors(obj: Any, device: torch.device) -> Any:
+    """Return a copy of `obj` in which all tensors are copied to `device`.
+    Tensors can be nested in lists, tuples and dicts."""
+    if isinstance(obj, torch.Tensor):
+        # A copy owns a storage of its own size, so that saving a view
+        # of a batched tensor does not save the whole batch.
+        obj = obj.detach()
+        if obj.device == device:
+            return obj.clone()
+        return obj.to(device)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_tensors(o, device) for o in obj)
+    if isinstance(obj, dict):
+        return {k: _copy_tensors(v, device) for k, v in obj.items()}
+    return obj
+
+
+def pack_state(state: Any) -> bytes:
+    """Serialize the state of a stream.
+
+    Args:
+      state:
+        Python objects, e.g., a dict, that can contain tensors on any
+        device, possibly nested in lists, tuples and dicts.
+    Returns:
+      Return the serialized state. Tensors are saved on CPU.
+    """
+    f = io.BytesIO()
+    torch.save(_copy_tensors(state, torch.device("cpu")), f)
+    return f.getvalue()
+
+
+def unpack_state(data: bytes, device: torch.device = torch.device("cpu")):
+    """Deserialize a state returned by :func:`pack_state`.
+
+    Args:
+      data:
+        The return value of :func:`pack_state`.
+      device:
+        The device of the returned tensors.
+    """
+    return torch.load(io.BytesIO(data), map_location=device)
+
+
+class StreamPool(object):
+    def __init__(
+        self,
+        snapshot: Callable[[Any], bytes],
+        restore: Callable[[bytes], Any],
+        max_host_bytes: Optional[int] = None,
+        swap_dir: Optional[Path] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """A pool of streams, some of which are resident while the others
+        are kept as snapshots in host memory or on disk.
+
+        A stream is evicted only by :func:`evict` and :func:`evict_idle`,
+        so the caller decides when it is safe, e.g., not while the stream
+        is being decoded.
+
+        Args:
+          snapshot:
+            A function that takes a stream and returns its snapshot. It is
+            called when the stream is evicted, after which the pool drops
+            its reference to the stream.
+          restore:
+            A function that takes a snapshot and returns the stream.
+          max_host_bytes:
+            Maximum number of bytes of the snapshots kept in host memory.
+            If it is exceeded, the least recently used snapshots are moved
+            to `swap_dir`. None means no limit.
+          swap_dir:
+            The directory for the snapshots moved to disk. It is required
+            if `max_host_bytes` is not None.
+          clock:
+            It returns the current time in seconds.
+        """
+        if max_host_bytes is not None:
+            assert max_host_bytes >= 0, max_host_bytes
+            assert swap_dir is not None, "Please provide swap_dir"
+        self.snapshot = snapshot
+        self.restore = restore
+        self.max_host_bytes = max_host_bytes
+        self.swap_dir = Path(swap_dir) if swap_dir is not None else None
+        self.clock = clock
+
+        # In the order of the last access, the most recent one last
+        self._resident: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._last_access: Dict[Hashable, float] = {}
+
+        # In the order of the eviction, the least recent one first
+        self._host: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._host_bytes = 0
+        self._disk: Dict[Hashable, Path] = {}
+        self._file_ids = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._resident) + len(self._host) + len(self._disk)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._resident or key in self._host or key in self._disk
+
+    @property
+    def num_resident(self) -> int:
+        return len(self._resident)
+
+    @property
+    def num_in_host(self) -> int:
+        return len(self._host)
+
+    @property
+    def num_on_disk(self) -> int:
+        return len(self._disk)
+
+    @property
+    def host_bytes(self) -> int:
+        """Number of bytes of the snapshots kept in host memory."""
+        return self._host_bytes
+
+    def is_resident(self, key: Hashable) -> bool:
+        return key in self._resident
+
+    def add(self, key: Hashable, stream: Any) -> None:
+        """Add a resident stream."""
+        assert key not in self, key
+        self._resident[key] = stream
+        self._last_access[key] = self.clock()
+
+    def get(self, key: Hashable) -> Any:
+        """Return the stream with the given key. It is restored from its
+        snapshot if it has been evicted. The stream is marked as accessed.
+        """
+        if key in self._resident:
+            self._resident.move_to_end(key)
+        else:
+            # The snapshot is dropped only after the stream is restored,
+            # so that it is not lost if `restore` fails.
+            stream = self.restore(self._read_snapshot(key))
+            self._drop_snapshot(key)
+            self._resident[key] = stream
+        self._last_access[key] = self.clock()
+        return self._resident[key]
+
+    def lru_keys(self) -> Iterator[Hashable]:
+        """Iterate over the keys of the resident streams, the least
+        recently used one first."""
+        return iter(list(self._resident.keys()))
+
+    def evict(self, key: Hashable) -> int:
+        """Replace a resident stream with its snapshot.
+
+        Returns:
+          Return the size of the snapshot in bytes.
+        """
+        data = self.snapshot(self._resident[key])
+        del self._resident[key]
+        del self._last_access[key]
+        self._host[key] = data
+        self._host_bytes += len(data)
+        self._spill()
+        return len(data)
+
+    def evict_idle(
+        self,
+        max_idle_seconds: float,
+        keep: Optional[Callable[[Hashable], bool]] = None,
+    ) -> List[Hashable]:
+        """Evict the streams that have not been accessed for at least
+        `max_idle_seconds`.
+
+        Args:
+          max_idle_seconds:
+            Streams idle for at least this number of seconds are evicted.
+          keep:
+            If not None, the streams whose keys `k` satisfy `keep(k)` are
+            not evicted.
+        Returns:
+          Return the keys of the evicted streams.
+        """
+        now = self.clock()
+        keys = [
+            k
+            for k in self.lru_keys()
+            if now - self._last_access[k] >= max_idle_seconds
+            and (keep is None or not keep(k))
+        ]
+        for k in keys:
+            self.evict(k)
+        return keys
+
+    def remove(self, key: Hashable) -> None:
+        """Remove a stream, whether it is resident or not."""
+        if key in self._resident:
+            del self._resident[key]
+            del self._last_access[key]
+        else:
+            self._drop_snapshot(key)
+
+    def clear(self) -> None:
+        """Remove all streams and the files in `swap_dir`."""
+        for key in list(self._disk.keys()):
+            self._drop_snapshot(key)
+        self._resident.clear()
+        self._last_access.clear()
+        self._host.clear()
+        self._host_bytes = 0
+
+    def _read_snapshot(self, key: Hashable) -> bytes:
+        if key in self._host:
+            return self._host[key]
+        return self._disk[key].read_bytes()
+
+    def _drop_snapshot(self, key: Hashable) -> None:
+        if key in self._host:
+            self._host_bytes -= len(self._host.pop(key))
+        else:
+            self._disk.pop(key).unlink()
+
+    def _spill(self) -> None:
+        """Move the least recently evicted snapshots to disk until the
+        snapshots in host memory fit into `max_host_bytes`."""
+        if self.max_host_bytes is None:
+            return
+        self.swap_dir.mkdir(parents=True, exist_ok=True)
+        while self._host_bytes > self.max_host_bytes:
+            key, data = self._host.popitem(last=False)
+            self._host_bytes -= len(data)
+            filename = self.swap_dir / f"stream-{next(self._file_ids)}.pt"
+            filename.write_bytes(data)
+            self._disk[key] = filename
@@ -26,7 +26,7 @@ from collections import defaultdict
 from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Iterable, List, TextIO, Tuple, Union
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple, Union
 
 import k2
 import k2.version
@@ -612,6 +612,76 @@ class MetricsTracker(collections.defaultdict):
             tb_writer.add_scalar(prefix + k, v, batch_idx)
 
 
+class TensorMetricsTracker(MetricsTracker):
+    """A MetricsTracker whose values can be tensors, e.g., 0-D tensors on
+    the GPU.
+
+    Adding and scaling trackers do not synchronize with the device, so
+    there is no need to call `.item()` in every training step. Values are
+    copied to the CPU only when they are needed, i.e., by
+    :meth:`norm_items`, :meth:`write_summary`, `str()` or
+    :meth:`to_metrics_tracker`, which is typically every `log_interval`
+    batches.
+    """
+
+    def __add__(self, other: MetricsTracker) -> "TensorMetricsTracker":
+        ans = TensorMetricsTracker()
+        for k, v in self.items():
+            ans[k] = v
+        for k, v in other.items():
+            ans[k] = ans[k] + v
+        return ans
+
+    def __mul__(self, alpha: float) -> "TensorMetricsTracker":
+        ans = TensorMetricsTracker()
+        for k, v in self.items():
+            ans[k] = v * alpha
+        return ans
+
+    def __str__(self) -> str:
+        return str(self.to_metrics_tracker())
+
+    def to_metrics_tracker(self) -> MetricsTracker:
+        """Return a MetricsTracker with the values as Python numbers.
+
+        It synchronizes with each device only once.
+        """
+        ans = MetricsTracker()
+        device_keys = defaultdict(list)
+        for k, v in self.items():
+            if isinstance(v, torch.Tensor):
+                device_keys[v.device].append(k)
+            else:
+                ans[k] = v
+
+        for keys in device_keys.values():
+            values = torch.stack(
+                [self[k].detach().reshape(()).double() for k in keys]
+            )
+            for k, v in zip(keys, values.tolist()):
+                ans[k] = v
+        return ans
+
+    def norm_items(self) -> List[Tuple[str, float]]:
+        return self.to_metrics_tracker().norm_items()
+
+    def reduce(self, device):
+        """
+        Like :meth:`MetricsTracker.reduce`, but the result is kept
+        on `device`.
+        """
+        keys = sorted(self.keys())
+        s = torch.stack(
+            [
+                torch.as_tensor(self[k], device=device).reshape(()).double()
+                for k in keys
+            ]
+        )
+        dist.all_reduce(s, op=dist.ReduceOp.SUM)
+        for i, k in enumerate(keys):
+            self[k] = s[i]
+
+
 def concat(
     ragged: k2.RaggedTensor, value: int, direction: str
 ) -> k2.RaggedTensor:
@@ -884,6 +954,7 @@ def load_averaged_model(
     epoch: int,
     avg: int,
     device: torch.device,
+    cache_dir: Optional[str] = None,
 ):
     """
     Load a model which is the average of all checkpoints
@@ -894,6 +965,7 @@ def load_averaged_model(
     :param epoch: the last epoch to load from
     :param avg: how many models to average from
     :param device: move model to this device
+    :param cache_dir: if not None, cache the averaged model in this directory
 
     :return: A model averaged
     """
@@ -904,7 +976,9 @@ def load_averaged_model(
 
     logging.info(f"averaging {filenames}")
     model.to(device)
-    model.load_state_dict(average_checkpoints(filenames, device=device))
+    model.load_state_dict(
+        average_checkpoints(filenames, device=device, cache_dir=cache_dir)
+    )
 
     return model
 
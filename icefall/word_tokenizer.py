@@ -0,0 +1,243 @@
+# Copyright    2026  agent
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Convert transcripts to word IDs and token IDs.
+
+The transcripts of a training set are the same in every epoch, so there is
+no need to split them and to look up their words again and again:
+
+  - :class:`WordTokenizer` copies the word table into a plain dict once and
+    memoizes the word IDs of a bounded number of transcripts it has seen.
+  - :meth:`WordTokenizer.tokenize_cuts` converts the transcripts of a
+    CutSet and stores the word IDs in the custom field "word_ids" of each
+    supervision. :meth:`WordTokenizer.supervisions_to_word_ids` takes them
+    from the cuts of a batch, so no string is processed in the training
+    loop.
+
+Usage::
+
+    tokenizer = lexicon.word_tokenizer(oov="<UNK>")
+    train_cuts = tokenizer.tokenize_cuts(train_cuts).to_eager()
+    ...
+    # The dataset has to be created with return_cuts=True
+    supervision_segments, texts = encode_supervisions(
+        batch["supervisions"], subsampling_factor=4
+    )
+    word_ids = tokenizer.supervisions_to_word_ids(batch["supervisions"], texts)
+"""
+
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import k2
+import torch
+from lhotse import CutSet
+from lhotse.supervision import SupervisionSegment
+from lhotse.utils import fastcopy
+
+
+def _tokenize_supervision(
+    sup: SupervisionSegment, word2id: Dict[str, int], oov_id: int, key: str
+) -> SupervisionSegment:
+    """Return a copy of `sup` with the word IDs of its text in the custom
+    field `key`. It is not a closure, so that lazy CutSets using it can be
+    pickled, e.g., to be sent to dataloader workers."""
+    custom = dict(sup.custom) if sup.custom is not None else {}
+    custom[key] = [word2id.get(w, oov_id) for w in (sup.text or "").split()]
+    return fastcopy(sup, custom=custom)
+
+
+class WordTokenizer(object):
+    def __init__(
+        self,
+        word_table: k2.SymbolTable,
+        oov: str = "<UNK>",
+        ragged_lexicon: Optional[k2.RaggedTensor] = None,
+        max_cached_texts: int = 10000,
+        key: str = "word_ids",
+    ):
+        """
+        Args:
+          word_table:
+            The word symbol table.
+          oov:
+            The OOV word. If a word is not in `word_table`, it is replaced
+            with `oov`, which has to be in `word_table`.
+          ragged_lexicon:
+            If not None, it is a ragged tensor with 2 axes [word][token]
+            indexed by word IDs, e.g., `UniqLexicon.ragged_lexicon`.
+            It is required by :meth:`texts_to_token_ids`.
+          max_cached_texts:
+            At most this number of transcripts are memoized. Once it is
+            reached, new transcripts are converted without being memoized.
+            0 disables the memoization.
+          key:
+            The name of the custom field of supervisions that holds the
+            word IDs. See :meth:`tokenize_cuts`.
+        """
+        assert max_cached_texts >= 0, max_cached_texts
+        self.oov_id = word_table[oov]
+        self.word2id: Dict[str, int] = {
+            w: word_table[w] for w in word_table.symbols
+        }
+        self.ragged_lexicon = ragged_lexicon
+        self.max_cached_texts = max_cached_texts
+        self.key = key
+
+        self._cache: Dict[str, Tuple[int, ...]] = {}
+
+    def text_to_word_ids(self, text: str) -> Tuple[int, ...]:
+        """Return the word IDs of a transcript whose words are separated
+        by space(s)."""
+        word_ids = self._cache.get(text)
+        if word_ids is None:
+            word_ids = self._text_to_word_ids(text)
+            if len(self._cache) < self.max_cached_texts:
+                self._cache[text] = word_ids
+        return word_ids
+
+    def _text_to_word_ids(self, text: str) -> Tuple[int, ...]:
+        get = self.word2id.get
+        oov_id = self.oov_id
+        return tuple([get(w, oov_id) for w in text.split()])
+
+    def texts_to_word_ids(self, texts: List[str]) -> List[List[int]]:
+        """Convert a list of texts to a list-of-list of word IDs.
+
+        Args:
+          texts:
+            It is a list of strings. Each string consists of space(s)
+            separated words. An example containing two strings is given below:
+
+                ['HELLO ICEFALL', 'HELLO k2']
+        Returns:
+          Return a list-of-list of word IDs.
+        """
+        return [list(self.text_to_word_ids(text)) for text in texts]
+
+    def word_ids_to_token_ids(
+        self, word_ids_list: List[List[int]]
+    ) -> k2.RaggedTensor:
+        """Convert a list-of-list of word IDs to token IDs.
+
+        The word IDs are looked up in `self.ragged_lexicon` with a single
+        call of `k2.RaggedTensor.index()` for the whole batch.
+
+        Returns:
+          Return a ragged int tensor with 2 axes [utterance][token_id]
+        """
+        assert self.ragged_lexicon is not None, "Please provide ragged_lexicon"
+        row_splits = torch.zeros(len(word_ids_list) + 1, dtype=torch.int32)
+        row_splits[1:] = torch.tensor(
+            [len(word_ids) for word_ids in word_ids_list], dtype=torch.int32
+        ).cumsum(0)
+        values = torch.tensor(
+            [i for word_ids in word_ids_list for i in word_ids],
+            dtype=torch.int32,
+        )
+        shape = k2.ragged.create_ragged_shape2(
+            row_splits=row_splits, cached_tot_size=values.numel()
+        )
+        ragged_indexes = k2.RaggedTensor(shape, values)
+
+        ans = self.ragged_lexicon.index(ragged_indexes)
+        ans = ans.remove_axis(ans.num_axes - 2)
+        return ans
+
+    def texts_to_token_ids(self, texts: List[str]) -> k2.RaggedTensor:
+        """Convert a list of texts to token IDs.
+
+        Returns:
+          Return a ragged int tensor with 2 axes [utterance][token_id]
+        """
+        return self.word_ids_to_token_ids(
+            [self.text_to_word_ids(text) for text in texts]
+        )
+
+    def tokenize_cuts(self, cuts: CutSet) -> CutSet:
+        """Store the word IDs of the text of each supervision in its custom
+        field `self.key`.
+
+        The returned CutSet is lazy if `cuts` is lazy, i.e., the texts are
+        converted whenever the cuts are read, e.g., by a sampler in every
+        epoch. Call `to_eager()` on it to convert them only once. The word
+        IDs are not memoized, since they are stored in the cuts.
+        """
+        return cuts.map_supervisions(
+            partial(
+                _tokenize_supervision,
+                word2id=self.word2id,
+                oov_id=self.oov_id,
+                key=self.key,
+            )
+        )
+
+    def supervisions_to_word_ids(
+        self,
+        supervisions: Dict[str, Any],
+        texts: Optional[List[str]] = None,
+    ) -> List[List[int]]:
+        """Return the word IDs of `supervisions["text"]`, in the same order.
+
+        Args:
+          supervisions:
+            It is `batch["supervisions"]` of a batch from
+            `K2SpeechRecognitionDataset`. If the dataset is created with
+            `return_cuts=True` and the cuts have been processed by
+            :meth:`tokenize_cuts`, the word IDs are taken from the cuts;
+            otherwise they are computed from the texts.
+          texts:
+            If not None, it is a permutation of `supervisions["text"]`,
+            e.g., the texts returned by
+            :func:`icefall.utils.encode_supervisions`, and the word IDs
+            are returned in its order.
+        Returns:
+          Return a list-of-list of word IDs.
+        """
+        if texts is None:
+            return self._supervisions_to_word_ids(supervisions)
+        # Equal texts have equal word IDs, so it does not matter how
+        # encode_supervisions() orders them
+        text_to_word_ids = dict(
+            zip(
+                supervisions["text"],
+                self._supervisions_to_word_ids(supervisions),
+            )
+        )
+        return [text_to_word_ids[text] for text in texts]
+
+    def _supervisions_to_word_ids(
+        self, supervisions: Dict[str, Any]
+    ) -> List[List[int]]:
+        cuts = supervisions.get("cut")
+        if cuts is None:
+            return self.texts_to_word_ids(supervisions["text"])
+
+        # supervisions["cut"] contains each cut once per supervision, in
+        # the order of supervisions["text"]
+        ans = []
+        prev_cut = None
+        for cut in cuts:
+            if cut is not prev_cut:
+                prev_cut = cut
+                i = 0
+            sup = cut.supervisions[i]
+            i += 1
+            if sup.custom is None or self.key not in sup.custom:
+                return self.texts_to_word_ids(supervisions["text"])
+            ans.append(sup.custom[self.key])
+        return ans
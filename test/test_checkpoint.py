@@ -16,12 +16,16 @@
 # limitations under the License.
 
 
+import zipfile
+
 import pytest
 import torch
 import torch.nn as nn
 
 from icefall.checkpoint import (
+    AsyncCheckpointWriter,
     average_checkpoints,
+    find_checkpoints,
     load_checkpoint,
     save_checkpoint,
 )
@@ -65,3 +69,86 @@ def test_average_checkpoints(checkpoints1, checkpoints2):
     state_dict = average_checkpoints([checkpoints1, checkpoints2])
     assert torch.allclose(state_dict["p1"], torch.Tensor([30, 25.0]))
     assert torch.allclose(state_dict["p2"], torch.tensor([5, 51]))
+
+
+def test_average_checkpoints_closes_files(
+    checkpoints1, checkpoints2, monkeypatch
+):
+    opened = []
+
+    class ZipFile(zipfile.ZipFile):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            opened.append(self)
+
+    monkeypatch.setattr(zipfile, "ZipFile", ZipFile)
+    average_checkpoints([checkpoints1, checkpoints2])
+    assert len(opened) == 2
+    assert all(f.fp is None for f in opened)
+
+
+def test_average_checkpoints_shared_and_cached(tmp_path):
+    filenames = []
+    for i in range(3):
+        m = nn.Module()
+        m.p1 = nn.Parameter(torch.tensor([1.0, 2.0]) * (i + 1))
+        m.p2 = m.p1
+        f = tmp_path / f"epoch-{i}.pt"
+        optimizer = torch.optim.SGD(m.parameters(), lr=0.1)
+        save_checkpoint(f, m, optimizer=optimizer)
+        filenames.append(f)
+
+    cache_dir = tmp_path / "cache"
+    state_dict = average_checkpoints(filenames, cache_dir=cache_dir)
+    assert torch.allclose(state_dict["p1"], torch.Tensor([2.0, 4.0]))
+    assert state_dict["p1"] is state_dict["p2"]
+    assert len(list(cache_dir.glob("*.pt"))) == 1
+
+    state_dict2 = average_checkpoints(filenames, cache_dir=cache_dir)
+    assert torch.equal(state_dict["p1"], state_dict2["p1"])
+
+    # The cache is invalidated once a checkpoint is modified
+    m = nn.Module()
+    m.p1 = nn.Parameter(torch.tensor([4.0, 8.0]))
+    m.p2 = m.p1
+    save_checkpoint(filenames[0], m)
+    state_dict3 = average_checkpoints(filenames, cache_dir=cache_dir)
+    assert torch.allclose(state_dict3["p1"], torch.Tensor([3.0, 6.0]))
+
+
+def test_async_checkpoint_writer(tmp_path):
+    m = nn.Module()
+    m.p1 = nn.Parameter(torch.tensor([1.0, 2.0]))
+    m.p2 = m.p1
+    optimizer = torch.optim.Adam(m.parameters(), lr=0.1)
+
+    writer = AsyncCheckpointWriter()
+    for i in range(1, 5):
+        m.p1.sum().backward()
+        optimizer.step()
+        writer.save_with_global_batch_idx(
+            out_dir=tmp_path,
+            global_batch_idx=i,
+            model=m,
+            params={"batch_idx_train": i},
+            optimizer=optimizer,
+            keep_last_k=2,
+        )
+        # Changes after save() do not affect the saved checkpoint
+        expected = m.p1.detach().clone()
+        with torch.no_grad():
+            m.p1 += 100
+    writer.copyfile(tmp_path / "checkpoint-4.pt", tmp_path / "best.pt")
+    writer.close()
+
+    assert find_checkpoints(tmp_path) == [
+        f"{tmp_path}/checkpoint-4.pt",
+        f"{tmp_path}/checkpoint-3.pt",
+    ]
+    assert not list(tmp_path.glob("*.tmp"))
+
+    checkpoint = torch.load(tmp_path / "best.pt")
+    assert checkpoint["batch_idx_train"] == 4
+    assert torch.equal(checkpoint["model"]["p1"], expected)
+    assert checkpoint["model"]["p1"] is checkpoint["model"]["p2"]
+    assert "state" in checkpoint["optimizer"]
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import k2
+import torch
+
+from icefall.context_graph import ContextGraph, get_context_graph
+
+
+def _walk(context_graph, tokens, num_labels=10):
+    """Return the total score of the given tokens, including the
+    final score."""
+    state = torch.tensor([context_graph.root])
+    total = 0.0
+    for token in tokens:
+        next_states, scores = context_graph.get_next_states_and_scores(
+            state, num_labels=num_labels
+        )
+        total += scores[0, token].item()
+        state = next_states[:, token]
+    return total + context_graph.get_final_scores(state).item()
+
+
+def test_context_graph():
+    context_graph = ContextGraph([[1, 2, 3], [2, 4], [5]], context_score=1.0)
+
+    states = torch.tensor([context_graph.root])
+    next_states, scores = context_graph.get_next_states_and_scores(
+        states, num_labels=10
+    )
+    assert next_states.shape == (1, 10)
+    assert scores[0].tolist() == [0, 1, 1, 0, 0, 1, 0, 0, 0, 0]
+    # A whole phrase is matched, so we go back to the root
+    assert next_states[0, 5] == context_graph.root
+
+    # Matched phrases keep their bonus
+    assert _walk(context_graph, [1, 2, 3]) == 3
+    assert _walk(context_graph, [7, 2, 4, 7]) == 2
+    assert _walk(context_graph, [5, 5]) == 2
+    # [2, 4] is matched via the failure link of [1, 2]
+    assert _walk(context_graph, [1, 2, 4]) == 2
+    # Failed partial matches are taken back
+    assert _walk(context_graph, [1, 2, 7]) == 0
+    assert _walk(context_graph, [1, 2]) == 0
+    assert _walk(context_graph, [1, 2, 7, 2, 4]) == 2
+
+
+def test_context_graph_nested_phrases():
+    # Like "NEW YORK" and "NEW YORK CITY"
+    context_graph = ContextGraph([[1, 2], [1, 2, 3]], context_score=1.0)
+
+    # The match of [1, 2] continues to [1, 2, 3]
+    state = torch.tensor([context_graph.root])
+    for token in [1, 2]:
+        next_states, _ = context_graph.get_next_states_and_scores(
+            state, num_labels=10
+        )
+        state = next_states[:, token]
+    assert state.item() != context_graph.root
+
+    assert _walk(context_graph, [1, 2, 3]) == 3
+    # [1, 2] keeps its bonus if [1, 2, 3] is not matched
+    assert _walk(context_graph, [1, 2]) == 2
+    assert _walk(context_graph, [1, 2, 4]) == 2
+    assert _walk(context_graph, [1, 2, 1, 2, 3]) == 5
+    assert _walk(context_graph, [1, 4]) == 0
+
+    # A phrase in the middle of a longer one
+    context_graph = ContextGraph([[1, 2, 3, 4], [2, 3]], context_score=1.0)
+    assert _walk(context_graph, [1, 2, 3, 4]) == 4
+    assert _walk(context_graph, [1, 2, 3, 5]) == 2
+    assert _walk(context_graph, [2, 3, 5]) == 2
+    assert _walk(context_graph, [1, 2, 5]) == 0
+
+
+def _best_coverage(phrases, tokens, context_score):
+    """Return the largest total bonus of non-overlapping phrases
+    in the tokens."""
+    best = [0.0] * (len(tokens) + 1)
+    for i in range(1, len(tokens) + 1):
+        best[i] = best[i - 1]
+        for phrase in phrases:
+            n = len(phrase)
+            if n <= i and tokens[i - n : i] == phrase:  # noqa
+                best[i] = max(best[i], best[i - n] + n * context_score)
+    return best[-1]
+
+
+def test_context_graph_random():
+    rng = random.Random(0)
+    for _ in range(1000):
+        phrases = [
+            [rng.randint(1, 3) for _ in range(rng.randint(1, 4))]
+            for _ in range(rng.randint(1, 3))
+        ]
+        tokens = [rng.randint(1, 3) for _ in range(rng.randint(0, 8))]
+        context_graph = ContextGraph(phrases, context_score=1.0)
+        total = _walk(context_graph, tokens, num_labels=4)
+        # No token is boosted twice, and matched phrases keep their bonus
+        best = _best_coverage(phrases, tokens, 1.0)
+        assert 0 <= total <= best, (phrases, tokens, total, best)
+        if tokens in phrases:
+            assert total == best, (phrases, tokens, total, best)
+
+
+def test_context_graph_overlapping_phrases():
+    context_graph = ContextGraph([[1, 1], [1, 1, 2]], context_score=1.0)
+    assert _walk(context_graph, [1, 1, 1]) == 2
+    assert _walk(context_graph, [1, 1, 2]) == 3
+    assert _walk(context_graph, [1, 1, 3]) == 2
+
+    context_graph = ContextGraph([[1, 1], [1, 1, 2, 2]], context_score=1.0)
+    assert _walk(context_graph, [1, 1, 1]) == 2
+
+
+def test_context_graph_empty():
+    context_graph = ContextGraph([], context_score=1.0)
+    next_states, scores = context_graph.get_next_states_and_scores(
+        torch.tensor([0, 0]), num_labels=5
+    )
+    assert torch.all(next_states == 0)
+    assert torch.all(scores == 0)
+
+
+def test_context_graph_to_fsa():
+    context_graph = ContextGraph([[1, 2]], context_score=1.0)
+    fsa = context_graph.to_fsa(vocab_size=4)
+    assert fsa.shape[0] == context_graph.num_nodes + 1
+
+    # Accepts every token sequence
+    path = k2.intersect(
+        fsa, k2.linear_fsa([3, 1, 2, 1]), treat_epsilons_specially=False
+    )
+    assert path.num_arcs > 0
+
+    # [1, 2] is boosted, but the trailing [1] is not
+    total = path.get_tot_scores(log_semiring=False, use_double_scores=True)
+    assert total.item() == 2
+
+
+def test_get_context_graph():
+    a = get_context_graph([[1, 2], [3]], context_score=1.0)
+    b = get_context_graph([[1, 2], [3]], context_score=1.0)
+    c = get_context_graph([[1, 2], [3]], context_score=2.0)
+    assert a is b
+    assert a is not c
@@ -23,7 +23,9 @@ You can run this file in one of the two ways:
 """
 
 import k2
-from icefall.decode import Nbest
+import torch
+from icefall.decode import Nbest, compute_rnn_lm_scores
+from icefall.rnn_lm.model import RnnLmModel
 
 
 def test_nbest_from_lattice():
@@ -60,3 +62,41 @@ def test_nbest_from_lattice():
     argmax = tot_scores.argmax()
     best_path = k2.index_fsa(nbest2.fsa, argmax)
     print(best_path[0])
+
+
+def test_compute_rnn_lm_scores():
+    torch.manual_seed(20221024)
+    model = RnnLmModel(
+        vocab_size=10, embedding_dim=8, hidden_dim=16, num_layers=2
+    )
+    model.eval()
+
+    token_ids = [
+        [3, 4, 5],
+        [3, 4, 6, 7],
+        [3, 4],
+        [8],
+        [],
+        [3, 4, 5],
+    ]
+    sos_id = eos_id = 1
+
+    with torch.no_grad():
+        expected = compute_rnn_lm_scores(
+            model, token_ids, sos_id=sos_id, eos_id=eos_id, blank_id=0
+        )
+        for prefix_tree in [False, True]:
+            for max_tokens in [0, 1, 5, 100]:
+                scores = compute_rnn_lm_scores(
+                    model,
+                    token_ids,
+                    sos_id=sos_id,
+                    eos_id=eos_id,
+                    blank_id=0,
+                    prefix_tree=prefix_tree,
+                    max_tokens=max_tokens,
+                )
+                assert torch.allclose(scores, expected, atol=1e-5), (
+                    scores,
+                    expected,
+                )
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+from lhotse import CutSet
+from lhotse.testing.dummies import dummy_cut
+
+from icefall.decode_pipeline import (
+    CostBucketingSampler,
+    DecodeCostModel,
+    PipelinedDecoder,
+)
+
+
+def _cuts(durations):
+    return CutSet.from_cuts(
+        dummy_cut(i, duration=d) for i, d in enumerate(durations)
+    )
+
+
+def test_cost_bucketing_sampler():
+    cuts = _cuts([3.0, 10.0, 5.0, 2.0, 9.0, 1.0])
+    sampler = CostBucketingSampler(cuts, max_duration=20.0)
+    batches = [[c.duration for c in b] for b in sampler]
+    # Sorted by duration, and padded durations are at most 20 seconds
+    assert batches == [[10.0, 9.0], [5.0, 3.0, 2.0, 1.0]]
+
+    # A cut longer than max_duration is put into a batch of its own
+    sampler = CostBucketingSampler(cuts, max_duration=4.0)
+    assert [len(b) for b in sampler] == [1, 1, 1, 1, 2]
+
+
+def test_cost_bucketing_sampler_with_cost_model():
+    cuts = _cuts([4.0] * 10)
+    cost_model = DecodeCostModel()
+    sampler = CostBucketingSampler(
+        cuts, max_duration=100.0, cost_model=cost_model, max_batch_seconds=2.0
+    )
+    # Nothing is measured yet
+    assert [len(b) for b in sampler] == [10]
+
+    # 400 frames per cut, 1 ms per frame for the search
+    cost_model.update(
+        num_cuts=1, max_frames=400, encoder_seconds=0.2, search_seconds=0.4
+    )
+    assert cost_model.estimate(num_cuts=5, max_frames=400) == pytest.approx(2)
+    assert [len(b) for b in sampler] == [5, 5]
+
+
+def test_pipelined_decoder():
+    dl = [{"inputs": torch.full((2, 3, 4), float(i))} for i in range(10)]
+
+    def encode(batch):
+        assert not torch.is_grad_enabled()
+        return batch["inputs"].sum()
+
+    cost_model = DecodeCostModel()
+    outputs = []
+    for batch, encoder_out in PipelinedDecoder(
+        dl, encode=encode, cost_model=cost_model
+    ):
+        outputs.append((batch["inputs"][0, 0, 0].item(), encoder_out.item()))
+    assert outputs == [(i, 24 * i) for i in range(10)]
+    assert cost_model.encoder_seconds_per_frame is not None
+
+    # Stop early
+    for i, _ in enumerate(PipelinedDecoder(dl, encode=encode)):
+        if i == 2:
+            break
+
+    # Errors of the encoder are raised in the calling thread
+    def fail(batch):
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        for _ in PipelinedDecoder(dl, encode=fail):
+            pass
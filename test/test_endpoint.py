@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from icefall.endpoint import EndpointRule, Endpointer
+
+
+def test_endpoint_rule():
+    rule = EndpointRule(
+        must_contain_nonsilence=True,
+        min_trailing_silence=1.0,
+        min_utterance_length=0.0,
+    )
+    assert rule.is_satisfied(True, 1.0, 3.0)
+    assert not rule.is_satisfied(True, 0.9, 3.0)
+    assert not rule.is_satisfied(False, 1.0, 3.0)
+
+
+def test_endpointer():
+    # Use the default rules with 40 ms frames
+    endpointer = Endpointer(frame_shift=0.04)
+
+    # rule 1: 2.4 seconds of silence
+    assert not endpointer(False, num_trailing_blanks=59, num_frames=59)
+    assert endpointer(False, num_trailing_blanks=60, num_frames=60)
+
+    # rule 2: 1.2 seconds of silence after something is decoded
+    assert not endpointer(True, num_trailing_blanks=29, num_frames=100)
+    assert endpointer(True, num_trailing_blanks=30, num_frames=100)
+
+    # rule 3: the segment is 20 seconds long
+    assert not endpointer(True, num_trailing_blanks=0, num_frames=499)
+    assert endpointer(True, num_trailing_blanks=0, num_frames=500)
+
+    endpointer = Endpointer(
+        frame_shift=0.04,
+        rules=[
+            EndpointRule(
+                must_contain_nonsilence=True,
+                min_trailing_silence=0.4,
+                min_utterance_length=1.0,
+            )
+        ],
+    )
+    assert not endpointer(True, num_trailing_blanks=10, num_frames=24)
+    assert endpointer(True, num_trailing_blanks=10, num_frames=25)
+    assert not endpointer(False, num_trailing_blanks=100, num_frames=100)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import k2
+import torch
+
+from icefall.fsa_cache import FsaCache
+
+
+class Compiler(object):
+    def __init__(self):
+        self.num_compiled = 0
+
+    def __call__(self, keys):
+        self.num_compiled += len(keys)
+        return k2.linear_fsa([list(k) for k in keys])
+
+
+def test_fsa_cache(tmp_path):
+    keys = [(1, 2, 3), (2, 3), (1, 2, 3), (4,)]
+    expected = k2.linear_fsa([list(k) for k in keys])
+
+    compiler = Compiler()
+    cache = FsaCache(max_num_arcs=100, cache_dir=tmp_path, shard_size=2)
+
+    fsa_vec = cache.get_or_compile(keys, compiler)
+    assert compiler.num_compiled == 3
+    assert str(fsa_vec) == str(expected)
+    assert torch.equal(fsa_vec.arcs.values(), expected.arcs.values())
+
+    fsa_vec = cache.get_or_compile(keys[::-1], compiler)
+    assert compiler.num_compiled == 3
+    assert cache.num_hits == 5
+    assert str(fsa_vec[0]) == str(expected[3])
+
+    # The disk cache is used by a new cache
+    cache.flush()
+    cache = FsaCache(max_num_arcs=100, cache_dir=tmp_path)
+    fsa_vec = cache.get_or_compile(keys, compiler)
+    assert compiler.num_compiled == 3
+    assert str(fsa_vec) == str(expected)
+
+
+def test_fsa_cache_reads_only_requested_fsas(tmp_path, monkeypatch):
+    keys = [(i, i + 1) for i in range(10)]
+    compiler = Compiler()
+    cache = FsaCache(max_num_arcs=100, cache_dir=tmp_path, shard_size=10)
+    cache.get_or_compile(keys, compiler)
+    assert len(list(tmp_path.glob("shard-*.bin"))) == 1
+
+    num_loaded = [0]
+    torch_load = torch.load
+
+    def load(*args, **kwargs):
+        num_loaded[0] += 1
+        return torch_load(*args, **kwargs)
+
+    monkeypatch.setattr(torch, "load", load)
+
+    cache = FsaCache(max_num_arcs=100, cache_dir=tmp_path)
+    fsa_vec = cache.get_or_compile([keys[7], keys[3]], compiler)
+    assert compiler.num_compiled == 10
+    assert num_loaded[0] == 2
+    assert str(fsa_vec[0]) == str(k2.linear_fsa([list(keys[7])])[0])
+
+
+def test_fsa_cache_eviction():
+    compiler = Compiler()
+    # Each linear FSA with n labels has n + 1 arcs
+    cache = FsaCache(max_num_arcs=7)
+
+    cache.get_or_compile([(1, 2, 3), (4, 5)], compiler)
+    assert cache.num_arcs == 7
+
+    cache.get_or_compile([(6,)], compiler)
+    assert (1, 2, 3) not in cache.fsas
+    assert cache.num_arcs == 5
+
+    fsa_vec = cache.get_or_compile([(1, 2, 3), (6,)], compiler)
+    assert compiler.num_compiled == 4
+    assert fsa_vec.shape[0] == 2
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+MAKE_KN_LM = (
+    Path(__file__).resolve().parent.parent / "icefall/shared/make_kn_lm.py"
+)
+
+
+def _make_kn_lm(text: Path, order: int, *extra_args) -> str:
+    return subprocess.run(
+        [sys.executable, str(MAKE_KN_LM), "-ngram-order", str(order)]
+        + ["-text", str(text)]
+        + list(extra_args),
+        check=True,
+        stdout=subprocess.PIPE,
+        encoding="latin-1",
+    ).stdout
+
+
+@pytest.mark.parametrize("order", [2, 4])
+def test_array_backend(tmp_path, order):
+    rng = random.Random(order)
+    words = [f"w{i}" for i in range(30)]
+    text = tmp_path / "text.txt"
+    with open(text, "w", encoding="latin-1") as f:
+        for _ in range(500):
+            n = rng.randint(0, 8)
+            f.write(" ".join(rng.choice(words) for _ in range(n)) + "\n")
+
+    expected = _make_kn_lm(text, order, "-backend", "dict")
+    assert expected.startswith("\\data\\")
+
+    assert _make_kn_lm(text, order) == expected
+    assert _make_kn_lm(text, order, "-num-jobs", "2") == expected
+
+
+# Counts the merges of ArrayNgramCounts. It runs in a subprocess because
+# make_kn_lm.py parses the command line and wraps sys.stdout when it is
+# imported.
+COUNT_MERGES = """
+import importlib.util
+import random
+import sys
+
+spec = importlib.util.spec_from_file_location("make_kn_lm", sys.argv[1])
+make_kn_lm = importlib.util.module_from_spec(spec)
+sys.argv = sys.argv[1:]
+spec.loader.exec_module(make_kn_lm)
+
+rng = random.Random(0)
+words = [f"w{i}" for i in range(30)]
+lines = [
+    " ".join(rng.choice(words) for _ in range(rng.randint(0, 8)))
+    for _ in range(2000)
+]
+ngram_counts = make_kn_lm.ArrayNgramCounts(4, lines_per_shard=10)
+
+num_merges = 0
+merge = ngram_counts.merge
+
+
+def counting_merge():
+    global num_merges
+    num_merges += int(len(ngram_counts.pending) > 0)
+    merge()
+
+
+ngram_counts.merge = counting_merge
+ngram_counts.add_raw_counts_from_lines(lines)
+assert ngram_counts.counts[0].sum() == sum(
+    len(line.split()) + 2 for line in lines
+)
+print(num_merges)
+"""
+
+
+def test_array_backend_merges():
+    num_merges = subprocess.run(
+        [sys.executable, "-c", COUNT_MERGES, str(MAKE_KN_LM)],
+        check=True,
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+    ).stdout
+    # The vocabulary is covered by the first few of the 200 shards, so the
+    # merges must not be triggered by the number of unigrams, which would
+    # merge after nearly every shard.
+    assert int(num_merges) <= 20, num_merges
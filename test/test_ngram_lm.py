@@ -15,10 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import tempfile
+
 import graphviz
 import kaldifst
+import torch
 
-from icefall import NgramLm, NgramLmStateCost
+from icefall import CompiledNgramLm, NgramLm, NgramLmStateCost
 
 
 def generate_fst(filename: str):
@@ -64,5 +67,69 @@ def main():
     print(s2.state_cost)
 
 
+def test_compiled_ngram_lm():
+    filename = "test.fst"
+    generate_fst(filename)
+    ngram_lm = NgramLm(filename, backoff_id=3, is_binary=True)
+    compiled_lm = CompiledNgramLm.from_ngram_lm(ngram_lm)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        compiled_lm.save(tmp_dir)
+        loaded_lm = CompiledNgramLm.load(tmp_dir)
+
+        for lm in [compiled_lm, loaded_lm]:
+            for state in range(ngram_lm.lm.num_states):
+                for label in [0, 1, 2, 3, 4, 5]:
+                    expected = ngram_lm.get_next_state_and_cost(state, label)
+                    assert lm.get_next_state_and_cost(state, label) == expected
+
+                    next_states, next_costs = lm.get_next_states_and_costs(
+                        states=torch.tensor([state]),
+                        labels=torch.tensor([label]),
+                    )
+                    mask = next_states[0] >= 0
+                    assert next_states[0][mask].tolist() == expected[0]
+                    assert next_costs[0][mask].tolist() == expected[1]
+
+        state_cost = NgramLmStateCost(ngram_lm)
+        compiled_state_cost = NgramLmStateCost(loaded_lm)
+        for label in [1, 2, 2, 1, 2]:
+            state_cost = state_cost.forward_one_step(label)
+            compiled_state_cost = compiled_state_cost.forward_one_step(label)
+            assert dict(state_cost.state_cost) == dict(
+                compiled_state_cost.state_cost
+            )
+
+
+def test_compiled_ngram_lm_all_labels():
+    filename = "test.fst"
+    generate_fst(filename)
+    ngram_lm = NgramLm(filename, backoff_id=3, is_binary=True)
+    compiled_lm = CompiledNgramLm.from_ngram_lm(ngram_lm)
+
+    states = torch.arange(ngram_lm.lm.num_states)
+    (
+        next_states,
+        next_costs,
+    ) = compiled_lm.get_next_states_and_costs_for_all_labels(
+        states, num_labels=7
+    )
+    assert next_states.shape == next_costs.shape == (states.numel(), 7)
+
+    for state in states.tolist():
+        for label in range(7):
+            # The first match is from the highest order n-gram
+            expected_states, expected_costs = ngram_lm.get_next_state_and_cost(
+                state, label
+            )
+            if expected_states:
+                assert next_states[state, label] == expected_states[0]
+                assert abs(next_costs[state, label] - expected_costs[0]) < 1e-4
+            else:
+                assert next_states[state, label] == -1
+                assert next_costs[state, label] == float("inf")
+
+
 if __name__ == "__main__":
     main()
+    test_compiled_ngram_lm()
+    test_compiled_ngram_lm_all_labels()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from icefall.stream_pool import StreamPool, pack_state, unpack_state
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_pack_state():
+    batch = torch.arange(1000.0).reshape(10, 100)
+    state = {
+        "states": ([batch[1], batch[2]], [batch[3, :10]]),
+        "hyp": [0, 0, 5],
+        "done": False,
+    }
+    data = pack_state(state)
+    # Only the views are saved, not the whole batch
+    assert len(data) < batch.numel() * 4
+
+    restored = unpack_state(data)
+    assert isinstance(restored["states"], tuple)
+    assert torch.equal(restored["states"][0][1], batch[2])
+    assert torch.equal(restored["states"][1][0], batch[3, :10])
+    assert restored["hyp"] == [0, 0, 5]
+    assert restored["done"] is False
+
+
+def _make_pool(**kwargs):
+    clock = Clock()
+    pool = StreamPool(
+        snapshot=lambda s: pack_state(s),
+        restore=lambda data: unpack_state(data),
+        clock=clock,
+        **kwargs,
+    )
+    return pool, clock
+
+
+def test_stream_pool_evict_idle():
+    pool, clock = _make_pool()
+    for i in range(3):
+        pool.add(i, {"id": i, "x": torch.full((10,), float(i))})
+        clock.now += 1
+
+    # Stream 0 is accessed last
+    pool.get(0)
+    clock.now = 4
+    assert pool.evict_idle(max_idle_seconds=2.5) == [1]
+    assert pool.evict_idle(max_idle_seconds=1.5, keep=lambda k: k == 2) == []
+    assert pool.evict_idle(max_idle_seconds=1.5) == [2]
+    assert pool.num_resident == 1
+    assert pool.num_in_host == 2
+    assert len(pool) == 3
+    assert 1 in pool and not pool.is_resident(1)
+
+    s = pool.get(1)
+    assert s["id"] == 1 and torch.equal(s["x"], torch.full((10,), 1.0))
+    assert pool.is_resident(1)
+    assert pool.num_in_host == 1
+
+    pool.remove(2)
+    pool.remove(1)
+    assert list(pool.lru_keys()) == [0]
+    assert pool.host_bytes == 0
+
+
+def test_stream_pool_swap_to_disk(tmp_path):
+    size = len(pack_state({"id": 0, "x": torch.zeros(100)}))
+    pool, clock = _make_pool(max_host_bytes=2 * size, swap_dir=tmp_path)
+    for i in range(4):
+        pool.add(i, {"id": i, "x": torch.full((100,), float(i))})
+    for i in range(4):
+        pool.evict(i)
+
+    # The first evicted streams are moved to disk
+    assert pool.num_in_host == 2
+    assert pool.num_on_disk == 2
+    assert pool.host_bytes <= 2 * size
+    assert len(list(tmp_path.iterdir())) == 2
+
+    for i in range(4):
+        s = pool.get(i)
+        assert s["id"] == i and torch.equal(s["x"], torch.full((100,), i))
+    assert pool.num_on_disk == 0
+    assert len(list(tmp_path.iterdir())) == 0
+
+    pool.evict(0)
+    pool.evict(1)
+    pool.evict(2)
+    pool.clear()
+    assert len(pool) == 0
+    assert len(list(tmp_path.iterdir())) == 0
+
+
+def test_stream_pool_restore_failure():
+    def restore(data):
+        raise RuntimeError("failed")
+
+    pool = StreamPool(snapshot=lambda s: pack_state(s), restore=restore)
+    pool.add("a", [1, 2, 3])
+    pool.evict("a")
+    with pytest.raises(RuntimeError):
+        pool.get("a")
+    # The snapshot is kept
+    assert "a" in pool and pool.num_in_host == 1
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+import uuid
+from functools import partial
+from pathlib import Path
+
+import k2
+import torch
+
+from icefall.dataset.targets import (
+    BpeTargets,
+    GraphTargets,
+    TargetsDataset,
+    get_token_ids,
+)
+from icefall.fsa_cache import FsaCache
+
+
+class DummySp(object):
+    def encode(self, texts, out_type=int):
+        return [[len(w) for w in t.split()] for t in texts]
+
+
+class DummyDataset(torch.utils.data.Dataset):
+    def __getitem__(self, texts):
+        return {"supervisions": {"text": texts}}
+
+
+def test_targets_dataset():
+    sp = DummySp()
+    targets_fn = BpeTargets("bpe.model")
+    targets_fn.sp = sp
+
+    dataset = TargetsDataset(DummyDataset(), targets_fn)
+    texts = ["a bb ccc", "", "dddd"]
+    batch = dataset[texts]
+
+    y = get_token_ids(batch, sp, torch.device("cpu"))
+    assert y == k2.RaggedTensor([[1, 2, 3], [], [4]])
+
+    # Without targets, the token IDs are computed with `sp`
+    del batch["targets"]
+    y = get_token_ids(batch, sp, torch.device("cpu"))
+    assert y == k2.RaggedTensor([[1, 2, 3], [], [4]])
+
+    # The BPE model is not pickled
+    targets_fn = pickle.loads(pickle.dumps(targets_fn))
+    assert targets_fn.sp is None
+
+
+class DummySupervisionDataset(torch.utils.data.Dataset):
+    def __getitem__(self, texts):
+        n = len(texts)
+        return {
+            "supervisions": {
+                "text": texts,
+                "sequence_idx": torch.arange(n),
+                "start_frame": torch.zeros(n, dtype=torch.int64),
+                "num_frames": torch.arange(n, 0, -1) * 100,
+            }
+        }
+
+
+class DummyGraphCompiler(object):
+    """It compiles each transcript to a linear FSA of word lengths, and
+    creates a file in `compiled_dir` for every compiled FSA."""
+
+    def __init__(self, cache_dir: Path, compiled_dir: Path):
+        self.cache = FsaCache(max_num_arcs=1000, cache_dir=cache_dir)
+        self.compiled_dir = compiled_dir
+
+    def compile_word_ids(self, word_ids_list):
+        for _ in word_ids_list:
+            (self.compiled_dir / uuid.uuid4().hex).touch()
+        return k2.linear_fsa([list(w) for w in word_ids_list])
+
+    def compile(self, texts):
+        word_ids_list = [[len(w) for w in t.split()] for t in texts]
+        return self.cache.get_or_compile(word_ids_list, self.compile_word_ids)
+
+
+def test_graph_targets_cache_in_workers(tmp_path):
+    cache_dir = tmp_path / "cache"
+    compiled_dir = tmp_path / "compiled"
+    compiled_dir.mkdir()
+
+    targets_fn = GraphTargets(
+        partial(
+            DummyGraphCompiler, cache_dir=cache_dir, compiled_dir=compiled_dir
+        ),
+        subsampling_factor=4,
+    )
+    dataset = TargetsDataset(DummySupervisionDataset(), targets_fn)
+    batches = [["a bb", "ccc"], ["dddd e"], ["ff g", "hh hhh", "i"]]
+    dl = torch.utils.data.DataLoader(
+        dataset,
+        sampler=batches,
+        batch_size=None,
+        num_workers=2,
+        persistent_workers=True,
+    )
+
+    for batch in dl:
+        assert "graphs" in batch["targets"]
+    assert len(list(compiled_dir.iterdir())) == 6
+
+    # The second epoch uses the graphs cached in the workers
+    for batch in dl:
+        assert "graphs" in batch["targets"]
+    assert len(list(compiled_dir.iterdir())) == 6
+
+    # The graphs are flushed to the cache dir when the workers exit
+    del dl
+    assert len(list(cache_dir.glob("shard-*.idx"))) > 0
+    cache = FsaCache(max_num_arcs=1000, cache_dir=cache_dir)
+    assert len(cache.disk_index) == 6
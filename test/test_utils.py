@@ -23,6 +23,8 @@ import torch
 from icefall.env import get_env_info
 from icefall.utils import (
     AttributeDict,
+    MetricsTracker,
+    TensorMetricsTracker,
     add_eos,
     add_sos,
     encode_supervisions,
@@ -165,3 +167,32 @@ def test_add_eos():
         [[1, 2, eos_id], [3, eos_id], [eos_id], [5, 8, 9, eos_id]]
     )
     assert str(ragged_eos) == str(expected)
+
+
+def test_tensor_metrics_tracker():
+    a = MetricsTracker()
+    a["frames"] = 10
+    a["loss"] = 2.5
+    a["utterances"] = 2
+    a["utt_duration"] = 20
+
+    b = TensorMetricsTracker()
+    b["frames"] = torch.tensor(10)
+    b["loss"] = torch.tensor(2.5)
+    b["utterances"] = 2
+    b["utt_duration"] = torch.tensor(20)
+
+    tot_a = MetricsTracker()
+    tot_b = TensorMetricsTracker()
+    for _ in range(3):
+        tot_a = tot_a * 0.5 + a
+        tot_b = tot_b * 0.5 + b
+
+    assert isinstance(tot_b, TensorMetricsTracker)
+    assert isinstance(tot_b["loss"], torch.Tensor)
+    assert str(tot_a) == str(tot_b)
+    assert tot_a.norm_items() == pytest.approx(tot_b.norm_items())
+
+    c = tot_b.to_metrics_tracker()
+    assert type(c) is MetricsTracker
+    assert c["frames"] == pytest.approx(tot_a["frames"])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Copyright    2026  agent
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+
+import k2
+from lhotse import CutSet, load_manifest_lazy
+from lhotse.testing.dummies import dummy_cut, dummy_supervision
+
+from icefall.word_tokenizer import WordTokenizer
+
+
+def _word_table():
+    s = """
+<eps> 0
+<UNK> 1
+a 2
+b 3
+c 4
+"""
+    return k2.SymbolTable.from_str(s)
+
+
+def test_word_tokenizer():
+    tokenizer = WordTokenizer(_word_table(), oov="<UNK>", max_cached_texts=2)
+    texts = ["a b", "", "c  d a", "a b"]
+    assert tokenizer.texts_to_word_ids(texts) == [[2, 3], [], [4, 1, 2], [2, 3]]
+    # At most 2 texts are memoized
+    assert len(tokenizer._cache) == 2
+
+    # [word][token]
+    tokenizer.ragged_lexicon = k2.RaggedTensor([[], [9], [5, 6], [7], [8]])
+    y = tokenizer.texts_to_token_ids(texts)
+    assert y == k2.RaggedTensor([[5, 6, 7], [], [8, 9, 5, 6], [5, 6, 7]])
+
+
+def test_tokenize_cuts():
+    tokenizer = WordTokenizer(_word_table(), oov="<UNK>")
+    cuts = CutSet.from_cuts(
+        [dummy_cut(0, supervisions=[dummy_supervision(0, text="a b")])]
+        + [
+            dummy_cut(
+                1,
+                supervisions=[
+                    dummy_supervision(1, text="c"),
+                    dummy_supervision(2, text="a d"),
+                ],
+            )
+        ]
+    )
+    cuts = tokenizer.tokenize_cuts(cuts).to_eager()
+    assert cuts[1].supervisions[1].custom["word_ids"] == [2, 1]
+    # The word IDs stored in the cuts are not memoized
+    assert len(tokenizer._cache) == 0
+
+    # Like batch["supervisions"] with return_cuts=True
+    supervisions = {
+        "text": ["a b", "c", "a d"],
+        "cut": [c for c in cuts for _ in c.supervisions],
+    }
+    # The texts are not used
+    tokenizer.word2id = {}
+    expected = [[2, 3], [4], [2, 1]]
+    assert tokenizer.supervisions_to_word_ids(supervisions) == expected
+
+    # In the order of the texts returned by encode_supervisions()
+    texts = ["a d", "a b", "c"]
+    expected = [[2, 1], [2, 3], [4]]
+    assert tokenizer.supervisions_to_word_ids(supervisions, texts) == expected
+
+
+def test_tokenize_lazy_cuts(tmp_path):
+    tokenizer = WordTokenizer(_word_table(), oov="<UNK>")
+    filename = tmp_path / "cuts.jsonl.gz"
+    CutSet.from_cuts(
+        [dummy_cut(0, supervisions=[dummy_supervision(0, text="a d")])]
+    ).to_file(filename)
+
+    cuts = tokenizer.tokenize_cuts(load_manifest_lazy(filename))
+    assert cuts.is_lazy
+    # Lazy CutSets are pickled, e.g., when sent to dataloader workers
+    cuts = pickle.loads(pickle.dumps(cuts))
+    assert next(iter(cuts)).supervisions[0].custom["word_ids"] == [2, 1]